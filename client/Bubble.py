@@ -1,8 +1,28 @@
 from datetime import datetime
+from html import escape
 from theme import DarkTheme as T
 
 # Класс Bubble отвечает за создание HTML-блока для одного сообщения
 class Bubble:
+    # Возвращает HTML-ссылку на вложение (вставляется в пузырь вместо текста).
+    # Ссылка вида attachment:<id> обрабатывается окном чата — по ней файл скачивается
+    @classmethod
+    def attachment(cls, file: dict) -> str:
+        return (
+            f'<a href="attachment:{file["id"]}" style="color:{T.TEXT_MAIN};">'
+            f'📎 {escape(file.get("name") or "файл")}</a>'
+            f' <span style="color:{T.TEXT_SUB};">({cls.file_size(file.get("size") or 0)})</span>'
+        )
+
+    # Размер файла для подписи («12 КБ», «1.5 МБ»)
+    @classmethod
+    def file_size(cls, size: float) -> str:
+        for unit in ("Б", "КБ", "МБ", "ГБ"):
+            if size < 1024 or unit == "ГБ":
+                break
+            size /= 1024
+        return f"{size:.0f} {unit}" if unit == "Б" else f"{size:.1f} {unit}"
+
     # Возвращает HTML-представление сообщения
     # text — текст сообщения
     # outgoing — True, если сообщение исходящее (от нас)
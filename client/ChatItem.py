@@ -12,6 +12,12 @@ from PyQt5.QtWidgets import (
 
 from theme import DarkTheme as T
 
+
+# Время последнего сообщения для строки списка
+def _time_str(ts: int) -> str:
+    return datetime.fromtimestamp(ts).strftime("%H:%M")
+
+
 # Элемент списка чатов — отображает имя, время и последнее сообщение
 class ChatItem(QWidget):
     def __init__(self, display_name: str, last_msg: str, last_ts: int):
@@ -26,37 +32,79 @@ class ChatItem(QWidget):
         vbox.setContentsMargins(8, 4, 8, 4)  # отступы от краёв
         vbox.setSpacing(2)
 
-        # Верхний ряд: имя + время
+        # Верхний ряд: отметка «в сети» + имя + время
         row = QHBoxLayout()
 
+        self.lbl_online = QLabel("●")  # собеседник в сети (только для приватных чатов)
+        self.lbl_online.setStyleSheet(f"color:{T.ONLINE}; font-size:11px;")
+        self.lbl_online.hide()
+        row.addWidget(self.lbl_online)
+
         self.lbl_name = QLabel(display_name)  # имя пользователя или название чата
         self.lbl_name.setStyleSheet(f"color:{T.TEXT_MAIN}; font-weight:bold; font-size:15px;")
         row.addWidget(self.lbl_name, 1)  # растягивается по ширине
 
-        ts_str = datetime.fromtimestamp(last_ts).strftime("%H:%M")    # формат времени
-        self.lbl_time = QLabel(ts_str)
+        self.lbl_time = QLabel(_time_str(last_ts))
         self.lbl_time.setStyleSheet( f"color:{T.TEXT_SUB}; font-size:11px;")
 
         row.addWidget(self.lbl_time, 0, Qt.AlignRight)   # время справа
         vbox.addLayout(row)
 
-        # Нижний ряд: превью последнего сообщения
+        # Нижний ряд: превью последнего сообщения + счётчик непрочитанных
+        bottom = QHBoxLayout()
+
         self.lbl_preview = QLabel(last_msg)
         self.lbl_preview.setStyleSheet(f"color:{T.TEXT_SUB}; font-size:13px;")
         # Одна строка в высоту
         self.lbl_preview.setFixedHeight(self.lbl_preview.fontMetrics().lineSpacing()) # ограничиваем одной строкой
-        vbox.addWidget(self.lbl_preview)
+        bottom.addWidget(self.lbl_preview, 1)
+
+        self.lbl_unread = QLabel()
+        self.lbl_unread.setStyleSheet(T.qss_badge())
+        self.lbl_unread.hide()  # показываем только при наличии непрочитанных
+        bottom.addWidget(self.lbl_unread, 0, Qt.AlignRight)
+        vbox.addLayout(bottom)
 
         self._selected = False  # флаг выделения
+        self._preview = last_msg  # последнее сообщение (пока показывается «печатает…», надпись занята)
+        self._typing = ""         # текст индикатора набора ("" — никто не печатает)
         self._update_style()  # применяем стиль
 
 
+    # Обновляет название, превью и время. Надписи, которые не изменились, не трогаются
+    def set_preview(self, display_name: str, last_msg: str, last_ts: int):
+        ts_str = _time_str(last_ts)
+        if self.lbl_name.text() != display_name:
+            self.lbl_name.setText(display_name)
+        self._preview = last_msg
+        if not self._typing and self.lbl_preview.text() != last_msg:
+            self.lbl_preview.setText(last_msg)
+        if self.lbl_time.text() != ts_str:
+            self.lbl_time.setText(ts_str)
+
+
+    # Показывает присутствие: отметку «в сети» и вместо превью — кто печатает ("" — никто)
+    def set_presence(self, online: bool, typing: str):
+        self.lbl_online.setVisible(online)
+        if typing == self._typing:
+            return
+        self._typing = typing
+        self.lbl_preview.setText(typing or self._preview)
+        self._update_style()  # индикатор набора выделен цветом
+
+
     # Устанавливает флаг выделения и обновляет стиль
     def setSelected(self, sel: bool):
         self._selected = sel
         self._update_style()
 
 
+    # Показывает количество непрочитанных сообщений (0 — скрыть значок)
+    def set_unread(self, count: int):
+        self.lbl_unread.setText(str(count) if count < 1000 else "999+")
+        self.lbl_unread.setVisible(count > 0)
+
+
     # Обновляет фон и цвет текста в зависимости от состояния (выбран/не выбран)
     def _update_style(self):
         bg = self.sel_bg if self._selected else self.default_bg  # выбираем фон
@@ -64,7 +112,7 @@ class ChatItem(QWidget):
 
         # Цвета текста: при выделении — белый, иначе стандартные из темы
         name_col = "#FFFFFF" if self._selected else T.TEXT_MAIN
-        preview_col = "#FFFFFF" if self._selected else T.TEXT_SUB
+        preview_col = "#FFFFFF" if self._selected else (T.ACCENT_HOVER if self._typing else T.TEXT_SUB)
         time_col = "#FFFFFF" if self._selected else T.TEXT_SUB
 
         self.lbl_name.setStyleSheet(
@@ -76,4 +124,5 @@ class ChatItem(QWidget):
         self.lbl_time.setStyleSheet(
             f"color:{time_col}; font-size:11px;"
         )
+        self.lbl_unread.setStyleSheet(T.qss_badge(selected=self._selected))
 
@@ -1,13 +1,11 @@
 # Импорт стандартных библиотек
-import json
-import socket
 import time
 from collections import defaultdict
 from typing import Dict
 
 # Импорт компонентов PyQt5
-from PyQt5.QtCore import Qt
-from PyQt5.QtGui import QTextCursor
+from PyQt5.QtCore import Qt, QTimer, QUrl
+from PyQt5.QtGui import QTextCursor, QDesktopServices
 from PyQt5.QtWidgets import (
     QWidget,
     QVBoxLayout,
@@ -19,31 +17,56 @@ from PyQt5.QtWidgets import (
     QTextBrowser,
     QSplitter,
     QLabel,
-    QMessageBox, QDialog,
+    QMessageBox, QDialog, QFileDialog, QMenu, QInputDialog,
 )
 
-from NetworkWorker import NetworkWorker
+from NetworkWorker import NetworkWorker, STATE_RECONNECTING
+from chatcache import ChatCache
+from chatfilter import ChatFilterIndex
+from prefetch import HistoryPrefetcher
+from presence import PresenceState, TYPING_INTERVAL
+from search import MessageIndex, data_dir, default_path
+from transfer import FileTransfers
+from export import ChatExports, FORMAT_HTML, FORMAT_JSONL
 from Bubble import Bubble
 from theme import DarkTheme as T
 from ChatItem import ChatItem
-from NewChatDialog import NewChatDialog
-from NewGroupChatDialog import NewGroupChatDialog
+from tracing import tracer
+from capture import recorder
+import startup
 from html import escape
 
+# Списки чатов, пришедшие в течение этого времени (мс) после отрисовки списка, не рисуются сразу:
+# по его истечении рисуется только последний из них (активная группа присылает список после каждого сообщения)
+CHATLIST_FRAME_MS = 50
+
 
 # Главное окно чата.
 # Отображает список чатов, историю переписки, поле ввода сообщений и заголовок текущего диалога.
 # Также обрабатывает сетевые события через NetworkWorker (входящие сообщения, обновления и т.п.).
 class ChatWindow(QWidget):
-    def __init__(self, username: str, sock: socket.socket):
+    def __init__(self, username: str, net: NetworkWorker):
         super().__init__()
         self.username = username            # имя текущего пользователя
-        self.sock = sock                   # сокет подключения к серверу
 
-        # Сохраняем историю сообщений по каждому чату для устранения дубликатов
-        self.shown_messages = set()
+        # Последние сообщения каждого чата (с устранением дубликатов) и счётчики непрочитанных
+        self.cache = ChatCache()
+        # Локальный полнотекстовый индекс всех полученных сообщений
+        self.index = MessageIndex(default_path(username))
         # Имя текущего выбранного чата (username или ID группы)
         self.current_peer: str | None = None
+        # Более ранняя история, подгруженная прокруткой вверх (в кэш не попадает — он хранит только хвост)
+        self._older: dict[str, list[dict]] = {}          # peer → сообщения перед хвостом из кэша
+        self._cursors: dict[str, str] = {}               # peer → курсор следующей более ранней страницы
+        self._loading_older: dict[str, list[dict]] = {}  # peer → страница, которая сейчас приходит
+        self._stale_older: set[str] = set()              # чаты, чья приходящая страница уже не примыкает к хвосту
+        # Строки списка чатов по peer и индекс фильтра списка (обновляются вместе со строками)
+        self._items: dict[str, QListWidgetItem] = {}
+        self.chat_index = ChatFilterIndex()
+        self._filter_matches: set[str] | None = None  # чаты, подходящие под фильтр (None — фильтра нет)
+        self._styled_selected: set[str] = set()       # чаты, строки которых сейчас окрашены как выделенные
+        # Открывавшиеся диалоги (создаются при первом открытии и дальше переиспользуются)
+        self._dialogs: dict[str, QDialog] = {}
 
         # Заголовок окна и базовые размеры
         self.setWindowTitle(f"Shichat — {self.username}")
@@ -77,12 +100,27 @@ class ChatWindow(QWidget):
         self.new_group_btn.clicked.connect(self.open_new_group)
         left_layout.addWidget(self.new_group_btn)
 
+        # Кнопка «Поиск сообщений»
+        self.search_btn = QPushButton("Поиск сообщений")
+        self.search_btn.setStyleSheet(T.qss_button_dark())
+        self.search_btn.clicked.connect(self.open_search)
+        left_layout.addWidget(self.search_btn)
+
+        # Фильтр списка чатов по названию и логину (без запросов к серверу)
+        self.filter_input = QLineEdit()
+        self.filter_input.setPlaceholderText("Фильтр чатов…")
+        self.filter_input.setClearButtonEnabled(True)
+        self.filter_input.setStyleSheet(T.qss_input())
+        self.filter_input.textChanged.connect(self.apply_filter)
+        left_layout.addWidget(self.filter_input)
+
         # Список чатов
         self.chat_list = QListWidget()
         self.chat_list.setStyleSheet(T.qss_user_list())
         self.chat_list.itemClicked.connect(self.change_chat)
-        self.chat_list.itemClicked.connect(self.change_chat)
         self.chat_list.itemSelectionChanged.connect(self.update_selection_styles)
+        self.chat_list.setContextMenuPolicy(Qt.CustomContextMenu)  # меню чата: выгрузка истории; у группы — участники
+        self.chat_list.customContextMenuRequested.connect(self.chat_menu)
         left_layout.addWidget(self.chat_list, 1)
 
         splitter.addWidget(left_container)
@@ -102,11 +140,24 @@ class ChatWindow(QWidget):
         # Область отображения сообщений
         self.chat_view = QTextBrowser()
         self.chat_view.setStyleSheet(T.qss_chat_view())
-        self.chat_view.setOpenExternalLinks(True)
+        self.chat_view.setOpenLinks(False)  # ссылки (в том числе на вложения) обрабатывает on_link
+        self.chat_view.anchorClicked.connect(self.on_link)
+        self.chat_view.verticalScrollBar().valueChanged.connect(self.on_scroll)
         right_layout.addWidget(self.chat_view, 1)
 
-        # Нижняя панель: поле ввода + кнопка отправки
+        # Строка состояния передачи файлов (скрыта, пока ничего не передаётся)
+        self.transfer_status = QLabel()
+        self.transfer_status.setStyleSheet(f"color:{T.TEXT_SUB}; font-size:12px; margin:0 8px;")
+        self.transfer_status.hide()
+        right_layout.addWidget(self.transfer_status)
+
+        # Нижняя панель: кнопка вложения + поле ввода + кнопка отправки
         input_panel = QHBoxLayout()
+        self.attach_btn = QPushButton("📎")
+        self.attach_btn.setStyleSheet(T.qss_button_dark())
+        self.attach_btn.clicked.connect(self.attach_file)
+        input_panel.addWidget(self.attach_btn)
+
         self.input_edit = QLineEdit()
         self.input_edit.setPlaceholderText("Напишите сообщение…")
         self.input_edit.returnPressed.connect(self.send_message)
@@ -124,12 +175,63 @@ class ChatWindow(QWidget):
         splitter.setStretchFactor(0, 1)     # левая панель — 1/4 ширины
         splitter.setStretchFactor(1, 3)     # правая панель — 3/4 ширины
 
-        #Сетевое подключение (работает в фоне)
-        self.net = NetworkWorker(sock)
+        #Сетевое подключение (работает в фоне, вход уже выполнен)
+        self.net = net
         self.net.message_received.connect(self.on_message)
         self.net.chatlist_received.connect(self.on_chatlist)
+        self.net.chat_delta.connect(self.on_chat_delta)
         self.net.connection_lost.connect(self.on_disconnect)
-        self.net.start()
+        self.net.session_replaced.connect(self.on_session_replaced)
+        self.net.reconnecting.connect(self.on_reconnecting)
+        self.net.reconnected.connect(self.on_reconnected)
+        self.net.history_end.connect(self.on_history_end)
+        self.net.request_rejected.connect(self.on_request_rejected)
+        self._last_sent: tuple[str, str] | None = None  # (чат, текст) последнего отправленного сообщения
+
+        # Присутствие собеседников: пакеты presence меняют только затронутые строки списка чатов
+        self.presence = PresenceState()
+        self.net.presence_changed.connect(self.on_presence)
+        self._typing_timer = QTimer(self)  # снимает истёкшие индикаторы набора, пока они есть
+        self._typing_timer.setInterval(1000)
+        self._typing_timer.timeout.connect(self._expire_typing)
+        self._typing_sent: dict[str, float] = {}  # peer → когда отправлен наш последний пакет typing
+        self.input_edit.textEdited.connect(self.on_input_edited)
+
+        # Списки чатов отрисовываются не чаще раза в CHATLIST_FRAME_MS (побеждает последний пришедший)
+        self._chatlist_pending: list | None = None
+        self._chatlist_timer = QTimer(self)
+        self._chatlist_timer.setSingleShot(True)
+        self._chatlist_timer.setInterval(CHATLIST_FRAME_MS)
+        self._chatlist_timer.timeout.connect(self._flush_chatlist)
+
+        # Фоновая предзагрузка истории самых свежих чатов (стартует по первому списку чатов)
+        self.prefetcher = HistoryPrefetcher(self.net.send, self.cache, self.username)
+
+        # Изменения локального индекса сообщений сохраняются на диск пачками, а не по одному
+        self.index_timer = QTimer(self)
+        self.index_timer.timeout.connect(self.index.commit)
+        self.index_timer.start(2000)
+
+        # Передача файлов: пакеты file_* сетевой поток передаёт прямо в FileTransfers
+        self.files = FileTransfers(self.net, data_dir(username))
+        self.files.progress.connect(self.on_transfer_progress)
+        self.files.upload_done.connect(self.on_upload_done)
+        self.files.download_done.connect(self.on_download_done)
+        self.files.failed.connect(self.on_transfer_failed)
+        self.net.files = self.files
+
+        # Выгрузка истории чатов в файл: пакеты chat_export_* сетевой поток передаёт прямо в ChatExports
+        self.exports = ChatExports(self.net, username)
+        self.exports.progress.connect(self.on_export_progress)
+        self.exports.done.connect(self.on_export_done)
+        self.exports.failed.connect(self.on_export_failed)
+        self.net.exports = self.exports
+        self._attachments: dict[int, dict] = {}  # вложения из показанных сообщений (по ID)
+        self._export_titles: dict[str, str] = {}  # peer → название чата для строки состояния выгрузки
+
+        # Обработчики подключены — получаем пакеты, пришедшие сразу после входа (первый список чатов)
+        self.net.attach()
+        self.files.resume_pending()  # продолжаем загрузки, прерванные в прошлый раз
 
     # Переключение на выбранный чат из списка.
     # Обновляет заголовок, очищает старые сообщения и отправляет запрос на историю с сервера.
@@ -142,9 +244,21 @@ class ChatWindow(QWidget):
         peer = item.data(Qt.UserRole)
         self.current_peer = peer
 
-        # Очищаем окно сообщений и сбрасываем кэш
+        # Чат открыт — непрочитанных больше нет
+        self.cache.clear_unread(peer)
+        widget.set_unread(0)
+
+        # Если хвост истории уже в памяти — показываем его без запроса к серверу
+        if self.cache.is_complete(peer):
+            self._render_chat(peer)
+            return
+
+        # Иначе очищаем окно сообщений и буфер чата и загружаем историю заново
+        # (ранние страницы и курсор относились к прежнему хвосту)
+        self._older.pop(peer, None)
+        self._cursors.pop(peer, None)
         self.chat_view.clear()
-        self.shown_messages.clear()
+        self.cache.begin_history(peer)
 
         # Формируем и отправляем запрос на историю сообщений
         pkt = {
@@ -152,81 +266,367 @@ class ChatWindow(QWidget):
             "from": self.username,
             "to": peer,
         }
+        self.prefetcher.interactive(peer)  # фоновая предзагрузка подождёт этот запрос
         try:
-            self.sock.sendall((json.dumps(pkt) + "\n").encode())
+            self.net.send(pkt)
         except OSError:
-            self.on_disconnect()
+            self._send_failed()
+            return
+
+
+    # Сервер закончил передавать историю чата. Для хвоста — запоминаем курсор ранней истории
+    # и продолжаем фоновую предзагрузку; для ранней страницы — выводим её над уже показанными
+    def on_history_end(self, peer: str, cursor: str):
+        page = self._loading_older.pop(peer, None)
+        if peer in self._stale_older:
+            # Пока страница шла, буфер сдвинулся: курсор уже взят из буфера, а страница отбрасывается
+            self._stale_older.discard(peer)
             return
+        if cursor:
+            self._cursors[peer] = cursor
+        else:
+            self._cursors.pop(peer, None)  # раньше сообщений нет
+        if page is None:
+            self._older.pop(peer, None)
+            self.prefetcher.on_history_end(peer)
+            return
+
+        self._older[peer] = page + self._older.get(peer, [])
+        if peer == self.current_peer:
+            # Сохраняем расстояние до низа, чтобы видимые сообщения не сдвинулись
+            bar = self.chat_view.verticalScrollBar()
+            from_bottom = bar.maximum() - bar.value()
+            self._render_chat(peer)
+            bar.setValue(bar.maximum() - from_bottom)
+
+
+    # Прокрутка окна сообщений до самого верха подгружает более раннюю историю
+    def on_scroll(self, value: int):
+        if value == 0 and self.current_peer:
+            self.load_older(self.current_peer)
+
+
+    # Запрашивает страницу истории перед самым ранним показанным сообщением
+    def load_older(self, peer: str):
+        cursor = self._cursors.get(peer)
+        if not cursor or peer in self._loading_older:
+            return  # ранней истории нет, хвост ещё загружается или страница уже запрошена
+        self._loading_older[peer] = []
+        try:
+            self.net.send({"type": "history", "from": self.username, "to": peer, "cursor": cursor})
+        except OSError:
+            self._loading_older.pop(peer, None)
+            self._send_failed()
+
 
     # Обработка нового списка чатов от сервера.
-    # Обновляет визуальный список, восстанавливает активный чат и применяет стили выбора.
+    # Первый список после паузы рисуется сразу, следующие в течение CHATLIST_FRAME_MS
+    # откладываются, и по истечении рисуется только последний из них.
     def on_chatlist(self, chats):
-        prev = self.current_peer  # Сохраняем текущий активный чат
-
-        self.chat_list.clear()
-        self.current_peer = None
-
-        for c in chats:
-            # Создаём виджет превью для чата
-            widget = ChatItem(
-                display_name=c['display_name'],
-                last_msg=c['last_msg'][:100],
-                last_ts=c['last_ts']
-            )
-            item = QListWidgetItem(self.chat_list)
-            item.setSizeHint(widget.sizeHint())
-            item.setData(Qt.UserRole, c['peer'])
+        if self._chatlist_timer.isActive():
+            self._chatlist_pending = chats  # предыдущий отложенный список уже не нужен
+            return
+        self._apply_chatlist(chats)
+        self._chatlist_timer.start()
+
+
+    # Рисует отложенный список чатов, если за время паузы он приходил
+    def _flush_chatlist(self):
+        chats, self._chatlist_pending = self._chatlist_pending, None
+        if chats is not None:
+            self._apply_chatlist(chats)
+            self._chatlist_timer.start()
+
+
+    # Приводит список чатов на экране к новому списку.
+    # Строки, у которых изменились только название, превью или время, обновляются на месте;
+    # пересоздаются лишь строки, сменившие позицию. Прокрутка и выделение сохраняются.
+    def _apply_chatlist(self, chats):
+        wanted = {c['peer'] for c in chats}
+        items: dict[str, QListWidgetItem] = {}
+        for row in reversed(range(self.chat_list.count())):
+            item = self.chat_list.item(row)
+            peer = item.data(Qt.UserRole)
+            if peer in wanted:
+                items[peer] = item
+            else:
+                self._take_chat_item(item)  # чата больше нет в списке
+
+        for row, c in enumerate(chats):
+            item = self.chat_list.item(row)
+            if item is not None and item.data(Qt.UserRole) == c['peer']:
+                # Строка на своём месте — обновляем надписи, если они изменились
+                self.chat_list.itemWidget(item).set_preview(c['display_name'], c['last_msg'][:100], c['last_ts'])
+                self.chat_index.put(c['peer'], c['display_name'])
+                continue
+            # Чат сменил позицию (обычно поднялся наверх) или появился — строка на новом месте
+            old = items.get(c['peer'])
+            if old is not None:
+                self._take_chat_item(old)
+            item = self._add_chat_item(c, row)
+            if c['peer'] == self.current_peer:
+                self.chat_list.setCurrentItem(item)  # выделение пропало вместе с прежней строкой
+
+        if self.current_peer not in wanted:
+            self.current_peer = None
+
+        # Название открытого чата могло измениться
+        if self.current_peer:
+            current = self._chat_item(self.current_peer)
+            self.header.setText(self.chat_list.itemWidget(current).lbl_name.text())
+
+        self.apply_filter()
+        self.update_selection_styles()
+
+        # По первому списку чатов запускаем предзагрузку истории самых свежих из них
+        if not self.prefetcher.started:
+            startup.mark("first_chatlist")
+            startup.report("нажатие «Войти» → первый список чатов", "login_click", "first_chatlist")
+        self.prefetcher.start(chats)
+
+
+    # Создаёт строку списка чатов (в конец списка или на место row)
+    def _add_chat_item(self, c: dict, row: int | None = None) -> QListWidgetItem:
+        # Создаём виджет превью для чата
+        widget = ChatItem(
+            display_name=c['display_name'],
+            last_msg=c['last_msg'][:100],
+            last_ts=c['last_ts']
+        )
+        item = QListWidgetItem()
+        item.setSizeHint(widget.sizeHint())
+        item.setData(Qt.UserRole, c['peer'])
+        if row is None:
             self.chat_list.addItem(item)
-            self.chat_list.setItemWidget(item, widget)
+        else:
+            self.chat_list.insertItem(row, item)
+        self.chat_list.setItemWidget(item, widget)
+        widget.set_unread(self.cache.unread(c['peer']))
+        self._items[c['peer']] = item
+        self._show_presence(c['peer'])
+        self._styled_selected.discard(c['peer'])  # новая строка окрашена как невыделенная
+        self.chat_index.put(c['peer'], c['display_name'])
+        if self._filter_matches is not None and c['peer'] not in self._filter_matches:
+            item.setHidden(True)  # при включённом фильтре строку покажет apply_filter, если она подходит
+        return item
+
+
+    # Убирает строку из списка чатов (вместе с её записью в индексе фильтра)
+    def _take_chat_item(self, item: QListWidgetItem):
+        peer = item.data(Qt.UserRole)
+        self.chat_list.takeItem(self.chat_list.row(item))
+        self._items.pop(peer, None)
+        self.chat_index.remove(peer)
 
-            # Если это тот же чат, что был открыт — выделяем снова
-            if c['peer'] == prev:
-                self.current_peer = prev
-                self.chat_list.setCurrentItem(item)
 
-        # Обновляем заголовок, если активный чат восстановлен
-        if self.current_peer:
-            current = self.chat_list.currentItem()
-            if current:
-                display = current.text().split("\n", 1)[0]
-                self.header.setText(display)
+    # Строка списка чатов по peer (или None)
+    def _chat_item(self, peer: str) -> QListWidgetItem | None:
+        return self._items.get(peer)
+
+
+    # Фильтр списка чатов: скрывает строки, название и логин которых не содержат текст фильтра.
+    # Вызывается при вводе и после каждого изменения списка; видимость меняется
+    # только у строк, для которых результат фильтра изменился
+    def apply_filter(self, *_):
+        matches = self.chat_index.match(self.filter_input.text())
+        prev, self._filter_matches = self._filter_matches, matches
+        if matches is None and prev is None:
+            return
+        if matches is None or prev is None:
+            changed = list(self._items)  # фильтр включён или снят — проверяем все строки
+        else:
+            changed = prev ^ matches
+        for peer in changed:
+            item = self._items.get(peer)
+            if item is None:
+                continue
+            hide = matches is not None and peer not in matches
+            if item.isHidden() != hide:
+                item.setHidden(hide)
+
+
+    # Изменение одного чата от сервера (создана группа, нас добавили или удалили из группы).
+    # Меняется только его строка — без запроса и перерисовки всего списка
+    def on_chat_delta(self, pkt: dict):
+        c = pkt.get("chat") or {}
+        peer = c.get("peer")
+        if not peer:
+            return
+        c.setdefault("last_msg", "")
+        c.setdefault("last_ts", 0)
+        self._delta_pending(pkt.get("op"), c)
+        item = self._chat_item(peer)
+
+        if pkt.get("op") == "remove":
+            if item is None:
+                return
+            self._take_chat_item(item)
+            if peer == self.current_peer:
+                self.current_peer = None
+                self.chat_view.clear()
+                self.header.setText("Выберите чат")
+            return
 
+        if item is not None:
+            # Чат уже в списке — обновляем название
+            self.chat_list.itemWidget(item).lbl_name.setText(c.get("display_name") or "")
+            self.chat_index.put(peer, c.get("display_name") or "")
+            self.apply_filter()
+            return
+        # Новый чат — наверх списка (список отсортирован по свежести)
+        self._add_chat_item(c, 0)
+        self.apply_filter()
         self.update_selection_styles()
 
 
-    # Применяет стиль выделения к каждому элементу чата.
+    # Отложенный список чатов пришёл раньше изменения — применяем изменение и к нему,
+    # иначе его отрисовка вернула бы удалённую группу или убрала добавленную
+    def _delta_pending(self, op: str, c: dict):
+        pending = self._chatlist_pending
+        if pending is None:
+            return
+        peer = c['peer']
+        if op == "remove":
+            self._chatlist_pending = [x for x in pending if x['peer'] != peer]
+        elif any(x['peer'] == peer for x in pending):
+            # Чат уже в списке — меняется только название
+            self._chatlist_pending = [{**x, "display_name": c.get("display_name") or ""} if x['peer'] == peer else x
+                                      for x in pending]
+        else:
+            self._chatlist_pending = [c] + pending
+
+
+    # Контекстное меню строки списка чатов: выгрузка истории в файл, для группы — ещё добавить участника и выйти из группы
+    def chat_menu(self, pos):
+        item = self.chat_list.itemAt(pos)
+        if item is None:
+            return
+        chat = item.data(Qt.UserRole)
+        menu = QMenu(self)
+        if self.exports.busy(chat):
+            export = None
+            cancel_export = menu.addAction("Отменить выгрузку истории")
+        else:
+            export = menu.addAction("Выгрузить историю…")
+            cancel_export = None
+        add = leave = None
+        if chat.isdigit():
+            add = menu.addAction("Добавить участника…")
+            leave = menu.addAction("Выйти из группы")
+        action = menu.exec_(self.chat_list.viewport().mapToGlobal(pos))
+        if action is None:
+            return
+        try:
+            if action is export:
+                self.export_chat(chat, self.chat_list.itemWidget(item).lbl_name.text())
+            elif action is cancel_export:
+                self.exports.cancel(chat)
+                self._export_titles.pop(chat, None)
+                self.transfer_status.hide()
+            elif action is add:
+                text, ok = QInputDialog.getText(self, "Добавить участника", "Логины (через запятую):")
+                names = [n.strip() for n in text.split(",") if n.strip()]
+                if ok and names:
+                    self.net.send_group_add(chat, names)
+            elif action is leave:
+                self.net.send_group_remove(chat, [self.username])
+        except OSError:
+            self._send_failed()
+
+
+    # Выбор файла и формата и выгрузка всей истории чата (сервер присылает её порциями)
+    def export_chat(self, chat: str, title: str):
+        html_filter, jsonl_filter = "Страница HTML (*.html)", "JSON Lines (*.jsonl)"
+        path, chosen = QFileDialog.getSaveFileName(
+            self, "Выгрузить историю", f"{title or chat}.html", f"{html_filter};;{jsonl_filter}")
+        if not path:
+            return
+        fmt = FORMAT_JSONL if chosen == jsonl_filter or path.endswith(".jsonl") else FORMAT_HTML
+        self._export_titles[chat] = title or chat
+        self.exports.start(chat, path, fmt, title or chat)
+
+
+    # Применяет стиль выделения к строкам списка чатов.
     # Используется для подсветки выбранного чата в списке.
+    # Перекрашиваются только строки, у которых выделение изменилось (в длинном списке — не все).
     def update_selection_styles(self):
-        for i in range(self.chat_list.count()):
-            item = self.chat_list.item(i)
-            widget = self.chat_list.itemWidget(item)
+        selected = {item.data(Qt.UserRole) for item in self.chat_list.selectedItems()}
+        for peer in self._styled_selected ^ selected:
+            item = self._items.get(peer)
+            widget = self.chat_list.itemWidget(item) if item is not None else None
             if widget:
-                widget.setSelected(item.isSelected())
+                widget.setSelected(peer in selected)
+        self._styled_selected = selected
 
 
     # Обрабатывает входящее сообщение от сервера.
-    # Проверяет, что сообщение не повторяется и относится к текущему открытому чату.
-    # Если это групповой чат — добавляет имя отправителя. Затем выводит сообщение на экран.
+    # Каждое сообщение попадает в буфер своего чата (дубликаты отбрасываются).
+    # Для открытого чата оно сразу выводится на экран, для остальных — растёт счётчик непрочитанных.
     def on_message(self, pkt: dict):
         frm = pkt.get("from")
         to = pkt.get("to")
-        content = pkt.get("content")
-        ts = pkt.get("timestamp", int(time.time()))  # Если сервер не прислал время — используем текущее
-        dispname = pkt.get("display_name", frm)  # Имя для отображения (если есть), иначе логин
+        pkt.setdefault("timestamp", int(time.time()))  # Если сервер не прислал время — используем текущее
 
         # Определяем, кому принадлежит чат — если сообщение нам, значит peer это отправитель
         peer = to if to != self.username else frm
 
-        # Проверка на дубликат (чтобы одно сообщение не появилось дважды)
-        msg_key = (frm, to, ts, content)
-        if msg_key in self.shown_messages:
+        # Собеседник прислал сообщение — значит, уже не печатает
+        if not pkt.get("history") and self.presence.stopped(peer, frm):
+            self._show_presence(peer)
+
+        # Ранняя история (прокрутка вверх) собирается отдельно и выводится целиком по history_end
+        if pkt.get("history") and peer in self._loading_older:
+            self._loading_older[peer].append(pkt)
+            self.index.add(peer, pkt)
+            return
+
+        # Кладём в буфер чата; None — такое сообщение уже было (чтобы одно сообщение не появилось дважды)
+        pos = self.cache.add(peer, pkt)
+        if pos is None:
             return
-        self.shown_messages.add(msg_key)
+        if self.cache.trimmed(peer):
+            self._ring_trimmed(peer)
+        self.index.add(peer, pkt)  # новое сообщение — в локальный поисковый индекс
 
-        # Если сообщение не для текущего открытого чата — игнорируем
+        # Сообщение не для текущего открытого чата — только отмечаем как непрочитанное
         if peer != self.current_peer:
+            if not pkt.get("history") and frm != self.username:
+                self._set_unread(peer, self.cache.bump_unread(peer))
+            return
+
+        # Сообщение пришло не по порядку — перерисовываем чат из буфера целиком
+        if pos < len(self.cache.messages(peer)) - 1:
+            self._render_chat(peer)
             return
 
+        self._render_message(pkt, peer)
+        self.chat_view.moveCursor(QTextCursor.End)  # Прокручиваем чат вниз к новому сообщению
+        tracer.on_render(pkt)  # отметка отрисовки (если сообщение трассируется)
+
+
+    # Буфер чата вытеснил самое старое сообщение. Загруженные ранее страницы и курсор вели
+    # к прежнему началу буфера, и между ними и буфером теперь дыра: страницы сбрасываются,
+    # а ранняя история продолжается от самого старого сообщения, оставшегося в буфере
+    def _ring_trimmed(self, peer: str):
+        self._older.pop(peer, None)
+        oldest = self.cache.oldest(peer)
+        cursor = oldest.get("cursor") if oldest and self.cache.is_complete(peer) else None
+        if cursor:
+            self._cursors[peer] = cursor
+        else:
+            self._cursors.pop(peer, None)
+        if peer in self._loading_older:
+            self._stale_older.add(peer)
+
+
+    # Выводит одно сообщение в окно чата.
+    # Если это групповой чат — добавляет имя отправителя над сообщением.
+    def _render_message(self, pkt: dict, peer: str):
+        frm = pkt.get("from")
+        content = pkt.get("content")
+        ts = pkt["timestamp"]
+        dispname = pkt.get("display_name", frm)  # Имя для отображения (если есть), иначе логин
+
         outgoing = (frm == self.username)  # Проверяем, мы ли автор сообщения
 
         # В групповом чате отображаем имя отправителя над сообщением
@@ -240,9 +640,34 @@ class ChatWindow(QWidget):
                 )
                 self.chat_view.append(header_html)
 
+        # Сообщение с вложением — вместо текста ссылка на файл
+        file = pkt.get("file")
+        if file:
+            self._attachments[file["id"]] = file
+            content = Bubble.attachment(file)
+
         # Добавляем само сообщение в виде HTML-пузыря
         self.chat_view.append(Bubble.html(content, outgoing, ts))
-        self.chat_view.moveCursor(QTextCursor.End)  # Прокручиваем чат вниз к новому сообщению
+
+
+    # Перерисовывает открытый чат из буфера сообщений (без запроса к серверу).
+    # Пока окно очищается и заполняется, прокрутка проходит через верх — это не запрос ранней истории
+    def _render_chat(self, peer: str):
+        bar = self.chat_view.verticalScrollBar()
+        bar.blockSignals(True)
+        self.chat_view.clear()
+        for pkt in self._older.get(peer, []) + self.cache.messages(peer):
+            self._render_message(pkt, peer)
+        self.chat_view.moveCursor(QTextCursor.End)
+        bar.blockSignals(False)
+
+
+    # Обновляет значок непрочитанных у чата в списке
+    def _set_unread(self, peer: str, count: int):
+        item = self._chat_item(peer)
+        widget = self.chat_list.itemWidget(item) if item is not None else None
+        if widget:
+            widget.set_unread(count)
 
 
     # Отправляет текст из поля ввода на сервер как новое сообщение.
@@ -259,15 +684,109 @@ class ChatWindow(QWidget):
             "content": text,
             "timestamp": int(time.time()),
         }
+        trace = tracer.new_trace()  # метки времени для трассировки задержек (если включена)
+        if trace:
+            pkt["trace"] = trace
         try:
-            self.sock.sendall((json.dumps(pkt) + "\n").encode())  # Отправляем JSON-пакет на сервер
+            self.net.send(pkt)  # Отправляем пакет на сервер
         except OSError:
-            self.on_disconnect()  # Если соединение прервано — вызываем обработчик отключения
+            self._send_failed()  # Соединение прервано — ждём переподключения или закрываем окно
             return
 
+        self._last_sent = (self.current_peer, text)  # вернём в поле ввода, если сервер отклонит сообщение
+        self._typing_sent.pop(self.current_peer, None)  # собеседник снял индикатор — следующий набор сообщаем сразу
         self.input_edit.clear()  # Очищаем поле ввода после отправки
 
 
+    # Пакет присутствия: обновляем только строки чатов, которых он касается
+    def on_presence(self, pkt: dict):
+        for peer in self.presence.apply(pkt):
+            self._show_presence(peer)
+        if self.presence.has_typing() and not self._typing_timer.isActive():
+            self._typing_timer.start()
+
+
+    # Снимает истёкшие индикаторы набора; таймер работает, только пока кто-то печатает
+    def _expire_typing(self):
+        for peer in self.presence.expire():
+            self._show_presence(peer)
+        if not self.presence.has_typing():
+            self._typing_timer.stop()
+
+
+    # Показывает в строке чата, в сети ли собеседник и кто печатает
+    def _show_presence(self, peer: str):
+        item = self._items.get(peer)
+        if item is None:
+            return  # такого чата в списке нет
+        typists = self.presence.typing(peer)
+        if not typists:
+            typing = ""
+        elif typists == [peer]:
+            typing = "печатает…"  # приватный чат
+        else:
+            typing = f"{', '.join(typists)} {'печатает' if len(typists) == 1 else 'печатают'}…"
+        self.chat_list.itemWidget(item).set_presence(peer in self.presence.online, typing)
+
+
+    # Пользователь набирает текст — сообщаем собеседникам не чаще раза в TYPING_INTERVAL секунд на чат
+    def on_input_edited(self, text: str):
+        peer = self.current_peer
+        if not text.strip() or not peer:
+            return
+        now = time.monotonic()
+        if now - self._typing_sent.get(peer, float("-inf")) < TYPING_INTERVAL:
+            return
+        self._typing_sent[peer] = now
+        try:
+            self.net.send_typing(peer)
+        except OSError:
+            pass  # индикатор не важен; об обрыве соединения сообщит NetworkWorker
+
+
+    # Сервер отклонил запрос из-за лимита запросов или перегрузки (retry_after — через сколько мс повторить).
+    # Историю запрашиваем снова сами, о сообщении и прочих действиях сообщаем пользователю
+    def on_request_rejected(self, pkt: dict):
+        request, peer, retry = pkt.get("request"), pkt.get("to") or "", pkt.get("retry_after") or 0
+        if request == "history":
+            if self._loading_older.pop(peer, None) is not None:
+                self._stale_older.discard(peer)
+                QTimer.singleShot(retry, lambda: self.load_older(peer))  # ранняя страница
+                return
+            self.cache.abort_history(peer)  # хвост не пришёл — из кэша чат показывать нельзя
+            if self.prefetcher.on_rejected(peer):
+                QTimer.singleShot(retry, self.prefetcher.resume)
+            else:
+                QTimer.singleShot(retry, lambda: self._retry_history(peer))
+            return
+        if request == "message" and self._last_sent and self._last_sent[0] == peer:
+            if peer == self.current_peer and not self.input_edit.text():
+                self.input_edit.setText(self._last_sent[1])  # текст не потерян — можно отправить снова
+            self._last_sent = None
+        notice = pkt.get("content") or "Сервер отклонил запрос"
+        self.transfer_status.setText(notice)
+        self.transfer_status.show()
+        QTimer.singleShot(max(retry, 3000), lambda: self._hide_notice(notice))
+
+
+    # Повторяет отклонённый сервером запрос хвоста истории, если чат всё ещё открыт и не загружен
+    def _retry_history(self, peer: str):
+        if peer != self.current_peer or self.cache.is_complete(peer):
+            self.prefetcher.on_history_end(peer)  # запроса больше не ждём — фоновая предзагрузка продолжается
+            return
+        self.cache.begin_history(peer)
+        try:
+            self.net.send({"type": "history", "from": self.username, "to": peer})
+        except OSError:
+            self._send_failed()
+
+
+    # Скрывает сообщение об отказе сервера, если строку состояния с тех пор не заняла передача файла
+    def _hide_notice(self, notice: str):
+        if self.transfer_status.text() == notice:
+            self.transfer_status.hide()
+
+
     # Обработка потери соединения с сервером.
     # Показывает предупреждение и закрывает окно чата.
     def on_disconnect(self):
@@ -275,38 +794,176 @@ class ChatWindow(QWidget):
         self.close()
 
 
+    # Вход в этот аккаунт выполнен на другом устройстве — окно закрывается без переподключения
+    def on_session_replaced(self, text: str):
+        QMessageBox.warning(self, "Сеанс завершён", text)
+        self.close()
+
+
+    # Отправка не удалась. Если идёт переподключение — окно остаётся открытым (набранный текст
+    # не стирается), иначе соединение потеряно окончательно.
+    def _send_failed(self):
+        if self.net.state == STATE_RECONNECTING:
+            self.on_reconnecting()
+            return
+        self.on_disconnect()
+
+
+    # Соединение оборвалось, NetworkWorker входит заново по токену сессии
+    def on_reconnecting(self):
+        self.header.setText("Нет соединения, переподключение…")
+
+
+    # Соединение восстановлено. Пока его не было, сообщения могли прийти мимо кэша,
+    # поэтому кэш сбрасывается, а история открытого чата загружается заново
+    def on_reconnected(self):
+        self.cache.invalidate()
+        self.prefetcher.reset()
+        self._loading_older.clear()  # ответы на запросы ранней истории пропали вместе с соединением
+        self._stale_older.clear()
+        for peer in self.presence.clear():  # сервер пришлёт новый снимок присутствия
+            self._show_presence(peer)
+        self._typing_sent.clear()
+        item = self.chat_list.currentItem()
+        if item is not None and self.current_peer:
+            self.change_chat(item)
+        else:
+            self.header.setText("")
+        self.files.resume_pending()  # прерванные обрывом передачи продолжаются с места остановки
+        self.files.resume_downloads()
+
+
     # Обработка закрытия главного окна.
     # Останавливает сетевой поток перед выходом из приложения.
     def closeEvent(self, event):
         self.net.stop()
+        self.files.stop()
+        self.exports.stop()
+        self.index.close()
+        tracer.export()  # выгружаем собранные задержки в файл (если трассировка включена)
+        recorder.close()  # дописываем запись трафика (если она включена)
         super().closeEvent(event)
 
 
+    # Выбор файла и загрузка его в открытый чат.
+    # Сообщение с вложением появится в чате, когда сервер получит файл целиком
+    def attach_file(self):
+        if not self.current_peer:
+            return
+        path, _ = QFileDialog.getOpenFileName(self, "Отправить файл")
+        if path:
+            self.files.upload(path, self.current_peer)
+
+
+    # Клик по ссылке в окне сообщений: вложение скачиваем, остальные ссылки открываем в браузере
+    def on_link(self, url: QUrl):
+        if url.scheme() != "attachment":
+            QDesktopServices.openUrl(url)
+            return
+        file = self._attachments.get(int(url.path() or 0))
+        if file:
+            self.files.download(file["id"], file.get("name") or "", file.get("size") or 0)
+
+
+    # Ход передачи файла
+    def on_transfer_progress(self, file_id: int, name: str, done: int, total: int):
+        self.transfer_status.setText(f"{name}: {done * 100 // max(total, 1)}%")
+        self.transfer_status.show()
+
+
+    # Файл загружен на сервер (сообщение с ним придёт как обычное)
+    def on_upload_done(self, file_id: int, name: str):
+        self.transfer_status.hide()
+
+
+    # Файл скачан — открываем его программой по умолчанию
+    def on_download_done(self, file_id: int, path: str):
+        self.transfer_status.hide()
+        QDesktopServices.openUrl(QUrl.fromLocalFile(path))
+
+
+    # Передача не удалась (загрузка продолжится при следующем входе, скачивание — по новому клику)
+    def on_transfer_failed(self, file_id: int, name: str, error: str):
+        self.transfer_status.setText(f"{name}: {error}")
+        self.transfer_status.show()
+
+
+    # Ход выгрузки истории чата
+    def on_export_progress(self, peer: str, done: int, total: int):
+        title = self._export_titles.get(peer, peer)
+        self.transfer_status.setText(f"Выгрузка «{title}»: {done * 100 // max(total, 1)}%")
+        self.transfer_status.show()
+
+
+    # История чата выгружена
+    def on_export_done(self, peer: str, path: str, count: int):
+        notice = f"Выгрузка «{self._export_titles.pop(peer, peer)}» готова: {count} сообщ., {path}"
+        self.transfer_status.setText(notice)
+        self.transfer_status.show()
+        QTimer.singleShot(5000, lambda: self._hide_notice(notice))
+
+
+    # Выгрузка не удалась (недописанный файл удалён)
+    def on_export_failed(self, peer: str, error: str):
+        self.transfer_status.setText(f"Выгрузка «{self._export_titles.pop(peer, peer)}»: {error}")
+        self.transfer_status.show()
+
+
+    # Открытие диалога поиска по сообщениям.
+    # По двойному клику на результат открывается соответствующий чат.
+    def open_search(self):
+        from MessageSearchDialog import MessageSearchDialog  # импортируем при первом открытии
+
+        # Названия чатов для подписи результатов
+        names = {}
+        for i in range(self.chat_list.count()):
+            item = self.chat_list.item(i)
+            widget = self.chat_list.itemWidget(item)
+            if widget:
+                names[item.data(Qt.UserRole)] = widget.lbl_name.text()
+
+        dlg = self._dialog("search", lambda: MessageSearchDialog(self.net, self.index, names, self))
+        dlg.reset(names)
+        if dlg.exec_() == QDialog.Accepted and dlg.chosen_peer:
+            self.open_chat(dlg.chosen_peer)
+
+
+    # Возвращает диалог по ключу, создавая его при первом обращении.
+    # Диалоги переиспользуются: пока закрыты, они не подписаны на ответы сервера (см. NetworkWorker.request)
+    def _dialog(self, key: str, create):
+        dlg = self._dialogs.get(key)
+        if dlg is None:
+            dlg = self._dialogs[key] = create()
+        return dlg
+
+
+    # Выделяет чат в списке и открывает его
+    def open_chat(self, peer: str):
+        item = self._chat_item(peer)
+        if item is not None:
+            self.chat_list.setCurrentItem(item)
+            self.change_chat(item)
+
+
     # Открытие диалога создания нового приватного чата.
     # После выбора собеседника сервер создаст чат, и его появление будет обработано в on_chat_created.
     def open_new_chat(self):
-        dlg = NewChatDialog(self.net, self)
+        from NewChatDialog import NewChatDialog  # диалог нужен редко — импортируем при первом открытии
+
+        dlg = self._dialog("new_chat", lambda: NewChatDialog(self.net, self))
+        dlg.reset()
         if dlg.exec_() == QDialog.Accepted:
             # После подтверждения сервер отправит событие 'chat_created'
             pass
 
 
     # Открытие диалога создания группового чата.
-    # Собирает список пользователей из текущих чатов и передаёт его в диалог создания группы.
     def open_new_group(self):
-        # Собираем список всех пользователей из текущего списка чатов
-        all_users = []
-        for i in range(self.chat_list.count()):
-            item = self.chat_list.item(i)
-            username = item.data(Qt.UserRole)
-            displayname = item.text().split("\n", 1)[0]
-            all_users.append({
-                "username": username,
-                "display_name": displayname
-            })
+        from NewGroupChatDialog import NewGroupChatDialog  # импортируем при первом открытии
 
         # Открываем модальное окно создания группы
-        dlg = NewGroupChatDialog(self.net, all_users, self)
+        dlg = self._dialog("new_group", lambda: NewGroupChatDialog(self.net, self.username, self))
+        dlg.reset()
 
         try:
             result = dlg.exec_()  # Ожидаем результат от пользователя
@@ -1,10 +1,7 @@
-# Импорт стандартных библиотек
-import json
-import socket
-
-
 # Импорт виджетов и оконных компонентов из PyQt5
+from PyQt5.QtCore import QTimer
 from PyQt5.QtWidgets import (
+    QApplication,
     QWidget,
     QVBoxLayout,
     QLineEdit,
@@ -12,10 +9,11 @@ from PyQt5.QtWidgets import (
     QMessageBox,
 )
 
-# Импорт других окон и темы оформления
-from ChatWindow import ChatWindow
+# Импорт темы оформления.
+# Окно чата, окно регистрации и сетевой модуль импортируются лениво — только когда нужны,
+# чтобы окно входа появлялось как можно быстрее
 from theme import DarkTheme as T
-from SignupWindow import SignupWindow
+import startup
 
 # Адрес сервера, к которому подключается клиент
 SERVER_HOST = "localhost"
@@ -62,10 +60,42 @@ class LoginWindow(QWidget):
         self.signup_btn.clicked.connect(self.open_signup)
         layout.addWidget(self.signup_btn)
 
+        # Пока пользователь вводит пароль, заранее загружаем модули окна чата
+        self._painted = False
+        self.pass_edit.textEdited.connect(self._schedule_warm_up)
+
+
+    # Первая отрисовка окна входа — отметка времени запуска
+    def paintEvent(self, event):
+        super().paintEvent(event)
+        if self._painted:
+            return
+        self._painted = True
+        startup.mark("first_paint")
+        startup.report("запуск → первая отрисовка окна входа", "process_start", "first_paint")
+        if startup.profiling():
+            QTimer.singleShot(0, QApplication.quit)  # замер для startup_profile.py окончен
+
+
+    # Откладывает прогрев до возврата в цикл событий, чтобы не задерживать ввод символа
+    def _schedule_warm_up(self):
+        self.pass_edit.textEdited.disconnect(self._schedule_warm_up)
+        QTimer.singleShot(0, self.warm_up)
+
+
+    # Загружает модули, нужные после входа (окно чата, диалоги, сеть).
+    # Повторный импорт ничего не стоит, поэтому вызывать можно сколько угодно раз
+    def warm_up(self):
+        import ChatWindow  # noqa: F401 — тянет за собой NetworkWorker, ChatItem и Bubble
+        import NewChatDialog  # noqa: F401
+        import NewGroupChatDialog  # noqa: F401
+        import MessageSearchDialog  # noqa: F401
+        startup.mark("warm_up")
+
 
     # Выполняет вход пользователя в систему.
-    # Проверяет заполненность полей, подключается к серверу, отправляет логин и пароль.
-    # В случае успешного ответа — открывает главное окно чата.
+    # Проверяет заполненность полей и запускает вход в фоне (окно при этом не замирает).
+    # Результат приходит сигналами NetworkWorker.
     def try_login(self):
         # Считываем и обрезаем пробелы с введённых значений
         username = self.name_edit.text().strip()
@@ -76,41 +106,55 @@ class LoginWindow(QWidget):
             QMessageBox.warning(self, "Ошибка", "Введите имя и пароль")
             return
 
-        # Подготовка JSON-пакета авторизации заранее
-        pkt = {
-            "type": "signin",
-            "from": username,
-            "password": password,
-        }
+        startup.mark("login_click")
+
+        # Блокируем кнопку на время входа, чтобы не запустить его дважды
+        self.join_btn.setEnabled(False)
+        self.join_btn.setText("Вход…")
+
+        from NetworkWorker import NetworkWorker
+
+        self.username = username
+        self.net = NetworkWorker()
+        self.net.logged_in.connect(self.on_logged_in)
+        self.net.login_failed.connect(self.on_login_failed)
+        self.net.connect_failed.connect(self.on_connect_failed)
+        self.net.login(SERVER_HOST, SERVER_PORT, username, password)
+
 
-        try:
-            # Устанавливаем TCP-соединение с сервером
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.connect((SERVER_HOST, SERVER_PORT))
+    # Сервер подтвердил вход — открываем главное окно чата.
+    # Соединение и всё, что сервер уже успел прислать, передаются окну чата.
+    def on_logged_in(self):
+        from ChatWindow import ChatWindow
 
-            # Отправляем JSON-пакет, преобразованный в строку + символ новой строки
-            sock.sendall((json.dumps(pkt) + "\n").encode())
+        self.main = ChatWindow(self.username, self.net)
+        self.main.show()
+        self.close()
 
-            # Ждём ответ от сервера
-            resp = sock.recv(4096).decode()
-            # Преобразуем строку в словарь Python
-            data = json.loads(resp)
 
-            if data.get("type") == "login_ok":
-                self.main = ChatWindow(username, sock)
-                self.main.show()
-                self.close()
-            else:
-                QMessageBox.warning(self, "Ошибка", data.get("content", "Неизвестная ошибка"))
-                sock.close()
+    # Сервер отклонил вход (неверный пароль, нет такого пользователя и т.п.)
+    def on_login_failed(self, text: str):
+        self._reset_login_button()
+        QMessageBox.warning(self, "Ошибка", text)
 
-        except OSError as e:
-            QMessageBox.critical(self, "Ошибка", f"Не удалось подключиться: {e}")
+
+    # Не удалось подключиться к серверу или он не ответил вовремя
+    def on_connect_failed(self, text: str):
+        self._reset_login_button()
+        QMessageBox.critical(self, "Ошибка", f"Не удалось подключиться: {text}")
+
+
+    # Возвращает кнопку входа в исходное состояние
+    def _reset_login_button(self):
+        self.join_btn.setEnabled(True)
+        self.join_btn.setText("Войти")
 
 
     # Открывает окно регистрации.
     # При нажатии на кнопку "Регистрация" создаётся новое окно SignupWindow,
     # и отображается поверх текущего окна входа.
     def open_signup(self):
+        from SignupWindow import SignupWindow
+
         self.signup = SignupWindow()  # создаём окно регистрации
         self.signup.show()            # отображаем его пользователю
@@ -0,0 +1,183 @@
+# Импорт стандартных библиотек
+from datetime import datetime
+
+# Импорт компонентов PyQt5
+from PyQt5.QtCore import Qt, QTimer
+from PyQt5.QtWidgets import (
+    QVBoxLayout,
+    QHBoxLayout,
+    QLineEdit,
+    QPushButton,
+    QListWidget,
+    QListWidgetItem,
+    QDialog,
+    QLabel,
+)
+
+from theme import DarkTheme as T
+
+# Задержка перед запросом к серверу (мс): не шлём запрос на каждый введённый символ
+SERVER_SEARCH_DELAY = 250
+# Размер страницы результатов
+PAGE_SIZE = 20
+
+
+# Диалог поиска по сообщениям.
+# Сразу показывает совпадения из локального индекса (без сервера), затем дополняет
+# их результатами сервера, которые охватывают всю историю. Кнопка «Ещё» загружает следующую страницу.
+# По двойному клику открывает чат с найденным сообщением (peer сохраняется в self.chosen_peer).
+# Окно создаётся один раз и переиспользуется (перед показом вызывается reset());
+# ответы сервера приходят только на последний запрос и только пока окно открыто.
+class MessageSearchDialog(QDialog):
+    def __init__(self, net_worker, index, chat_names: dict[str, str], parent=None):
+        super().__init__(parent)
+        self.net = net_worker              # сетевой обработчик
+        self.index = index                 # локальный индекс сообщений (MessageIndex)
+        self.chat_names = chat_names       # peer → название чата (для подписи результата)
+        self.chosen_peer: str | None = None
+
+        self._query = ""                   # текущий запрос
+        self._local_offset = 0             # сколько локальных результатов уже показано
+        self._server_before = 0            # курсор следующей страницы сервера (0 — больше нет)
+        self._seen: set[tuple] = set()     # уже показанные сообщения (локальные и серверные совпадают)
+        self._req_id = 0                   # номер последнего запроса к серверу
+
+        self.setWindowTitle("Поиск сообщений")
+        self.resize(520, 460)
+        self.setStyleSheet(f"background:{T.PANEL}; border-radius:8px;")
+
+        layout = QVBoxLayout(self)
+        layout.setContentsMargins(16, 16, 16, 16)
+        layout.setSpacing(10)
+
+        # Заголовок окна
+        title = QLabel("Поиск по сообщениям")
+        title.setStyleSheet(f"color:{T.TEXT_MAIN}; font-size:16px; font-weight:bold;")
+        layout.addWidget(title)
+
+        # Поле ввода запроса
+        self.search_input = QLineEdit()
+        self.search_input.setPlaceholderText("Слова из сообщения…")
+        self.search_input.setStyleSheet(T.qss_input())
+        layout.addWidget(self.search_input)
+
+        # Список найденных сообщений
+        self.result_list = QListWidget()
+        self.result_list.setStyleSheet(T.qss_user_list() + T.qss_user_list_large(size=13))
+        self.result_list.setWordWrap(True)
+        layout.addWidget(self.result_list, 1)
+
+        # Ошибка поиска на сервере (локальные результаты при этом остаются)
+        self.status = QLabel()
+        self.status.setStyleSheet(f"color:{T.TEXT_SUB}; font-size:12px;")
+        self.status.hide()
+        layout.addWidget(self.status)
+
+        # Кнопки «Ещё» и «Закрыть»
+        btn_layout = QHBoxLayout()
+        self.more_btn = QPushButton("Ещё")
+        self.more_btn.setEnabled(False)
+        self.more_btn.setStyleSheet(T.qss_button())
+        btn_layout.addWidget(self.more_btn)
+
+        close_btn = QPushButton("Закрыть")
+        close_btn.setStyleSheet(T.qss_button_dark())
+        close_btn.clicked.connect(self.reject)
+        btn_layout.addWidget(close_btn)
+        layout.addLayout(btn_layout)
+
+        # Запрос к серверу откладываем, пока пользователь печатает
+        self._server_timer = QTimer(self)
+        self._server_timer.setSingleShot(True)
+        self._server_timer.setInterval(SERVER_SEARCH_DELAY)
+        self._server_timer.timeout.connect(self._search_server)
+
+        # Подключение сигналов
+        self.search_input.textChanged.connect(self.on_search_text)
+        self.result_list.itemDoubleClicked.connect(self.on_item_chosen)
+        self.more_btn.clicked.connect(self.on_more)
+        self.finished.connect(self._server_timer.stop)  # закрытое окно не отправляет отложенный запрос
+
+
+    # Подготовка к повторному показу: актуальные названия чатов, пустой поиск
+    def reset(self, chat_names: dict[str, str]):
+        self.chat_names = chat_names
+        self.chosen_peer = None
+        self.search_input.clear()
+        self.on_search_text("")
+
+
+    # Новый запрос: сразу ищем локально, сервер — после паузы в наборе
+    def on_search_text(self, text: str):
+        self._query = text.strip()
+        self._local_offset = 0
+        self._server_before = 0
+        self._seen.clear()
+        self._req_id = 0  # ответ на прежний запрос уже не нужен
+        self.result_list.clear()
+        self.status.hide()
+        self.more_btn.setEnabled(False)
+        if not self._query:
+            self._server_timer.stop()
+            return
+
+        self._add_results(self.index.search(self._query, PAGE_SIZE))
+        self._local_offset = PAGE_SIZE
+        self._server_timer.start()
+
+
+    # Отправляет запрос на сервер (первая или следующая страница)
+    def _search_server(self):
+        try:
+            self._req_id = self.net.send_message_search(
+                self._query, self._server_before, PAGE_SIZE, owner=self, handler=self.on_server_results)
+        except OSError:
+            pass  # соединение потеряно — об этом сообщит NetworkWorker
+
+
+    # Обработка страницы результатов от сервера
+    def on_server_results(self, pkt: dict):
+        if pkt.get("req_id") != self._req_id:
+            return  # ответ на устаревший запрос — пользователь уже ввёл другой текст
+        if pkt.get("content"):
+            # Сервер не смог выполнить поиск: курсор прежний, «Ещё» повторит ту же страницу
+            self.status.setText(pkt["content"])
+            self.status.show()
+            self.more_btn.setEnabled(bool(self._server_before))
+            return
+        self.status.hide()
+        self._add_results(pkt.get("results") or [])
+        self._server_before = pkt.get("before") or 0
+        self.more_btn.setEnabled(bool(self._server_before))
+
+
+    # Следующая страница: локальные результаты сразу, серверные — запросом
+    def on_more(self):
+        self._add_results(self.index.search(self._query, PAGE_SIZE, self._local_offset))
+        self._local_offset += PAGE_SIZE
+        if self._server_before:
+            self.more_btn.setEnabled(False)  # включится, когда придёт ответ сервера
+            self._search_server()
+
+
+    # Добавляет найденные сообщения в список (без повторов)
+    def _add_results(self, hits: list[dict]):
+        for h in hits:
+            key = (h.get("peer"), h.get("from"), h.get("timestamp"), h.get("content"))
+            if key in self._seen:
+                continue
+            self._seen.add(key)
+
+            # Пустой peer — приватный чат, собеседника которого больше нет
+            chat = self.chat_names.get(h["peer"], h["peer"]) or "Удалённый собеседник"
+            when = datetime.fromtimestamp(h.get("timestamp") or 0).strftime("%d.%m.%Y %H:%M")
+            author = h.get("display_name") or h.get("from") or ""
+            item = QListWidgetItem(f"{chat} · {when}\n{author}: {h.get('content', '')[:200]}")
+            item.setData(Qt.UserRole, h["peer"])
+            self.result_list.addItem(item)
+
+
+    # Двойной клик по результату — закрываем диалог и открываем чат
+    def on_item_chosen(self, item: QListWidgetItem):
+        self.chosen_peer = item.data(Qt.UserRole)
+        self.accept()
@@ -1,40 +1,118 @@
 # Импорт стандартных библиотек
-import json
+import itertools
+import random
 import socket
 import threading
+import time
+import zlib
 
 # Импорт компонентов Qt для сигналов и событий
-from PyQt5.QtCore import Qt, pyqtSignal, QObject
+from PyQt5.QtCore import Qt, pyqtSignal, QObject, QTimer
+
+from capture import recorder
+from protocol import Codec, client_caps
+from tracing import tracer
+
+# Таймауты этапов входа (в секундах)
+CONNECT_TIMEOUT = 5    # установка TCP-соединения
+LOGIN_TIMEOUT = 15     # ожидание ответа на signin (проверка пароля на сервере небыстрая)
+# Паузы между попытками переподключения (секунды). Фактическая пауза — случайная от 0 до указанной,
+# чтобы после перезапуска сервера клиенты не переподключались все одновременно
+RECONNECT_DELAYS = (1, 2, 4, 8, 15, 30)
+
+# Состояния соединения
+STATE_IDLE = "idle"              # ещё не подключались
+STATE_CONNECTING = "connecting"  # устанавливаем TCP-соединение
+STATE_AUTH = "auth"              # signin отправлен, ждём ответ
+STATE_READY = "ready"            # вход выполнен, ждём подключения окна чата
+STATE_ATTACHED = "attached"      # пакеты передаются окну чата
+STATE_RECONNECTING = "reconnecting"  # соединение оборвалось, входим заново по токену сессии
+STATE_CLOSED = "closed"          # соединение закрыто или вход не удался
 
 
 # Класс NetworkWorker — сетевой обработчик, работающий в фоне.
-# Отвечает за приём сообщений от сервера через сокет,
-# обработку полученных данных и отправку сигналов в интерфейс (GUI).
+# Выполняет вход как конечный автомат (подключение → signin → ответ) в фоновом потоке,
+# не блокируя окно входа, затем принимает пакеты от сервера и отправляет сигналы в интерфейс (GUI).
+# Всё, что сервер прислал сразу за login_ok (первый список чатов), придерживается
+# до вызова attach() и передаётся окну чата без повторного запроса.
+# При обрыве соединения переподключается сам, предъявляя токен сессии из login_ok вместо пароля.
 # Также позволяет инициировать отправку сообщений: поиск пользователей, создание чатов и групп.
+#
+# Окна, которые живут недолго (диалоги), получают ответы сервера не через общие сигналы,
+# а через запросы с владельцем: request() отправляет запрос с номером (req_id) и вызывает
+# обработчик только для ответа на него. Когда владелец закрывается (finished) или уничтожается,
+# его запросы снимаются — закрытое окно больше не получает пакеты и не делает лишней работы.
 class NetworkWorker(QObject):
+    # Сигналы этапа входа
+    logged_in = pyqtSignal()                   # Сервер подтвердил вход
+    login_failed = pyqtSignal(str)             # Сервер отклонил вход (текст ошибки)
+    connect_failed = pyqtSignal(str)           # Не удалось подключиться или сервер не ответил
+
     # Сигналы, по которым другие окна могут реагировать на события от сервера
     message_received = pyqtSignal(dict)        # Пришло сообщение
     chatlist_received = pyqtSignal(list)       # Обновился список чатов
-    connection_lost = pyqtSignal()             # Потеря соединения с сервером
+    connection_lost = pyqtSignal()             # Соединение потеряно, переподключиться не удалось
+    session_replaced = pyqtSignal(str)         # Сервер закрыл соединение: выполнен вход на другом устройстве (текст)
+    reconnecting = pyqtSignal()                # Соединение оборвалось, идёт переподключение
+    reconnected = pyqtSignal()                 # Переподключение удалось (сервер пришлёт свежий список чатов)
     user_search_result = pyqtSignal(list)      # Результат поиска пользователей
     chat_created = pyqtSignal(dict)            # Создан приватный чат
     group_created = pyqtSignal(dict)           # Создан групповой чат
+    chat_delta = pyqtSignal(dict)              # Изменение одного чата в списке (op: "add" или "remove")
+    history_end = pyqtSignal(str, str)         # История чата передана полностью (чат, курсор более ранней страницы)
+    message_search_result = pyqtSignal(dict)   # Страница результатов поиска по сообщениям
+    presence_changed = pyqtSignal(dict)        # Присутствие собеседников: снимок или изменения (пакет "presence")
+    request_rejected = pyqtSignal(dict)        # Сервер отклонил запрос (лимит запросов или перегрузка): error с retry_after
+    _reply = pyqtSignal(int, dict)             # Ответ на запрос с req_id (из потока чтения — в поток интерфейса)
 
 
-    def __init__(self, sock: socket.socket):
+    def __init__(self):
         super().__init__()
-        self.sock = sock
+        self.sock: socket.socket | None = None
+        self.codec = Codec()            # формат протокола, согласованный при входе
+        self.state = STATE_IDLE         # текущее состояние соединения
+        self._pending: list[dict] = []  # пакеты, пришедшие вместе с ответом на вход
+        self._attached = threading.Event()  # окно чата подключило обработчики сигналов
+        self._send_lock = threading.Lock()  # пакеты из разных потоков не должны перемешиваться
         self._running = True  # флаг, указывающий, запущен ли поток
+        self.files = None     # обработчик передачи файлов (FileTransfers), подключает окно чата
+        self.exports = None   # выгрузки истории чатов (ChatExports), подключает окно чата
+        self.token: str | None = None  # токен сессии для переподключения без пароля
+        self._replaced: str | None = None  # текст session_replaced: вход вытеснен, переподключаться нельзя
+        self._addr: tuple[str, int] | None = None  # адрес сервера
+        self._username = ""
+        self._req_ids = itertools.count(1)   # номера запросов (req_id)
+        self._requests: dict[int, tuple[QObject, object, dict]] = {}  # req_id → (владелец, обработчик ответа, пакет)
+        self._latest: dict[int, int] = {}    # id(владельца) → req_id его последнего запроса
+        self._scoped: set[int] = set()       # владельцы, у которых уже отслеживается закрытие
+        self._reply.connect(self._on_reply)
+
+
+    # Начинает вход в фоновом потоке. Результат придёт сигналом logged_in, login_failed или connect_failed.
+    def login(self, host: str, port: int, username: str, password: str):
+        self._addr = (host, port)
+        self._username = username
+        pkt = {
+            "type": "signin",
+            "from": username,
+            "password": password,
+            "caps": client_caps(),  # предлагаем серверу компактный формат и сжатие
+        }
+        threading.Thread(target=self._run, args=(host, port, pkt), daemon=True).start()
 
 
-    # Запускает фоновый поток, который будет постоянно слушать сокет
-    def start(self):
-        threading.Thread(target=self._read_loop, daemon=True).start()
+    # Окно чата подключило свои обработчики — можно передавать пакеты (начиная с отложенных)
+    def attach(self):
+        self._attached.set()
 
 
     # Останавливает работу: завершает поток и закрывает сокет
     def stop(self):
         self._running = False
+        self.state = STATE_CLOSED
+        self._attached.set()  # будим поток, если он ещё ждёт окно чата
+        if self.sock is None:
+            return
         try:
             self.sock.shutdown(socket.SHUT_RDWR)
             self.sock.close()
@@ -42,55 +120,318 @@ class NetworkWorker(QObject):
             pass
 
 
+    # Тело фонового потока: вход, затем цикл чтения
+    def _run(self, host: str, port: int, pkt: dict):
+        if not self._login(host, port, pkt):
+            return
+
+        # Ждём, пока окно чата подключит обработчики, иначе первый список чатов потеряется
+        self._attached.wait()
+        if not self._running:
+            return
+        self.state = STATE_ATTACHED
+        while True:
+            self._read_loop()
+            if not self._running:
+                return  # соединение закрыли мы сами
+            if self._replaced is not None:
+                # Вход вытеснен новым: переподключение по токену вытеснило бы тот вход в ответ
+                self.state = STATE_CLOSED
+                self.session_replaced.emit(self._replaced)
+                return
+            if not self._reconnect():
+                self.state = STATE_CLOSED
+                self.connection_lost.emit()
+                return
+
+
+    # Этапы входа. Возвращает True, если сервер подтвердил вход.
+    def _login(self, host: str, port: int, pkt: dict) -> bool:
+        try:
+            sock, codec, packets = self._handshake(host, port, pkt)
+        except (OSError, ValueError, zlib.error) as e:
+            self.state = STATE_CLOSED
+            self.connect_failed.emit(str(e))
+            return False
+
+        resp = packets[0]
+        if resp.get("type") != "login_ok":
+            sock.close()
+            self.state = STATE_CLOSED
+            self.login_failed.emit(resp.get("content", "Неизвестная ошибка"))
+            return False
+
+        with self._send_lock:
+            self.sock, self.codec = sock, codec
+        self.token = resp.get("token")
+        self._pending = packets[1:]
+        self.state = STATE_READY
+        self.logged_in.emit()
+        return True
+
+
+    # Подключение и обмен signin → ответ. Возвращает сокет, кодек соединения и пришедшие пакеты
+    # (первый — ответ сервера). При ошибке сети выбрасывает исключение, сокет при этом закрыт.
+    # Во время переподключения состояние остаётся STATE_RECONNECTING до успеха.
+    def _handshake(self, host: str, port: int, pkt: dict) -> tuple[socket.socket, Codec, list[dict]]:
+        first = self.state != STATE_RECONNECTING
+        if first:
+            self.state = STATE_CONNECTING
+        sock = socket.create_connection((host, port), timeout=CONNECT_TIMEOUT)
+        codec = Codec()
+        recorder.connected()
+        try:
+            if first:
+                self.state = STATE_AUTH
+            sock.settimeout(LOGIN_TIMEOUT)
+            sock.sendall(codec.encode(pkt))  # до входа протокол всегда текстовый
+            recorder.signin(pkt)
+
+            # Читаем, пока не придёт ответ. Вместе с ним может прийти и следующий пакет (список чатов) —
+            # кодек переключается на согласованный формат и сохраняет всё, что пришло после ответа
+            packets = []
+            received = []
+            while not packets:
+                part = sock.recv(65536)
+                if not part:
+                    raise OSError("сервер закрыл соединение")
+                received.append(part)
+                packets = codec.feed(part)
+            recorder.login_response(b"".join(received))
+            sock.settimeout(None)
+        except BaseException:
+            sock.close()
+            raise
+        return sock, codec, packets
+
+
+    # Переподключение после обрыва: вход по токену сессии с паузами между попытками.
+    # Возвращает True, если соединение восстановлено.
+    def _reconnect(self) -> bool:
+        if not self.token or self._addr is None:
+            return False
+        self.state = STATE_RECONNECTING
+        self.reconnecting.emit()
+        if self.files is not None:
+            self.files.on_disconnect()  # загрузка не должна ждать подтверждений от старого соединения
+        if self.exports is not None:
+            self.exports.on_disconnect()  # сервер прекратил выгрузки вместе с соединением
+        pkt = {"type": "signin", "from": self._username, "token": self.token, "caps": client_caps()}
+
+        for delay in RECONNECT_DELAYS:
+            time.sleep(random.uniform(0, delay))
+            if not self._running:
+                return False
+            try:
+                sock, codec, packets = self._handshake(*self._addr, pkt)
+            except (OSError, ValueError, zlib.error):
+                continue  # сервер недоступен — пробуем ещё раз
+
+            resp = packets[0]
+            if resp.get("type") != "login_ok":
+                sock.close()
+                return False  # токен не принят (истёк) — нужен вход с паролем
+
+            with self._send_lock:
+                self.sock, self.codec = sock, codec
+            self.token = resp.get("token") or self.token
+            self._pending = packets[1:]  # свежий список чатов — отдаст цикл чтения
+            self.state = STATE_ATTACHED
+            self.reconnected.emit()
+            return True
+        return False
+
+
     # Цикл чтения данных из сокета. Вызывается в отдельном потоке.
-    # Считывает данные построчно (до \n), превращает в JSON и вызывает нужный сигнал.
+    # Кодек собирает из байтов готовые пакеты (JSON-строки или кадры), для каждого вызывается нужный сигнал.
     def _read_loop(self):
-        buffer = ""
+        # Сначала отдаём пакеты, которые пришли вместе с ответом на вход
+        for pkt in self._pending:
+            self._dispatch(pkt)
+        self._pending = []
+
         while self._running:
             try:
-                part = self.sock.recv(4096)
+                part = self.sock.recv(65536)
                 if not part:
                     break  # соединение закрыто со стороны сервера
+                recorder.received(part)
+
+                for pkt in self.codec.feed(part):
+                    self._dispatch(pkt)
 
-                buffer += part.decode()
-
-                # Обрабатываем каждую строку по \n
-                while "\n" in buffer:
-                    line, buffer = buffer.split("\n", 1)
-                    if not line:
-                        continue
-
-                    pkt = json.loads(line)
-                    ptype = pkt.get("type")
-
-                    # Определяем тип полученного пакета и испускаем соответствующий сигнал
-                    if ptype == "chatlist":
-                        self.chatlist_received.emit(pkt.get("chats", []))
-                    elif ptype == "message":
-                        self.message_received.emit(pkt)
-                    elif ptype == "user_search_result":
-                        self.user_search_result.emit(pkt.get("users", []))
-                    elif ptype == "chat_created":
-                        self.chat_created.emit(pkt)
-                    elif ptype == "group_created":
-                        self.group_created.emit(pkt)
-
-            except (ConnectionResetError, OSError, json.JSONDecodeError):
+            except (ConnectionResetError, OSError, ValueError, zlib.error):
                 break
-        # Если вышли из цикла — сигнал об отключении
-        self.connection_lost.emit()
+        # Соединение оборвалось (или закрыто нами) — дальше решает _run
+        self.sock.close()
 
 
-    # Отправляет запрос на поиск пользователей по строке запроса
-    def send_user_search(self, query: str):
+    # Определяет тип полученного пакета и испускает соответствующий сигнал
+    def _dispatch(self, pkt: dict):
+        req_id = pkt.get("req_id")
+        if req_id:
+            self._reply.emit(req_id, pkt)  # ответ на request() — только его владельцу
+            return
+        ptype = pkt.get("type")
+        if ptype == "chatlist":
+            self.chatlist_received.emit(pkt.get("chats") or [])
+        elif ptype == "message":
+            tracer.on_arrival(pkt)  # отметка прихода (если сообщение трассируется)
+            self.message_received.emit(pkt)
+        elif ptype == "user_search_result":
+            self.user_search_result.emit(pkt.get("users") or [])
+        elif ptype == "chat_created":
+            self.chat_created.emit(pkt)
+        elif ptype == "group_created":
+            self.group_created.emit(pkt)
+        elif ptype == "chat_delta":
+            self.chat_delta.emit(pkt)
+        elif ptype == "history_end":
+            self.history_end.emit(pkt.get("to") or "", pkt.get("cursor") or "")
+        elif ptype == "message_search_result":
+            self.message_search_result.emit(pkt)
+        elif ptype == "presence":
+            self.presence_changed.emit(pkt)
+        elif ptype == "session_replaced":
+            # Сервер сейчас закроет соединение; токен больше не действует
+            self.token = None
+            self._replaced = pkt.get("content") or "Выполнен вход на другом устройстве"
+        elif ptype in ("file_accept", "file_ack", "file_chunk", "file_error"):
+            # Передача файлов обрабатывается прямо в потоке чтения: подтверждения не ждут интерфейс
+            if self.files is not None:
+                self.files.on_packet(pkt)
+        elif ptype in ("chat_export_accept", "chat_export_chunk", "chat_export_end"):
+            # Порции выгрузки чата — тоже в потоке чтения: их подтверждение не ждёт интерфейс
+            if self.exports is not None:
+                self.exports.on_packet(pkt)
+        elif ptype == "error" and pkt.get("retry_after"):
+            # Отказ из-за лимита запросов: отклонённые пакеты передач повторяют FileTransfers и ChatExports,
+            # остальные — окно чата
+            if pkt.get("request") in ("file_offer", "file_download"):
+                if self.files is not None:
+                    self.files.on_packet(pkt)
+            elif pkt.get("request") == "chat_export":
+                if self.exports is not None:
+                    self.exports.on_packet(pkt)
+            else:
+                self.request_rejected.emit(pkt)
+
+
+    # Отправляет пакет серверу в согласованном формате.
+    # При обрыве соединения (в том числе во время переподключения) выбрасывает OSError —
+    # его обрабатывает вызывающий код.
+    def send(self, pkt: dict):
+        with self._send_lock:
+            if self.state == STATE_RECONNECTING:
+                raise OSError("нет соединения с сервером")
+            data = self.codec.encode(pkt)
+            recorder.sent(data)
+            self.sock.sendall(data)
+
+
+    # Отправляет запрос с номером и возвращает номер. handler(pkt) вызывается в потоке интерфейса
+    # для ответа на этот запрос, если owner к тому времени не закрыт. Ответы на запросы,
+    # которые owner успел заменить новыми, обработчику по-прежнему приходят — отбрасывает их он сам.
+    # Если сервер отклонил последний запрос owner с retry_after, запрос повторяется с тем же номером.
+    def request(self, owner: QObject, pkt: dict, handler) -> int:
+        req_id = next(self._req_ids)
+        self._scope(owner)
+        self._requests[req_id] = (owner, handler, pkt)
+        self._latest[id(owner)] = req_id
+        try:
+            self.send({**pkt, "req_id": req_id})
+        except OSError:
+            del self._requests[req_id]
+            raise
+        return req_id
+
+
+    # Снимает все запросы владельца. При закрытии owner вызывается автоматически
+    def release(self, owner: QObject):
+        for req_id in [r for r, (o, *_) in self._requests.items() if o is owner]:
+            del self._requests[req_id]
+        self._latest.pop(id(owner), None)
+
+
+    # Начинает отслеживать закрытие владельца (один раз на владельца)
+    def _scope(self, owner: QObject):
+        key = id(owner)
+        if key in self._scoped:
+            return
+        self._scoped.add(key)
+        if hasattr(owner, "finished"):
+            owner.finished.connect(lambda _result: self.release(owner))  # диалог закрыт (он может открыться снова)
+        owner.destroyed.connect(lambda: self._forget(key))
+
+
+    # Владелец уничтожен: остались только его записи — сам объект уже недоступен
+    def _forget(self, key: int):
+        self._scoped.discard(key)
+        self._latest.pop(key, None)
+        for req_id in [r for r, (o, *_) in self._requests.items() if id(o) == key]:
+            del self._requests[req_id]
+
+
+    # Ответ на request(): вызываем обработчик, если запрос ещё не снят.
+    # Отказ с retry_after на последний запрос владельца не передаётся обработчику — запрос повторяется
+    def _on_reply(self, req_id: int, pkt: dict):
+        entry = self._requests.get(req_id)
+        if entry is None:
+            return
+        retry = pkt.get("retry_after") if pkt.get("type") == "error" else 0
+        if retry and self._latest.get(id(entry[0])) == req_id:
+            QTimer.singleShot(retry, lambda: self._retry(req_id))
+            return
+        del self._requests[req_id]
+        entry[1](pkt)
+
+
+    # Повторяет отклонённый запрос, если владелец не закрыт и не отправил с тех пор новый
+    def _retry(self, req_id: int):
+        entry = self._requests.get(req_id)
+        if entry is None:
+            return
+        owner, _, pkt = entry
+        if self._latest.get(id(owner)) != req_id:
+            del self._requests[req_id]  # запрос уже заменён новым — его ответ не нужен
+            return
+        try:
+            self.send({**pkt, "req_id": req_id})
+        except OSError:
+            del self._requests[req_id]  # соединение потеряно — об этом сообщит NetworkWorker
+
+
+    # Отправляет запрос на поиск пользователей по строке запроса.
+    # С owner и handler ответ придёт только в handler (см. request), иначе — сигналом user_search_result
+    def send_user_search(self, query: str, owner: QObject | None = None, handler=None) -> int:
         pkt = {"type": "user_search", "query": query}
-        self.sock.sendall((json.dumps(pkt) + "\n").encode())
+        if owner is not None:
+            return self.request(owner, pkt, handler)
+        self.send(pkt)
+        return 0
+
+
+    # Отправляет запрос полнотекстового поиска по сообщениям.
+    # before — курсор страницы из предыдущего ответа (0 — первая страница).
+    # С owner и handler ответ придёт только в handler, иначе — сигналом message_search_result
+    def send_message_search(self, query: str, before: int = 0, limit: int = 20,
+                            owner: QObject | None = None, handler=None) -> int:
+        pkt = {"type": "message_search", "query": query, "before": before, "limit": limit}
+        if owner is not None:
+            return self.request(owner, pkt, handler)
+        self.send(pkt)
+        return 0
+
+
+    # Сообщает собеседникам чата, что пользователь печатает (частоту ограничивает вызывающий код)
+    def send_typing(self, peer: str):
+        self.send({"type": "typing", "to": peer})
 
 
     # Отправляет запрос на создание приватного чата с другим пользователем
     def send_start_chat(self, peer: str):
         pkt = {"type": "start_chat", "to": peer}
-        self.sock.sendall((json.dumps(pkt) + "\n").encode())
+        self.send(pkt)
 
 
     # Отправляет запрос на создание группового чата с заданными участниками
@@ -100,4 +441,14 @@ class NetworkWorker(QObject):
             "name": name,
             "participants": participants
         }
-        self.sock.sendall((json.dumps(pkt) + "\n").encode())
\ No newline at end of file
+        self.send(pkt)
+
+
+    # Отправляет запрос на добавление участников в группу
+    def send_group_add(self, chat: str, participants: list[str]):
+        self.send({"type": "group_add", "to": chat, "participants": participants})
+
+
+    # Отправляет запрос на удаление участников из группы (себя — чтобы выйти из неё)
+    def send_group_remove(self, chat: str, participants: list[str]):
+        self.send({"type": "group_remove", "to": chat, "participants": participants})
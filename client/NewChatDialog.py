@@ -14,11 +14,14 @@ from theme import DarkTheme as T
 
 
 # Диалог создания нового чата с пользователем
-# Отображает поле поиска, список найденных пользователей и кнопки управления
+# Отображает поле поиска, список найденных пользователей и кнопки управления.
+# Окно создаётся один раз и переиспользуется (перед показом вызывается reset()).
+# Результаты поиска приходят только на последний запрос и только пока окно открыто
 class NewChatDialog(QDialog):
     def __init__(self, net_worker, parent=None):
         super().__init__(parent)
         self.net = net_worker   # сетевой обработчик, через него отправляются запросы на сервер
+        self._req_id = 0        # номер последнего запроса поиска (ответы на прежние отбрасываются)
 
         self.setWindowTitle("Новый чат")
         self.resize(400, 300)
@@ -53,35 +56,49 @@ class NewChatDialog(QDialog):
         self.ok_btn = QPushButton("Начать чат")
         self.ok_btn.setEnabled(False)   # по умолчанию кнопка отключена
         self.ok_btn.setStyleSheet(T.qss_button())
-        self.ok_btn.clicked.connect(self.on_ok)
         btn_layout.addWidget(self.ok_btn)
 
         self.cancel_btn = QPushButton("Отмена")
         self.cancel_btn.setStyleSheet(T.qss_button_dark())
-        self.cancel_btn.clicked.connect(self.reject)
         btn_layout.addWidget(self.cancel_btn)
 
         layout.addLayout(btn_layout)
 
         # Подключение сигналов
         self.search_input.textChanged.connect(self.on_search_text)
-        self.net.user_search_result.connect(self.on_search_results)
         self.result_list.itemSelectionChanged.connect(self.on_item_selected)
         self.ok_btn.clicked.connect(self.on_ok)
         self.cancel_btn.clicked.connect(self.reject)
 
 
+    # Подготовка к повторному показу: пустой поиск, кнопка выключена
+    def reset(self):
+        self.search_input.clear()
+        self.result_list.clear()
+        self.ok_btn.setEnabled(False)
+        self._req_id = 0
+
+
     # Обработка изменения текста в поле поиска
     def on_search_text(self, text: str):
         query = text.strip()
-        if query:
-            self.net.send_user_search(query)   # отправляем запрос на сервер
+        if not query:
+            self._req_id = 0
+            self.result_list.clear()
+            return
+        try:
+            # Ответ придёт в on_search_results, пока окно открыто
+            self._req_id = self.net.send_user_search(query, self, self.on_search_results)
+        except OSError:
+            pass  # соединение потеряно — об этом сообщит NetworkWorker
 
 
     # Обработка полученного списка пользователей от сервера
-    def on_search_results(self, users: list):
+    def on_search_results(self, pkt: dict):
+        if pkt.get("req_id") != self._req_id:
+            return  # ответ на устаревший запрос — пользователь уже ввёл другой текст
         self.result_list.clear()
-        for u in users:
+        for u in pkt.get("users") or []:
             item = QListWidgetItem(f"{u['display_name']} ({u['username']})")
             item.setData(Qt.UserRole, u['username'])  # сохраняем username
             self.result_list.addItem(item)
@@ -94,6 +111,8 @@ class NewChatDialog(QDialog):
 
     # При подтверждении — отправляем запрос на создание чата и закрываем окно
     def on_ok(self):
-        peer = self.result_list.currentItem().data(Qt.UserRole)
-        self.net.send_start_chat(peer)
-        self.accept()
\ No newline at end of file
+        item = self.result_list.currentItem()
+        if item is None:
+            return
+        self.net.send_start_chat(item.data(Qt.UserRole))
+        self.accept()
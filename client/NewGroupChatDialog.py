@@ -16,7 +16,9 @@ from theme import DarkTheme as T
 
 
 # Диалог создания группового чата
-# Позволяет задать название, выбрать участников и отправить запрос серверу
+# Позволяет задать название, выбрать участников и отправить запрос серверу.
+# Окно создаётся один раз и переиспользуется (перед показом вызывается reset()).
+# Результаты поиска приходят только на последний запрос и только пока окно открыто
 class NewGroupChatDialog(QDialog):
     def __init__(self, net_worker, current_user: str, parent=None):
         super().__init__(parent)
@@ -24,6 +26,7 @@ class NewGroupChatDialog(QDialog):
         self.net = net_worker                   # сетевой обработчик
         self.current_user = current_user        # имя текущего пользователя
         self.selected_users: set[str] = set()   # выбранные участники (username'ы)
+        self._req_id = 0                        # номер последнего запроса поиска
 
         self.setWindowTitle("Создать групповой чат")
         self.resize(520, 420)
@@ -90,22 +93,38 @@ class NewGroupChatDialog(QDialog):
         self.chosen_list.itemDoubleClicked.connect(self._remove_selected)
         self.ok_btn.clicked.connect(self._on_ok)
 
-        self.net.user_search_result.connect(self._on_search_results)
+
+    # Подготовка к повторному показу: пустые название, участники и поиск
+    def reset(self):
+        self.name_input.clear()
+        self.search_input.clear()
+        self.result_list.clear()
+        self.chosen_list.clear()
+        self.selected_users.clear()
+        self._req_id = 0
+        self._update_ok_enabled()
 
 
     # Отправка запроса на поиск, если строка непустая
     def _on_search_text(self, text: str):
         query = text.strip()
-        if query:
-            self.net.send_user_search(query)   # отправляем запрос на сервер
-        else:
+        if not query:
+            self._req_id = 0
             self.result_list.clear()   # если поле пустое — очищаем список
+            return
+        try:
+            # Ответ придёт в _on_search_results, пока окно открыто
+            self._req_id = self.net.send_user_search(query, self, self._on_search_results)
+        except OSError:
+            pass  # соединение потеряно — об этом сообщит NetworkWorker
 
 
     # Обработка результатов поиска от сервера
-    def _on_search_results(self, users: list):
+    def _on_search_results(self, pkt: dict):
+        if pkt.get("req_id") != self._req_id:
+            return  # ответ на устаревший запрос
         self.result_list.clear()
-        for u in users:
+        for u in pkt.get("users") or []:
             if u["username"] == self.current_user:
                 continue    # исключаем самого себя из результатов
             item = QListWidgetItem(f"{u['display_name']} ({u['username']})")
@@ -0,0 +1,102 @@
+# bench_protocol.py — сравнение форматов протокола: байты в сети и время декодирования на клиенте
+#
+# Запуск: python bench_protocol.py [--chats 5000] [--history 500] [--repeat 20]
+# Строит синтетические пакеты (список чатов и страницу истории) и для каждого
+# формата (JSON-строки, кадры JSON, MessagePack, с deflate и без) выводит
+# размер на проводе и среднее время разбора кодеком клиента.
+
+# Импорт стандартных библиотек
+import argparse
+import time
+
+from protocol import CAP_DEFLATE, CAP_FRAME, CAP_MSGPACK, Codec, msgpack
+
+
+# Синтетический список чатов: как его формирует fetchUserChats на сервере
+def make_chatlist(n: int) -> list[dict]:
+    now = int(time.time())
+    chats = []
+    for i in range(n):
+        chats.append({
+            "chat_id": 100000 + i,
+            "peer": f"user{i:05d}" if i % 5 else str(100000 + i),
+            "display_name": f"Пользователь {i}" if i % 5 else f"Группа №{i}",
+            "last_msg": f"Последнее сообщение в чате {i}, немного текста для реалистичности",
+            "last_ts": now - i * 37,
+        })
+    return [{"type": "chatlist", "chats": chats}]
+
+
+# Синтетическая страница истории: каждое сообщение — отдельный пакет, как в handleHistoryRequest
+def make_history(n: int) -> list[dict]:
+    now = int(time.time())
+    return [{
+        "type": "message",
+        "from": "alice" if i % 2 else "bob",
+        "to": "42",
+        "content": f"Сообщение номер {i}: привет, как дела? Всё работает быстро?",
+        "display_name": "Алиса" if i % 2 else "Боб",
+        "timestamp": now - (n - i) * 11,
+    } for i in range(n)]
+
+
+# Варианты формата: название и список возможностей, согласованных при входе
+def variants() -> list[tuple[str, list[str] | None]]:
+    out = [
+        ("json-lines", None),
+        ("json-frame", [CAP_FRAME]),
+        ("json-frame+deflate", [CAP_FRAME, CAP_DEFLATE]),
+    ]
+    if msgpack is not None:
+        out += [
+            ("msgpack", [CAP_FRAME, CAP_MSGPACK]),
+            ("msgpack+deflate", [CAP_FRAME, CAP_MSGPACK, CAP_DEFLATE]),
+        ]
+    return out
+
+
+# Кодирует пакеты в заданном формате и замеряет разбор на стороне клиента
+def measure(packets: list[dict], caps: list[str] | None, repeat: int) -> tuple[int, float]:
+    enc = Codec()
+    if caps:
+        enc.apply(caps)
+    wire = b"".join(enc.encode(p) for p in packets)
+
+    best = float("inf")
+    for _ in range(repeat):
+        dec = Codec()
+        if caps:
+            dec.apply(caps)
+        t0 = time.perf_counter()
+        # Данные приходят из сокета кусками по 64 КБ — имитируем это
+        got = 0
+        for off in range(0, len(wire), 65536):
+            got += len(dec.feed(wire[off:off + 65536]))
+        best = min(best, time.perf_counter() - t0)
+        assert got == len(packets)
+    return len(wire), best
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Сравнение форматов протокола Shichat")
+    ap.add_argument("--chats", type=int, default=5000)
+    ap.add_argument("--history", type=int, default=500)
+    ap.add_argument("--repeat", type=int, default=20)
+    args = ap.parse_args()
+
+    if msgpack is None:
+        print("msgpack не установлен — варианты MessagePack пропущены (pip install msgpack)")
+
+    for title, packets in (
+        (f"chatlist, {args.chats} чатов", make_chatlist(args.chats)),
+        (f"history, {args.history} сообщений", make_history(args.history)),
+    ):
+        print(f"\n{title}")
+        print(f"{'формат':<22}{'байт':>12}{'декодирование, мс':>20}")
+        for name, caps in variants():
+            size, secs = measure(packets, caps, args.repeat)
+            print(f"{name:<22}{size:>12}{secs * 1000:>20.2f}")
+
+
+if __name__ == "__main__":
+    main()
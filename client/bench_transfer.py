@@ -0,0 +1,127 @@
+# bench_transfer.py — пропускная способность загрузки файла и задержка сообщений во время неё
+#
+# Запуск: python bench_transfer.py --user bench --password secret --to bench2 [--size 64] [--ping 0.05]
+# Нужен запущенный сервер и тестовые учётные записи: скрипт отправляет в чат с --to
+# служебные сообщения и один файл случайного содержимого.
+# Этапы:
+#   1. только сообщения — задержка «отправка → эхо от сервера» без нагрузки;
+#   2. загрузка файла --size МБ и те же сообщения параллельно — пропускная способность
+#      загрузки и задержка сообщений, которым приходится проходить между кусками файла.
+
+# Импорт стандартных библиотек
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+# Импорт компонентов Qt (цикл событий для сигналов NetworkWorker)
+from PyQt5.QtCore import QCoreApplication, QTimer
+
+from NetworkWorker import NetworkWorker
+from transfer import FileTransfers
+
+BASELINE_SECONDS = 3   # длительность первого этапа
+
+
+# Процентиль по отсортированному списку (в миллисекундах)
+def pct(values: list[float], p: float) -> float:
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] * 1000
+
+
+def report(title: str, rtts: list[float]):
+    print(f"{title}: сообщений {len(rtts)}, задержка p50 {pct(rtts, 0.5):.1f} мс, "
+          f"p95 {pct(rtts, 0.95):.1f} мс, max {pct(rtts, 1.0):.1f} мс")
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Замер передачи файлов Shichat")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8080)
+    ap.add_argument("--user", required=True)
+    ap.add_argument("--password", required=True)
+    ap.add_argument("--to", required=True, help="собеседник (логин) или ID группы")
+    ap.add_argument("--size", type=int, default=64, help="размер файла, МБ")
+    ap.add_argument("--ping", type=float, default=0.05, help="интервал между сообщениями, с")
+    args = ap.parse_args()
+
+    app = QCoreApplication(sys.argv)
+    net = NetworkWorker()
+    files = FileTransfers(net, tempfile.mkdtemp(prefix="shichat-bench-"))
+    net.files = files
+
+    # Файл случайного содержимого (не сжимается — как фото или архив)
+    src = tempfile.NamedTemporaryFile(prefix="bench-", suffix=".bin", delete=False)
+    for _ in range(args.size):
+        src.write(os.urandom(1024 * 1024))
+    src.close()
+
+    sent: dict[str, float] = {}          # текст сообщения → время отправки
+    rtts = {"baseline": [], "upload": []}
+    state = {"phase": "baseline", "seq": 0, "upload_start": 0.0}
+
+    # Служебное сообщение с уникальным текстом; задержка считается по его эху от сервера
+    def ping():
+        state["seq"] += 1
+        text = f"bench-ping {state['phase']} {state['seq']}"
+        sent[text] = time.perf_counter()
+        net.send({"type": "message", "from": args.user, "to": args.to, "content": text})
+
+    def on_message(pkt: dict):
+        t0 = sent.pop(pkt.get("content") or "", None)
+        if t0 is not None and pkt.get("from") == args.user:
+            rtts[pkt["content"].split()[1]].append(time.perf_counter() - t0)
+
+    def start_upload():
+        report("без загрузки", rtts["baseline"])
+        state["phase"] = "upload"
+        state["upload_start"] = time.perf_counter()
+        files.upload(src.name, args.to)
+
+    def on_done(file_id: int, name: str):
+        secs = time.perf_counter() - state["upload_start"]
+        timer.stop()
+        print(f"загрузка: {args.size} МБ за {secs:.2f} с — {args.size / secs:.1f} МБ/с")
+        report("во время загрузки", rtts["upload"])
+        app.quit()
+
+    def on_failed(file_id: int, name: str, error: str):
+        print("передача не удалась:", error)
+        app.exit(1)
+
+    def on_logged_in():
+        net.attach()
+        timer.start()
+        QTimer.singleShot(BASELINE_SECONDS * 1000, start_upload)
+
+    def on_error(text: str):
+        print("вход не удался:", text)
+        app.exit(1)
+
+    timer = QTimer()
+    timer.setInterval(int(args.ping * 1000))
+    timer.timeout.connect(ping)
+
+    net.logged_in.connect(on_logged_in)
+    net.login_failed.connect(on_error)
+    net.connect_failed.connect(on_error)
+    net.connection_lost.connect(lambda: on_error("соединение потеряно"))
+    net.message_received.connect(on_message)
+    files.upload_done.connect(on_done)
+    files.failed.connect(on_failed)
+
+    net.login(args.host, args.port, args.user, args.password)
+    code = app.exec_()
+
+    files.stop()
+    net.stop()
+    os.unlink(src.name)
+    sys.exit(code)
+
+
+if __name__ == "__main__":
+    main()
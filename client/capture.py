@@ -0,0 +1,131 @@
+# capture.py — запись сетевого трафика клиента для последующего воспроизведения (replay.py)
+#
+# Включается переменной окружения SHICHAT_CAPTURE=<путь к файлу>.
+# NetworkWorker записывает байты каждого соединения ровно так, как они прошли через сокет
+# (входящие — кусками, как их вернул recv), с монотонной меткой времени. Поэтому запись
+# воспроизводит и декодирование (кадры, MessagePack, deflate), и темп прихода пакетов.
+#
+# Формат файла: заголовок MAGIC, затем записи
+#   [1 байт — вид][8 байт — наносекунды от начала записи][4 байта — длина][данные]
+# (числа big-endian). Виды записей: REC_IN — входящие байты, REC_OUT — исходящие,
+# REC_CONNECT — новое соединение (кодек снова начинает с JSON-строк), данных у неё нет.
+#
+# Пароль и токен сессии в запись не попадают (заменяются на "***"), но сообщения,
+# имена и вложения записываются как есть — файл записи нужно хранить как личные данные.
+
+# Импорт стандартных библиотек
+import atexit
+import json
+import os
+import struct
+import threading
+import time
+
+# Переменная окружения с путём к файлу записи
+CAPTURE_ENV = "SHICHAT_CAPTURE"
+
+MAGIC = b"SHICAP1\n"
+REC_IN = 0
+REC_OUT = 1
+REC_CONNECT = 2
+
+_RECORD = struct.Struct(">BQI")   # вид, время (нс от начала), длина данных
+_SECRET_FIELDS = ("password", "token")
+_REDACTED = "***"
+
+
+# Копия пакета без секретов (пароля и токена сессии)
+def redact(pkt: dict) -> dict:
+    return {k: (_REDACTED if k in _SECRET_FIELDS and v else v) for k, v in pkt.items()}
+
+
+# Класс TrafficRecorder — запись байтов соединений в файл.
+# Вызывается из сетевого потока и из потока интерфейса (отправка), поэтому пишет под блокировкой.
+class TrafficRecorder:
+    def __init__(self, path: str | None = None):
+        self.path = path
+        self.enabled = bool(path)  # запись включена, только если задан файл
+        self._f = None
+        self._t0 = 0
+        self._lock = threading.Lock()
+
+
+    # Новое соединение (первое или после переподключения)
+    def connected(self):
+        self._write(REC_CONNECT, b"")
+
+
+    # Входящие байты из recv
+    def received(self, data: bytes):
+        self._write(REC_IN, data)
+
+
+    # Исходящие байты, переданные в sendall
+    def sent(self, data: bytes):
+        self._write(REC_OUT, data)
+
+
+    # Пакет signin: записывается без пароля и токена (до входа протокол всегда текстовый)
+    def signin(self, pkt: dict):
+        if self.enabled:
+            self._write(REC_OUT, (json.dumps(redact(pkt)) + "\n").encode())
+
+
+    # Байты, в которых пришёл ответ на signin. Ответ — всегда первая JSON-строка соединения;
+    # он записывается без токена сессии, всё, что пришло после него, — как есть
+    def login_response(self, data: bytes):
+        if not self.enabled:
+            return
+        pos = data.find(b"\n")
+        if pos >= 0:
+            try:
+                resp = json.loads(data[:pos])
+            except ValueError:
+                pass
+            else:
+                data = json.dumps(redact(resp)).encode() + data[pos:]
+        self._write(REC_IN, data)
+
+
+    # Дописывает одну запись (файл открывается при первой записи)
+    def _write(self, kind: int, data: bytes):
+        if not self.enabled:
+            return
+        with self._lock:
+            if self._f is None:
+                self._f = open(self.path, "wb")
+                self._f.write(MAGIC)
+                self._t0 = time.monotonic_ns()
+                atexit.register(self.close)
+            self._f.write(_RECORD.pack(kind, time.monotonic_ns() - self._t0, len(data)))
+            self._f.write(data)
+
+
+    # Сбрасывает буфер и закрывает файл записи
+    def close(self):
+        with self._lock:
+            if self._f is not None:
+                self._f.close()
+                self._f = None
+            self.enabled = False
+
+
+# Читает файл записи: возвращает записи (вид, наносекунды от начала, данные) по порядку.
+# Оборванная последняя запись (клиент завершился аварийно) пропускается
+def read_capture(path: str):
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path}: это не файл записи трафика")
+        while True:
+            head = f.read(_RECORD.size)
+            if len(head) < _RECORD.size:
+                return
+            kind, t, n = _RECORD.unpack(head)
+            data = f.read(n)
+            if len(data) < n:
+                return
+            yield kind, t, data
+
+
+# Общий записывающий объект процесса
+recorder = TrafficRecorder(os.environ.get(CAPTURE_ENV))
@@ -0,0 +1,138 @@
+# chatcache.py — кэш последних сообщений по каждому чату и счётчики непрочитанных
+#
+# Каждый входящий пакет "message" попадает в кольцевой буфер своего чата
+# (старые сообщения вытесняются). Если хвост истории чата уже был загружен
+# с сервера, дальше он поддерживается живыми сообщениями, и чат можно
+# открыть прямо из памяти, без повторного запроса истории.
+
+# Импорт стандартных библиотек
+from bisect import bisect_right
+from collections import deque
+
+# Сколько последних сообщений хранить на каждый чат
+DEFAULT_LIMIT = 200
+
+
+# Ключ сообщения для устранения дубликатов (эхо, повтор в истории и т.п.)
+def message_key(pkt: dict) -> tuple:
+    return (pkt.get("from"), pkt.get("to"), pkt.get("timestamp"), pkt.get("content"))
+
+
+# Кольцевой буфер сообщений одного чата.
+# Сообщения упорядочены по времени; дубликаты отбрасываются.
+class _ChatRing:
+    def __init__(self, limit: int):
+        self.msgs: deque[dict] = deque(maxlen=limit)  # сами пакеты, от старых к новым
+        self.keys: set[tuple] = set()                 # ключи сообщений, лежащих в буфере
+        self.complete = False                         # хвост истории загружен с сервера
+        self.trimmed = False                          # последнее добавление вытеснило самое старое сообщение
+
+
+    # Добавляет пакет и возвращает его позицию в буфере (или None для дубликата)
+    def add(self, pkt: dict) -> int | None:
+        key = message_key(pkt)
+        self.trimmed = False
+        if key in self.keys:
+            return None
+
+        # Если буфер полон, самое старое сообщение будет вытеснено — забываем его ключ
+        if len(self.msgs) == self.msgs.maxlen:
+            self.trimmed = True
+            self.keys.discard(message_key(self.msgs[0]))
+        self.keys.add(key)
+
+        ts = pkt.get("timestamp") or 0
+        if not self.msgs or (self.msgs[-1].get("timestamp") or 0) <= ts:
+            self.msgs.append(pkt)  # обычный случай — сообщение новее всех
+            return len(self.msgs) - 1
+
+        # Пришло не по порядку (например, живое сообщение обогнало ответ на запрос истории).
+        # В полный deque вставить нельзя — сначала вытесняем самое старое (его ключ уже забыт)
+        if len(self.msgs) == self.msgs.maxlen:
+            self.msgs.popleft()
+        stamps = [m.get("timestamp") or 0 for m in self.msgs]
+        pos = bisect_right(stamps, ts)
+        self.msgs.insert(pos, pkt)
+        return pos
+
+
+# Класс ChatCache — буферы сообщений и счётчики непрочитанных для всех чатов пользователя
+class ChatCache:
+    def __init__(self, limit: int = DEFAULT_LIMIT):
+        self.limit = limit
+        self._rings: dict[str, _ChatRing] = {}  # peer (логин собеседника или ID группы) → буфер
+        self._unread: dict[str, int] = {}       # peer → количество непрочитанных
+
+
+    # Возвращает (или создаёт) буфер чата
+    def _ring(self, peer: str) -> _ChatRing:
+        ring = self._rings.get(peer)
+        if ring is None:
+            ring = self._rings[peer] = _ChatRing(self.limit)
+        return ring
+
+
+    # Добавляет сообщение в буфер чата.
+    # Возвращает позицию в буфере или None, если такое сообщение уже есть.
+    def add(self, peer: str, pkt: dict) -> int | None:
+        return self._ring(peer).add(pkt)
+
+
+    # Сообщения чата из буфера (от старых к новым)
+    def messages(self, peer: str) -> list[dict]:
+        ring = self._rings.get(peer)
+        return list(ring.msgs) if ring else []
+
+
+    # Самое старое сообщение в буфере чата (None, если буфер пуст)
+    def oldest(self, peer: str) -> dict | None:
+        ring = self._rings.get(peer)
+        return ring.msgs[0] if ring and ring.msgs else None
+
+
+    # True, если последнее добавленное в буфер чата сообщение вытеснило самое старое
+    def trimmed(self, peer: str) -> bool:
+        ring = self._rings.get(peer)
+        return bool(ring and ring.trimmed)
+
+
+    # True, если хвост истории чата уже загружен и его можно показать без запроса к серверу
+    def is_complete(self, peer: str) -> bool:
+        ring = self._rings.get(peer)
+        return bool(ring and ring.complete)
+
+
+    # Сбрасывает буфер перед загрузкой истории; всё, что придёт дальше, считается полным хвостом
+    def begin_history(self, peer: str):
+        ring = self._rings[peer] = _ChatRing(self.limit)
+        ring.complete = True
+
+
+    # Загрузка истории не состоялась (сервер отклонил запрос) — хвост снова считается неполным
+    def abort_history(self, peer: str):
+        ring = self._rings.get(peer)
+        if ring is not None:
+            ring.complete = False
+
+
+    # Соединение восстановлено: пока его не было, сообщения могли прийти мимо буферов,
+    # поэтому ни один хвост больше не считается полным (сообщения остаются до новой загрузки истории)
+    def invalidate(self):
+        for ring in self._rings.values():
+            ring.complete = False
+
+
+    # Увеличивает счётчик непрочитанных и возвращает новое значение
+    def bump_unread(self, peer: str) -> int:
+        self._unread[peer] = self._unread.get(peer, 0) + 1
+        return self._unread[peer]
+
+
+    # Сбрасывает счётчик непрочитанных (чат открыт)
+    def clear_unread(self, peer: str):
+        self._unread.pop(peer, None)
+
+
+    # Количество непрочитанных сообщений в чате
+    def unread(self, peer: str) -> int:
+        return self._unread.get(peer, 0)
@@ -0,0 +1,90 @@
+# chatfilter.py — индекс для мгновенного фильтра списка чатов
+#
+# Строка чата (название и peer) раскладывается на триграммы: для каждой тройки
+# символов хранится множество чатов, где она встречается. Запрос из трёх и более
+# символов находит кандидатов пересечением множеств своих триграмм (от самого
+# маленького), затем каждый кандидат проверяется поиском подстроки. Короткий
+# запрос (1–2 символа) проверяется подстрокой по всем чатам — это тоже быстро.
+# Индекс обновляется по одному чату (списки чатов и chat_delta), а не строится
+# заново на каждое нажатие клавиши.
+
+# Длина n-граммы индекса
+GRAM = 3
+
+
+# Нормализованная строка для поиска: без учёта регистра, ё = е
+def _norm(text: str) -> str:
+    return text.casefold().replace("ё", "е")
+
+
+# Множество триграмм строки
+def _grams(text: str) -> set[str]:
+    return {text[i:i + GRAM] for i in range(len(text) - GRAM + 1)}
+
+
+# Класс ChatFilterIndex — подстрочный поиск по названиям чатов и peer
+class ChatFilterIndex:
+    def __init__(self):
+        self._names: dict[str, str] = {}        # peer → название, с которым чат проиндексирован
+        self._text: dict[str, str] = {}         # peer → нормализованная строка чата
+        self._grams: dict[str, set[str]] = {}   # триграмма → peer'ы чатов, где она есть
+
+
+    # Добавляет чат или обновляет его название (если строка не изменилась — ничего не делает)
+    def put(self, peer: str, display_name: str):
+        if self._names.get(peer) == display_name:
+            return  # обычный случай при обновлении списка чатов
+        self._names[peer] = display_name
+        text = _norm(f"{display_name}\n{peer}")  # перевод строки не даёт совпасть «через границу»
+        old = self._text.get(peer)
+        if old is not None:
+            self._unindex(peer, old)
+        self._text[peer] = text
+        for g in _grams(text):
+            self._grams.setdefault(g, set()).add(peer)
+
+
+    # Убирает чат из индекса
+    def remove(self, peer: str):
+        self._names.pop(peer, None)
+        old = self._text.pop(peer, None)
+        if old is not None:
+            self._unindex(peer, old)
+
+
+    # Убирает peer из множеств триграмм строки text
+    def _unindex(self, peer: str, text: str):
+        for g in _grams(text):
+            peers = self._grams.get(g)
+            if peers is not None:
+                peers.discard(peer)
+                if not peers:
+                    del self._grams[g]
+
+
+    # Чаты, название или peer которых содержит запрос. None — запрос пуст (подходят все)
+    def match(self, query: str) -> set[str] | None:
+        q = _norm(query.strip())
+        if not q:
+            return None
+        if len(q) < GRAM:
+            return {p for p, t in self._text.items() if q in t}
+
+        postings = []
+        for g in _grams(q):
+            peers = self._grams.get(g)
+            if not peers:
+                return set()  # такой триграммы нет ни в одном чате
+            postings.append(peers)
+        postings.sort(key=len)
+        found = set(postings[0])
+        for peers in postings[1:]:
+            found &= peers
+            if not found:
+                return found
+        # Все триграммы есть в строке — но не обязательно подряд
+        return {p for p in found if q in self._text[p]}
+
+
+    def __len__(self) -> int:
+        return len(self._text)
@@ -0,0 +1,109 @@
+# cluster_check.py — проверка работы нескольких узлов сервера на одной машине
+#
+# Запуск узлов (общая БД, разные адреса и имена):
+#   CLUSTER=postgres NODE_ID=n1 LISTEN_ADDR=:8081 METRICS_ADDR=127.0.0.1:9091 go run .
+#   CLUSTER=postgres NODE_ID=n2 LISTEN_ADDR=:8082 METRICS_ADDR=127.0.0.1:9092 go run .
+# Проверка:
+#   python cluster_check.py --nodes 127.0.0.1:8081,127.0.0.1:8082 --alice alice:pw --bob bob:pw
+# Сценарий:
+#   1. alice входит на первый узел, bob — на второй; alice пишет bob —
+#      сообщение и обновлённый список чатов должны дойти через шину узлов;
+#   2. bob входит ещё раз на первый узел — прежнее соединение bob на втором узле
+#      должно быть закрыто (один вход на весь кластер).
+
+# Импорт стандартных библиотек
+import argparse
+import socket
+import sys
+import time
+
+from protocol import Codec, client_caps
+
+TIMEOUT = 5  # сколько ждать каждого события (секунды)
+
+
+# Простой синхронный клиент: вход и чтение пакетов с таймаутом
+class Client:
+    def __init__(self, addr: str, user: str, password: str):
+        host, port = addr.rsplit(":", 1)
+        self.user = user
+        self.codec = Codec()
+        self.sock = socket.create_connection((host, int(port)), timeout=TIMEOUT)
+        self.pending: list[dict] = []
+        self.send({"type": "signin", "from": user, "password": password, "caps": client_caps()})
+        resp = self.wait(lambda p: p.get("type") in ("login_ok", "error"))
+        if resp is None or resp["type"] != "login_ok":
+            raise SystemExit(f"{user}@{addr}: вход не удался: {resp}")
+
+    def send(self, pkt: dict):
+        self.sock.sendall(self.codec.encode(pkt))
+
+    # Ждёт пакет, подходящий под условие. None — таймаут; "closed" — сервер закрыл соединение
+    def wait(self, match, timeout: float = TIMEOUT):
+        deadline = time.monotonic() + timeout
+        while True:
+            for i, p in enumerate(self.pending):
+                if match(p):
+                    return self.pending.pop(i)
+            left = deadline - time.monotonic()
+            if left <= 0:
+                return None
+            self.sock.settimeout(left)
+            try:
+                data = self.sock.recv(65536)
+            except socket.timeout:
+                return None
+            except OSError:
+                return "closed"
+            if not data:
+                return "closed"
+            self.pending += self.codec.feed(data)
+
+    def close(self):
+        self.sock.close()
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Проверка нескольких узлов сервера Shichat")
+    ap.add_argument("--nodes", required=True, help="адреса двух узлов: host:port,host:port")
+    ap.add_argument("--alice", required=True, help="логин:пароль первого пользователя")
+    ap.add_argument("--bob", required=True, help="логин:пароль второго пользователя")
+    args = ap.parse_args()
+
+    n1, n2 = args.nodes.split(",")
+    alice_user, alice_pw = args.alice.split(":", 1)
+    bob_user, bob_pw = args.bob.split(":", 1)
+    failed = False
+
+    # 1. Сообщение между узлами
+    alice = Client(n1, alice_user, alice_pw)
+    bob = Client(n2, bob_user, bob_pw)
+    text = f"cluster-check {time.time_ns()}"
+    t0 = time.perf_counter()
+    alice.send({"type": "message", "from": alice_user, "to": bob_user, "content": text})
+    got = bob.wait(lambda p: p.get("type") == "message" and p.get("content") == text)
+    if isinstance(got, dict):
+        print(f"сообщение {n1} → {n2}: доставлено за {(time.perf_counter() - t0) * 1000:.1f} мс")
+    else:
+        print(f"сообщение {n1} → {n2}: НЕ доставлено")
+        failed = True
+    chatlist = bob.wait(lambda p: p.get("type") == "chatlist")
+    print("список чатов получателя:", "обновлён" if isinstance(chatlist, dict) else "НЕ обновлён")
+    failed |= not isinstance(chatlist, dict)
+
+    # 2. Повторный вход на другом узле вытесняет прежний
+    bob2 = Client(n1, bob_user, bob_pw)
+    closed = bob.wait(lambda p: False)
+    if closed == "closed":
+        print(f"повторный вход {bob_user} на {n1}: прежнее соединение на {n2} закрыто")
+    else:
+        print(f"повторный вход {bob_user} на {n1}: прежнее соединение на {n2} НЕ закрыто")
+        failed = True
+
+    for c in (alice, bob, bob2):
+        c.close()
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
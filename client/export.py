@@ -0,0 +1,244 @@
+# export.py — выгрузка всей истории чата в файл (JSON Lines или HTML)
+#
+# chat_export → chat_export_accept (всего сообщений, окно) → chat_export_chunk … ← chat_export_ack → chat_export_end
+#
+# Сервер читает историю курсором БД и присылает её порциями от старых сообщений к новым.
+# Поток чтения NetworkWorker только кладёт порции в очередь выгрузки, а пишет файл отдельный поток —
+# цепочкой генераторов: порции → сообщения → строки файла. Порция подтверждается серверу, когда
+# её строки записаны, и сервер не опережает подтверждения больше чем на окно, поэтому в очереди
+# не бывает больше нескольких порций: память не растёт с длиной истории.
+# Файл пишется рядом с итоговым (.part) и переименовывается, только когда выгрузка закончена.
+
+# Импорт стандартных библиотек
+import json
+import os
+import queue
+import threading
+from datetime import datetime
+from html import escape
+
+# Импорт компонентов Qt для сигналов
+from PyQt5.QtCore import QObject, pyqtSignal
+
+from Bubble import Bubble
+from theme import DarkTheme as T
+
+FORMAT_JSONL = "jsonl"
+FORMAT_HTML = "html"
+CHUNK_TIMEOUT = 60        # ожидание следующей порции от сервера (секунды)
+
+# Конец выгрузки в очереди порций: текст ошибки или None — выгрузка закончена
+_END = object()
+
+
+# Выгрузка одного чата
+class _Export:
+    def __init__(self, peer: str, path: str, fmt: str, title: str):
+        self.peer = peer
+        self.path = path                 # итоговый файл
+        self.part = path + ".part"       # файл, который дописывается по мере приёма
+        self.fmt = fmt
+        self.title = title               # название чата (заголовок HTML)
+        self.total = 0                   # всего сообщений (из chat_export_accept)
+        self.written = 0                 # сколько сообщений записано в файл
+        self.chunks: queue.Queue = queue.Queue()  # порции от потока чтения; размер ограничен окном сервера
+        self.cancelled = False
+
+
+# Ошибка выгрузки (текст — для пользователя)
+class ExportError(Exception):
+    pass
+
+
+# Строки JSON Lines: одно сообщение — одна строка в том виде, в каком его прислал сервер
+def jsonl_lines(messages):
+    for m in messages:
+        yield json.dumps(m, ensure_ascii=False) + "\n"
+
+
+# Строки HTML-страницы: сообщения оформлены теми же пузырями, что и в окне чата,
+# с разделителями по дням (в пузыре только время)
+def html_lines(messages, title: str, username: str, group: bool):
+    yield (
+        '<!DOCTYPE html>\n<html><head><meta charset="utf-8">'
+        f'<title>{escape(title)}</title></head>\n'
+        f'<body style="background:{T.PANEL}; color:{T.TEXT_MAIN}; font-family:sans-serif;">\n'
+        f'<h2>{escape(title)}</h2>\n'
+    )
+    day = None
+    for m in messages:
+        ts = m.get("timestamp") or 0
+        d = datetime.fromtimestamp(ts).strftime("%d.%m.%Y")
+        if d != day:
+            day = d
+            yield f'<div style="text-align:center; color:{T.TEXT_SUB}; font-size:12px; margin:12px 0;">{d}</div>\n'
+
+        frm = m.get("from") or ""
+        outgoing = frm == username
+        # В групповом чате — имя отправителя над сообщением, как в окне чата
+        if group and not outgoing:
+            yield (
+                f'<div style="font-size:12px; margin:0 8px 2px 8px;">'
+                f'{escape(m.get("display_name") or frm)}&nbsp;({escape(frm)})</div>\n'
+            )
+        file = m.get("file")
+        if file:
+            # Ссылки attachment: работают только в окне чата, поэтому вложение — просто подпись
+            content = f'📎 {escape(file.get("name") or "файл")} ({Bubble.file_size(file.get("size") or 0)})'
+        else:
+            content = escape(m.get("content") or "")
+        yield Bubble.html(content, outgoing, ts) + "\n"
+    yield "</body></html>\n"
+
+
+# Класс ChatExports — выгрузки истории чатов одного пользователя (не больше одной на чат).
+# Пакеты chat_export_* NetworkWorker передаёт в on_packet прямо из потока чтения.
+class ChatExports(QObject):
+    progress = pyqtSignal(str, int, int)  # peer, записано сообщений, всего
+    done = pyqtSignal(str, str, int)      # peer, путь к файлу, сообщений
+    failed = pyqtSignal(str, str)         # peer, текст ошибки
+
+
+    def __init__(self, net, username: str):
+        super().__init__()
+        self.net = net
+        self.username = username
+        self._lock = threading.Lock()
+        self._exports: dict[str, _Export] = {}  # peer → идущая выгрузка
+
+
+    # Начинает выгрузку чата peer в файл path (формат fmt — FORMAT_JSONL или FORMAT_HTML)
+    def start(self, peer: str, path: str, fmt: str, title: str):
+        x = _Export(peer, path, fmt, title)
+        with self._lock:
+            if peer in self._exports:
+                return  # этот чат уже выгружается
+            self._exports[peer] = x
+        threading.Thread(target=self._write, args=(x,), daemon=True).start()
+        self._send(x, {"type": "chat_export", "to": peer})
+
+
+    # Отменяет выгрузку чата (недописанный файл удаляется)
+    def cancel(self, peer: str):
+        with self._lock:
+            x = self._exports.get(peer)
+        if x is None:
+            return
+        x.cancelled = True
+        x.chunks.put((_END, "Выгрузка отменена"))
+        try:
+            self.net.send({"type": "chat_export_cancel", "to": peer})
+        except OSError:
+            pass  # соединения нет — сервер и так прекратил выгрузку
+
+
+    # Выгружается ли сейчас чат peer
+    def busy(self, peer: str) -> bool:
+        with self._lock:
+            return peer in self._exports
+
+
+    # Соединение оборвалось: сервер прекратил выгрузки, продолжения не будет
+    def on_disconnect(self):
+        with self._lock:
+            exports = list(self._exports.values())
+        for x in exports:
+            x.chunks.put((_END, "Соединение с сервером потеряно"))
+
+
+    # Закрытие окна: выгрузки прерываются
+    def stop(self):
+        with self._lock:
+            exports = list(self._exports.values())
+        for x in exports:
+            x.cancelled = True
+            x.chunks.put((_END, "Выгрузка отменена"))
+
+
+    # Обработка пакетов выгрузки (вызывается из потока чтения NetworkWorker)
+    def on_packet(self, pkt: dict):
+        with self._lock:
+            x = self._exports.get(pkt.get("to") or "")
+        if x is None:
+            return  # относится к уже завершённой или отменённой выгрузке
+        ptype = pkt.get("type")
+        if ptype == "chat_export_accept":
+            x.total = pkt.get("size") or 0
+            self.progress.emit(x.peer, 0, x.total)
+        elif ptype == "chat_export_chunk":
+            x.chunks.put(pkt.get("messages") or [])
+        elif ptype == "chat_export_end":
+            x.chunks.put((_END, pkt.get("content") or None))
+        elif ptype == "error" and pkt.get("retry_after"):
+            # Сервер занят другими выгрузками — повторяем запрос позже
+            t = threading.Timer(pkt["retry_after"] / 1000, self._send, args=(x, {"type": "chat_export", "to": x.peer}))
+            t.daemon = True
+            t.start()
+
+
+    # Отправляет пакет выгрузки; если соединения нет — выгрузка завершается ошибкой
+    def _send(self, x: _Export, pkt: dict):
+        with self._lock:
+            if self._exports.get(x.peer) is not x:
+                return  # выгрузка уже закончена или отменена
+        try:
+            self.net.send(pkt)
+        except OSError as e:
+            x.chunks.put((_END, str(e)))
+
+
+    # Порции выгрузки по мере прихода. Когда генератор просят о следующей порции, предыдущая
+    # уже записана — она подтверждается серверу, и тот может прислать следующую
+    def _frames(self, x: _Export):
+        while True:
+            try:
+                frame = x.chunks.get(timeout=CHUNK_TIMEOUT)
+            except queue.Empty:
+                raise ExportError("Сервер не отвечает") from None
+            if isinstance(frame, tuple):
+                if frame[1]:
+                    raise ExportError(frame[1])
+                return
+            yield frame
+            if x.cancelled:
+                raise ExportError("Выгрузка отменена")
+            x.written += len(frame)
+            self._send(x, {"type": "chat_export_ack", "to": x.peer, "offset": x.written})
+            self.progress.emit(x.peer, x.written, max(x.total, x.written))
+
+
+    # Сообщения выгрузки по одному, от старых к новым
+    def _messages(self, x: _Export):
+        for frame in self._frames(x):
+            yield from frame
+
+
+    # Поток записи: строки нужного формата из сообщений выгрузки дописываются в файл
+    def _write(self, x: _Export):
+        messages = self._messages(x)
+        if x.fmt == FORMAT_HTML:
+            lines = html_lines(messages, x.title, self.username, x.peer.isdigit())
+        else:
+            lines = jsonl_lines(messages)
+        try:
+            with open(x.part, "w", encoding="utf-8") as f:
+                f.writelines(lines)
+            os.replace(x.part, x.path)
+        except (ExportError, OSError) as e:
+            with self._lock:
+                self._exports.pop(x.peer, None)
+            # Сервер мог ещё не закончить выгрузку (например, не записался файл) — она больше не нужна
+            try:
+                self.net.send({"type": "chat_export_cancel", "to": x.peer})
+            except OSError:
+                pass  # соединения нет — сервер и так прекратил выгрузку
+            try:
+                os.remove(x.part)
+            except OSError:
+                pass
+            if not x.cancelled:
+                self.failed.emit(x.peer, str(e))
+            return
+        with self._lock:
+            self._exports.pop(x.peer, None)
+        self.done.emit(x.peer, x.path, x.written)
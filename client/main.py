@@ -1,10 +1,15 @@
 # Импорт стандартных библиотек
 import sys
 
+# Первая отметка времени запуска — до импорта Qt
+import startup
+startup.mark("process_start")
+
 # Импорт основных классов из PyQt5 для запуска GUI-приложения
 from PyQt5.QtWidgets import QApplication
 
-# Импорт окна входа в систему
+# Импорт окна входа в систему.
+# Модуль окна входа лёгкий: окно чата, диалоги и сеть загружаются позже (см. LoginWindow.warm_up)
 from LoginWindow import LoginWindow
 
 
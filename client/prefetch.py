@@ -0,0 +1,93 @@
+# prefetch.py — фоновая предзагрузка истории самых свежих чатов после входа
+#
+# После первого списка чатов запрашивает историю N самых свежих чатов,
+# не больше нескольких запросов одновременно. Ответы попадают в ChatCache,
+# поэтому первый клик по такому чату отрисовывается из памяти.
+# Предзагрузка уступает интерактивным запросам: пока пользователь ждёт
+# историю открытого чата, новые фоновые запросы не отправляются.
+
+# Сколько самых свежих чатов предзагружать
+PREFETCH_CHATS = 10
+# Сколько фоновых запросов истории может выполняться одновременно
+PREFETCH_CONCURRENCY = 2
+
+
+# Класс HistoryPrefetcher — очередь фоновых запросов истории
+class HistoryPrefetcher:
+    def __init__(self, send, cache, username: str, limit: int = PREFETCH_CHATS, concurrency: int = PREFETCH_CONCURRENCY):
+        self.send = send                # функция отправки пакета серверу
+        self.cache = cache              # ChatCache, куда складываются сообщения
+        self.username = username        # текущий пользователь (поле "from" запроса истории)
+        self.limit = limit
+        self.concurrency = concurrency
+        self.started = False            # предзагрузка запускается один раз — по первому списку чатов
+        self._queue: list[str] = []     # чаты, ожидающие предзагрузки (по убыванию свежести)
+        self._inflight: set[str] = set()     # фоновые запросы в работе
+        self._interactive: set[str] = set()  # запросы, которых ждёт пользователь
+
+
+    # Запускает предзагрузку по первому списку чатов (сервер присылает его отсортированным по свежести)
+    def start(self, chats: list[dict]):
+        if self.started:
+            return
+        self.started = True
+        for c in chats:
+            if len(self._queue) >= self.limit:
+                break
+            if not c.get("last_ts"):
+                continue  # в пустом чате нечего предзагружать
+            self._queue.append(c["peer"])
+        self._pump()
+
+
+    # Соединение восстановлено: незавершённые запросы пропали вместе со старым соединением.
+    # Предзагрузка запустится заново по первому списку чатов нового соединения
+    def reset(self):
+        self.started = False
+        self._queue.clear()
+        self._inflight.clear()
+        self._interactive.clear()
+
+
+    # Пользователь сам открыл чат и запросил историю — фоновые запросы ждут, пока она не придёт
+    def interactive(self, peer: str):
+        if peer in self._queue:
+            self._queue.remove(peer)
+        self._interactive.add(peer)
+
+
+    # Сервер закончил передавать историю чата — освобождаем место и отправляем следующий запрос
+    def on_history_end(self, peer: str):
+        self._interactive.discard(peer)
+        self._inflight.discard(peer)
+        self._pump()
+
+
+    # Сервер отклонил запрос истории (лимит запросов). Если он фоновый — чат возвращается
+    # в начало очереди, а очередь ждёт resume(). Возвращает, был ли запрос фоновым
+    def on_rejected(self, peer: str) -> bool:
+        if peer not in self._inflight:
+            return False
+        self._inflight.discard(peer)
+        self._queue.insert(0, peer)
+        return True
+
+
+    # Продолжает отправку фоновых запросов (после паузы, которую попросил сервер)
+    def resume(self):
+        self._pump()
+
+
+    # Отправляет фоновые запросы, пока есть свободные места и нет интерактивных запросов
+    def _pump(self):
+        while self._queue and not self._interactive and len(self._inflight) < self.concurrency:
+            peer = self._queue.pop(0)
+            if self.cache.is_complete(peer):
+                continue  # история уже в памяти (чат открывали или он уже предзагружен)
+            self.cache.begin_history(peer)
+            self._inflight.add(peer)
+            try:
+                self.send({"type": "history", "from": self.username, "to": peer})
+            except OSError:
+                self._queue.clear()  # соединение потеряно — об этом сообщит NetworkWorker
+                return
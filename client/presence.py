@@ -0,0 +1,96 @@
+# presence.py — присутствие собеседников и индикатор набора текста
+#
+# Сервер присылает пакеты "presence": после входа — снимок (full: кого в нём нет, тот не в сети),
+# дальше — только изменения, собранные за короткое окно. PresenceState хранит, кто в сети
+# и кто где печатает, и на каждый пакет возвращает peer'ы чатов, строки которых изменились, —
+# окно обновляет только их, а не перерисовывает список чатов.
+#
+# События «перестал печатать» нет: индикатор держится TYPING_TTL секунд после последнего
+# пакета и снимается раньше, если от этого пользователя пришло сообщение или он вышел.
+
+# Импорт стандартных библиотек
+import time
+
+# Сколько секунд показывать «печатает…» после последнего пакета
+TYPING_TTL = 6
+# Не чаще скольких секунд отправлять свой пакет typing в один чат (меньше TYPING_TTL,
+# чтобы у собеседника индикатор не мигал, пока пользователь продолжает печатать)
+TYPING_INTERVAL = 3
+
+
+# Класс PresenceState — кто из собеседников в сети и кто где печатает
+class PresenceState:
+    def __init__(self):
+        self.online: set[str] = set()                   # логины собеседников в сети
+        self._typing: dict[str, dict[str, float]] = {}  # peer чата → {логин: когда индикатор истекает}
+
+
+    # Применяет пакет "presence" и возвращает peer'ы изменившихся чатов.
+    # Приватный чат — это peer, равный логину собеседника, поэтому логин тоже попадает в результат
+    def apply(self, pkt: dict, now: float | None = None) -> set[str]:
+        now = time.monotonic() if now is None else now
+        changed = set()
+        if pkt.get("full"):
+            changed |= self.clear()
+        for ch in pkt.get("presence") or []:
+            user = ch.get("user") or ""
+            if ch.get("online"):
+                if user not in self.online:
+                    self.online.add(user)
+                    changed.add(user)
+            elif user in self.online:
+                self.online.discard(user)
+                changed.add(user)
+                changed |= self._drop_typist(user)  # вышел — больше не печатает
+            chat = ch.get("typing")
+            if chat:
+                self._typing.setdefault(chat, {})[user] = now + TYPING_TTL
+                changed.add(chat)
+        return changed
+
+
+    # От пользователя пришло сообщение в чат peer — он больше не печатает. True — индикатор снят
+    def stopped(self, peer: str, user: str) -> bool:
+        typists = self._typing.get(peer)
+        if not typists or typists.pop(user, None) is None:
+            return False
+        if not typists:
+            del self._typing[peer]
+        return True
+
+
+    # Снимает истёкшие индикаторы и возвращает peer'ы, где они были
+    def expire(self, now: float | None = None) -> set[str]:
+        now = time.monotonic() if now is None else now
+        changed = set()
+        for peer in list(self._typing):
+            typists = self._typing[peer]
+            for user in [u for u, t in typists.items() if t <= now]:
+                del typists[user]
+                changed.add(peer)
+            if not typists:
+                del self._typing[peer]
+        return changed
+
+
+    # Кто печатает в чате peer (логины по порядку)
+    def typing(self, peer: str) -> list[str]:
+        return sorted(self._typing.get(peer, ()))
+
+
+    # Есть ли индикаторы, которые нужно снимать по времени
+    def has_typing(self) -> bool:
+        return bool(self._typing)
+
+
+    # Забывает всё (перед снимком или после обрыва соединения); возвращает затронутые peer'ы
+    def clear(self) -> set[str]:
+        changed = self.online | set(self._typing)
+        self.online = set()
+        self._typing.clear()
+        return changed
+
+
+    # Убирает пользователя из всех индикаторов набора
+    def _drop_typist(self, user: str) -> set[str]:
+        return {peer for peer in list(self._typing) if self.stopped(peer, user)}
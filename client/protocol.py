@@ -0,0 +1,146 @@
+# protocol.py — кодирование и декодирование пакетов протокола Shichat
+#
+# По умолчанию каждый пакет — это JSON-строка, завершённая "\n".
+# При входе клиент предлагает серверу возможности (поле "caps" в signin),
+# сервер отвечает выбранными в login_ok и сразу после него переключается
+# на кадры с префиксом длины: [4 байта длины][1 байт флагов][тело].
+# Тело — MessagePack (если установлен пакет msgpack) или JSON,
+# крупные тела сжимаются deflate.
+
+# Импорт стандартных библиотек
+import base64
+import json
+import struct
+import zlib
+
+# MessagePack необязателен: без него клиент использует кадры с JSON внутри
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+CAP_FRAME = "frame"
+CAP_MSGPACK = "msgpack"
+CAP_DEFLATE = "deflate"
+
+DEFLATE_THRESHOLD = 1024          # тела меньше этого размера не сжимаются
+FLAG_DEFLATE = 0x01               # тело кадра сжато deflate (raw, без заголовка zlib)
+# Предел размера входящего пакета. Сервер сам принимает не больше 1 МБ,
+# но отдаёт пакеты крупнее (список из 5 000 чатов в JSON уже больше 1 МБ)
+MAX_PACKET_SIZE = 64 * 1024 * 1024
+
+_HEADER = struct.Struct(">I")     # длина кадра (флаги + тело), big-endian
+
+
+# Возможности протокола, которые клиент предлагает серверу при входе
+def client_caps() -> list[str]:
+    caps = [CAP_FRAME, CAP_DEFLATE]
+    if msgpack is not None:
+        caps.insert(1, CAP_MSGPACK)
+    return caps
+
+
+# Класс Codec — состояние формата одного соединения.
+# Накапливает входящие байты и выдаёт готовые пакеты; переключается на
+# согласованный формат сам, как только встречает login_ok со списком caps.
+class Codec:
+    def __init__(self):
+        self.framed = False       # кадры с длиной вместо JSON-строк
+        self.use_msgpack = False  # тело кадра в MessagePack
+        self.deflate = False      # сжимать крупные исходящие кадры
+        self._buf = bytearray()   # ещё не разобранные входящие байты
+
+
+    # Переключает кодек на возможности, выбранные сервером
+    def apply(self, caps: list[str]):
+        self.framed = CAP_FRAME in caps
+        self.use_msgpack = CAP_MSGPACK in caps and msgpack is not None
+        self.deflate = CAP_DEFLATE in caps
+
+
+    # Сериализует пакет в текущем формате
+    def encode(self, pkt: dict) -> bytes:
+        if not self.framed:
+            return (json.dumps(pkt) + "\n").encode()
+
+        if self.use_msgpack:
+            body = msgpack.packb(pkt, use_bin_type=True)
+        else:
+            body = json.dumps(pkt, separators=(",", ":")).encode()
+
+        # Куски файлов не сжимаем: вложения обычно уже сжаты, а deflate на каждом куске дорог
+        flags = 0
+        if self.deflate and len(body) > DEFLATE_THRESHOLD and pkt.get("type") != "file_chunk":
+            comp = zlib.compressobj(wbits=-15)
+            body = comp.compress(body) + comp.flush()
+            flags |= FLAG_DEFLATE
+
+        return _HEADER.pack(len(body) + 1) + bytes((flags,)) + body
+
+
+    # Готовит двоичные данные (кусок файла) к отправке в текущем формате:
+    # MessagePack передаёт байты как есть, в JSON они кодируются base64 (так их читает и пишет сервер)
+    def pack_bytes(self, data: bytes):
+        if self.use_msgpack:
+            return data
+        return base64.b64encode(data).decode("ascii")
+
+
+    # Добавляет полученные из сокета байты и возвращает все полностью пришедшие пакеты
+    def feed(self, data: bytes) -> list[dict]:
+        self._buf += data
+        packets = []
+        while True:
+            pkt = self._next_line() if not self.framed else self._next_frame()
+            if pkt is None:
+                return packets
+            packets.append(pkt)
+            # После login_ok сервер переходит на выбранный формат — следуем за ним
+            if pkt.get("type") == "login_ok" and not self.framed:
+                self.apply(pkt.get("caps") or [])
+
+
+    # Извлекает из буфера одну JSON-строку (или None, если строка ещё не пришла целиком)
+    def _next_line(self) -> dict | None:
+        while True:
+            pos = self._buf.find(b"\n")
+            if pos < 0:
+                if len(self._buf) > MAX_PACKET_SIZE:
+                    raise ValueError("пакет превышает допустимый размер")
+                return None
+            line = bytes(self._buf[:pos])
+            del self._buf[:pos + 1]
+            if line.strip():
+                return json.loads(line)
+
+
+    # Извлекает из буфера один кадр (или None, если кадр ещё не пришёл целиком)
+    def _next_frame(self) -> dict | None:
+        if len(self._buf) < _HEADER.size:
+            return None
+        (n,) = _HEADER.unpack_from(self._buf)
+        if n == 0 or n > MAX_PACKET_SIZE + 1:
+            raise ValueError("пакет превышает допустимый размер")
+        end = _HEADER.size + n
+        if len(self._buf) < end:
+            return None
+
+        flags = self._buf[_HEADER.size]
+        body = bytes(self._buf[_HEADER.size + 1:end])
+        del self._buf[:end]
+
+        if flags & FLAG_DEFLATE:
+            # Ограничиваем размер распакованных данных тем же пределом
+            body = zlib.decompressobj(wbits=-15).decompress(body, MAX_PACKET_SIZE + 1)
+            if len(body) > MAX_PACKET_SIZE:
+                raise ValueError("пакет превышает допустимый размер")
+        if self.use_msgpack:
+            return msgpack.unpackb(body, raw=False)
+        return json.loads(body)
+
+
+# Возвращает двоичные данные из поля пакета (bytes в MessagePack или строка base64 в JSON)
+def unpack_bytes(value) -> bytes:
+    if isinstance(value, str):
+        return base64.b64decode(value)
+    return bytes(value or b"")
@@ -0,0 +1,172 @@
+# replay.py — воспроизведение записи трафика (SHICHAT_CAPTURE, см. capture.py)
+#
+# Запуск: python replay.py capture.bin [--speed 0] [--gui] [--repeat 1]
+#   --speed 0   — как можно быстрее (по умолчанию); 1 — в темпе записи; 10 — в 10 раз быстрее
+#   --gui       — пакеты проходят через NetworkWorker и ChatWindow, как при живом соединении;
+#                 без флага — только декодирование кодеком клиента (без Qt)
+#   --repeat N  — повторить N раз и вывести лучший результат (для регрессионных замеров)
+# Для запуска без дисплея: QT_QPA_PLATFORM=offscreen python replay.py capture.bin --gui
+#
+# Записанная сессия становится воспроизводимым тестом производительности: время декодирования
+# и время, за которое окно чата обработало все пакеты, сравниваются между версиями клиента.
+# Исходящие пакеты клиента при воспроизведении никуда не отправляются.
+
+# Импорт стандартных библиотек
+import argparse
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import Counter
+
+from capture import REC_CONNECT, REC_IN, REC_OUT, read_capture
+from protocol import Codec
+from search import DATA_DIR_ENV
+
+
+# Входящие записи файла: (время от начала в нс, данные или None — начало нового соединения)
+def load_inbound(path: str) -> list[tuple[int, bytes | None]]:
+    out = []
+    for kind, t, data in read_capture(path):
+        if kind == REC_CONNECT:
+            out.append((t, None))
+        elif kind == REC_IN:
+            out.append((t, data))
+    return out
+
+
+# Ждёт момента записи t (нс от начала), пересчитанного со скоростью speed.
+# Возвращает опоздание в нс (воспроизведение не успевает за записью)
+def _pace(start: int, t: int, speed: float) -> int:
+    if speed <= 0:
+        return 0
+    due = start + int(t / speed)
+    now = time.monotonic_ns()
+    if now < due:
+        time.sleep((due - now) / 1e9)
+        return 0
+    return now - due
+
+
+# Воспроизводит входящие байты через кодек и для каждого пакета вызывает on_packet.
+# Возвращает (пакеты по типам, время в кодеке в нс, наибольшее опоздание в нс)
+def feed(records, speed: float, on_packet=None) -> tuple[Counter, int, int]:
+    types = Counter()
+    decode_ns = 0
+    worst_lag = 0
+    codec = Codec()
+    start = time.monotonic_ns()
+    for t, data in records:
+        worst_lag = max(worst_lag, _pace(start, t, speed))
+        if data is None:
+            codec = Codec()  # переподключение: новое соединение начинается с JSON-строк
+            continue
+        t0 = time.perf_counter_ns()
+        packets = codec.feed(data)
+        decode_ns += time.perf_counter_ns() - t0
+        for pkt in packets:
+            types[pkt.get("type")] += 1
+            if on_packet is not None:
+                on_packet(pkt)
+    return types, decode_ns, worst_lag
+
+
+# Только декодирование. Возвращает (пакеты по типам, общее время в мс, время кодека в мс, опоздание в мс)
+def replay_headless(records, speed: float) -> tuple[Counter, float, float, float]:
+    t0 = time.perf_counter()
+    types, decode_ns, lag = feed(records, speed)
+    return types, (time.perf_counter() - t0) * 1000, decode_ns / 1e6, lag / 1e6
+
+
+# Пакеты проходят через NetworkWorker._dispatch (в отдельном потоке, как цикл чтения)
+# и обрабатываются окном чата. Время считается до обработки окном последнего пакета.
+def replay_gui(records, speed: float, username: str) -> tuple[Counter, float, float, float]:
+    from PyQt5.QtCore import pyqtSignal
+    from PyQt5.QtWidgets import QApplication
+    from NetworkWorker import NetworkWorker, STATE_ATTACHED
+    from ChatWindow import ChatWindow
+
+    # NetworkWorker без сокета: пакеты берутся из записи, исходящие отбрасываются
+    class ReplayWorker(NetworkWorker):
+        finished = pyqtSignal()  # все пакеты переданы (приходит в поток интерфейса после них)
+
+        def send(self, pkt: dict):
+            pass
+
+        def stop(self):
+            self._running = False
+
+    app = QApplication.instance() or QApplication([])
+    net = ReplayWorker()
+    net.state = STATE_ATTACHED
+    window = ChatWindow(username, net)
+    result = {}
+
+    def run():
+        result["feed"] = feed(records, speed, net._dispatch)
+        net.finished.emit()
+
+    def done():
+        result["total"] = (time.perf_counter() - t0) * 1000
+        app.quit()
+
+    net.finished.connect(done)
+    t0 = time.perf_counter()
+    threading.Thread(target=run, daemon=True).start()
+    app.exec_()
+    window.close()
+
+    types, decode_ns, lag = result["feed"]
+    return types, result["total"], decode_ns / 1e6, lag / 1e6
+
+
+# Логин из записанного signin (поле "from"), чтобы окно чата различало свои и чужие сообщения
+def captured_username(path: str) -> str:
+    for kind, _, data in read_capture(path):
+        if kind == REC_OUT and data.startswith(b"{"):
+            try:
+                pkt = json.loads(data)
+            except ValueError:
+                continue
+            if pkt.get("type") == "signin":
+                return pkt.get("from") or "replay"
+    return "replay"
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Воспроизведение записи трафика Shichat")
+    ap.add_argument("capture", help="файл записи (SHICHAT_CAPTURE)")
+    ap.add_argument("--speed", type=float, default=0, help="0 — как можно быстрее, 1 — темп записи, N — в N раз быстрее")
+    ap.add_argument("--gui", action="store_true", help="через NetworkWorker и ChatWindow")
+    ap.add_argument("--repeat", type=int, default=1)
+    args = ap.parse_args()
+
+    records = load_inbound(args.capture)
+    size = sum(len(d) for _, d in records if d)
+    duration = records[-1][0] / 1e9 if records else 0
+    print(f"запись: {len(records)} кусков, {size} байт, {duration:.1f} с")
+
+    if args.gui:
+        # Окно чата пишет локальный индекс и состояние передач — во временный каталог, а не в данные пользователя
+        os.environ.setdefault(DATA_DIR_ENV, tempfile.mkdtemp(prefix="shichat-replay-"))
+        username = captured_username(args.capture)
+
+    best = None
+    for _ in range(max(1, args.repeat)):
+        if args.gui:
+            res = replay_gui(records, args.speed, username)
+        else:
+            res = replay_headless(records, args.speed)
+        if best is None or res[1] < best[1]:
+            best = res
+
+    types, total_ms, decode_ms, lag_ms = best
+    print(f"пакетов: {sum(types.values())} ({', '.join(f'{t}: {n}' for t, n in types.most_common())})")
+    print(f"всего: {total_ms:.1f} мс, декодирование: {decode_ms:.1f} мс")
+    if args.speed > 0:
+        print(f"наибольшее отставание от темпа записи: {lag_ms:.1f} мс")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+# search.py — локальный полнотекстовый индекс сообщений (SQLite FTS5)
+#
+# Все сообщения, которые клиент получает (живые, история, предзагрузка),
+# складываются в SQLite-базу пользователя с FTS5-индексом. Поиск по ней
+# мгновенный и не требует сервера; более старые сообщения ищет сервер
+# (пакет message_search).
+# Если SQLite собран без FTS5, используется поиск подстроки (LIKE).
+
+# Импорт стандартных библиотек
+import os
+import re
+import sqlite3
+
+from chatcache import message_key
+
+# Каталог с данными клиента (можно переопределить переменной окружения)
+DATA_DIR_ENV = "SHICHAT_DATA_DIR"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id           INTEGER PRIMARY KEY,
+    key          TEXT UNIQUE,       -- ключ для устранения дубликатов
+    peer         TEXT NOT NULL,     -- собеседник или ID группы
+    sender       TEXT,
+    display_name TEXT,
+    content      TEXT,
+    ts           INTEGER
+);
+CREATE INDEX IF NOT EXISTS messages_ts_idx ON messages(ts);
+"""
+
+_FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+    content,
+    content='messages', content_rowid='id',
+    tokenize='unicode61 remove_diacritics 2'
+);
+CREATE TRIGGER IF NOT EXISTS messages_ai AFTER INSERT ON messages BEGIN
+    INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content);
+END;
+"""
+
+# Слова запроса: буквы и цифры (остальное — разделители)
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+
+# Каталог с данными пользователя (создаётся при первом обращении)
+def data_dir(username: str) -> str:
+    base = os.environ.get(DATA_DIR_ENV) or os.path.join(os.path.expanduser("~"), ".shichat")
+    path = os.path.join(base, username)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+# Путь к базе сообщений пользователя по умолчанию
+def default_path(username: str) -> str:
+    return os.path.join(data_dir(username), "messages.db")
+
+
+# Класс MessageIndex — локальная база сообщений с полнотекстовым поиском
+class MessageIndex:
+    def __init__(self, path: str = ":memory:"):
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")     # запись не блокирует чтение
+        self.db.execute("PRAGMA synchronous=NORMAL")   # без fsync на каждую транзакцию
+        self.db.executescript(_SCHEMA)
+        try:
+            self.db.executescript(_FTS_SCHEMA)
+            self.fts = True
+        except sqlite3.OperationalError:
+            self.fts = False  # SQLite без FTS5 — ищем подстрокой
+        self._dirty = False
+
+
+    # Добавляет сообщение в индекс (дубликаты игнорируются). Изменения фиксируются в commit()
+    def add(self, peer: str, pkt: dict):
+        key = repr(message_key(pkt))
+        self.db.execute(
+            "INSERT OR IGNORE INTO messages(key, peer, sender, display_name, content, ts) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (key, peer, pkt.get("from"), pkt.get("display_name"), pkt.get("content") or "", pkt.get("timestamp")),
+        )
+        self._dirty = True
+
+
+    # Фиксирует накопленные изменения на диске
+    def commit(self):
+        if self._dirty:
+            self.db.commit()
+            self._dirty = False
+
+
+    # Ищет сообщения по словам запроса (все слова, по префиксу), от новых к старым.
+    # Возвращает страницу результатов в том же виде, что и сервер (поля SearchHit).
+    def search(self, query: str, limit: int = 20, offset: int = 0) -> list[dict]:
+        tokens = _TOKEN_RE.findall(query.lower())
+        if not tokens:
+            return []
+
+        if self.fts:
+            # Каждое слово — в кавычках (без синтаксиса FTS5) и с поиском по префиксу
+            match = " ".join('"' + t.replace('"', '""') + '"*' for t in tokens)
+            rows = self.db.execute(
+                "SELECT m.peer, m.sender, m.display_name, m.content, m.ts "
+                "FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid "
+                "WHERE messages_fts MATCH ? "
+                "ORDER BY m.ts DESC, m.id DESC LIMIT ? OFFSET ?",
+                (match, limit, offset),
+            )
+        else:
+            where = " AND ".join("lower(content) LIKE ?" for _ in tokens)
+            rows = self.db.execute(
+                "SELECT peer, sender, display_name, content, ts FROM messages "
+                f"WHERE {where} ORDER BY ts DESC, id DESC LIMIT ? OFFSET ?",
+                (*[f"%{t}%" for t in tokens], limit, offset),
+            )
+
+        return [
+            {"peer": peer, "from": sender, "display_name": dname, "content": content, "timestamp": ts}
+            for peer, sender, dname, content, ts in rows
+        ]
+
+
+    # Закрывает базу (с сохранением изменений)
+    def close(self):
+        self.commit()
+        self.db.close()
@@ -0,0 +1,39 @@
+# startup.py — замеры времени запуска клиента
+#
+# Отметки ставятся по ходу запуска (нажатие «Войти», первый список чатов и т.д.),
+# а интервалы между ними печатаются, если задана переменная окружения SHICHAT_STARTUP_LOG.
+
+# Импорт стандартных библиотек
+import os
+import time
+
+# Переменная окружения, включающая вывод замеров
+STARTUP_ENV = "SHICHAT_STARTUP_LOG"
+# Переменная окружения для startup_profile.py: закрыть приложение сразу после первой отрисовки
+PROFILE_ENV = "SHICHAT_STARTUP_PROFILE"
+
+_marks: dict[str, float] = {}  # имя отметки → время (perf_counter)
+
+
+# Ставит отметку времени (повторная отметка с тем же именем игнорируется)
+def mark(name: str):
+    _marks.setdefault(name, time.perf_counter())
+
+
+# Интервал между двумя отметками в миллисекундах (или None, если какой-то отметки нет)
+def elapsed_ms(start: str, end: str) -> float | None:
+    if start not in _marks or end not in _marks:
+        return None
+    return (_marks[end] - _marks[start]) * 1000
+
+
+# Печатает интервал между отметками, если замеры включены
+def report(label: str, start: str, end: str):
+    ms = elapsed_ms(start, end)
+    if ms is not None and os.environ.get(STARTUP_ENV):
+        print(f"[startup] {label}: {ms:.1f} ms")
+
+
+# True, если клиент запущен для замера времени запуска (startup_profile.py)
+def profiling() -> bool:
+    return bool(os.environ.get(PROFILE_ENV))
@@ -0,0 +1,88 @@
+# startup_profile.py — замер холодного запуска клиента
+#
+# Запуск: python startup_profile.py [--runs 5] [--top 15]
+# Несколько раз запускает main.py с "-X importtime" и флагом SHICHAT_STARTUP_PROFILE
+# (приложение закрывается сразу после первой отрисовки окна входа) и выводит:
+#   * время от старта процесса до первой отрисовки (медиана и разброс);
+#   * самые дорогие импорты первого запуска по накопленному времени.
+# Для запуска без дисплея: QT_QPA_PLATFORM=offscreen python startup_profile.py
+
+# Импорт стандартных библиотек
+import argparse
+import os
+import re
+import statistics
+import subprocess
+import sys
+import time
+
+from startup import PROFILE_ENV, STARTUP_ENV
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Строка вывода -X importtime: "import time: self [us] | cumulative | imported package"
+IMPORT_RE = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)")
+# Строка замера из startup.report
+PAINT_RE = re.compile(r"\[startup\] .*?: ([\d.]+) ms")
+
+
+# Один запуск клиента. Возвращает (мс до первой отрисовки по часам процесса,
+# мс по внешним часам, строки вывода importtime)
+def run_once() -> tuple[float | None, float, list[str]]:
+    env = dict(os.environ, **{PROFILE_ENV: "1", STARTUP_ENV: "1"})
+    t0 = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "main.py"],
+        cwd=HERE, env=env, capture_output=True, text=True, timeout=60,
+    )
+    wall = (time.perf_counter() - t0) * 1000
+
+    paint = None
+    for line in proc.stdout.splitlines():
+        m = PAINT_RE.search(line)
+        if m:
+            paint = float(m.group(1))
+    return paint, wall, proc.stderr.splitlines()
+
+
+# Разбирает вывод importtime: (накопленное время в мкс, глубина вложенности, модуль)
+def parse_imports(lines: list[str]) -> list[tuple[int, int, str]]:
+    out = []
+    for line in lines:
+        m = IMPORT_RE.match(line)
+        if m:
+            depth = (len(m.group(3)) - 1) // 2
+            out.append((int(m.group(2)), depth, m.group(4)))
+    return out
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Замер холодного запуска клиента Shichat")
+    ap.add_argument("--runs", type=int, default=5)
+    ap.add_argument("--top", type=int, default=15)
+    args = ap.parse_args()
+
+    paints, walls, first = [], [], None
+    for _ in range(args.runs):
+        paint, wall, stderr = run_once()
+        if paint is not None:
+            paints.append(paint)
+        walls.append(wall)
+        first = first or stderr
+
+    if paints:
+        print(f"старт main.py → первая отрисовка: медиана {statistics.median(paints):.1f} ms "
+              f"(мин {min(paints):.1f}, макс {max(paints):.1f}, запусков {len(paints)})")
+    else:
+        print("первая отрисовка не зафиксирована (нет дисплея? попробуйте QT_QPA_PLATFORM=offscreen)")
+    print(f"весь процесс, включая запуск интерпретатора: медиана {statistics.median(walls):.1f} ms")
+
+    imports = parse_imports(first or [])
+    total = sum(cum for cum, depth, _ in imports if depth == 0)
+    print(f"\nимпорты первого запуска: всего {total / 1000:.1f} ms, самые дорогие (накопленно):")
+    for cum, depth, name in sorted(imports, reverse=True)[:args.top]:
+        print(f"{cum / 1000:>9.1f} ms  {'  ' * depth}{name}")
+
+
+if __name__ == "__main__":
+    main()
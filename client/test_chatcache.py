@@ -0,0 +1,67 @@
+# Тесты кольцевых буферов чатов (chatcache.py). Запуск: python -m pytest client
+import unittest
+
+from chatcache import ChatCache, message_key
+
+
+def msg(ts: int, text: str = "") -> dict:
+    return {"from": "bob", "to": "me", "timestamp": ts, "content": text or f"m{ts}"}
+
+
+class ChatRingTest(unittest.TestCase):
+    def test_keeps_last_messages(self):
+        cache = ChatCache(limit=3)
+        for ts in (10, 20, 30, 40):
+            cache.add("bob", msg(ts))
+        self.assertEqual([m["timestamp"] for m in cache.messages("bob")], [20, 30, 40])
+        # Вытесненное сообщение снова принимается, оставшиеся — дубликаты
+        self.assertIsNone(cache.add("bob", msg(30)))
+
+    def test_out_of_order_in_full_ring(self):
+        cache = ChatCache(limit=3)
+        for ts in (10, 20, 30):
+            cache.add("bob", msg(ts))
+        self.assertEqual(cache.add("bob", msg(15)), 0)
+        self.assertEqual([m["timestamp"] for m in cache.messages("bob")], [15, 20, 30])
+        # Ключи совпадают с сообщениями в буфере
+        ring = cache._rings["bob"]
+        self.assertEqual(ring.keys, {message_key(m) for m in ring.msgs})
+        self.assertIsNone(cache.add("bob", msg(15)))
+        self.assertEqual(cache.add("bob", msg(10)), 0)
+
+    def test_out_of_order_in_middle(self):
+        cache = ChatCache(limit=5)
+        for ts in (10, 30):
+            cache.add("bob", msg(ts))
+        self.assertEqual(cache.add("bob", msg(20)), 1)
+        self.assertEqual(cache.add("bob", msg(30, "other")), 3)
+        self.assertEqual([m["timestamp"] for m in cache.messages("bob")], [10, 20, 30, 30])
+
+    def test_trimmed_and_oldest(self):
+        cache = ChatCache(limit=2)
+        self.assertIsNone(cache.oldest("bob"))
+        cache.add("bob", msg(10))
+        cache.add("bob", msg(20))
+        self.assertFalse(cache.trimmed("bob"))
+        cache.add("bob", msg(30))
+        self.assertTrue(cache.trimmed("bob"))
+        self.assertEqual(cache.oldest("bob")["timestamp"], 20)
+        # Дубликат ничего не вытесняет
+        self.assertIsNone(cache.add("bob", msg(30)))
+        self.assertFalse(cache.trimmed("bob"))
+
+    def test_history_and_unread(self):
+        cache = ChatCache()
+        self.assertFalse(cache.is_complete("bob"))
+        cache.begin_history("bob")
+        self.assertTrue(cache.is_complete("bob"))
+        cache.invalidate()
+        self.assertFalse(cache.is_complete("bob"))
+        self.assertEqual(cache.bump_unread("bob"), 1)
+        self.assertEqual(cache.bump_unread("bob"), 2)
+        cache.clear_unread("bob")
+        self.assertEqual(cache.unread("bob"), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,54 @@
+# Тесты индекса фильтра списка чатов (chatfilter.py). Запуск: python -m pytest client
+import unittest
+
+from chatfilter import ChatFilterIndex
+
+
+def index(**chats: str) -> ChatFilterIndex:
+    idx = ChatFilterIndex()
+    for peer, name in chats.items():
+        idx.put(peer, name)
+    return idx
+
+
+class ChatFilterTest(unittest.TestCase):
+    def test_empty_query_matches_all(self):
+        self.assertIsNone(index(bob="Боб").match("  "))
+
+    def test_short_queries(self):
+        idx = index(bob="Боб Петров", alice="Алиса", **{"42": "Работа"})
+        self.assertEqual(idx.match("б"), {"bob", "42"})
+        self.assertEqual(idx.match("ал"), {"alice"})
+        self.assertEqual(idx.match("AL"), {"alice"})  # без учёта регистра, peer тоже ищется
+
+    def test_substring(self):
+        idx = index(bob="Боб Петров", fedor="Фёдор")
+        self.assertEqual(idx.match("петр"), {"bob"})
+        self.assertEqual(idx.match("федор"), {"fedor"})  # ё = е
+        self.assertEqual(idx.match("сидоров"), set())
+
+    def test_grams_without_substring(self):
+        # Все триграммы запроса «абвбаб» есть в строке, но подряд они не идут
+        idx = index(x="абвгд бвба вбаб")
+        self.assertEqual(idx.match("абвбаб"), set())
+        self.assertEqual(idx.match("бвба"), {"x"})
+        # Совпадение не переходит через границу названия и peer
+        self.assertEqual(index(bob="Бо").match("бо\nb"), {"bob"})
+        self.assertEqual(index(bob="Бо").match("боb"), set())
+
+    def test_put_and_remove(self):
+        idx = index(bob="Боб", alice="Алиса")
+        idx.put("bob", "Роберт")
+        self.assertEqual(idx.match("боб"), set())
+        self.assertEqual(idx.match("роб"), {"bob"})
+        idx.remove("bob")
+        self.assertEqual(idx.match("роб"), set())
+        self.assertEqual(len(idx), 1)
+        # Триграммы удалённого чата не остаются в индексе
+        self.assertFalse(any("bob" in peers for peers in idx._grams.values()))
+        idx.remove("nobody")
+        self.assertEqual(idx.match("али"), {"alice"})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,55 @@
+# Тесты состояния присутствия (presence.py). Запуск: python -m pytest client
+import unittest
+
+from presence import PresenceState, TYPING_TTL
+
+
+class PresenceStateTest(unittest.TestCase):
+    def test_online_changes(self):
+        st = PresenceState()
+        self.assertEqual(st.apply({"presence": [{"user": "bob", "online": True}]}, now=0), {"bob"})
+        # Повтор того же состояния ничего не меняет
+        self.assertEqual(st.apply({"presence": [{"user": "bob", "online": True}]}, now=0), set())
+        self.assertEqual(st.apply({"presence": [{"user": "bob", "online": False}]}, now=0), {"bob"})
+        self.assertEqual(st.online, set())
+
+    def test_full_snapshot_replaces_state(self):
+        st = PresenceState()
+        st.apply({"presence": [{"user": "bob", "online": True}, {"user": "ann", "online": True}]}, now=0)
+        changed = st.apply({"full": True, "presence": [{"user": "ann", "online": True}]}, now=0)
+        self.assertEqual(st.online, {"ann"})
+        self.assertEqual(changed, {"bob", "ann"})
+
+    def test_typing_expires(self):
+        st = PresenceState()
+        pkt = {"presence": [{"user": "bob", "online": True, "typing": "42"}]}
+        self.assertEqual(st.apply(pkt, now=10), {"bob", "42"})
+        self.assertEqual(st.typing("42"), ["bob"])
+        self.assertEqual(st.expire(now=10 + TYPING_TTL - 1), set())
+        # Новый пакет продлевает индикатор
+        st.apply(pkt, now=12)
+        self.assertEqual(st.expire(now=10 + TYPING_TTL), set())
+        self.assertEqual(st.expire(now=12 + TYPING_TTL), {"42"})
+        self.assertEqual(st.typing("42"), [])
+        self.assertFalse(st.has_typing())
+
+    def test_typing_stops(self):
+        st = PresenceState()
+        st.apply({"presence": [
+            {"user": "bob", "online": True, "typing": "bob"},
+            {"user": "bob", "online": True, "typing": "42"},
+            {"user": "ann", "online": True, "typing": "42"},
+        ]}, now=0)
+        # Сообщение от bob в чате 42 снимает только его индикатор там
+        self.assertTrue(st.stopped("42", "bob"))
+        self.assertFalse(st.stopped("42", "bob"))
+        self.assertEqual(st.typing("42"), ["ann"])
+        # Вышедший пользователь перестаёт печатать везде
+        changed = st.apply({"presence": [{"user": "bob", "online": False}]}, now=1)
+        self.assertEqual(changed, {"bob"})
+        self.assertEqual(st.typing("bob"), [])
+        self.assertEqual(st.typing("42"), ["ann"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,98 @@
+# Тесты кодека протокола (protocol.py). Запуск: python -m pytest client
+import os
+import struct
+import unittest
+
+import protocol
+from protocol import Codec, CAP_DEFLATE, CAP_FRAME, CAP_MSGPACK, DEFLATE_THRESHOLD, FLAG_DEFLATE
+
+
+def codec(*caps: str) -> Codec:
+    c = Codec()
+    if caps:
+        c.apply(list(caps))
+    return c
+
+
+class CodecTest(unittest.TestCase):
+    def roundtrip(self, caps: tuple, pkt: dict) -> bytes:
+        data = codec(*caps).encode(pkt)
+        self.assertEqual(codec(*caps).feed(data), [pkt])
+        return data
+
+    def test_json_lines(self):
+        data = self.roundtrip((), {"type": "message", "content": "привет"})
+        self.assertTrue(data.endswith(b"\n"))
+        # Пакет, пришедший по частям, выдаётся только целиком; пустые строки пропускаются
+        c = codec()
+        self.assertEqual(c.feed(data[:5]), [])
+        self.assertEqual(c.feed(data[5:] + b"\n"), [{"type": "message", "content": "привет"}])
+
+    def test_framed_json(self):
+        pkt = {"type": "history", "to": "bob"}
+        data = self.roundtrip((CAP_FRAME,), pkt)
+        (n,) = struct.unpack(">I", data[:4])
+        self.assertEqual(n, len(data) - 4)
+        self.assertEqual(data[4], 0)
+        # Два кадра в одном куске и кадр, разрезанный на части
+        c = codec(CAP_FRAME)
+        self.assertEqual(c.feed(data + data[:3]), [pkt])
+        self.assertEqual(c.feed(data[3:]), [pkt])
+
+    @unittest.skipIf(protocol.msgpack is None, "нет пакета msgpack")
+    def test_framed_msgpack(self):
+        pkt = {"type": "file_chunk", "file_id": 7, "data": b"\x00\x01\xff"}
+        self.roundtrip((CAP_FRAME, CAP_MSGPACK), pkt)
+
+    def test_deflate_above_threshold(self):
+        small = {"type": "message", "content": "x"}
+        big = {"type": "message", "content": "y" * (DEFLATE_THRESHOLD * 4)}
+        self.assertEqual(self.roundtrip((CAP_FRAME, CAP_DEFLATE), small)[4], 0)
+        data = self.roundtrip((CAP_FRAME, CAP_DEFLATE), big)
+        self.assertEqual(data[4], FLAG_DEFLATE)
+        self.assertLess(len(data), DEFLATE_THRESHOLD)
+        # Куски файлов не сжимаются
+        chunk = {"type": "file_chunk", "data": "z" * (DEFLATE_THRESHOLD * 4)}
+        self.assertEqual(self.roundtrip((CAP_FRAME, CAP_DEFLATE), chunk)[4], 0)
+
+    def test_switch_to_frames_after_login_ok(self):
+        # login_ok и первый кадр приходят одним куском — кадр разбирается уже в новом формате
+        login = {"type": "login_ok", "caps": [CAP_FRAME, CAP_DEFLATE]}
+        chats = {"type": "chatlist", "chats": [{"peer": "bob"}]}
+        data = codec().encode(login) + codec(CAP_FRAME, CAP_DEFLATE).encode(chats)
+        c = codec()
+        self.assertEqual(c.feed(data), [login, chats])
+        self.assertTrue(c.framed and c.deflate)
+        self.assertFalse(c.use_msgpack)
+
+    def test_max_packet_size(self):
+        # Длина кадра больше предела
+        c = codec(CAP_FRAME)
+        with self.assertRaises(ValueError):
+            c.feed(struct.pack(">I", protocol.MAX_PACKET_SIZE + 2) + b"\x00")
+        # Нулевая длина
+        with self.assertRaises(ValueError):
+            codec(CAP_FRAME).feed(struct.pack(">I", 0))
+        # Строка без перевода строки длиннее предела
+        old = protocol.MAX_PACKET_SIZE
+        protocol.MAX_PACKET_SIZE = 64
+        try:
+            with self.assertRaises(ValueError):
+                codec().feed(b"{" + b" " * 100)
+            # Сжатое тело, которое распаковывается больше предела
+            body = {"type": "message", "content": "a" * 1000}
+            data = codec(CAP_FRAME, CAP_DEFLATE).encode(body)
+            self.assertLess(len(data), 64)
+            with self.assertRaises(ValueError):
+                codec(CAP_FRAME, CAP_DEFLATE).feed(data)
+        finally:
+            protocol.MAX_PACKET_SIZE = old
+
+    def test_pack_bytes(self):
+        data = os.urandom(100)
+        self.assertEqual(protocol.unpack_bytes(codec(CAP_FRAME).pack_bytes(data)), data)
+        self.assertEqual(protocol.unpack_bytes(None), b"")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,5 +1,7 @@
 # theme.py — централизованные цвета и генераторы QSS для тёмной темы интерфейса
 
+from functools import cache
+
 # Класс описывает цветовую схему приложения и возвращает строки стилей (QSS)
 class DarkTheme:
     # Цветовая палитра
@@ -11,9 +13,11 @@ class DarkTheme:
     FIELD = "#3A3A3C"        # фон поля ввода текста
     TEXT_MAIN = "#E0E0E0"    # основной цвет текста
     TEXT_SUB = "#A0A0A0"     # второстепенный текст (время, подписи)
+    ONLINE = "#4CAF50"       # отметка «в сети» в списке чатов
 
     # Стиль для списка пользователей (QListWidget)
     @classmethod
+    @cache  # строка стиля строится один раз при первом обращении
     def qss_user_list(cls) -> str:
         return f"""
         QListWidget {{
@@ -30,6 +34,7 @@ class DarkTheme:
 
     # Стиль списка с увеличенным шрифтом
     @classmethod
+    @cache
     def qss_user_list_large(cls, *, size: int = 14) -> str:
         return f"""
             QListWidget {{
@@ -40,6 +45,7 @@ class DarkTheme:
 
     # Стиль заголовка окна (название чата)
     @classmethod
+    @cache
     def qss_header(cls) -> str:
         return (
             f"font-size:16px;padding:8px;"
@@ -49,6 +55,7 @@ class DarkTheme:
 
     # Стиль области сообщений (chat_view)
     @classmethod
+    @cache
     def qss_chat_view(cls) -> str:
         return (
             f"background:{cls.PANEL};"
@@ -58,6 +65,7 @@ class DarkTheme:
 
     # Стиль поля ввода текста
     @classmethod
+    @cache
     def qss_input(cls) -> str:
         return (
             f"background:{cls.FIELD};color:#FFFFFF;"
@@ -66,6 +74,7 @@ class DarkTheme:
 
     # Стиль кнопки (синий)
     @classmethod
+    @cache
     def qss_button(cls, *, accent: str | None = None) -> str:
         acc = accent or cls.ACCENT
         return f"""
@@ -84,6 +93,7 @@ class DarkTheme:
 
     # Стиль кнопки (серый)
     @classmethod
+    @cache
     def qss_button_dark(cls, *, accent: str | None = None) -> str:
         acc = accent or cls.ACCENT_SOFT
         return f"""
@@ -101,10 +111,23 @@ class DarkTheme:
         """
 
     @staticmethod
+    @cache
     def qss_sender_label():
         return (
             f"padding:4px 8px; "
             f"font-size:12px; "
             f"font-weight:bold; "
             f"color:#FFFFFF;"
-        )
\ No newline at end of file
+        )
+
+    # Стиль значка с количеством непрочитанных сообщений
+    @classmethod
+    @cache
+    def qss_badge(cls, *, selected: bool = False) -> str:
+        bg = "#FFFFFF" if selected else cls.ACCENT
+        fg = cls.ACCENT if selected else "#FFFFFF"
+        return (
+            f"background:{bg};color:{fg};"
+            f"border-radius:8px;padding:0 6px;"
+            f"font-size:11px;font-weight:bold;"
+        )
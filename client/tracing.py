@@ -0,0 +1,114 @@
+# tracing.py — сквозная трассировка задержек сообщений (клиент → сервер → получатели)
+#
+# Включается переменной окружения SHICHAT_TRACE=<путь к файлу>.
+# Отправитель добавляет в пакет поле "trace" с временем отправки, сервер дописывает
+# время приёма, записи в БД и записи в сокет получателя, а NetworkWorker и ChatWindow
+# на стороне получателя — время прихода пакета и время отрисовки.
+# Итоговая разбивка задержки по этапам сохраняется в файл (одна JSON-строка на сообщение).
+
+# Импорт стандартных библиотек
+import json
+import os
+import threading
+import time
+import uuid
+
+# Переменная окружения с путём к файлу экспорта
+TRACE_ENV = "SHICHAT_TRACE"
+
+
+# Переводит разницу наносекундных меток в миллисекунды (или None, если одной из меток нет)
+def _ms(end, start):
+    if not end or not start:
+        return None
+    return round((end - start) / 1e6, 3)
+
+
+# Класс LatencyTracer — собирает метки времени трассируемых сообщений
+# и строит по ним разбивку задержки по этапам.
+class LatencyTracer:
+    def __init__(self, path: str | None = None):
+        self.path = path                  # файл, в который выгружаются результаты
+        self.enabled = bool(path)         # трассировка включена, только если задан файл
+        self._sent: dict[str, int] = {}   # id трассы → монотонное время отправки (для своих сообщений)
+        self._rows: list[dict] = []       # собранные, но ещё не выгруженные разбивки
+        self._lock = threading.Lock()     # метки ставятся из сетевого потока и из GUI
+
+
+    # Создаёт поле "trace" для нового исходящего сообщения (или None, если трассировка выключена)
+    def new_trace(self) -> dict | None:
+        if not self.enabled:
+            return None
+        trace = {
+            "id": uuid.uuid4().hex[:16],
+            "client_send": time.monotonic_ns(),
+            "client_send_wall": time.time_ns(),
+        }
+        with self._lock:
+            self._sent[trace["id"]] = trace["client_send"]
+        return trace
+
+
+    # Отмечает приход пакета из сокета (вызывается в потоке NetworkWorker)
+    def on_arrival(self, pkt: dict):
+        trace = pkt.get("trace")
+        if not self.enabled or not trace:
+            return
+        trace["client_recv"] = time.monotonic_ns()
+        trace["client_recv_wall"] = time.time_ns()
+
+
+    # Отмечает окончание отрисовки сообщения и сохраняет разбивку задержки
+    def on_render(self, pkt: dict):
+        trace = pkt.get("trace")
+        if not self.enabled or not trace or "client_recv" not in trace:
+            return
+        trace["client_render"] = time.monotonic_ns()
+        row = self.breakdown(trace)
+        with self._lock:
+            self._rows.append(row)
+
+
+    # Строит разбивку задержки по этапам (в миллисекундах).
+    # Интервалы внутри одного процесса считаются по монотонным часам,
+    # интервалы между машинами — по Unix-времени (требуют синхронизации часов).
+    def breakdown(self, trace: dict) -> dict:
+        with self._lock:
+            send_mono = self._sent.pop(trace.get("id"), None)
+        echo = send_mono is not None  # своё сообщение вернулось эхом от сервера
+
+        # Момент, когда сервер начал писать пакет в сокет этого клиента
+        server_out = trace.get("server_fanout") or trace.get("server_db_commit")
+
+        row = {
+            "id": trace.get("id"),
+            "role": "echo" if echo else "recipient",
+            "uplink_ms": _ms(trace.get("server_recv"), trace.get("client_send_wall")),
+            "db_ms": _ms(trace.get("server_db_commit"), trace.get("server_recv")),
+            "lock_fanout_ms": _ms(trace.get("server_fanout"), trace.get("server_db_commit")),
+            "downlink_ms": _ms(trace.get("client_recv_wall"), server_out),
+            "render_ms": _ms(trace.get("client_render"), trace.get("client_recv")),
+        }
+        if echo:
+            # Для эха полный путь измеряется одними и теми же монотонными часами
+            row["total_ms"] = _ms(trace.get("client_render"), send_mono)
+        else:
+            render_wall = trace["client_recv_wall"] + (trace["client_render"] - trace["client_recv"])
+            row["total_ms"] = _ms(render_wall, trace.get("client_send_wall"))
+        return row
+
+
+    # Дописывает накопленные разбивки в файл (JSON Lines) и очищает буфер
+    def export(self, path: str | None = None):
+        path = path or self.path
+        with self._lock:
+            rows, self._rows = self._rows, []
+        if not path or not rows:
+            return
+        with open(path, "a", encoding="utf-8") as f:
+            for row in rows:
+                f.write(json.dumps(row, ensure_ascii=False) + "\n")
+
+
+# Общий трассировщик процесса
+tracer = LatencyTracer(os.environ.get(TRACE_ENV))
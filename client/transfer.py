@@ -0,0 +1,358 @@
+# transfer.py — передача файлов (вложений) кусками по соединению чата
+#
+# Загрузка:   file_offer → file_accept (с какого смещения слать и окно) → file_chunk … ← file_ack
+# Скачивание: file_download → file_accept → file_chunk … → file_ack (подтверждает клиент)
+#
+# Куски по 64 КБ читаются из файла через mmap и отправляются через NetworkWorker.send —
+# под тем же замком, что и сообщения, поэтому набранное сообщение уходит между кусками,
+# а за ним в сети стоит не больше окна неподтверждённых байт.
+# Незавершённые загрузки запоминаются в uploads.json и продолжаются после следующего входа
+# с того места, до которого сервер успел записать файл. Недокачанные файлы лежат рядом
+# с расширением .part и докачиваются с места обрыва.
+# Если сервер отклонил file_offer или file_download из-за лимита запросов (error с retry_after),
+# запрос повторяется через указанное время.
+
+# Импорт стандартных библиотек
+import json
+import mmap
+import os
+import threading
+from collections import deque
+
+# Импорт компонентов Qt для сигналов
+from PyQt5.QtCore import QObject, pyqtSignal
+
+from protocol import unpack_bytes
+
+CHUNK_SIZE = 64 * 1024    # размер куска (как fileChunkSize на сервере)
+ACCEPT_TIMEOUT = 15       # ожидание ответа на file_offer (секунды)
+ACK_TIMEOUT = 30          # ожидание подтверждения, когда окно заполнено (секунды)
+
+
+# Загрузка одного файла на сервер
+class _Upload:
+    def __init__(self, path: str, to: str, file_id: int = 0):
+        self.path = path
+        self.to = to                          # чат назначения (логин собеседника или ID группы)
+        self.file_id = file_id                # 0 — сервер ещё не завёл вложение
+        self.name = os.path.basename(path)
+        self.size = os.path.getsize(path)
+        self.accepted: tuple[int, int] | None = None  # (смещение, окно) из file_accept
+        self.acked = 0                        # сколько байт сервер подтвердил
+        self.error: str | None = None         # текст file_error от сервера
+        self.retry_after = 0                  # сервер отклонил file_offer: повторить через столько мс
+        self.lost = False                     # соединение оборвалось во время загрузки
+
+
+# Скачивание одного файла с сервера
+class _Download:
+    def __init__(self, file_id: int, path: str, size: int):
+        self.file_id = file_id
+        self.path = path                      # итоговый путь
+        self.part = path + ".part"            # файл, который дописывается по мере приёма
+        self.size = size
+        self.received = 0
+        self.f = None
+
+
+# Класс FileTransfers — загрузки и скачивания файлов одного пользователя.
+# Загрузки идут по очереди в отдельном потоке; пакеты от сервера (file_accept, file_ack,
+# file_chunk, file_error) NetworkWorker передаёт в on_packet прямо из потока чтения,
+# чтобы подтверждения не ждали очереди событий интерфейса.
+class FileTransfers(QObject):
+    progress = pyqtSignal(int, str, int, int)  # file_id, имя файла, передано байт, всего
+    upload_done = pyqtSignal(int, str)         # file_id, имя файла
+    download_done = pyqtSignal(int, str)       # file_id, путь к сохранённому файлу
+    failed = pyqtSignal(int, str, str)         # file_id, имя файла, текст ошибки
+
+
+    def __init__(self, net, data_dir: str):
+        super().__init__()
+        self.net = net
+        self.files_dir = os.path.join(data_dir, "files")     # скачанные файлы
+        self._state_path = os.path.join(data_dir, "uploads.json")  # незавершённые загрузки
+        os.makedirs(self.files_dir, exist_ok=True)
+
+        self._cond = threading.Condition()   # защищает состояние ниже и будит поток загрузки
+        self._queue: deque[_Upload] = deque()
+        self._current: _Upload | None = None
+        self._downloads: dict[int, _Download] = {}
+        self._running = True
+
+        threading.Thread(target=self._upload_loop, daemon=True).start()
+
+
+    # Ставит файл в очередь на загрузку в чат
+    def upload(self, path: str, to: str):
+        up = _Upload(path, to)
+        if up.size == 0:
+            self.failed.emit(0, up.name, "Файл пустой")
+            return
+        with self._cond:
+            self._queue.append(up)
+            self._cond.notify_all()
+
+
+    # Продолжает загрузки, прерванные закрытием программы или обрывом соединения
+    def resume_pending(self):
+        for st in self._load_state():
+            try:
+                up = _Upload(st["path"], st["to"], st["file_id"])
+            except OSError:
+                continue  # файл удалили — загружать нечего
+            with self._cond:
+                busy = [u.file_id for u in self._queue]
+                if self._current and not self._current.lost:
+                    busy.append(self._current.file_id)
+                if up.file_id in busy:
+                    continue  # уже в очереди или загружается (после переподключения)
+                self._queue.append(up)
+                self._cond.notify_all()
+
+
+    # Запрашивает файл с сервера. Если он уже скачан — сразу сообщает путь,
+    # если скачан частично — докачивает с места обрыва.
+    def download(self, file_id: int, name: str, size: int):
+        # Имя от сервера используем только как имя файла, без каталогов
+        safe = os.path.basename(name.replace("\\", "/")) or "file"
+        path = os.path.join(self.files_dir, f"{file_id}_{safe}")
+        if os.path.exists(path) and os.path.getsize(path) == size:
+            self.download_done.emit(file_id, path)
+            return
+
+        with self._cond:
+            if file_id in self._downloads:
+                return  # уже скачивается
+            d = _Download(file_id, path, size)
+            d.received = os.path.getsize(d.part) if os.path.exists(d.part) else 0
+            if d.received > size:
+                d.received = 0  # от другого файла — начинаем заново
+            d.f = open(d.part, "r+b" if d.received else "wb")
+            d.f.truncate(d.received)
+            d.f.seek(d.received)
+            self._downloads[file_id] = d
+
+        try:
+            self.net.send({"type": "file_download", "file_id": file_id, "offset": d.received})
+        except OSError as e:
+            self._drop_download(d, str(e))
+
+
+    # Соединение оборвалось (вызывается из потока NetworkWorker): текущая загрузка не ждёт
+    # подтверждений, которые уже не придут, а завершается с ошибкой и остаётся в uploads.json
+    def on_disconnect(self):
+        with self._cond:
+            if self._current is not None:
+                self._current.lost = True
+            self._cond.notify_all()
+
+
+    # Соединение восстановлено: недокачанные файлы запрашиваются заново с места обрыва
+    def resume_downloads(self):
+        with self._cond:
+            downloads = list(self._downloads.values())
+        for d in downloads:
+            try:
+                self.net.send({"type": "file_download", "file_id": d.file_id, "offset": d.received})
+            except OSError as e:
+                self._drop_download(d, str(e))
+
+
+    # Останавливает передачи (закрытие окна); незавершённые продолжатся при следующем входе
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+            downloads = list(self._downloads.values())
+            self._downloads.clear()
+        for d in downloads:
+            d.f.close()
+
+
+    # Обработка пакетов передачи файлов (вызывается из потока чтения NetworkWorker)
+    def on_packet(self, pkt: dict):
+        ptype = pkt.get("type")
+        file_id = pkt.get("file_id") or 0
+
+        with self._cond:
+            d = self._downloads.get(file_id)
+            up = self._current
+
+        if d is not None:
+            self._on_download_packet(d, ptype, pkt)
+            return
+        if up is None or (up.file_id and up.file_id != file_id):
+            return  # относится к уже завершённой или отменённой передаче
+
+        with self._cond:
+            if ptype == "file_accept" and up.accepted is None:
+                up.file_id = file_id
+                up.accepted = (pkt.get("offset") or 0, pkt.get("window") or CHUNK_SIZE)
+                up.acked = up.accepted[0]
+            elif ptype == "file_ack":
+                up.acked = max(up.acked, pkt.get("offset") or 0)
+            elif ptype == "file_error":
+                up.error = pkt.get("content") or "Ошибка передачи файла"
+            elif ptype == "error" and up.accepted is None:
+                up.retry_after = pkt.get("retry_after") or 0
+            self._cond.notify_all()
+
+
+    # Пакеты скачивания: куски дописываются в .part и сразу подтверждаются
+    def _on_download_packet(self, d: _Download, ptype: str, pkt: dict):
+        if ptype == "error":
+            timer = threading.Timer(pkt["retry_after"] / 1000, self._resend_download, args=(d,))
+            timer.daemon = True
+            timer.start()
+            return
+        if ptype == "file_error":
+            self._drop_download(d, pkt.get("content") or "Ошибка передачи файла")
+            return
+        if ptype == "file_accept":
+            if (pkt.get("offset") or 0) != d.received:
+                self._drop_download(d, "Сервер начал передачу не с того места")
+            return
+        if ptype != "file_chunk":
+            return
+
+        data = unpack_bytes(pkt.get("data"))
+        if (pkt.get("offset") or 0) != d.received or d.received + len(data) > d.size:
+            self._drop_download(d, "Нарушен порядок кусков файла")
+            return
+        try:
+            d.f.write(data)
+            d.received += len(data)
+            self.net.send({"type": "file_ack", "file_id": d.file_id, "offset": d.received})
+        except OSError as e:
+            self._drop_download(d, str(e))
+            return
+        self.progress.emit(d.file_id, os.path.basename(d.path), d.received, d.size)
+
+        if d.received == d.size:
+            with self._cond:
+                self._downloads.pop(d.file_id, None)
+            d.f.close()
+            os.replace(d.part, d.path)
+            self.download_done.emit(d.file_id, d.path)
+
+
+    # Повторяет отклонённый сервером file_download, если скачивание ещё не отменено
+    def _resend_download(self, d: _Download):
+        with self._cond:
+            if self._downloads.get(d.file_id) is not d:
+                return
+        try:
+            self.net.send({"type": "file_download", "file_id": d.file_id, "offset": d.received})
+        except OSError as e:
+            self._drop_download(d, str(e))
+
+
+    # Прерывает скачивание; уже принятая часть остаётся в .part для докачки
+    def _drop_download(self, d: _Download, error: str):
+        with self._cond:
+            self._downloads.pop(d.file_id, None)
+        d.f.close()
+        self.failed.emit(d.file_id, os.path.basename(d.path), error)
+
+
+    # Поток загрузки: файлы из очереди отправляются по одному
+    def _upload_loop(self):
+        while True:
+            with self._cond:
+                while self._running and not self._queue:
+                    self._cond.wait()
+                if not self._running:
+                    return
+                up = self._queue.popleft()
+                self._current = up
+            try:
+                self._run_upload(up)
+            except (OSError, ValueError) as e:
+                # Обрыв соединения или ошибка чтения — состояние в uploads.json остаётся для докачки
+                self.failed.emit(up.file_id, up.name, str(e))
+            finally:
+                with self._cond:
+                    self._current = None
+
+
+    # Загрузка одного файла: предложение, затем куски с учётом окна, затем ожидание последнего подтверждения
+    def _run_upload(self, up: _Upload):
+        offer = {"type": "file_offer", "to": up.to, "name": up.name, "size": up.size}
+        if up.file_id:
+            offer["file_id"] = up.file_id  # докачка: сервер ответит, сколько байт уже получил
+        while True:
+            self.net.send(offer)
+            self._wait(up, lambda: up.accepted is not None or up.retry_after, ACCEPT_TIMEOUT)
+            if up.accepted is not None:
+                break
+            # Сервер отклонил предложение из-за лимита запросов — ждём и предлагаем снова
+            delay, up.retry_after = up.retry_after, 0
+            with self._cond:
+                self._cond.wait_for(lambda: up.lost or not self._running, delay / 1000)
+        offset, window = up.accepted
+        self._remember(up)
+
+        with open(up.path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if len(mm) != up.size:
+                raise ValueError("файл изменился во время загрузки")
+            sent = offset
+            while sent < up.size:
+                # Не больше окна неподтверждённых байт: иначе сообщения встали бы в очередь за файлом
+                self._wait(up, lambda: sent - up.acked < window, ACK_TIMEOUT)
+                chunk = mm[sent:sent + CHUNK_SIZE]
+                self.net.send({
+                    "type": "file_chunk",
+                    "file_id": up.file_id,
+                    "offset": sent,
+                    "data": self.net.codec.pack_bytes(chunk),
+                })
+                sent += len(chunk)
+                self.progress.emit(up.file_id, up.name, up.acked, up.size)
+
+        self._wait(up, lambda: up.acked >= up.size, ACK_TIMEOUT)
+        self._forget(up)
+        self.progress.emit(up.file_id, up.name, up.size, up.size)
+        self.upload_done.emit(up.file_id, up.name)
+
+
+    # Ждёт условия для загрузки; выбрасывает OSError при ошибке от сервера, остановке или таймауте
+    def _wait(self, up: _Upload, ready, timeout: float):
+        with self._cond:
+            ok = self._cond.wait_for(lambda: ready() or up.error or up.lost or not self._running, timeout)
+            if up.error:
+                if up.file_id:
+                    self._forget(up)  # сервер отказался продолжать — докачивать нечего
+                raise OSError(up.error)
+            if not self._running:
+                raise OSError("передача остановлена")
+            if up.lost:
+                raise OSError("соединение прервано")
+            if not ok:
+                raise OSError("сервер не отвечает")
+
+
+    # Сохраняет загрузку в uploads.json, чтобы продолжить её после перезапуска
+    def _remember(self, up: _Upload):
+        state = [s for s in self._load_state() if s["file_id"] != up.file_id]
+        state.append({"file_id": up.file_id, "path": up.path, "to": up.to})
+        self._save_state(state)
+
+
+    # Удаляет загрузку из uploads.json (завершена или не может быть продолжена)
+    def _forget(self, up: _Upload):
+        self._save_state([s for s in self._load_state() if s["file_id"] != up.file_id])
+
+
+    def _load_state(self) -> list[dict]:
+        try:
+            with open(self._state_path, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return []
+
+
+    def _save_state(self, state: list[dict]):
+        tmp = self._state_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(state, f, ensure_ascii=False)
+        os.replace(tmp, self._state_path)
@@ -2,7 +2,7 @@ package main
 
 import (
 	"context"
-	"encoding/json"
+	"errors"
 	"fmt"
 	"golang.org/x/crypto/bcrypt"
 	"net"
@@ -36,8 +36,14 @@ func handleSignup(conn net.Conn, m Message) {
 		return
 	}
 
-	// Хэшируем пароль с помощью bcrypt
-	hashBytes, err := bcrypt.GenerateFromPassword([]byte(pwd), bcrypt.DefaultCost)
+	// Хэшируем пароль с помощью bcrypt (в пуле проверки паролей)
+	var hashBytes []byte
+	if perr := auth.run("hash", func() {
+		hashBytes, err = bcrypt.GenerateFromPassword([]byte(pwd), bcrypt.DefaultCost)
+	}); perr != nil {
+		sendError(conn, "Сервер перегружен, попробуйте позже")
+		return
+	}
 	if err != nil {
 		sendError(conn, "Ошибка хеширования пароля")
 		return
@@ -55,20 +61,74 @@ func handleSignup(conn net.Conn, m Message) {
 	}
 
 	// Отправляем клиенту сообщение об успешной регистрации
-	resp := Message{Type: "signup_ok", Content: "Регистрация прошла успешно"}
-	data, _ := json.Marshal(resp)
-	conn.Write(append(data, '\n'))
+	sendMessage(conn, Message{Type: "signup_ok", Content: "Регистрация прошла успешно"})
 }
 
-// handleLogin обрабатывает вход пользователя по логину и паролю.
+// handleLogin обрабатывает вход пользователя по логину и паролю
+// или по токену сессии, выданному при прошлом входе (переподключение без bcrypt).
 // Если данные верны — возвращает ID пользователя и отправляет клиенту подтверждение.
-func handleLogin(conn net.Conn, m Message) (userID int64, err error) {
+func handleLogin(conn net.Conn, m Message) (userID, session int64, err error) {
 	username := m.From
-	pwd := m.Password
 
+	if m.Token != "" {
+		// Переподключение: достаточно проверить подпись и срок действия токена
+		if userID, err = verifySessionToken(context.Background(), m.Token, username); err != nil {
+			if errors.Is(err, errSessionReplaced) {
+				sendError(conn, "Выполнен вход на другом устройстве, войдите заново")
+			} else {
+				sendError(conn, "Сессия истекла, войдите заново")
+			}
+			return 0, 0, err
+		}
+	} else if userID, err = checkPassword(conn, username, m.Password); err != nil {
+		return 0, 0, err // ошибка уже отправлена клиенту
+	}
+
+	// Обновляем дату и время последнего входа.
+	// Заодно проверяем, что пользователь с токеном всё ещё существует
+	tag, err := DB.Exec(context.Background(),
+		`UPDATE users SET last_login_at = CURRENT_TIMESTAMP WHERE id = $1 AND username = $2`,
+		userID, username,
+	)
+	if err != nil {
+		// Ошибка не критична — просто выводим в лог
+		fmt.Println("DB warning: не удалось обновить last_login_at:", err)
+	} else if tag.RowsAffected() == 0 {
+		sendError(conn, "Пользователь не найден")
+		return 0, 0, fmt.Errorf("auth failed")
+	}
+
+	// Один вход на пользователя: прежнее соединение на этом узле закрывается сразу,
+	// на другом узле — событием kick при регистрации входа в кластере.
+	// Номер нового входа попадает в токен сессии
+	removeClientByName(username)
+	if session, err = node.claim(context.Background(), userID); err != nil {
+		fmt.Println("Ошибка регистрации входа в кластере:", err)
+		sendError(conn, "Ошибка сервера, попробуйте ещё раз")
+		return 0, 0, err
+	}
+
+	// Отправляем сообщение об успешном входе вместе с новым токеном сессии.
+	// Выбираем формат протокола из предложенного клиентом.
+	// login_ok ещё уходит JSON-строкой, всё последующее — уже в новом формате
+	caps := negotiate(m.Caps)
+	sendMessage(conn, Message{Type: "login_ok", Content: "OK", Caps: caps, Token: newSessionToken(userID, session, username)})
+	if wc, ok := conn.(*wireConn); ok {
+		wc.apply(caps)
+	}
+
+	// Отправляем клиенту список доступных чатов
+	sendChatList(conn, userID)
+	return userID, session, nil
+}
+
+// checkPassword проверяет пароль пользователя и возвращает его ID.
+// bcrypt выполняется в пуле проверки паролей; при ошибке клиенту отправляется её текст.
+func checkPassword(conn net.Conn, username, pwd string) (int64, error) {
 	// Ищем пользователя по логину и получаем его ID и хэш пароля
+	var userID int64
 	var hashInDB string
-	err = DB.QueryRow(context.Background(),
+	err := DB.QueryRow(context.Background(),
 		`SELECT id, password_hash FROM users WHERE username = $1`, username,
 	).Scan(&userID, &hashInDB)
 	if err != nil {
@@ -77,36 +137,24 @@ func handleLogin(conn net.Conn, m Message) (userID int64, err error) {
 	}
 
 	// Проверяем, что переданный пароль совпадает с хэшем
-	if err := bcrypt.CompareHashAndPassword([]byte(hashInDB), []byte(pwd)); err != nil {
+	var cmpErr error
+	if err := auth.run("check", func() {
+		cmpErr = bcrypt.CompareHashAndPassword([]byte(hashInDB), []byte(pwd))
+	}); err != nil {
+		sendError(conn, "Сервер перегружен, попробуйте позже")
+		return 0, err
+	}
+	if cmpErr != nil {
 		sendError(conn, "Неверный пароль")
 		return 0, fmt.Errorf("auth failed")
 	}
-
-	// Обновляем дату и время последнего входа
-	if _, err := DB.Exec(context.Background(),
-		`UPDATE users SET last_login_at = CURRENT_TIMESTAMP WHERE id = $1`,
-		userID,
-	); err != nil {
-		// Ошибка не критична — просто выводим в лог
-		fmt.Println("DB warning: не удалось обновить last_login_at:", err)
-	}
-
-	// Отправляем сообщение об успешном входе
-	resp := Message{Type: "login_ok", Content: "OK"}
-	data, _ := json.Marshal(resp)
-	conn.Write(append(data, '\n'))
-
-	// Отправляем клиенту список доступных чатов
-	sendChatList(conn, userID)
 	return userID, nil
 }
 
 // sendError отправляет клиенту сообщение об ошибке с переданным текстом.
 func sendError(conn net.Conn, text string) {
-	resp := Message{
+	sendMessage(conn, Message{
 		Type:    "error",
 		Content: text,
-	}
-	data, _ := json.Marshal(resp)
-	conn.Write(append(data, '\n'))
+	})
 }
@@ -0,0 +1,90 @@
+package main
+
+import (
+	"errors"
+	"os"
+	"runtime"
+	"strconv"
+	"time"
+)
+
+// Проверка и хэширование паролей (bcrypt) выполняются в ограниченном пуле воркеров,
+// а не в горутине соединения: при массовом переподключении bcrypt не занимает все ядра,
+// а лишние входы сразу получают отказ вместо ожидания в течение минут.
+//
+// Размер пула — AUTH_WORKERS (по умолчанию число ядер), длина очереди — AUTH_QUEUE.
+
+var errAuthBusy = errors.New("очередь проверки паролей переполнена")
+
+// authJob — одна операция bcrypt в очереди пула.
+type authJob struct {
+	op     string    // "check" или "hash" — метка в метриках
+	fn     func()    // сама операция
+	queued time.Time // момент постановки в очередь
+	done   chan struct{}
+}
+
+// authPool — воркеры bcrypt и очередь заданий для них.
+type authPool struct {
+	jobs chan authJob
+}
+
+// auth — пул проверки паролей сервера.
+var auth = newAuthPool(envInt("AUTH_WORKERS", runtime.NumCPU()), envInt("AUTH_QUEUE", 256))
+
+// newAuthPool запускает workers воркеров с очередью на queue заданий.
+func newAuthPool(workers, queue int) *authPool {
+	p := &authPool{jobs: make(chan authJob, queue)}
+	for i := 0; i < workers; i++ {
+		go p.worker()
+	}
+	newGaugeFunc("shichat_auth_queue_depth", "Операции bcrypt, ожидающие воркера.",
+		func() float64 { return float64(len(p.jobs)) })
+	newGaugeFunc("shichat_auth_queue_capacity", "Максимальная длина очереди операций bcrypt.",
+		func() float64 { return float64(cap(p.jobs)) })
+	newGaugeFunc("shichat_auth_workers", "Количество воркеров bcrypt.",
+		func() float64 { return float64(workers) })
+	return p
+}
+
+// worker выполняет задания из очереди.
+func (p *authPool) worker() {
+	for job := range p.jobs {
+		authQueueWait.observeSince(job.op, job.queued)
+		start := time.Now()
+		job.fn()
+		authDuration.observeSince(job.op, start)
+		close(job.done)
+	}
+}
+
+// run выполняет операцию в пуле и ждёт её завершения.
+// Если очередь заполнена, сразу возвращает errAuthBusy.
+func (p *authPool) run(op string, fn func()) error {
+	job := authJob{op: op, fn: fn, queued: time.Now(), done: make(chan struct{})}
+	select {
+	case p.jobs <- job:
+	default:
+		authRejected.inc()
+		return errAuthBusy
+	}
+	<-job.done
+	return nil
+}
+
+// envInt читает положительное целое из переменной окружения (или возвращает значение по умолчанию).
+func envInt(name string, def int) int {
+	if n, err := strconv.Atoi(os.Getenv(name)); err == nil && n > 0 {
+		return n
+	}
+	return def
+}
+
+// envNonNegInt читает из переменной окружения целое не меньше нуля (0 — обычно «выключено»)
+// или возвращает значение по умолчанию.
+func envNonNegInt(name string, def int) int {
+	if n, err := strconv.Atoi(os.Getenv(name)); err == nil && n >= 0 {
+		return n
+	}
+	return def
+}
@@ -2,11 +2,13 @@ package main
 
 import (
 	"context"
-	"encoding/json"
 	"fmt"
 	"net"
 	"strconv"
+	"strings"
 	"time"
+
+	"github.com/jackc/pgx/v5"
 )
 
 // handleMessage обрабатывает входящее сообщение от клиента.
@@ -24,20 +26,24 @@ func handleMessage(senderConn net.Conn, m Message) {
 	ctx := context.Background()
 
 	// Если это не группа — значит, приватный чат, нужно получить chatID вручную
-	var chatID int64
+	var chatID, recvID int64
 	if id, err := strconv.ParseInt(m.To, 10, 64); err == nil {
 		chatID = id // это групповой чат
 	} else {
 		// Получаем ID получателя и создаём приватный чат при необходимости
-		var recvID int64
-		if err := DB.QueryRow(ctx,
+		start := time.Now()
+		err := DB.QueryRow(ctx,
 			`SELECT id FROM users WHERE username=$1`, m.To,
-		).Scan(&recvID); err != nil {
+		).Scan(&recvID)
+		observeQuery("message_resolve_peer", start)
+		if err != nil {
 			sendError(senderConn, "Пользователь не найден")
 			return
 		}
 		var err2 error
+		start = time.Now()
 		chatID, err2 = GetOrCreatePrivateChat(ctx, sender.ID, recvID)
+		observeQuery("message_private_chat", start)
 		if err2 != nil {
 			fmt.Println("Ошибка БД (поиск или создание чата):", err2)
 			return
@@ -49,86 +55,148 @@ func handleMessage(senderConn net.Conn, m Message) {
 		m.Timestamp = time.Now().Unix()
 	}
 	m.From = sender.Name
+	start := time.Now()
 	_ = DB.QueryRow(ctx,
 		`SELECT display_name FROM users WHERE id=$1`, sender.ID,
 	).Scan(&m.DisplayName)
+	observeQuery("message_display_name", start)
 
 	// Сохраняем сообщение в базу данных
-	if _, err := DB.Exec(ctx,
+	var msgID int64
+	var sentAt time.Time
+	start = time.Now()
+	err := DB.QueryRow(ctx,
 		`INSERT INTO messages(chat_id, sender_id, content)
-		 VALUES ($1,$2,$3)`,
+		 VALUES ($1,$2,$3) RETURNING id, sent_at`,
 		chatID, sender.ID, m.Content,
-	); err != nil {
+	).Scan(&msgID, &sentAt)
+	observeQuery("message_insert", start)
+	if err != nil {
 		fmt.Println("Ошибка БД (сохранение сообщения):", err)
 		return
 	}
+	m.Cursor = historyCursor(sentAt, msgID)
+	cached := cachedMessage{id: msgID, senderID: sender.ID, username: sender.Name,
+		displayName: m.DisplayName, content: m.Content, sentAt: sentAt}
+	// Сообщение с вложением: связываем вложение с сохранённым сообщением
+	if m.File != nil {
+		start = time.Now()
+		_, err = DB.Exec(ctx,
+			`UPDATE attachments SET message_id=$1, message_sent_at=$2 WHERE id=$3`, msgID, sentAt, m.File.ID)
+		observeQuery("message_attachment", start)
+		if err != nil {
+			fmt.Println("Ошибка БД (привязка вложения):", err)
+		} else {
+			cached.file = m.File
+		}
+	}
+	messagesTotal.inc()
 
-	// Отправляем сообщение обратно отправителю (эхо)
-	data, _ := json.Marshal(m)
-	data = append(data, '\n')
-	senderConn.Write(data)
+	// Дополняем хвост чата в кэше истории этого узла и (в фоне) остальных узлов
+	hist.add(chatID, cached)
+	broadcastHistory(ctx, chatID, cached)
+	if m.Trace != nil {
+		m.Trace.ServerDBCommit = time.Now().UnixNano()
+	}
 
-	// Рассылаем сообщение другим участникам
-	if _, err := strconv.ParseInt(m.To, 10, 64); err == nil {
+	// Отправляем сообщение обратно отправителю (эхо).
+	// Пакет кодируется один раз на каждый формат протокола и переиспользуется при рассылке
+	pkt := newOutPacket(&m)
+	writePacket(senderConn, m.Type, pkt.bytesFor(senderConn))
+
+	// Получатели: участники группы или собеседник в приватном чате (кроме самого отправителя)
+	fanoutStart := time.Now()
+	var recipients []int64
+	if recvID == 0 {
 		// Групповой чат — получаем всех участников
+		start := time.Now()
 		rows, _ := DB.Query(ctx,
 			`SELECT user_id FROM chat_members WHERE chat_id=$1`, chatID)
-		defer rows.Close()
 		for rows.Next() {
 			var uid int64
 			rows.Scan(&uid)
-			if uid == sender.ID {
-				continue // не отправляем самому себе
-			}
-			mu.Lock()
-			for c, cl := range clients {
-				if cl.ID == uid {
-					c.Write(data)
-				}
+			if uid != sender.ID {
+				recipients = append(recipients, uid)
 			}
-			mu.Unlock()
-		}
-	} else {
-		// Приватный чат — отправляем второму участнику
-		mu.Lock()
-		if rc, ok := nameToConn[m.To]; ok && rc != senderConn {
-			rc.Write(data)
 		}
-		mu.Unlock()
+		rows.Close()
+		observeQuery("message_members", start)
+	} else if recvID != sender.ID {
+		recipients = []int64{recvID}
 	}
 
-	// Обновляем список чатов у отправителя
+	// Рассылаем сообщение другим участникам — на этом узле и на узлах, где они онлайн
+	deliver(ctx, recipients, pkt, senderConn)
+	fanoutDuration.observeSince("message", fanoutStart)
+
+	// Обновляем список чатов у отправителя и остальных участников
+	fanoutStart = time.Now()
+	defer fanoutDuration.observeSince("chatlist", fanoutStart)
 	sendChatList(senderConn, sender.ID)
+	refreshChatLists(ctx, recipients)
+}
 
-	// Также обновляем чат-листы у остальных участников
-	if _, err := strconv.ParseInt(m.To, 10, 64); err == nil {
-		rows, _ := DB.Query(ctx,
-			`SELECT user_id FROM chat_members WHERE chat_id=$1`, chatID)
-		defer rows.Close()
-		for rows.Next() {
-			var uid int64
-			rows.Scan(&uid)
-			mu.Lock()
-			for c, cl := range clients {
-				if cl.ID == uid {
-					sendChatList(c, uid)
-				}
-			}
-			mu.Unlock()
-		}
-	} else {
-		// Приватный чат — обновляем только у собеседника
-		mu.Lock()
-		if rc, ok := nameToConn[m.To]; ok {
-			recipientID := clients[rc].ID
-			sendChatList(rc, recipientID)
-		}
-		mu.Unlock()
+// fanoutData возвращает пакет для записи получателю.
+// Для трассируемых сообщений проставляет время записи в сокет и сериализует пакет заново,
+// иначе возвращает уже готовые данные без лишней работы.
+func fanoutData(pkt *outPacket, conn net.Conn) []byte {
+	if pkt.m.Trace == nil {
+		return pkt.bytesFor(conn)
+	}
+	pkt.m.Trace.ServerFanout = time.Now().UnixNano()
+	return encodePacket(conn, pkt.m)
+}
+
+// historyPage — сколько сообщений истории отдаётся за один запрос (LIMIT в запросах ниже).
+const historyPage = 50
+
+// historyQuery — последние сообщения чата (индекс messages_chat_sent_idx).
+// Секции messages просматриваются от новых к старым, и чтение останавливается,
+// как только набрана страница, — старые месяцы не читаются.
+const historyQuery = `
+	SELECT m.id, m.sender_id, u.username, u.display_name, m.content, m.sent_at,
+	       a.id, a.name, a.size
+	FROM messages m
+	JOIN users u ON u.id = m.sender_id
+	LEFT JOIN attachments a ON a.message_id = m.id
+	WHERE m.chat_id=$1
+	ORDER BY m.sent_at DESC, m.id DESC
+	LIMIT 50`
+
+// historyBeforeQuery — страница истории раньше курсора (sent_at, id).
+// Условие по sent_at отсекает секции новее курсора ещё до чтения индексов.
+const historyBeforeQuery = `
+	SELECT m.id, m.sender_id, u.username, u.display_name, m.content, m.sent_at,
+	       a.id, a.name, a.size
+	FROM messages m
+	JOIN users u ON u.id = m.sender_id
+	LEFT JOIN attachments a ON a.message_id = m.id
+	WHERE m.chat_id=$1 AND m.sent_at <= $2 AND (m.sent_at, m.id) < ($2, $3)
+	ORDER BY m.sent_at DESC, m.id DESC
+	LIMIT 50`
+
+// historyCursor — курсор страницы истории: время (в микросекундах) и ID самого раннего сообщения.
+func historyCursor(sentAt time.Time, id int64) string {
+	return fmt.Sprintf("%d.%d", sentAt.UnixMicro(), id)
+}
+
+// parseHistoryCursor разбирает курсор, присланный клиентом.
+func parseHistoryCursor(s string) (time.Time, int64, bool) {
+	us, id, ok := strings.Cut(s, ".")
+	if !ok {
+		return time.Time{}, 0, false
+	}
+	u, err1 := strconv.ParseInt(us, 10, 64)
+	i, err2 := strconv.ParseInt(id, 10, 64)
+	if err1 != nil || err2 != nil {
+		return time.Time{}, 0, false
 	}
+	return time.UnixMicro(u), i, true
 }
 
 // handleHistoryRequest обрабатывает запрос истории сообщений в чате.
-// Возвращает клиенту 50 последних сообщений в нужном порядке.
+// Возвращает клиенту 50 последних сообщений в нужном порядке, а если в запросе есть курсор —
+// 50 сообщений перед ним. В history_end передаётся курсор следующей (более ранней) страницы.
 func handleHistoryRequest(conn net.Conn, m Message) {
 	// Получаем отправителя по соединению
 	mu.Lock()
@@ -139,62 +207,134 @@ func handleHistoryRequest(conn net.Conn, m Message) {
 	}
 	ctx := context.Background()
 
-	var chatID int64
-	// Если это приватный чат — находим или создаём его
-	if id, err := strconv.ParseInt(m.To, 10, 64); err == nil {
-		chatID = id
+	// В конце (в том числе при ошибке) сообщаем, что история чата передана полностью:
+	// клиент по этому пакету ограничивает число параллельных запросов истории
+	// и запоминает курсор, с которого загружать более ранние сообщения
+	var cursor string
+	defer func() {
+		sendMessage(conn, Message{Type: "history_end", To: m.To, Cursor: cursor})
+	}()
+
+	chatID, ok := historyChatID(ctx, sender, m.To)
+	if !ok {
+		return
+	}
+
+	// Страница: последние сообщения или сообщения перед курсором.
+	// Сначала ищем её в кэше хвостов, затем — в БД
+	var before time.Time
+	var beforeID int64
+	if m.Cursor != "" {
+		if before, beforeID, ok = parseHistoryCursor(m.Cursor); !ok {
+			return
+		}
+	}
+	page, ok := hist.page(chatID, m.Cursor != "", before, beforeID)
+	if ok {
+		historyCacheHits.inc()
 	} else {
-		var rid int64
-		if err := DB.QueryRow(ctx,
-			`SELECT id FROM users WHERE username=$1`, m.To,
-		).Scan(&rid); err != nil {
+		historyCacheMisses.inc()
+		if page, ok = loadHistory(ctx, chatID, m.Cursor != "", before, beforeID); !ok {
 			return
 		}
-		chatID, _ = GetOrCreatePrivateChat(ctx, sender.ID, rid)
 	}
 
-	// Запрашиваем 50 последних сообщений
-	rows, err := DB.Query(ctx, `
-		SELECT m.sender_id, u.username, u.display_name, m.content, m.sent_at
-		FROM messages m
-		JOIN users u ON u.id = m.sender_id
-		WHERE m.chat_id=$1
-		ORDER BY m.sent_at DESC
-		LIMIT 50`, chatID)
+	// Полная страница — возможно, есть и более ранние сообщения
+	if len(page) == historyPage {
+		cursor = historyCursor(page[0].sentAt, page[0].id)
+	}
+
+	// Отправляем клиенту каждое сообщение по одному (от старых к новым)
+	for _, c := range page {
+		from := c.username
+		if c.senderID == sender.ID {
+			from = sender.Name
+		}
+		sendMessage(conn, Message{
+			Type:        "message",
+			From:        from,
+			To:          m.To,
+			Content:     c.content,
+			DisplayName: c.displayName,
+			Timestamp:   c.sentAt.Unix(),
+			History:     true,
+			File:        c.file,
+			Cursor:      historyCursor(c.sentAt, c.id),
+		})
+	}
+}
+
+// historyChatID возвращает ID чата из запроса истории: для группы это сам peer,
+// для приватного чата — чат с собеседником peer (создаётся при необходимости).
+func historyChatID(ctx context.Context, sender *Client, peer string) (int64, bool) {
+	if id, err := strconv.ParseInt(peer, 10, 64); err == nil {
+		return id, true
+	}
+	if id, ok := hist.privateChat(sender.ID, peer); ok {
+		return id, true
+	}
+	var rid int64
+	start := time.Now()
+	err := DB.QueryRow(ctx,
+		`SELECT id FROM users WHERE username=$1`, peer,
+	).Scan(&rid)
+	observeQuery("history_resolve_peer", start)
 	if err != nil {
-		return
+		return 0, false
 	}
-	defer rows.Close()
+	start = time.Now()
+	chatID, err := GetOrCreatePrivateChat(ctx, sender.ID, rid)
+	observeQuery("history_private_chat", start)
+	if err != nil {
+		return 0, false
+	}
+	hist.rememberPrivateChat(sender.ID, peer, chatID)
+	return chatID, true
+}
 
-	var history []Message
+// loadHistory читает страницу истории из БД (от старых к новым).
+// Последняя страница чата заодно становится его хвостом в кэше.
+func loadHistory(ctx context.Context, chatID int64, cursor bool, before time.Time, beforeID int64) ([]cachedMessage, bool) {
+	start := time.Now()
+	defer observeQuery("history_select", start)
+
+	var rows pgx.Rows
+	var err error
+	if cursor {
+		rows, err = DB.Query(ctx, historyBeforeQuery, chatID, before, beforeID)
+	} else {
+		hist.begin(chatID) // до запроса: сообщения, записанные во время чтения, не потеряются
+		rows, err = DB.Query(ctx, historyQuery, chatID)
+	}
+	if err != nil {
+		return nil, false
+	}
+	defer rows.Close()
 
-	// Читаем каждое сообщение из результата
+	// Строки приходят от новых к старым
+	var page []cachedMessage
 	for rows.Next() {
-		var sid int64
-		var username, dname, content string
-		var ts time.Time
-		if err := rows.Scan(&sid, &username, &dname, &content, &ts); err != nil {
-			continue
+		var c cachedMessage
+		var fileID, fileSize *int64
+		var fileName *string
+		if err := rows.Scan(&c.id, &c.senderID, &c.username, &c.displayName, &c.content, &c.sentAt,
+			&fileID, &fileName, &fileSize); err != nil {
+			return nil, false
 		}
-
-		// Формируем структуру Message и добавляем в начало списка
-		from, to := username, m.To
-		if sid == sender.ID {
-			from = sender.Name
+		if fileID != nil {
+			c.file = &FileInfo{ID: *fileID, Name: *fileName, Size: *fileSize}
 		}
-		history = append([]Message{{
-			Type:        "message",
-			From:        from,
-			To:          to,
-			Content:     content,
-			DisplayName: dname,
-			Timestamp:   ts.Unix(),
-		}}, history...)
+		page = append(page, c)
+	}
+	if rows.Err() != nil {
+		return nil, false
+	}
+	for i, j := 0, len(page)-1; i < j; i, j = i+1, j-1 {
+		page[i], page[j] = page[j], page[i]
 	}
 
-	// Отправляем клиенту каждое сообщение по одному
-	for _, msg := range history {
-		data, _ := json.Marshal(msg)
-		conn.Write(append(data, '\n'))
+	if !cursor {
+		hist.fill(chatID, page, len(page) < historyPage)
 	}
+	return page, true
 }
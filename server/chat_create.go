@@ -2,16 +2,23 @@ package main
 
 import (
 	"context"
-	"encoding/json"
+	"errors"
 	"fmt"
 	"net"
+	"strconv"
+	"strings"
+	"time"
+
+	"github.com/jackc/pgx/v5"
 )
 
 // handleStartChat обрабатывает запрос на создание приватного чата.
 // Получает ID собеседника, создаёт (или находит) чат в базе и отправляет клиенту информацию о чате.
 func handleStartChat(conn net.Conn, m Message) {
 	ctx := context.Background()
+	mu.Lock()
 	sender := clients[conn]
+	mu.Unlock()
 	if sender == nil {
 		// Соединение не зарегистрировано как клиент — игнорируем
 		return
@@ -42,21 +49,21 @@ func handleStartChat(conn net.Conn, m Message) {
 	}
 
 	// Отправляем клиенту информацию о созданном чате
-	resp := Message{Type: "chat_created", Chat: &preview}
-	data, _ := json.Marshal(resp)
-	conn.Write(append(data, '\n'))
+	sendMessage(conn, Message{Type: "chat_created", Chat: &preview})
 
 	// Обновляем клиенту список чатов
 	sendChatList(conn, sender.ID)
 
-	if peerConn, ok := nameToConn[m.To]; ok {
-		// peerID мы уже получили запросом к БД выше
-		sendChatList(peerConn, peerID)
+	// Собеседнику — тоже (на любом узле; peerID мы уже получили запросом к БД выше)
+	if peerID != sender.ID {
+		refreshChatLists(ctx, []int64{peerID})
 	}
 }
 
 // handleCreateGroup обрабатывает создание группового чата.
-// Создаёт запись в таблице чатов, добавляет участников и уведомляет всех онлайн-юзеров.
+// Участники ищутся одним запросом, чат и все участники записываются в одной транзакции:
+// если чего-то не хватает, группа не создаётся вовсе. Онлайн-участники получают chat_delta
+// с новой группой вместо полного списка чатов.
 func handleCreateGroup(conn net.Conn, m Message) {
 	// Получаем информацию о создателе чата
 	mu.Lock()
@@ -67,55 +74,46 @@ func handleCreateGroup(conn net.Conn, m Message) {
 	}
 
 	ctx := context.Background()
+	start := time.Now()
+	defer observeQuery("group_create", start)
 
-	// Формируем список участников: все из сообщения + сам создатель
-	members := append(m.Participants, sender.Name)
-
-	// Удаляем дубликаты имён (на всякий случай)
-	uniq := make(map[string]struct{})
-	var usersList []string
-	for _, u := range members {
-		if _, seen := uniq[u]; !seen {
-			uniq[u] = struct{}{}
-			usersList = append(usersList, u)
-		}
+	tx, err := DB.Begin(ctx)
+	if err != nil {
+		fmt.Println("Ошибка БД (создание группы):", err)
+		return
 	}
+	defer tx.Rollback(context.Background()) // после Commit ничего не делает
 
-	// Получаем user_id по username для всех участников
-	var userIDs []int64
-	for _, uname := range usersList {
-		var uid int64
-		if err := DB.QueryRow(ctx,
-			`SELECT id FROM users WHERE username=$1`, uname,
-		).Scan(&uid); err != nil {
-			sendError(conn, fmt.Sprintf("Пользователь %s не найден", uname))
-			return
-		}
-		userIDs = append(userIDs, uid)
+	// Участники: все из сообщения + сам создатель
+	userIDs, missing, err := resolveUsers(ctx, tx, append(m.Participants, sender.Name))
+	if err != nil {
+		fmt.Println("Ошибка БД (создание группы):", err)
+		return
+	}
+	if len(missing) > 0 {
+		sendError(conn, "Пользователь не найден: "+strings.Join(missing, ", "))
+		return
 	}
 
-	// Создаём новый групповой чат в базе данных
+	// Создаём групповой чат и добавляем всех участников одним оператором
 	var chatID int64
-	err := DB.QueryRow(ctx,
-		`INSERT INTO chats(is_group, title, creator_id)
-         VALUES (true, $1, $2)
-         RETURNING id`,
+	if err := tx.QueryRow(ctx,
+		`INSERT INTO chats(is_group, title, creator_id) VALUES (true, $1, $2) RETURNING id`,
 		m.Name, sender.ID,
-	).Scan(&chatID)
-	if err != nil {
-		fmt.Println("Ошибка БД (добавление участника в группу):", err)
+	).Scan(&chatID); err != nil {
+		fmt.Println("Ошибка БД (создание группы):", err)
 		return
 	}
-
-	// Добавляем каждого участника в таблицу chat_members
-	for _, uid := range userIDs {
-		if _, err := DB.Exec(ctx,
-			`INSERT INTO chat_members(chat_id, user_id) VALUES($1,$2)`,
-			chatID, uid,
-		); err != nil {
-			fmt.Println("Ошибка БД (добавление участника в группу):", err)
-			return
-		}
+	if _, err := tx.Exec(ctx,
+		`INSERT INTO chat_members(chat_id, user_id) SELECT $1, unnest($2::BIGINT[])`,
+		chatID, userIDs,
+	); err != nil {
+		fmt.Println("Ошибка БД (добавление участников группы):", err)
+		return
+	}
+	if err := tx.Commit(ctx); err != nil {
+		fmt.Println("Ошибка БД (создание группы):", err)
+		return
 	}
 
 	// Отправляем клиенту информацию о новой группе
@@ -123,21 +121,224 @@ func handleCreateGroup(conn net.Conn, m Message) {
 		ChatID:      chatID,
 		Peer:        fmt.Sprint(chatID), // для группы peer — это строка с ID
 		DisplayName: m.Name,
-		LastMsg:     "",
-		LastTS:      0,
 	}
-	resp := Message{Type: "group_created", Chat: &preview}
-	data, _ := json.Marshal(resp)
-	conn.Write(append(data, '\n'))
+	sendMessage(conn, Message{Type: "group_created", Chat: &preview})
 
-	// Всем онлайн-участникам отправляем обновлённый список чатов
+	// Всем онлайн-участникам (на любом узле) — новая строка списка чатов
+	deliver(ctx, userIDs, newOutPacket(&Message{Type: "chat_delta", Op: "add", Chat: &preview}), nil)
+}
+
+// handleGroupAdd добавляет участников в группу (m.To — ID группы, m.Participants — логины).
+// Добавлять может любой участник группы. Новые участники получают chat_delta с группой.
+func handleGroupAdd(conn net.Conn, m Message) {
+	mu.Lock()
+	sender := clients[conn]
+	mu.Unlock()
+	if sender == nil {
+		return
+	}
+	chatID, err := strconv.ParseInt(m.To, 10, 64)
+	if err != nil {
+		return
+	}
+
+	ctx := context.Background()
+	start := time.Now()
+	defer observeQuery("group_add", start)
+
+	tx, err := DB.Begin(ctx)
+	if err != nil {
+		fmt.Println("Ошибка БД (добавление в группу):", err)
+		return
+	}
+	defer tx.Rollback(context.Background())
+
+	title, _, err := lockGroup(ctx, tx, chatID, sender.ID)
+	if err != nil {
+		sendGroupError(conn, err)
+		return
+	}
+	userIDs, missing, err := resolveUsers(ctx, tx, m.Participants)
+	if err != nil {
+		fmt.Println("Ошибка БД (добавление в группу):", err)
+		return
+	}
+	if len(missing) > 0 {
+		sendError(conn, "Пользователь не найден: "+strings.Join(missing, ", "))
+		return
+	}
+
+	// Уже состоящие в группе пропускаются; RETURNING отдаёт только действительно добавленных
+	added, err := collectIDs(tx.Query(ctx, `
+		INSERT INTO chat_members(chat_id, user_id) SELECT $1, unnest($2::BIGINT[])
+		ON CONFLICT DO NOTHING
+		RETURNING user_id`, chatID, userIDs))
+	if err != nil {
+		fmt.Println("Ошибка БД (добавление в группу):", err)
+		return
+	}
+	if err := tx.Commit(ctx); err != nil {
+		fmt.Println("Ошибка БД (добавление в группу):", err)
+		return
+	}
+
+	preview := ChatPreview{ChatID: chatID, Peer: fmt.Sprint(chatID), DisplayName: title}
+	// Последнее сообщение группы — для строки в списке чатов новых участников
+	DB.QueryRow(ctx, `
+		SELECT content, EXTRACT(EPOCH FROM sent_at)::BIGINT
+		FROM messages WHERE chat_id=$1
+		ORDER BY sent_at DESC, id DESC LIMIT 1`, chatID,
+	).Scan(&preview.LastMsg, &preview.LastTS)
+	deliver(ctx, added, newOutPacket(&Message{Type: "chat_delta", Op: "add", Chat: &preview}), nil)
+}
+
+// handleGroupRemove удаляет участников из группы (m.To — ID группы, m.Participants — логины).
+// Выйти из группы может любой участник, удалять других — только создатель группы.
+// Удалённые участники получают chat_delta, убирающий группу из их списка чатов.
+func handleGroupRemove(conn net.Conn, m Message) {
+	mu.Lock()
+	sender := clients[conn]
+	mu.Unlock()
+	if sender == nil {
+		return
+	}
+	chatID, err := strconv.ParseInt(m.To, 10, 64)
+	if err != nil {
+		return
+	}
+
+	ctx := context.Background()
+	start := time.Now()
+	defer observeQuery("group_remove", start)
+
+	tx, err := DB.Begin(ctx)
+	if err != nil {
+		fmt.Println("Ошибка БД (удаление из группы):", err)
+		return
+	}
+	defer tx.Rollback(context.Background())
+
+	_, creator, err := lockGroup(ctx, tx, chatID, sender.ID)
+	if err != nil {
+		sendGroupError(conn, err)
+		return
+	}
+	userIDs, _, err := resolveUsers(ctx, tx, m.Participants)
+	if err != nil {
+		fmt.Println("Ошибка БД (удаление из группы):", err)
+		return
+	}
 	for _, uid := range userIDs {
-		mu.Lock()
-		for c, cl := range clients {
-			if cl.ID == uid {
-				sendChatList(c, uid)
-			}
+		if uid != sender.ID && creator != sender.ID {
+			sendError(conn, "Удалять участников может только создатель группы")
+			return
+		}
+	}
+
+	removed, err := collectIDs(tx.Query(ctx,
+		`DELETE FROM chat_members WHERE chat_id=$1 AND user_id = ANY($2) RETURNING user_id`,
+		chatID, userIDs))
+	if err != nil {
+		fmt.Println("Ошибка БД (удаление из группы):", err)
+		return
+	}
+	if err := tx.Commit(ctx); err != nil {
+		fmt.Println("Ошибка БД (удаление из группы):", err)
+		return
+	}
+
+	preview := ChatPreview{ChatID: chatID, Peer: fmt.Sprint(chatID)}
+	deliver(ctx, removed, newOutPacket(&Message{Type: "chat_delta", Op: "remove", Chat: &preview}), nil)
+}
+
+// errNotInGroup — группы нет или отправитель в ней не состоит.
+var errNotInGroup = errors.New("группа не найдена")
+
+// lockGroup проверяет, что userID состоит в группе, и блокирует строку группы до конца транзакции:
+// изменения состава одной группы выполняются по очереди. Возвращает название и создателя группы.
+func lockGroup(ctx context.Context, tx pgx.Tx, chatID, userID int64) (string, int64, error) {
+	var title *string
+	var creator *int64
+	err := tx.QueryRow(ctx, `
+		SELECT c.title, c.creator_id
+		FROM chats c
+		JOIN chat_members cm ON cm.chat_id = c.id AND cm.user_id = $2
+		WHERE c.id = $1 AND c.is_group
+		FOR UPDATE OF c`, chatID, userID,
+	).Scan(&title, &creator)
+	if errors.Is(err, pgx.ErrNoRows) {
+		return "", 0, errNotInGroup
+	}
+	if err != nil {
+		return "", 0, err
+	}
+	var t string
+	var c int64
+	if title != nil {
+		t = *title
+	}
+	if creator != nil {
+		c = *creator
+	}
+	return t, c, nil
+}
+
+// sendGroupError сообщает клиенту, что группа недоступна; ошибки БД только записываются в лог.
+func sendGroupError(conn net.Conn, err error) {
+	if errors.Is(err, errNotInGroup) {
+		sendError(conn, "Группа не найдена")
+		return
+	}
+	fmt.Println("Ошибка БД (группа):", err)
+}
+
+// resolveUsers находит ID пользователей по логинам одним запросом (повторы убираются).
+// Возвращает найденные ID и логины, которых нет в базе.
+func resolveUsers(ctx context.Context, tx pgx.Tx, names []string) ([]int64, []string, error) {
+	rows, err := tx.Query(ctx, `SELECT id, username FROM users WHERE username = ANY($1)`, names)
+	if err != nil {
+		return nil, nil, err
+	}
+	defer rows.Close()
+
+	found := make(map[string]bool, len(names))
+	var ids []int64
+	for rows.Next() {
+		var id int64
+		var name string
+		if err := rows.Scan(&id, &name); err != nil {
+			return nil, nil, err
+		}
+		found[name] = true
+		ids = append(ids, id)
+	}
+	if err := rows.Err(); err != nil {
+		return nil, nil, err
+	}
+
+	var missing []string
+	for _, n := range names {
+		if !found[n] {
+			found[n] = true // каждый отсутствующий логин — один раз
+			missing = append(missing, n)
+		}
+	}
+	return ids, missing, nil
+}
+
+// collectIDs читает столбец ID из результата запроса.
+func collectIDs(rows pgx.Rows, err error) ([]int64, error) {
+	if err != nil {
+		return nil, err
+	}
+	defer rows.Close()
+	var ids []int64
+	for rows.Next() {
+		var id int64
+		if err := rows.Scan(&id); err != nil {
+			return nil, err
 		}
-		mu.Unlock()
+		ids = append(ids, id)
 	}
+	return ids, rows.Err()
 }
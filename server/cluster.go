@@ -0,0 +1,258 @@
+package main
+
+import (
+	"context"
+	"fmt"
+	"net"
+	"os"
+	"sync/atomic"
+)
+
+// Работа нескольких узлов (процессов сервера) с общей базой.
+//
+// Клиенты каждого узла хранятся в его локальных картах (clients, nameToConn, idToConn).
+// Чтобы пакет дошёл до пользователя, подключённого к другому узлу, узлы обмениваются
+// событиями через шину (интерфейс cluster):
+//
+//	deliver  — отправить пакет перечисленным пользователям этого узла;
+//	chatlist — обновить им список чатов;
+//	kick     — закрыть соединение пользователя: он вошёл на другом узле;
+//	history  — в чат записано сообщение: дополнить им хвост чата в кэше истории (всем узлам);
+//	presence — отправить пользователям этого узла изменения присутствия (см. presence.go).
+//
+// Рассылка сначала отправляет пакет локальным получателям, затем спрашивает у шины,
+// на каких узлах онлайн остальные, и отправляет каждому такому узлу одно событие.
+// Узлы, где получателей нет, событий не получают.
+//
+// Реализации: localCluster — один процесс, без обращений к БД (по умолчанию);
+// pgCluster — PostgreSQL LISTEN/NOTIFY и таблица presence (CLUSTER=postgres).
+
+// cluster — связь узла с остальными узлами.
+type cluster interface {
+	// claim регистрирует вход пользователя на этом узле и возвращает номер сессии.
+	// Прежний вход того же пользователя на другом узле закрывается (один вход на кластер).
+	claim(ctx context.Context, userID int64) (int64, error)
+	// current возвращает номер текущего входа пользователя в кластере (0 — пользователь не онлайн).
+	current(ctx context.Context, userID int64) (int64, error)
+	// release снимает регистрацию при отключении (если её не перехватил более новый вход).
+	release(ctx context.Context, userID, session int64)
+	// route возвращает другие узлы, на которых онлайн кто-то из пользователей, и их пользователей.
+	route(ctx context.Context, userIDs []int64) (map[string][]int64, error)
+	// publish отправляет событие узлу node.
+	publish(ctx context.Context, node string, ev *busEvent) error
+	// broadcast отправляет событие всем узлам (включая этот: свои события узел пропускает).
+	broadcast(ctx context.Context, ev *busEvent) error
+	// listen принимает события, адресованные этому узлу, до отмены ctx.
+	listen(ctx context.Context, handle func(*busEvent))
+}
+
+// busEvent — событие, которое узел отправляет другому узлу.
+type busEvent struct {
+	Kind    string   `json:"kind"`              // "deliver", "chatlist", "kick", "history" или "presence"
+	From    string   `json:"from"`              // узел-отправитель
+	Users   []int64  `json:"users,omitempty"`   // пользователи узла-получателя, которых касается событие
+	Session int64    `json:"session,omitempty"` // kick: сессия нового входа (закрываются более старые)
+	Packet  *Message `json:"packet,omitempty"`  // deliver: пакет для получателей
+	Chat    int64    `json:"chat,omitempty"`    // history: чат, в который записано сообщение
+	// history: само сообщение (нет — не влезло в событие, хвост чата сбрасывается)
+	Message *busMessage `json:"message,omitempty"`
+	// presence: изменения для каждого получателя на узле
+	Presence map[int64][]PresenceChange `json:"presence,omitempty"`
+	Ref      int64                      `json:"ref,omitempty"` // событие не влезло в NOTIFY и лежит в bus_payloads
+}
+
+// Узел, на котором работает этот процесс
+var (
+	nodeID = defaultNodeID() // имя узла (NODE_ID)
+	node   cluster           // выбирается в startCluster
+)
+
+// defaultNodeID возвращает имя узла из NODE_ID или строит его из имени хоста и PID.
+func defaultNodeID() string {
+	if id := os.Getenv("NODE_ID"); id != "" {
+		return id
+	}
+	host, _ := os.Hostname()
+	return fmt.Sprintf("%s-%d", host, os.Getpid())
+}
+
+// startCluster выбирает реализацию шины по переменной окружения CLUSTER
+// и запускает приём событий от других узлов.
+func startCluster(ctx context.Context) error {
+	switch os.Getenv("CLUSTER") {
+	case "", "local":
+		node = &localCluster{}
+	case "postgres":
+		pg, err := newPgCluster(ctx, nodeID)
+		if err != nil {
+			return err
+		}
+		node = pg
+	default:
+		return fmt.Errorf("неизвестное значение CLUSTER: %q", os.Getenv("CLUSTER"))
+	}
+	go node.listen(ctx, handleBusEvent)
+	go sendHistoryEvents(ctx)
+	fmt.Println("Узел:", nodeID)
+	return nil
+}
+
+// localCluster — единственный узел: все клиенты в этом процессе, других узлов нет.
+type localCluster struct {
+	sessions atomic.Int64
+}
+
+func (c *localCluster) claim(ctx context.Context, userID int64) (int64, error) {
+	return c.sessions.Add(1), nil
+}
+
+func (c *localCluster) current(ctx context.Context, userID int64) (int64, error) {
+	mu.Lock()
+	defer mu.Unlock()
+	if conn, ok := idToConn[userID]; ok {
+		return clients[conn].Session, nil
+	}
+	return 0, nil
+}
+
+func (c *localCluster) release(ctx context.Context, userID, session int64) {}
+
+func (c *localCluster) route(ctx context.Context, userIDs []int64) (map[string][]int64, error) {
+	return nil, nil
+}
+
+func (c *localCluster) publish(ctx context.Context, node string, ev *busEvent) error { return nil }
+
+func (c *localCluster) broadcast(ctx context.Context, ev *busEvent) error { return nil }
+
+func (c *localCluster) listen(ctx context.Context, handle func(*busEvent)) {}
+
+// handleBusEvent выполняет событие, пришедшее от другого узла.
+func handleBusEvent(ev *busEvent) {
+	switch ev.Kind {
+	case "deliver":
+		if ev.Packet != nil {
+			deliverLocal(ev.Users, newOutPacket(ev.Packet), nil)
+		}
+	case "chatlist":
+		go refreshLocalChatLists(ev.Users) // запросы к БД не задерживают следующие события
+	case "kick":
+		mu.Lock()
+		for _, uid := range ev.Users {
+			if c, ok := idToConn[uid]; ok && clients[c].Session < ev.Session {
+				replaceSessionLocked(c)
+			}
+		}
+		mu.Unlock()
+	case "history":
+		if ev.From == nodeID {
+			break
+		}
+		if ev.Message != nil {
+			hist.add(ev.Chat, ev.Message.cached())
+		} else {
+			hist.drop(ev.Chat)
+		}
+	case "presence":
+		deliverPresenceLocal(ev.Presence) // получатели, успевшие отключиться, пропускаются
+	}
+}
+
+// deliver отправляет пакет пользователям userIDs на всех узлах (кроме соединения skip).
+func deliver(ctx context.Context, userIDs []int64, pkt *outPacket, skip net.Conn) {
+	deliverLocal(userIDs, pkt, skip)
+	publishTo(ctx, userIDs, &busEvent{Kind: "deliver", Packet: pkt.m})
+}
+
+// refreshChatLists отправляет свежий список чатов пользователям userIDs на всех узлах.
+func refreshChatLists(ctx context.Context, userIDs []int64) {
+	refreshLocalChatLists(userIDs)
+	publishTo(ctx, userIDs, &busEvent{Kind: "chatlist"})
+}
+
+// deliverLocal отправляет пакет тем из пользователей, кто подключён к этому узлу.
+func deliverLocal(userIDs []int64, pkt *outPacket, skip net.Conn) {
+	mu.Lock()
+	for _, uid := range userIDs {
+		if c, ok := idToConn[uid]; ok && c != skip {
+			writePacket(c, pkt.m.Type, fanoutData(pkt, c))
+		}
+	}
+	mu.Unlock()
+}
+
+// refreshLocalChatLists отправляет список чатов тем из пользователей, кто подключён к этому узлу.
+// Соединения собираются под mu, а запросы к БД выполняются уже без блокировки.
+func refreshLocalChatLists(userIDs []int64) {
+	type target struct {
+		conn net.Conn
+		uid  int64
+	}
+	var targets []target
+	mu.Lock()
+	for _, uid := range userIDs {
+		if c, ok := idToConn[uid]; ok {
+			targets = append(targets, target{c, uid})
+		}
+	}
+	mu.Unlock()
+	for _, t := range targets {
+		sendChatList(t.conn, t.uid)
+	}
+}
+
+// publishTo отправляет событие узлам, на которых онлайн кто-то из пользователей.
+// Каждый узел получает одно событие со списком только своих пользователей.
+func publishTo(ctx context.Context, userIDs []int64, ev *busEvent) {
+	if len(userIDs) == 0 {
+		return
+	}
+	routes, err := node.route(ctx, userIDs)
+	if err != nil {
+		fmt.Println("Ошибка маршрутизации между узлами:", err)
+		return
+	}
+	for n, users := range routes {
+		e := *ev
+		e.From, e.Users = nodeID, users
+		if err := node.publish(ctx, n, &e); err != nil {
+			fmt.Println("Ошибка отправки события узлу", n+":", err)
+		}
+	}
+}
+
+// broadcast отправляет событие всем узлам кластера.
+func broadcast(ctx context.Context, ev *busEvent) {
+	ev.From = nodeID
+	if err := node.broadcast(ctx, ev); err != nil {
+		fmt.Println("Ошибка отправки события узлам:", err)
+	}
+}
+
+// historyQueue — события "history", ждущие отправки узлам. Их отправляет отдельная горутина
+// (sendHistoryEvents), чтобы pg_notify не задерживал обработку каждого сообщения.
+var historyQueue = make(chan *busEvent, 4096)
+
+// broadcastHistory сообщает всем узлам о сохранённом в чат сообщении, не дожидаясь отправки.
+// Если очередь переполнена, событие отправляется сразу: потерянное событие оставило бы
+// хвост чата на других узлах без этого сообщения.
+func broadcastHistory(ctx context.Context, chatID int64, msg cachedMessage) {
+	ev := &busEvent{Kind: "history", Chat: chatID, Message: newBusMessage(msg)}
+	select {
+	case historyQueue <- ev:
+	default:
+		broadcast(ctx, ev)
+	}
+}
+
+// sendHistoryEvents отправляет события из historyQueue до отмены ctx.
+func sendHistoryEvents(ctx context.Context) {
+	for {
+		select {
+		case <-ctx.Done():
+			return
+		case ev := <-historyQueue:
+			broadcast(ctx, ev)
+		}
+	}
+}
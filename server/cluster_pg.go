@@ -0,0 +1,305 @@
+package main
+
+import (
+	"context"
+	"encoding/json"
+	"errors"
+	"fmt"
+	"strings"
+	"time"
+
+	"github.com/jackc/pgx/v5"
+)
+
+// broadcastChannel — общий канал LISTEN/NOTIFY всех узлов.
+const broadcastChannel = "shichat_all"
+
+// maxNotifyPayload — предел полезной нагрузки NOTIFY (в PostgreSQL — 8000 байт).
+// Более крупные события кладутся в таблицу bus_payloads, а в NOTIFY уходит только ссылка.
+const maxNotifyPayload = 7900
+
+// clusterDDL — таблицы для работы нескольких узлов (миграция 7).
+// Обе таблицы UNLOGGED: их содержимое имеет смысл только пока узлы работают,
+// а запись без WAL дешевле (входы и выходы пользователей — частые операции).
+const clusterDDL = `
+	CREATE SEQUENCE IF NOT EXISTS presence_session_seq;
+	CREATE UNLOGGED TABLE IF NOT EXISTS presence (
+		user_id      BIGINT PRIMARY KEY REFERENCES users(id) ON DELETE CASCADE,
+		node_id      TEXT NOT NULL,
+		session      BIGINT NOT NULL,
+		connected_at TIMESTAMPTZ NOT NULL DEFAULT now()
+	);
+	CREATE INDEX IF NOT EXISTS presence_node_idx ON presence(node_id);
+	CREATE UNLOGGED TABLE IF NOT EXISTS bus_payloads (
+		id         BIGSERIAL PRIMARY KEY,
+		body       TEXT NOT NULL,
+		created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+	)`
+
+// pgCluster — узлы, связанные через PostgreSQL.
+// Таблица presence хранит, на каком узле онлайн каждый пользователь (не больше одной строки на пользователя),
+// события доставляются через NOTIFY в канал узла-получателя.
+type pgCluster struct {
+	node    string
+	channel string // канал LISTEN/NOTIFY этого узла
+}
+
+// newPgCluster удаляет записи, оставшиеся от прошлого запуска этого узла.
+func newPgCluster(ctx context.Context, node string) (*pgCluster, error) {
+	if _, err := DB.Exec(ctx, `DELETE FROM presence WHERE node_id=$1`, node); err != nil {
+		return nil, fmt.Errorf("очистка presence: %w", err)
+	}
+	// Ссылки на события, которые так и не были получены (узел-получатель остановился)
+	if _, err := DB.Exec(ctx, `DELETE FROM bus_payloads WHERE created_at < now() - interval '1 hour'`); err != nil {
+		return nil, fmt.Errorf("очистка bus_payloads: %w", err)
+	}
+	return &pgCluster{node: node, channel: channelFor(node)}, nil
+}
+
+// channelFor возвращает имя канала NOTIFY для узла (имя канала — не длиннее 63 байт).
+func channelFor(node string) string {
+	ch := "shichat_node_" + strings.ToLower(node)
+	if len(ch) > 63 {
+		ch = ch[:63]
+	}
+	return ch
+}
+
+// claim записывает, что пользователь теперь онлайн на этом узле, и закрывает его прежний вход на другом узле.
+// Прежний узел читается под блокировкой строки presence в той же транзакции, что и замена:
+// из двух одновременных входов второй дождётся первого и увидит его узел.
+func (c *pgCluster) claim(ctx context.Context, userID int64) (int64, error) {
+	start := time.Now()
+	session, prev, err := c.takeOver(ctx, userID)
+	observeQuery("presence_claim", start)
+	if err != nil {
+		return 0, err
+	}
+	if prev != "" && prev != c.node {
+		// Номер сессии растёт по всему кластеру: старый узел закроет только более ранние входы
+		ev := &busEvent{Kind: "kick", From: c.node, Users: []int64{userID}, Session: session}
+		if err := c.publish(ctx, prev, ev); err != nil {
+			fmt.Println("Ошибка отправки события узлу", prev+":", err)
+		}
+	}
+	return session, nil
+}
+
+// takeOver записывает вход пользователя на этот узел и возвращает номер сессии и прежний узел ("" — записи не было).
+func (c *pgCluster) takeOver(ctx context.Context, userID int64) (int64, string, error) {
+	for {
+		tx, err := DB.Begin(ctx)
+		if err != nil {
+			return 0, "", err
+		}
+		session, prev, err := c.takeOverTx(ctx, tx, userID)
+		if errors.Is(err, pgx.ErrNoRows) {
+			tx.Rollback(context.Background())
+			continue // запись удалили между вставкой и блокировкой (прежний вход вышел) — заново
+		}
+		if err == nil {
+			err = tx.Commit(ctx)
+		}
+		if err != nil {
+			tx.Rollback(context.Background())
+			return 0, "", err
+		}
+		return session, prev, nil
+	}
+}
+
+// takeOverTx — одна попытка takeOver в транзакции tx.
+func (c *pgCluster) takeOverTx(ctx context.Context, tx pgx.Tx, userID int64) (int64, string, error) {
+	// Записи нет — вставляем свою. Если параллельный вход вставляет её же, вставка ждёт его фиксации
+	var session int64
+	err := tx.QueryRow(ctx, `
+		INSERT INTO presence(user_id, node_id, session)
+		VALUES ($1, $2, nextval('presence_session_seq'))
+		ON CONFLICT (user_id) DO NOTHING
+		RETURNING session`, userID, c.node,
+	).Scan(&session)
+	if err == nil {
+		return session, "", nil
+	}
+	if !errors.Is(err, pgx.ErrNoRows) {
+		return 0, "", err
+	}
+
+	// Запись есть: блокируем её, запоминаем прежний узел и занимаем
+	var prev string
+	if err := tx.QueryRow(ctx,
+		`SELECT node_id FROM presence WHERE user_id=$1 FOR UPDATE`, userID,
+	).Scan(&prev); err != nil {
+		return 0, "", err
+	}
+	err = tx.QueryRow(ctx, `
+		UPDATE presence SET node_id=$2, session=nextval('presence_session_seq'), connected_at=now()
+		WHERE user_id=$1
+		RETURNING session`, userID, c.node,
+	).Scan(&session)
+	return session, prev, err
+}
+
+// current возвращает номер входа, под которым пользователь записан в presence.
+func (c *pgCluster) current(ctx context.Context, userID int64) (int64, error) {
+	var session int64
+	start := time.Now()
+	err := DB.QueryRow(ctx, `SELECT session FROM presence WHERE user_id=$1`, userID).Scan(&session)
+	observeQuery("presence_current", start)
+	if errors.Is(err, pgx.ErrNoRows) {
+		return 0, nil
+	}
+	return session, err
+}
+
+// release удаляет запись о пользователе, если она всё ещё принадлежит этому входу.
+func (c *pgCluster) release(ctx context.Context, userID, session int64) {
+	start := time.Now()
+	if _, err := DB.Exec(ctx,
+		`DELETE FROM presence WHERE user_id=$1 AND session=$2`, userID, session,
+	); err != nil {
+		fmt.Println("Ошибка БД (presence):", err)
+	}
+	observeQuery("presence_release", start)
+}
+
+// route группирует онлайн-пользователей других узлов по узлам.
+func (c *pgCluster) route(ctx context.Context, userIDs []int64) (map[string][]int64, error) {
+	start := time.Now()
+	defer observeQuery("presence_route", start)
+	rows, err := DB.Query(ctx, `
+		SELECT node_id, array_agg(user_id)
+		FROM presence
+		WHERE user_id = ANY($1) AND node_id <> $2
+		GROUP BY node_id`, userIDs, c.node)
+	if err != nil {
+		return nil, err
+	}
+	defer rows.Close()
+
+	routes := make(map[string][]int64)
+	for rows.Next() {
+		var n string
+		var users []int64
+		if err := rows.Scan(&n, &users); err != nil {
+			return nil, err
+		}
+		routes[n] = users
+	}
+	return routes, rows.Err()
+}
+
+// publish отправляет событие в канал узла. Крупное событие сохраняется в bus_payloads,
+// а в NOTIFY уходит ссылка на него.
+func (c *pgCluster) publish(ctx context.Context, node string, ev *busEvent) error {
+	body, err := json.Marshal(ev)
+	if err != nil {
+		return err
+	}
+	if len(body) > maxNotifyPayload {
+		var ref int64
+		if err := DB.QueryRow(ctx,
+			`INSERT INTO bus_payloads(body) VALUES ($1) RETURNING id`, string(body),
+		).Scan(&ref); err != nil {
+			return err
+		}
+		body, _ = json.Marshal(&busEvent{Kind: ev.Kind, From: ev.From, Ref: ref})
+	}
+
+	return c.notify(ctx, channelFor(node), body)
+}
+
+// broadcast отправляет событие в общий канал. Такие события в bus_payloads не кладутся:
+// строку оттуда удаляет первый же получатель. Сообщение, с которым событие "history" не влезает
+// в NOTIFY, отправляется без него — узлы тогда сбрасывают хвост чата.
+func (c *pgCluster) broadcast(ctx context.Context, ev *busEvent) error {
+	body, err := json.Marshal(ev)
+	if err != nil {
+		return err
+	}
+	if len(body) > maxNotifyPayload && ev.Message != nil {
+		e := *ev
+		e.Message = nil
+		if body, err = json.Marshal(&e); err != nil {
+			return err
+		}
+	}
+	return c.notify(ctx, broadcastChannel, body)
+}
+
+// notify отправляет тело события в канал.
+func (c *pgCluster) notify(ctx context.Context, channel string, body []byte) error {
+	start := time.Now()
+	_, err := DB.Exec(ctx, `SELECT pg_notify($1, $2)`, channel, string(body))
+	observeQuery("bus_publish", start)
+	if err == nil {
+		busPublished.inc()
+	}
+	return err
+}
+
+// listen держит отдельное соединение с LISTEN на канале узла и общем канале,
+// и переподключается при обрыве.
+// События, отправленные, пока соединения нет, теряются (как и пакеты клиенту, который отключён).
+func (c *pgCluster) listen(ctx context.Context, handle func(*busEvent)) {
+	for ctx.Err() == nil {
+		if err := c.listenOnce(ctx, handle); err != nil && ctx.Err() == nil {
+			fmt.Println("Шина узлов: соединение потеряно, переподключение:", err)
+			time.Sleep(time.Second)
+		}
+	}
+}
+
+// listenOnce принимает уведомления до первой ошибки.
+// Соединение создаётся вне пула: оно всё время занято ожиданием уведомлений.
+func (c *pgCluster) listenOnce(ctx context.Context, handle func(*busEvent)) error {
+	conn, err := pgx.ConnectConfig(ctx, DB.Config().ConnConfig)
+	if err != nil {
+		return err
+	}
+	defer conn.Close(context.Background())
+
+	for _, ch := range []string{c.channel, broadcastChannel} {
+		if _, err := conn.Exec(ctx, "LISTEN "+pgx.Identifier{ch}.Sanitize()); err != nil {
+			return err
+		}
+	}
+	// Пока соединения не было, события "history" могли быть пропущены — кэш истории мог устареть
+	hist.clear()
+	for {
+		n, err := conn.WaitForNotification(ctx)
+		if err != nil {
+			return err
+		}
+		ev, err := c.decode(ctx, n.Payload)
+		if err != nil {
+			fmt.Println("Шина узлов: не удалось прочитать событие:", err)
+			continue
+		}
+		busReceived.inc()
+		handle(ev)
+	}
+}
+
+// decode разбирает событие; если пришла ссылка — забирает само событие из bus_payloads.
+// У каждого события один получатель, поэтому строка сразу удаляется.
+func (c *pgCluster) decode(ctx context.Context, payload string) (*busEvent, error) {
+	var ev busEvent
+	if err := json.Unmarshal([]byte(payload), &ev); err != nil {
+		return nil, err
+	}
+	if ev.Ref == 0 {
+		return &ev, nil
+	}
+	var body string
+	if err := DB.QueryRow(ctx,
+		`DELETE FROM bus_payloads WHERE id=$1 RETURNING body`, ev.Ref,
+	).Scan(&body); err != nil {
+		return nil, err
+	}
+	ev = busEvent{}
+	if err := json.Unmarshal([]byte(body), &ev); err != nil {
+		return nil, err
+	}
+	return &ev, nil
+}
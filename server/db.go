@@ -2,8 +2,9 @@ package main
 
 import (
 	"context"
-	"encoding/json"
+	"errors"
 	"fmt"
+	"github.com/jackc/pgx/v5"
 	"github.com/jackc/pgx/v5/pgxpool"
 	"net"
 	"os"
@@ -45,52 +46,67 @@ func InitDB() error {
 	return nil
 }
 
+// privateChatQuery — приватный чат пары пользователей (уникальный индекс chats_private_pair_idx).
+const privateChatQuery = `SELECT id FROM chats WHERE user_low=$1 AND user_high=$2`
+
+// FindPrivateChat возвращает ID существующего приватного чата между двумя пользователями,
+// ничего не создавая; если чата нет — pgx.ErrNoRows.
+func FindPrivateChat(ctx context.Context, user1, user2 int64) (int64, error) {
+	if user1 > user2 {
+		user1, user2 = user2, user1
+	}
+	var chatID int64
+	err := DB.QueryRow(ctx, privateChatQuery, user1, user2).Scan(&chatID)
+	return chatID, err
+}
+
 // GetOrCreatePrivateChat возвращает ID приватного чата между двумя пользователями.
 // Если такой чат уже есть, возвращает его ID. Иначе создаёт новый чат и добавляет участников.
+// Одновременные запросы для одной пары не создают двух чатов: пару защищает уникальный индекс.
 func GetOrCreatePrivateChat(ctx context.Context, user1, user2 int64) (int64, error) {
-	// Чтобы избежать дубликатов (user1 ↔ user2), сортируем ID по возрастанию
+	// Пара хранится упорядоченной (user1 ↔ user2 — тот же чат, что user2 ↔ user1)
 	if user1 > user2 {
 		user1, user2 = user2, user1
 	}
 
-	// Ищем существующий чат, где оба пользователя являются участниками, и он не групповой
+	// Обычный случай — чат уже есть
 	var chatID int64
-	query := `
-	SELECT cm1.chat_id
-	FROM chat_members cm1
-	JOIN chat_members cm2 ON cm1.chat_id = cm2.chat_id
-	JOIN chats c ON c.id = cm1.chat_id
-	WHERE cm1.user_id = $1 AND cm2.user_id = $2 AND c.is_group = false
-	LIMIT 1;
-	`
-	err := DB.QueryRow(ctx, query, user1, user2).Scan(&chatID)
+	err := DB.QueryRow(ctx, privateChatQuery, user1, user2).Scan(&chatID)
 	if err == nil {
-		// Чат найден — возвращаем его ID
 		return chatID, nil
 	}
-
-	// Чата нет — создаём новый
-	err = DB.QueryRow(ctx, `INSERT INTO chats (is_group) VALUES (false) RETURNING id`).Scan(&chatID)
-	if err != nil {
+	if !errors.Is(err, pgx.ErrNoRows) {
 		return 0, err
 	}
 
-	// Добавляем обоих пользователей в chat_members
-	_, err = DB.Exec(ctx, `
-		INSERT INTO chat_members (chat_id, user_id)
-		VALUES ($1, $2), ($1, $3)
-	`, chatID, user1, user2)
-	if err != nil {
+	// Чата нет — создаём его вместе с участниками одним оператором.
+	// Если параллельный запрос успел раньше, вставка ничего не делает и строк не возвращает
+	err = DB.QueryRow(ctx, `
+		WITH chat AS (
+			INSERT INTO chats (is_group, user_low, user_high) VALUES (false, $1, $2)
+			ON CONFLICT (user_low, user_high) WHERE user_low IS NOT NULL DO NOTHING
+			RETURNING id
+		), members AS (
+			INSERT INTO chat_members (chat_id, user_id)
+			SELECT DISTINCT chat.id, u FROM chat, unnest(ARRAY[$1, $2]::BIGINT[]) AS u
+		)
+		SELECT id FROM chat`, user1, user2,
+	).Scan(&chatID)
+	if err == nil {
+		return chatID, nil
+	}
+	if !errors.Is(err, pgx.ErrNoRows) {
 		return 0, err
 	}
 
-	return chatID, nil
+	// Чат создал параллельный запрос; новый оператор уже видит его строку
+	err = DB.QueryRow(ctx, privateChatQuery, user1, user2).Scan(&chatID)
+	return chatID, err
 }
 
-// fetchUserChats возвращает список чатов пользователя с краткой информацией:
-// ID чата, имя собеседника или название группы, последнее сообщение и время.
-func fetchUserChats(ctx context.Context, uid int64) ([]ChatPreview, error) {
-	const q = `
+// userChatsQuery — чаты пользователя (индекс chat_members_user_idx) с последним сообщением
+// каждого (индекс messages_chat_sent_idx).
+const userChatsQuery = `
 	SELECT
 	  ch.id AS chat_id,
 	  CASE
@@ -123,11 +139,14 @@ func fetchUserChats(ctx context.Context, uid int64) ([]ChatPreview, error) {
 		AND cm2.user_id <> $1
 	  LIMIT 1
 	) u2 ON true
-	ORDER BY last_ts DESC;
-	`
+	ORDER BY last_ts DESC`
 
-	// Выполняем SQL-запрос
-	rows, err := DB.Query(ctx, q, uid)
+// fetchUserChats возвращает список чатов пользователя с краткой информацией:
+// ID чата, имя собеседника или название группы, последнее сообщение и время.
+func fetchUserChats(ctx context.Context, uid int64) ([]ChatPreview, error) {
+	// Выполняем SQL-запрос (время выполнения и чтения строк попадает в метрики)
+	defer observeQuery("fetch_user_chats", time.Now())
+	rows, err := DB.Query(ctx, userChatsQuery, uid)
 	if err != nil {
 		return nil, err
 	}
@@ -161,7 +180,5 @@ func sendChatList(conn net.Conn, uid int64) {
 	}
 
 	// Формируем JSON-пакет и отправляем по соединению
-	msg := Message{Type: "chatlist", Chats: chats}
-	data, _ := json.Marshal(msg)
-	conn.Write(append(data, '\n'))
+	sendMessage(conn, Message{Type: "chatlist", Chats: chats})
 }
@@ -2,10 +2,10 @@ package main
 
 import (
 	"context"
-	"encoding/json"
 	"fmt"
 	"net"
 	"strings"
+	"time"
 )
 
 // handleUserSearch обрабатывает запрос на поиск пользователей по имени или отображаемому имени.
@@ -20,6 +20,7 @@ func handleUserSearch(conn net.Conn, m Message) {
 	ctx := context.Background()
 
 	// Выполняем запрос к БД: ищем пользователей, у которых логин или имя содержит подстроку
+	defer observeQuery("user_search", time.Now())
 	rows, err := DB.Query(ctx, `
         SELECT username, display_name
         FROM users
@@ -42,7 +43,5 @@ func handleUserSearch(conn net.Conn, m Message) {
 	}
 
 	// Формируем и отправляем клиенту JSON-ответ с найденными пользователями
-	resp := Message{Type: "user_search_result", Users: results}
-	data, _ := json.Marshal(resp)
-	conn.Write(append(data, '\n'))
+	sendMessage(conn, Message{Type: "user_search_result", Users: results, ReqID: m.ReqID})
 }
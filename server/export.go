@@ -0,0 +1,299 @@
+package main
+
+import (
+	"context"
+	"errors"
+	"fmt"
+	"net"
+	"strconv"
+	"sync"
+	"time"
+
+	"github.com/jackc/pgx/v5"
+)
+
+// Выгрузка всей истории чата.
+//
+// История читается курсором на стороне сервера (DECLARE … CURSOR в транзакции только для чтения)
+// по exportFrame строк за раз, и каждая порция сразу уходит клиенту отдельным пакетом. Ни сервер,
+// ни клиент не держат в памяти всю историю: на сервере — одна порция, на клиенте — не больше окна.
+// Порции идут по тому же соединению, что и чат, поэтому число неподтверждённых сообщений
+// ограничено окном (как при скачивании файлов): живые сообщения не застревают за выгрузкой.
+//
+//	chat_export        {to}                    — клиент просит выгрузить чат to
+//	chat_export_accept {to, size, window}      — сервер: всего сообщений и сколько их может быть в пути
+//	chat_export_chunk  {to, offset, messages}  — порция сообщений от старых к новым (offset — номер первого)
+//	chat_export_ack    {to, offset}            — клиент: первые offset сообщений записаны
+//	chat_export_cancel {to}                    — клиент отменяет выгрузку
+//	chat_export_end    {to, size[, content]}   — выгрузка закончена (size — сколько отправлено); content — текст ошибки
+//
+// Транзакция с уровнем REPEATABLE READ: выгрузка — согласованный снимок чата на момент начала,
+// сообщения, пришедшие во время выгрузки, в неё не попадают.
+
+const (
+	exportFrame   = 200              // сообщений в одной порции (столько же читает один FETCH)
+	exportWindow  = 4 * exportFrame  // сообщений в пути без подтверждения
+	exportAckWait = fileAckWait      // сколько ждать подтверждения от клиента
+	exportRetry   = 5 * time.Second  // через сколько повторить выгрузку, если все места заняты
+	exportTimeout = 30 * time.Minute // предел на одну выгрузку (транзакция держит снимок БД)
+)
+
+// exportSlots — одновременные выгрузки на узле (EXPORT_CONCURRENCY). Каждая держит соединение пула
+// всё время выгрузки, поэтому их немного и они не проходят через dbGate.
+var exportSlots = make(chan struct{}, envInt("EXPORT_CONCURRENCY", 2))
+
+// exportQuery — вся история чата от старых к новым (индекс messages_chat_sent_idx, обратный проход).
+const exportQuery = `
+	SELECT m.id, u.username, u.display_name, m.content, m.sent_at,
+	       a.id, a.name, a.size
+	FROM messages m
+	JOIN users u ON u.id = m.sender_id
+	LEFT JOIN attachments a ON a.message_id = m.id
+	WHERE m.chat_id=$1
+	ORDER BY m.sent_at, m.id`
+
+// errExportAborted — клиент отменил выгрузку, отключился или перестал подтверждать порции.
+var errExportAborted = errors.New("выгрузка прервана")
+
+// chatExport — выгрузка, идущая по соединению; подтверждения клиента приходят в канал.
+type chatExport struct {
+	acks   chan int64 // последнее подтверждённое число сообщений (буфер на одно значение)
+	cancel context.CancelFunc
+}
+
+// chatExports — выгрузки одного соединения (не больше одной на чат).
+type chatExports struct {
+	mu   sync.Mutex
+	runs map[string]*chatExport
+	ctx  context.Context // отменяется при отключении клиента
+	stop context.CancelFunc
+}
+
+// newChatExports создаёт пустое состояние выгрузок для соединения.
+func newChatExports() *chatExports {
+	ctx, stop := context.WithCancel(context.Background())
+	return &chatExports{runs: make(map[string]*chatExport), ctx: ctx, stop: stop}
+}
+
+// close прерывает все выгрузки соединения (клиент отключился).
+func (e *chatExports) close() {
+	e.stop()
+}
+
+// start обрабатывает chat_export: занимает место выгрузки и запускает её в отдельной горутине.
+func (e *chatExports) start(conn net.Conn, m Message) {
+	mu.Lock()
+	sender := clients[conn]
+	mu.Unlock()
+	if sender == nil {
+		return
+	}
+
+	select {
+	case exportSlots <- struct{}{}:
+	default:
+		exportRejected.inc()
+		sendRetryLater(conn, &m, "Сервер занят другими выгрузками", exportRetry)
+		return
+	}
+
+	ctx, cancel := context.WithTimeout(e.ctx, exportTimeout)
+	x := &chatExport{acks: make(chan int64, 1), cancel: cancel}
+	e.mu.Lock()
+	_, busy := e.runs[m.To]
+	if !busy {
+		e.runs[m.To] = x
+	}
+	e.mu.Unlock()
+	if busy {
+		<-exportSlots
+		cancel()
+		return // этот чат уже выгружается по соединению
+	}
+
+	go func() {
+		defer func() {
+			cancel()
+			<-exportSlots
+			e.mu.Lock()
+			delete(e.runs, m.To)
+			e.mu.Unlock()
+		}()
+		start := time.Now()
+		sent, err := serveExport(ctx, conn, sender, m.To, x.acks)
+		if errors.Is(err, errExportAborted) || ctx.Err() != nil {
+			exportDuration.observeSince("aborted", start)
+			return // клиенту конец выгрузки уже не нужен
+		}
+		end := Message{Type: "chat_export_end", To: m.To, Size: sent}
+		if err != nil {
+			end.Content = err.Error()
+			exportDuration.observeSince("error", start)
+		} else {
+			exportDuration.observeSince("done", start)
+		}
+		sendMessage(conn, end)
+	}()
+}
+
+// ack передаёт подтверждение клиента горутине выгрузки.
+func (e *chatExports) ack(m Message) {
+	e.mu.Lock()
+	x, ok := e.runs[m.To]
+	e.mu.Unlock()
+	if !ok {
+		return
+	}
+	// Как и при скачивании файлов, в канале держим только последнее значение
+	select {
+	case <-x.acks:
+	default:
+	}
+	x.acks <- m.Offset
+}
+
+// cancel обрабатывает chat_export_cancel.
+func (e *chatExports) cancel(m Message) {
+	e.mu.Lock()
+	x, ok := e.runs[m.To]
+	e.mu.Unlock()
+	if ok {
+		x.cancel()
+	}
+}
+
+// exportChatID возвращает ID выгружаемого чата: для группы это сам peer, для приватного чата —
+// уже существующий чат с собеседником peer. В отличие от historyChatID, ничего не создаёт:
+// выгрузка только читает, и выгрузка чата, которого нет, — ошибка.
+func exportChatID(ctx context.Context, sender *Client, peer string) (int64, bool) {
+	if id, err := strconv.ParseInt(peer, 10, 64); err == nil {
+		return id, true
+	}
+	if id, ok := hist.privateChat(sender.ID, peer); ok {
+		return id, true
+	}
+	var rid int64
+	start := time.Now()
+	err := DB.QueryRow(ctx,
+		`SELECT id FROM users WHERE username=$1`, peer,
+	).Scan(&rid)
+	observeQuery("export_resolve_peer", start)
+	if err != nil {
+		return 0, false
+	}
+	start = time.Now()
+	chatID, err := FindPrivateChat(ctx, sender.ID, rid)
+	observeQuery("export_private_chat", start)
+	if err != nil {
+		return 0, false
+	}
+	hist.rememberPrivateChat(sender.ID, peer, chatID)
+	return chatID, true
+}
+
+// serveExport читает историю чата курсором и отправляет её порциями, не опережая подтверждения
+// клиента больше чем на окно. Возвращает число отправленных сообщений; ошибка, кроме
+// errExportAborted, — текст для клиента.
+func serveExport(ctx context.Context, conn net.Conn, sender *Client, peer string, acks <-chan int64) (int64, error) {
+	chatID, ok := exportChatID(ctx, sender, peer)
+	if !ok {
+		return 0, errors.New("Чат не найден")
+	}
+
+	// Своя транзакция на соединении пула: курсор живёт только внутри неё
+	tx, err := DB.BeginTx(ctx, pgx.TxOptions{IsoLevel: pgx.RepeatableRead, AccessMode: pgx.ReadOnly})
+	if err != nil {
+		fmt.Println("Ошибка выгрузки чата:", err)
+		return 0, errors.New("Ошибка базы данных")
+	}
+	defer tx.Rollback(context.Background())
+
+	// Выгрузить чат может только его участник (групповой чат задаётся ID, и запрос истории этого не проверяет)
+	var member bool
+	start := time.Now()
+	err = tx.QueryRow(ctx,
+		`SELECT EXISTS (SELECT 1 FROM chat_members WHERE chat_id = $1 AND user_id = $2)`,
+		chatID, sender.ID,
+	).Scan(&member)
+	observeQuery("export_member", start)
+	if err != nil || !member {
+		return 0, errors.New("Чат не найден")
+	}
+
+	// Число сообщений — для индикатора хода выгрузки на клиенте (только индекс по chat_id)
+	var total int64
+	start = time.Now()
+	err = tx.QueryRow(ctx, `SELECT count(*) FROM messages WHERE chat_id = $1`, chatID).Scan(&total)
+	observeQuery("export_count", start)
+	if err != nil {
+		fmt.Println("Ошибка выгрузки чата:", err)
+		return 0, errors.New("Ошибка базы данных")
+	}
+
+	if _, err := tx.Exec(ctx, `DECLARE export_cur NO SCROLL CURSOR FOR `+exportQuery, chatID); err != nil {
+		fmt.Println("Ошибка выгрузки чата:", err)
+		return 0, errors.New("Ошибка базы данных")
+	}
+
+	sendMessage(conn, Message{Type: "chat_export_accept", To: peer, Size: total, Window: exportWindow})
+
+	// Порция переиспользуется: пакет кодируется сразу при отправке
+	frame := make([]ExportedMessage, 0, exportFrame)
+	var sent, acked int64
+	for {
+		// Окно заполнено — ждём подтверждения от клиента
+		for sent-acked >= exportWindow {
+			select {
+			case n := <-acks:
+				acked = max(acked, n)
+			case <-ctx.Done():
+				return sent, errExportAborted
+			case <-time.After(exportAckWait):
+				return sent, errExportAborted
+			}
+		}
+
+		var err error
+		if frame, err = fetchExportFrame(ctx, tx, frame[:0]); err != nil {
+			if ctx.Err() != nil {
+				return sent, errExportAborted
+			}
+			fmt.Println("Ошибка выгрузки чата:", err)
+			return sent, errors.New("Ошибка базы данных")
+		}
+		if len(frame) == 0 {
+			return sent, nil // курсор исчерпан
+		}
+		sendMessage(conn, Message{Type: "chat_export_chunk", To: peer, Offset: sent, Messages: frame})
+		sent += int64(len(frame))
+		exportMessages.add(uint64(len(frame)))
+	}
+}
+
+// fetchExportFrame читает из курсора следующую порцию в frame.
+func fetchExportFrame(ctx context.Context, tx pgx.Tx, frame []ExportedMessage) ([]ExportedMessage, error) {
+	start := time.Now()
+	defer observeQuery("export_fetch", start)
+
+	rows, err := tx.Query(ctx, fmt.Sprintf(`FETCH FORWARD %d FROM export_cur`, exportFrame))
+	if err != nil {
+		return frame, err
+	}
+	defer rows.Close()
+	for rows.Next() {
+		var x ExportedMessage
+		var sentAt time.Time
+		var fileID, fileSize *int64
+		var fileName *string
+		if err := rows.Scan(&x.ID, &x.From, &x.DisplayName, &x.Content, &sentAt,
+			&fileID, &fileName, &fileSize); err != nil {
+			return frame, err
+		}
+		x.Timestamp = sentAt.Unix()
+		if fileID != nil {
+			x.File = &FileInfo{ID: *fileID, Name: *fileName, Size: *fileSize}
+		}
+		frame = append(frame, x)
+	}
+	return frame, rows.Err()
+}
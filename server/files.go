@@ -0,0 +1,401 @@
+package main
+
+import (
+	"context"
+	"errors"
+	"fmt"
+	"net"
+	"os"
+	"path/filepath"
+	"strconv"
+	"sync"
+	"time"
+	"unicode/utf8"
+)
+
+// Передача файлов (вложений) кусками по тому же соединению, что и чат.
+// Каждый кусок — отдельный пакет, поэтому между ними проходят обычные сообщения,
+// а число неподтверждённых байт в пути ограничено окном (fileWindow).
+//
+// Загрузка (клиент → сервер):
+//
+//	file_offer  {to, name, size[, file_id]} — клиент предлагает файл; file_id — если докачивает прежнюю загрузку
+//	file_accept {file_id, offset, window}   — сервер: с какого смещения слать и сколько байт может быть без подтверждения
+//	file_chunk  {file_id, offset, data}     — кусок файла (не больше fileChunkSize)
+//	file_ack    {file_id, offset}           — сервер: всё до offset записано на диск
+//
+// Когда пришёл последний байт, в чате появляется сообщение с вложением (поле file).
+//
+// Скачивание (сервер → клиент):
+//
+//	file_download {file_id, offset}               — клиент запрашивает файл с offset (докачка)
+//	file_accept   {file_id, offset, size, window} — сервер начинает передачу
+//	file_chunk / file_ack                         — как при загрузке, но в обратную сторону
+//
+// При любой ошибке сервер присылает file_error {file_id, content}.
+// Файлы хранятся на диске в каталоге FILES_DIR, в БД — только их описание (таблица attachments).
+
+const (
+	fileChunkSize = 64 * 1024         // размер одного куска
+	fileWindow    = 4 * fileChunkSize // байт в пути без подтверждения: сообщение ждёт за загрузкой не больше окна
+	maxFileSize   = 2 << 30           // максимальный размер вложения (2 ГБ)
+	fileAckWait   = 30 * time.Second  // сколько ждать подтверждения от клиента при скачивании
+)
+
+// attachmentsDDL — таблица вложений (миграция 6). Содержимое файла лежит на диске, а не в строке messages.
+const attachmentsDDL = `
+	CREATE TABLE IF NOT EXISTS attachments (
+		id          BIGSERIAL PRIMARY KEY,
+		chat_id     BIGINT NOT NULL REFERENCES chats(id) ON DELETE CASCADE,
+		uploader_id BIGINT NOT NULL REFERENCES users(id),
+		message_id  BIGINT REFERENCES messages(id) ON DELETE SET NULL,
+		name        TEXT NOT NULL,
+		size        BIGINT NOT NULL,
+		complete    BOOLEAN NOT NULL DEFAULT false,
+		created_at  TIMESTAMPTZ NOT NULL DEFAULT now()
+	);
+	CREATE INDEX IF NOT EXISTS attachments_message_idx ON attachments(message_id)`
+
+// filesDir — каталог с содержимым вложений.
+var filesDir = "files"
+
+// ensureFilesDir создаёт каталог для файлов вложений.
+// Каталог берётся из переменной окружения FILES_DIR (по умолчанию ./files).
+func ensureFilesDir() error {
+	if dir := os.Getenv("FILES_DIR"); dir != "" {
+		filesDir = dir
+	}
+	if err := os.MkdirAll(filesDir, 0o750); err != nil {
+		return fmt.Errorf("каталог вложений: %w", err)
+	}
+	return nil
+}
+
+// attachmentPath возвращает путь к файлу вложения на диске.
+func attachmentPath(id int64) string {
+	return filepath.Join(filesDir, strconv.FormatInt(id, 10))
+}
+
+// upload — загрузка, идущая по соединению.
+type upload struct {
+	f        *os.File
+	to       string // чат назначения (как в поле To сообщения)
+	name     string
+	size     int64
+	received int64 // сколько байт уже записано
+}
+
+// download — скачивание, идущее по соединению; подтверждения клиента приходят в канал.
+type download struct {
+	acks chan int64 // последнее подтверждённое смещение (буфер на одно значение)
+}
+
+// fileTransfers — передачи файлов одного соединения.
+// Загрузки обрабатываются в цикле чтения соединения, скачивания — в отдельных горутинах.
+type fileTransfers struct {
+	uploads map[int64]*upload // только из цикла чтения, без блокировки
+
+	mu        sync.Mutex
+	downloads map[int64]*download
+	done      chan struct{} // закрывается при отключении клиента
+}
+
+// newFileTransfers создаёт пустое состояние передач для соединения.
+func newFileTransfers() *fileTransfers {
+	return &fileTransfers{
+		uploads:   make(map[int64]*upload),
+		downloads: make(map[int64]*download),
+		done:      make(chan struct{}),
+	}
+}
+
+// close прерывает все передачи соединения (клиент отключился).
+// Недокачанные файлы остаются на диске — клиент продолжит с того же места после переподключения.
+func (t *fileTransfers) close() {
+	for _, up := range t.uploads {
+		up.f.Close()
+	}
+	close(t.done)
+}
+
+// sendFileError сообщает клиенту об ошибке передачи файла.
+func sendFileError(conn net.Conn, fileID int64, text string) {
+	sendMessage(conn, Message{Type: "file_error", FileID: fileID, Content: text})
+}
+
+// offer обрабатывает file_offer: регистрирует новую загрузку или продолжает прерванную.
+func (t *fileTransfers) offer(conn net.Conn, m Message) {
+	mu.Lock()
+	sender := clients[conn]
+	mu.Unlock()
+	if sender == nil {
+		return
+	}
+	if m.Size <= 0 || m.Size > maxFileSize {
+		sendFileError(conn, m.FileID, "Недопустимый размер файла")
+		return
+	}
+	name := filepath.Base(m.Name)
+	if name == "." || name == string(filepath.Separator) || !utf8.ValidString(name) || len(name) > 255 {
+		sendFileError(conn, m.FileID, "Недопустимое имя файла")
+		return
+	}
+
+	ctx := context.Background()
+	fileID := m.FileID
+	if fileID == 0 {
+		// Новая загрузка: проверяем чат и заводим запись о вложении
+		chatID, err := fileChatID(ctx, sender, m.To)
+		if err != nil {
+			sendFileError(conn, 0, "Чат не найден")
+			return
+		}
+		start := time.Now()
+		err = DB.QueryRow(ctx, `
+			INSERT INTO attachments(chat_id, uploader_id, name, size)
+			VALUES ($1,$2,$3,$4) RETURNING id`,
+			chatID, sender.ID, name, m.Size,
+		).Scan(&fileID)
+		observeQuery("file_offer_insert", start)
+		if err != nil {
+			fmt.Println("Ошибка БД (создание вложения):", err)
+			sendFileError(conn, 0, "Не удалось начать загрузку")
+			return
+		}
+	} else {
+		// Докачка: вложение должно быть нашим, незавершённым, того же размера и в том же чате,
+		// где отправитель по-прежнему состоит (иначе файл ушёл бы в чужой чат при завершении)
+		var size, chatID int64
+		var complete bool
+		start := time.Now()
+		err := DB.QueryRow(ctx,
+			`SELECT size, complete, chat_id FROM attachments WHERE id=$1 AND uploader_id=$2`,
+			fileID, sender.ID,
+		).Scan(&size, &complete, &chatID)
+		observeQuery("file_offer_resume", start)
+		if err != nil || complete || size != m.Size {
+			sendFileError(conn, fileID, "Загрузку нельзя продолжить")
+			return
+		}
+		if toID, err := fileChatID(ctx, sender, m.To); err != nil || toID != chatID {
+			sendFileError(conn, fileID, "Загрузку нельзя продолжить")
+			return
+		}
+		if up, ok := t.uploads[fileID]; ok {
+			up.f.Close() // повторное предложение в том же соединении — начинаем заново с диска
+			delete(t.uploads, fileID)
+		}
+	}
+
+	// Точка докачки — сколько байт уже лежит на диске
+	f, err := os.OpenFile(attachmentPath(fileID), os.O_WRONLY|os.O_CREATE, 0o640)
+	if err != nil {
+		fmt.Println("Ошибка записи вложения:", err)
+		sendFileError(conn, fileID, "Не удалось начать загрузку")
+		return
+	}
+	st, err := f.Stat()
+	if err != nil || st.Size() > m.Size {
+		f.Close()
+		sendFileError(conn, fileID, "Загрузку нельзя продолжить")
+		return
+	}
+
+	t.uploads[fileID] = &upload{f: f, to: m.To, name: name, size: m.Size, received: st.Size()}
+	sendMessage(conn, Message{Type: "file_accept", FileID: fileID, Offset: st.Size(), Size: m.Size, Window: fileWindow})
+	if st.Size() == m.Size {
+		t.finish(conn, fileID) // файл уже целиком на диске (соединение оборвалось перед последним подтверждением)
+	}
+}
+
+// fileChatID определяет чат для вложения по полю To (логин собеседника или ID группы)
+// и проверяет, что отправитель в нём состоит.
+func fileChatID(ctx context.Context, sender *Client, to string) (int64, error) {
+	if id, err := strconv.ParseInt(to, 10, 64); err == nil {
+		var member bool
+		err := DB.QueryRow(ctx,
+			`SELECT EXISTS(SELECT 1 FROM chat_members WHERE chat_id=$1 AND user_id=$2)`, id, sender.ID,
+		).Scan(&member)
+		if err != nil {
+			return 0, err
+		}
+		if !member {
+			return 0, errors.New("не участник чата")
+		}
+		return id, nil
+	}
+	var peerID int64
+	if err := DB.QueryRow(ctx, `SELECT id FROM users WHERE username=$1`, to).Scan(&peerID); err != nil {
+		return 0, err
+	}
+	return GetOrCreatePrivateChat(ctx, sender.ID, peerID)
+}
+
+// chunk обрабатывает file_chunk от клиента: дописывает кусок и подтверждает его.
+// Куски приходят по одному TCP-соединению по порядку, поэтому смещение должно совпадать с уже принятым объёмом.
+func (t *fileTransfers) chunk(conn net.Conn, m Message) {
+	up, ok := t.uploads[m.FileID]
+	if !ok {
+		return // загрузка уже прервана — остальные куски из окна отбрасываем молча
+	}
+	n := int64(len(m.Data))
+	if m.Offset != up.received || n == 0 || n > fileChunkSize || up.received+n > up.size {
+		up.f.Close()
+		delete(t.uploads, m.FileID)
+		sendFileError(conn, m.FileID, "Нарушен порядок кусков файла")
+		return
+	}
+	if _, err := up.f.WriteAt(m.Data, m.Offset); err != nil {
+		fmt.Println("Ошибка записи вложения:", err)
+		up.f.Close()
+		delete(t.uploads, m.FileID)
+		sendFileError(conn, m.FileID, "Ошибка записи файла")
+		return
+	}
+	up.received += n
+	fileBytesReceived.add(uint64(n))
+
+	sendMessage(conn, Message{Type: "file_ack", FileID: m.FileID, Offset: up.received})
+	if up.received == up.size {
+		t.finish(conn, m.FileID)
+	}
+}
+
+// finish завершает загрузку: сбрасывает файл на диск, помечает вложение готовым
+// и отправляет в чат сообщение с вложением.
+func (t *fileTransfers) finish(conn net.Conn, fileID int64) {
+	up := t.uploads[fileID]
+	delete(t.uploads, fileID)
+	err := up.f.Sync()
+	if cerr := up.f.Close(); err == nil {
+		err = cerr
+	}
+	if err != nil {
+		fmt.Println("Ошибка записи вложения:", err)
+		sendFileError(conn, fileID, "Ошибка записи файла")
+		return
+	}
+
+	start := time.Now()
+	_, err = DB.Exec(context.Background(), `UPDATE attachments SET complete=true WHERE id=$1`, fileID)
+	observeQuery("file_complete", start)
+	if err != nil {
+		fmt.Println("Ошибка БД (завершение вложения):", err)
+		sendFileError(conn, fileID, "Не удалось сохранить файл")
+		return
+	}
+
+	// Сообщение с вложением сохраняется и рассылается так же, как обычное
+	handleMessage(conn, Message{
+		Type:    "message",
+		To:      up.to,
+		Content: up.name,
+		File:    &FileInfo{ID: fileID, Name: up.name, Size: up.size},
+	})
+}
+
+// download обрабатывает file_download: проверяет доступ и запускает передачу в отдельной горутине.
+func (t *fileTransfers) download(conn net.Conn, m Message) {
+	mu.Lock()
+	sender := clients[conn]
+	mu.Unlock()
+	if sender == nil {
+		return
+	}
+
+	t.mu.Lock()
+	_, busy := t.downloads[m.FileID]
+	d := &download{acks: make(chan int64, 1)}
+	if !busy {
+		t.downloads[m.FileID] = d
+	}
+	t.mu.Unlock()
+	if busy {
+		return // этот файл уже передаётся по соединению
+	}
+
+	go func() {
+		defer func() {
+			t.mu.Lock()
+			delete(t.downloads, m.FileID)
+			t.mu.Unlock()
+		}()
+		t.serveDownload(conn, sender, m, d)
+	}()
+}
+
+// serveDownload отправляет файл кусками, не опережая подтверждения клиента больше чем на окно.
+func (t *fileTransfers) serveDownload(conn net.Conn, sender *Client, m Message, d *download) {
+	// Скачать вложение может только участник чата, в котором оно отправлено
+	var size int64
+	start := time.Now()
+	err := DB.QueryRow(context.Background(), `
+		SELECT a.size FROM attachments a
+		JOIN chat_members cm ON cm.chat_id = a.chat_id AND cm.user_id = $2
+		WHERE a.id = $1 AND a.complete`,
+		m.FileID, sender.ID,
+	).Scan(&size)
+	observeQuery("file_download", start)
+	if err != nil {
+		sendFileError(conn, m.FileID, "Файл не найден")
+		return
+	}
+	if m.Offset < 0 || m.Offset > size {
+		sendFileError(conn, m.FileID, "Недопустимое смещение")
+		return
+	}
+
+	f, err := os.Open(attachmentPath(m.FileID))
+	if err != nil {
+		fmt.Println("Ошибка чтения вложения:", err)
+		sendFileError(conn, m.FileID, "Файл недоступен")
+		return
+	}
+	defer f.Close()
+
+	sendMessage(conn, Message{Type: "file_accept", FileID: m.FileID, Offset: m.Offset, Size: size, Window: fileWindow})
+
+	buf := make([]byte, fileChunkSize)
+	sent, acked := m.Offset, m.Offset
+	for sent < size {
+		// Окно заполнено — ждём подтверждения от клиента
+		for sent-acked >= fileWindow {
+			select {
+			case off := <-d.acks:
+				acked = max(acked, off)
+			case <-t.done:
+				return // клиент отключился — докачает позже
+			case <-time.After(fileAckWait):
+				return // клиент перестал подтверждать куски
+			}
+		}
+
+		n, err := f.ReadAt(buf[:min(int64(len(buf)), size-sent)], sent)
+		if n == 0 && err != nil {
+			fmt.Println("Ошибка чтения вложения:", err)
+			sendFileError(conn, m.FileID, "Ошибка чтения файла")
+			return
+		}
+		// Кусок кодируется сразу при отправке, поэтому буфер можно переиспользовать
+		sendMessage(conn, Message{Type: "file_chunk", FileID: m.FileID, Offset: sent, Data: buf[:n]})
+		sent += int64(n)
+		fileBytesSent.add(uint64(n))
+	}
+}
+
+// ack передаёт подтверждение клиента горутине, которая отправляет файл.
+func (t *fileTransfers) ack(m Message) {
+	t.mu.Lock()
+	d, ok := t.downloads[m.FileID]
+	t.mu.Unlock()
+	if !ok {
+		return
+	}
+	// В канале держим только последнее смещение: старое значение заменяем новым.
+	// Подтверждения приходят только из цикла чтения соединения, поэтому отправка не блокируется
+	select {
+	case <-d.acks:
+	default:
+	}
+	d.acks <- m.Offset
+}
@@ -0,0 +1,264 @@
+package main
+
+import (
+	"container/list"
+	"sync"
+	"time"
+)
+
+// Кэш хвостов истории активных чатов.
+//
+// Открытие популярной группы всеми её участниками приводит к одному и тому же запросу
+// последних сообщений. Поэтому узел держит в памяти последние сообщения чатов, историю которых
+// недавно запрашивали: хвост загружается из БД при первом запросе, а дальше поддерживается
+// сообщениями, которые сохраняет handleMessage. Запросы истории, попадающие в хвост
+// (последняя страница или страница перед курсором внутри хвоста), обслуживаются без обращения к БД.
+//
+// Число чатов ограничено (HISTORY_CACHE_CHATS, давно не использованные вытесняются),
+// число сообщений на чат — тоже (HISTORY_CACHE_TAIL). HISTORY_CACHE_CHATS=0 отключает кэш.
+//
+// Сообщение, сохранённое на другом узле, приходит в событии "history" и добавляется в хвост
+// так же, как своё. Если сообщение не влезло в событие, хвост чата сбрасывается до следующего запроса.
+
+// cachedMessage — сообщение истории в кэше (поля строки historyQuery).
+type cachedMessage struct {
+	id          int64
+	senderID    int64
+	username    string
+	displayName string
+	content     string
+	sentAt      time.Time
+	file        *FileInfo
+}
+
+// busMessage — сообщение в событии "history" (поля cachedMessage для шины узлов).
+type busMessage struct {
+	ID          int64     `json:"id"`
+	SenderID    int64     `json:"sender_id"`
+	Username    string    `json:"username"`
+	DisplayName string    `json:"display_name"`
+	Content     string    `json:"content"`
+	SentAt      time.Time `json:"sent_at"`
+	File        *FileInfo `json:"file,omitempty"`
+}
+
+// newBusMessage готовит сообщение к отправке другим узлам.
+func newBusMessage(c cachedMessage) *busMessage {
+	return &busMessage{ID: c.id, SenderID: c.senderID, Username: c.username, DisplayName: c.displayName,
+		Content: c.content, SentAt: c.sentAt, File: c.file}
+}
+
+// cached возвращает сообщение, пришедшее от другого узла, в виде записи кэша.
+func (b *busMessage) cached() cachedMessage {
+	return cachedMessage{id: b.ID, senderID: b.SenderID, username: b.Username, displayName: b.DisplayName,
+		content: b.Content, sentAt: b.SentAt, file: b.File}
+}
+
+// before сообщает, идёт ли сообщение раньше позиции (sentAt, id) — в порядке истории.
+func (c *cachedMessage) before(sentAt time.Time, id int64) bool {
+	return c.sentAt.Before(sentAt) || c.sentAt.Equal(sentAt) && c.id < id
+}
+
+// chatTail — последние сообщения одного чата, от старых к новым.
+type chatTail struct {
+	chatID int64
+	msgs   []cachedMessage
+	all    bool // раньше msgs[0] в чате сообщений нет (хвост — вся история чата)
+	ready  bool // хвост загружен; до этого запись — только отметка о загрузке
+	dirty  bool // пока хвост загружался, в чат записали сообщение: загруженное уже неполно
+	elem   *list.Element
+}
+
+// privateKey — приватный чат пользователя с собеседником (по логину собеседника).
+type privateKey struct {
+	user int64
+	peer string
+}
+
+// historyCache — хвосты чатов с вытеснением давно не использованных.
+type historyCache struct {
+	mu       sync.Mutex
+	chats    map[int64]*chatTail
+	lru      *list.List // *chatTail; в начале — последние использованные
+	maxChats int
+	maxTail  int
+	// ID приватных чатов по паре (пользователь, логин собеседника): запрос истории
+	// приватного чата тоже обходится без БД. Пара и чат не меняются, поэтому записи
+	// не устаревают; при переполнении карта просто очищается
+	private map[privateKey]int64
+}
+
+// hist — кэш истории этого узла.
+var hist = newHistoryCache(envNonNegInt("HISTORY_CACHE_CHATS", 1000), envInt("HISTORY_CACHE_TAIL", 200))
+
+// newHistoryCache создаёт кэш на maxChats чатов по maxTail сообщений (не меньше страницы истории).
+// При maxChats=0 кэш выключен: begin и rememberPrivateChat ничего не запоминают, поэтому
+// остальные методы ничего не находят, и все запросы истории идут в БД.
+func newHistoryCache(maxChats, maxTail int) *historyCache {
+	if maxTail < historyPage {
+		maxTail = historyPage
+	}
+	h := &historyCache{
+		chats:    make(map[int64]*chatTail),
+		lru:      list.New(),
+		maxChats: maxChats,
+		maxTail:  maxTail,
+		private:  make(map[privateKey]int64),
+	}
+	newGaugeFunc("shichat_history_cache_chats", "Чаты, хвосты истории которых лежат в кэше.",
+		func() float64 { return float64(h.stats().chats) })
+	newGaugeFunc("shichat_history_cache_messages", "Сообщения в кэше истории.",
+		func() float64 { return float64(h.stats().messages) })
+	return h
+}
+
+// cacheStats — размер кэша для метрик.
+type cacheStats struct {
+	chats, messages int
+}
+
+func (h *historyCache) stats() cacheStats {
+	h.mu.Lock()
+	defer h.mu.Unlock()
+	s := cacheStats{chats: len(h.chats)}
+	for _, t := range h.chats {
+		s.messages += len(t.msgs)
+	}
+	return s
+}
+
+// page возвращает страницу истории из кэша (от старых к новым): последнюю, если cursor пуст,
+// иначе — сообщения перед позицией (before, beforeID). ok=false — страницы в кэше нет.
+func (h *historyCache) page(chatID int64, cursor bool, before time.Time, beforeID int64) ([]cachedMessage, bool) {
+	h.mu.Lock()
+	defer h.mu.Unlock()
+	t := h.chats[chatID]
+	if t == nil || !t.ready {
+		return nil, false
+	}
+	msgs := t.msgs
+	if cursor {
+		n := 0
+		for n < len(msgs) && msgs[n].before(before, beforeID) {
+			n++
+		}
+		msgs = msgs[:n]
+	}
+	// Страница целиком внутри хвоста, или раньше хвоста сообщений нет вовсе
+	if len(msgs) < historyPage && !t.all {
+		return nil, false
+	}
+	if len(msgs) > historyPage {
+		msgs = msgs[len(msgs)-historyPage:]
+	}
+	h.lru.MoveToFront(t.elem)
+	return append([]cachedMessage(nil), msgs...), true
+}
+
+// begin отмечает, что хвост чата загружается из БД. Сообщения, записанные в чат
+// до fill, делают загрузку неполной — такой хвост в кэш не попадёт.
+func (h *historyCache) begin(chatID int64) {
+	if h.maxChats <= 0 {
+		return
+	}
+	h.mu.Lock()
+	defer h.mu.Unlock()
+	if t := h.chats[chatID]; t != nil {
+		h.lru.MoveToFront(t.elem)
+		return
+	}
+	t := &chatTail{chatID: chatID}
+	t.elem = h.lru.PushFront(t)
+	h.chats[chatID] = t
+	for len(h.chats) > h.maxChats {
+		old := h.lru.Remove(h.lru.Back()).(*chatTail)
+		delete(h.chats, old.chatID)
+	}
+}
+
+// fill сохраняет загруженную из БД последнюю страницу чата (от старых к новым).
+// all — в чате нет сообщений раньше этой страницы.
+func (h *historyCache) fill(chatID int64, msgs []cachedMessage, all bool) {
+	h.mu.Lock()
+	defer h.mu.Unlock()
+	t := h.chats[chatID]
+	if t == nil || t.ready {
+		return // запись вытеснена или сброшена, либо хвост уже загрузил параллельный запрос
+	}
+	if t.dirty {
+		h.lru.Remove(t.elem)
+		delete(h.chats, chatID)
+		return
+	}
+	t.msgs, t.all, t.ready = msgs, all, true
+}
+
+// add добавляет только что сохранённое сообщение в хвост чата, если хвост в кэше.
+func (h *historyCache) add(chatID int64, msg cachedMessage) {
+	h.mu.Lock()
+	defer h.mu.Unlock()
+	t := h.chats[chatID]
+	if t == nil {
+		return
+	}
+	if !t.ready {
+		t.dirty = true
+		return
+	}
+	// Параллельные вставки могут завершиться не в порядке sent_at — ищем место с конца.
+	// Сообщение уже может быть в хвосте, если его прочитал запрос, загрузивший хвост
+	i := len(t.msgs)
+	for i > 0 && msg.before(t.msgs[i-1].sentAt, t.msgs[i-1].id) {
+		i--
+	}
+	if i > 0 && t.msgs[i-1].id == msg.id {
+		return
+	}
+	t.msgs = append(t.msgs, cachedMessage{})
+	copy(t.msgs[i+1:], t.msgs[i:])
+	t.msgs[i] = msg
+	if len(t.msgs) > h.maxTail {
+		t.msgs = append([]cachedMessage(nil), t.msgs[len(t.msgs)-h.maxTail:]...)
+		t.all = false
+	}
+	h.lru.MoveToFront(t.elem)
+}
+
+// drop сбрасывает хвост чата (в чат записали сообщение на другом узле, а само сообщение не пришло).
+func (h *historyCache) drop(chatID int64) {
+	h.mu.Lock()
+	defer h.mu.Unlock()
+	if t := h.chats[chatID]; t != nil {
+		h.lru.Remove(t.elem)
+		delete(h.chats, chatID)
+	}
+}
+
+// clear сбрасывает все хвосты (события других узлов могли быть пропущены).
+func (h *historyCache) clear() {
+	h.mu.Lock()
+	defer h.mu.Unlock()
+	h.chats = make(map[int64]*chatTail)
+	h.lru.Init()
+}
+
+// privateChat возвращает ID приватного чата пользователя с собеседником peer, если он известен.
+func (h *historyCache) privateChat(userID int64, peer string) (int64, bool) {
+	h.mu.Lock()
+	defer h.mu.Unlock()
+	id, ok := h.private[privateKey{userID, peer}]
+	return id, ok
+}
+
+// rememberPrivateChat запоминает ID приватного чата пользователя с собеседником peer.
+func (h *historyCache) rememberPrivateChat(userID int64, peer string, chatID int64) {
+	if h.maxChats <= 0 {
+		return
+	}
+	h.mu.Lock()
+	defer h.mu.Unlock()
+	if len(h.private) >= 4*h.maxChats {
+		h.private = make(map[privateKey]int64)
+	}
+	h.private[privateKey{userID, peer}] = chatID
+}
@@ -1,8 +1,10 @@
 package main
 
 import (
+	"context"
 	"fmt"
 	"net"
+	"os"
 )
 
 func main() {
@@ -14,14 +16,52 @@ func main() {
 	// Гарантируем, что соединение с БД будет закрыто при завершении работы
 	defer DB.Close()
 
-	// Запускаем TCP-сервер на порту 8080 (принимает входящие подключения)
-	ln, err := net.Listen("tcp", ":8080")
+	// Приводим схему базы к текущей версии и проверяем, что запросы горячего пути идут по индексам.
+	// Если недостающие индексы ещё строятся (после запуска, в фоне), планы проверяются после них
+	pendingIndexes, err := migrate(context.Background())
+	if err != nil {
+		panic(err)
+	}
+	if len(pendingIndexes) == 0 {
+		if err := checkQueryPlans(context.Background()); err != nil {
+			panic(err)
+		}
+	}
+
+	// Секции сообщений на ближайшие месяцы и архивирование старых (ARCHIVE_MONTHS, ARCHIVE_DIR)
+	startPartitionMaintenance(context.Background())
+
+	// Запускаем HTTP-эндпоинт с метриками в формате Prometheus
+	startMetricsServer()
+
+	// Каталог для вложений (файлы хранятся на диске, а не в БД)
+	if err := ensureFilesDir(); err != nil {
+		panic(err)
+	}
+
+	// Связь с другими узлами (CLUSTER=postgres) или работа одним процессом (по умолчанию)
+	if err := startCluster(context.Background()); err != nil {
+		panic(err)
+	}
+
+	// Запускаем TCP-сервер (по умолчанию на порту 8080; несколько узлов на одной машине —
+	// с разными LISTEN_ADDR)
+	addr := os.Getenv("LISTEN_ADDR")
+	if addr == "" {
+		addr = ":8080"
+	}
+	ln, err := net.Listen("tcp", addr)
 	if err != nil {
 		panic(err)
 	}
 	// Закроем сокет при завершении работы программы
 	defer ln.Close()
-	fmt.Println("Server is listening on :8080")
+	fmt.Println("Server is listening on " + addr)
+
+	// Индексы, которых ещё нет, строятся, пока сервер уже принимает соединения
+	if len(pendingIndexes) > 0 {
+		startIndexMigrations(context.Background(), pendingIndexes)
+	}
 
 	for {
 		// Ожидаем новое входящее соединение от клиента
@@ -0,0 +1,359 @@
+package main
+
+import (
+	"fmt"
+	"io"
+	"net/http"
+	"os"
+	"sort"
+	"strconv"
+	"strings"
+	"sync"
+	"sync/atomic"
+	"time"
+)
+
+// Границы корзин гистограмм (в секундах).
+// Запросы к БД и рассылка — от долей миллисекунды до секунд,
+// запись в сокет обычно намного быстрее, поэтому у неё свои, более мелкие корзины.
+var (
+	dbBuckets     = []float64{0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5}
+	writeBuckets  = []float64{0.00001, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.05, 0.25}
+	exportBuckets = []float64{0.1, 0.5, 1, 5, 10, 30, 60, 300, 1800}
+)
+
+// histogram — простая гистограмма в формате Prometheus (накопительные корзины, сумма, количество).
+type histogram struct {
+	mu     sync.Mutex
+	bounds []float64 // верхние границы корзин
+	counts []uint64  // количество наблюдений в каждой корзине (не накопительно)
+	sum    float64   // сумма всех наблюдений
+	count  uint64    // общее количество наблюдений
+}
+
+// observe добавляет одно наблюдение в гистограмму.
+func (h *histogram) observe(v float64) {
+	h.mu.Lock()
+	i := sort.SearchFloat64s(h.bounds, v) // первая корзина, в которую попадает значение
+	h.counts[i]++
+	h.sum += v
+	h.count++
+	h.mu.Unlock()
+}
+
+// histogramVec — набор гистограмм с одной меткой (например, имя запроса к БД).
+type histogramVec struct {
+	name   string
+	help   string
+	label  string
+	bounds []float64
+
+	mu   sync.Mutex
+	byLV map[string]*histogram
+}
+
+// newHistogramVec создаёт набор гистограмм и регистрирует его для вывода на /metrics.
+func newHistogramVec(name, help, label string, bounds []float64) *histogramVec {
+	v := &histogramVec{name: name, help: help, label: label, bounds: bounds, byLV: make(map[string]*histogram)}
+	registry = append(registry, v)
+	return v
+}
+
+// with возвращает (или создаёт) гистограмму для значения метки.
+func (v *histogramVec) with(lv string) *histogram {
+	v.mu.Lock()
+	h, ok := v.byLV[lv]
+	if !ok {
+		// Последняя корзина — +Inf, поэтому счётчиков на один больше, чем границ
+		h = &histogram{bounds: v.bounds, counts: make([]uint64, len(v.bounds)+1)}
+		v.byLV[lv] = h
+	}
+	v.mu.Unlock()
+	return h
+}
+
+// observeSince записывает время, прошедшее с момента start, под значением метки lv.
+func (v *histogramVec) observeSince(lv string, start time.Time) {
+	v.with(lv).observe(time.Since(start).Seconds())
+}
+
+// writeTo выводит все гистограммы набора в текстовом формате Prometheus.
+func (v *histogramVec) writeTo(w io.Writer) {
+	fmt.Fprintf(w, "# HELP %s %s\n# TYPE %s histogram\n", v.name, v.help, v.name)
+
+	// Сортируем значения меток, чтобы вывод был стабильным
+	v.mu.Lock()
+	lvs := make([]string, 0, len(v.byLV))
+	for lv := range v.byLV {
+		lvs = append(lvs, lv)
+	}
+	v.mu.Unlock()
+	sort.Strings(lvs)
+
+	for _, lv := range lvs {
+		h := v.with(lv)
+		h.mu.Lock()
+		var cum uint64
+		for i, b := range h.bounds {
+			cum += h.counts[i]
+			fmt.Fprintf(w, "%s_bucket{%s=%q,le=%q} %d\n", v.name, v.label, lv, formatFloat(b), cum)
+		}
+		cum += h.counts[len(h.bounds)]
+		fmt.Fprintf(w, "%s_bucket{%s=%q,le=\"+Inf\"} %d\n", v.name, v.label, lv, cum)
+		fmt.Fprintf(w, "%s_sum{%s=%q} %s\n", v.name, v.label, lv, formatFloat(h.sum))
+		fmt.Fprintf(w, "%s_count{%s=%q} %d\n", v.name, v.label, lv, h.count)
+		h.mu.Unlock()
+	}
+}
+
+// counter — монотонно растущий счётчик.
+type counter struct {
+	name string
+	help string
+	v    atomic.Uint64
+}
+
+// newCounter создаёт счётчик и регистрирует его для вывода на /metrics.
+func newCounter(name, help string) *counter {
+	c := &counter{name: name, help: help}
+	registry = append(registry, c)
+	return c
+}
+
+// inc увеличивает счётчик на единицу.
+func (c *counter) inc() { c.v.Add(1) }
+
+// add увеличивает счётчик на n.
+func (c *counter) add(n uint64) { c.v.Add(n) }
+
+// writeTo выводит счётчик в текстовом формате Prometheus.
+func (c *counter) writeTo(w io.Writer) {
+	fmt.Fprintf(w, "# HELP %s %s\n# TYPE %s counter\n%s %d\n", c.name, c.help, c.name, c.name, c.v.Load())
+}
+
+// counterVec — набор счётчиков с одной меткой (например, тип пакета).
+type counterVec struct {
+	name  string
+	help  string
+	label string
+
+	mu   sync.Mutex
+	byLV map[string]*atomic.Uint64
+}
+
+// newCounterVec создаёт набор счётчиков и регистрирует его для вывода на /metrics.
+func newCounterVec(name, help, label string) *counterVec {
+	v := &counterVec{name: name, help: help, label: label, byLV: make(map[string]*atomic.Uint64)}
+	registry = append(registry, v)
+	return v
+}
+
+// inc увеличивает на единицу счётчик значения метки lv.
+func (v *counterVec) inc(lv string) {
+	v.mu.Lock()
+	c, ok := v.byLV[lv]
+	if !ok {
+		c = new(atomic.Uint64)
+		v.byLV[lv] = c
+	}
+	v.mu.Unlock()
+	c.Add(1)
+}
+
+// writeTo выводит все счётчики набора в текстовом формате Prometheus (метки по порядку).
+func (v *counterVec) writeTo(w io.Writer) {
+	fmt.Fprintf(w, "# HELP %s %s\n# TYPE %s counter\n", v.name, v.help, v.name)
+	v.mu.Lock()
+	defer v.mu.Unlock()
+	lvs := make([]string, 0, len(v.byLV))
+	for lv := range v.byLV {
+		lvs = append(lvs, lv)
+	}
+	sort.Strings(lvs)
+	for _, lv := range lvs {
+		fmt.Fprintf(w, "%s{%s=%q} %d\n", v.name, v.label, lv, v.byLV[lv].Load())
+	}
+}
+
+// gaugeFunc — мгновенное значение, которое вычисляется в момент запроса /metrics.
+type gaugeFunc struct {
+	name string
+	help string
+	f    func() float64
+}
+
+// newGaugeFunc регистрирует вычисляемое значение для вывода на /metrics.
+func newGaugeFunc(name, help string, f func() float64) *gaugeFunc {
+	g := &gaugeFunc{name: name, help: help, f: f}
+	registry = append(registry, g)
+	return g
+}
+
+// writeTo выводит значение в текстовом формате Prometheus.
+func (g *gaugeFunc) writeTo(w io.Writer) { writeGauge(w, g.name, g.help, g.f()) }
+
+// metric — всё, что умеет выводить себя в формате Prometheus.
+type metric interface {
+	writeTo(w io.Writer)
+}
+
+// registry — список всех зарегистрированных метрик (заполняется при инициализации пакета).
+var registry []metric
+
+// Метрики сервера
+var (
+	// Длительность каждого запроса к БД; метка query — место в коде, откуда запрос выполняется
+	dbQueryDuration = newHistogramVec("shichat_db_query_duration_seconds",
+		"Длительность запросов к PostgreSQL.", "query", dbBuckets)
+
+	// Длительность рассылки сообщения и обновлённых списков чатов участникам
+	fanoutDuration = newHistogramVec("shichat_fanout_duration_seconds",
+		"Длительность рассылки участникам чата.", "stage", dbBuckets)
+
+	// Время записи одного пакета в сокет клиента
+	writeDuration = newHistogramVec("shichat_write_duration_seconds",
+		"Задержка записи исходящего пакета в сокет.", "type", writeBuckets)
+
+	// Количество сохранённых сообщений (скорость — через rate() в Prometheus)
+	messagesTotal = newCounter("shichat_messages_total",
+		"Количество принятых и сохранённых сообщений.")
+
+	// Объём переданных файлов (пропускная способность — через rate() в Prometheus)
+	fileBytesReceived = newCounter("shichat_file_received_bytes_total",
+		"Байты вложений, принятые от клиентов.")
+	fileBytesSent = newCounter("shichat_file_sent_bytes_total",
+		"Байты вложений, отправленные клиентам.")
+
+	// Операции bcrypt в пуле проверки паролей: ожидание в очереди, выполнение и отказы при переполнении
+	authQueueWait = newHistogramVec("shichat_auth_queue_wait_seconds",
+		"Ожидание операции bcrypt в очереди пула.", "op", dbBuckets)
+	authDuration = newHistogramVec("shichat_auth_duration_seconds",
+		"Длительность операции bcrypt.", "op", dbBuckets)
+	authRejected = newCounter("shichat_auth_rejected_total",
+		"Операции bcrypt, отклонённые из-за переполненной очереди.")
+
+	// Запросы истории, обслуженные кэшем хвостов чатов и переданные в БД (доля попаданий — через rate())
+	historyCacheHits = newCounter("shichat_history_cache_hits_total",
+		"Запросы истории, обслуженные из кэша.")
+	historyCacheMisses = newCounter("shichat_history_cache_misses_total",
+		"Запросы истории, выполненные в БД.")
+
+	// Запросы клиентов, отклонённые корзинами соединения и ограничением запросов к БД (см. ratelimit.go)
+	rateLimited = newCounterVec("shichat_rate_limited_total",
+		"Пакеты, отклонённые ограничением частоты запросов соединения.", "type")
+	admissionRejected = newCounterVec("shichat_db_admission_rejected_total",
+		"Запросы, отклонённые из-за заполненного лимита одновременных запросов к БД.", "type")
+	admissionWait = newHistogramVec("shichat_db_admission_wait_seconds",
+		"Ожидание места для запроса к БД (только запросы, которые ждали).", "type", dbBuckets)
+
+	// Пакеты присутствия и число изменений в них (изменений на пакет — степень группировки)
+	presencePackets = newCounter("shichat_presence_packets_total",
+		"Отправленные клиентам пакеты presence.")
+	presenceChanges = newCounter("shichat_presence_changes_total",
+		"Изменения присутствия и набора текста в отправленных пакетах presence.")
+
+	// Выгрузки чатов (см. export.go): длительность по исходу, объём и отказы из-за занятых мест
+	exportDuration = newHistogramVec("shichat_export_duration_seconds",
+		"Длительность выгрузки чата.", "result", exportBuckets)
+	exportMessages = newCounter("shichat_export_messages_total",
+		"Сообщения, отправленные клиентам при выгрузке чатов.")
+	exportRejected = newCounter("shichat_export_rejected_total",
+		"Выгрузки, отклонённые из-за заполненного лимита EXPORT_CONCURRENCY.")
+
+	// События между узлами кластера (CLUSTER=postgres)
+	busPublished = newCounter("shichat_bus_published_total",
+		"События, отправленные другим узлам.")
+	busReceived = newCounter("shichat_bus_received_total",
+		"События, полученные от других узлов.")
+)
+
+// observeQuery записывает длительность запроса к БД, начатого в момент start.
+func observeQuery(name string, start time.Time) {
+	dbQueryDuration.observeSince(name, start)
+}
+
+// writeGauge выводит одно мгновенное значение (gauge) в формате Prometheus.
+func writeGauge(w io.Writer, name, help string, v float64) {
+	fmt.Fprintf(w, "# HELP %s %s\n# TYPE %s gauge\n%s %s\n", name, help, name, name, formatFloat(v))
+}
+
+// writeCounterValue выводит накопительное значение, взятое из внешнего источника (статистика пула).
+func writeCounterValue(w io.Writer, name, help string, v float64) {
+	fmt.Fprintf(w, "# HELP %s %s\n# TYPE %s counter\n%s %s\n", name, help, name, name, formatFloat(v))
+}
+
+// writePoolStats выводит статистику пула соединений pgxpool:
+// ожидание при получении соединения и насыщенность пула.
+func writePoolStats(w io.Writer) {
+	if DB == nil {
+		return
+	}
+	st := DB.Stat()
+	writeCounterValue(w, "shichat_pgxpool_acquire_total",
+		"Количество выдач соединения из пула.", float64(st.AcquireCount()))
+	writeCounterValue(w, "shichat_pgxpool_acquire_wait_seconds_total",
+		"Суммарное время ожидания соединения из пула.", st.AcquireDuration().Seconds())
+	writeCounterValue(w, "shichat_pgxpool_empty_acquire_total",
+		"Выдачи, которым пришлось ждать освобождения соединения.", float64(st.EmptyAcquireCount()))
+	writeCounterValue(w, "shichat_pgxpool_canceled_acquire_total",
+		"Выдачи, отменённые по контексту.", float64(st.CanceledAcquireCount()))
+	writeGauge(w, "shichat_pgxpool_acquired_conns",
+		"Соединения, занятые в данный момент.", float64(st.AcquiredConns()))
+	writeGauge(w, "shichat_pgxpool_idle_conns",
+		"Свободные соединения.", float64(st.IdleConns()))
+	writeGauge(w, "shichat_pgxpool_max_conns",
+		"Максимальный размер пула.", float64(st.MaxConns()))
+
+	// Насыщенность пула: доля занятых соединений от максимума
+	saturation := 0.0
+	if st.MaxConns() > 0 {
+		saturation = float64(st.AcquiredConns()) / float64(st.MaxConns())
+	}
+	writeGauge(w, "shichat_pgxpool_saturation",
+		"Доля занятых соединений пула (0..1).", saturation)
+}
+
+// handleMetrics отдаёт все метрики в текстовом формате Prometheus.
+func handleMetrics(w http.ResponseWriter, _ *http.Request) {
+	w.Header().Set("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+
+	// Количество подключённых (авторизованных) клиентов
+	mu.Lock()
+	connected := len(clients)
+	mu.Unlock()
+	writeGauge(w, "shichat_connected_clients", "Количество подключённых клиентов.", float64(connected))
+
+	for _, m := range registry {
+		m.writeTo(w)
+	}
+	writePoolStats(w)
+}
+
+// startMetricsServer запускает HTTP-эндпоинт /metrics в отдельной горутине.
+// Адрес берётся из переменной окружения METRICS_ADDR (по умолчанию только локальный интерфейс).
+func startMetricsServer() {
+	addr := os.Getenv("METRICS_ADDR")
+	if addr == "" {
+		addr = "127.0.0.1:9090"
+	}
+
+	mux := http.NewServeMux()
+	mux.HandleFunc("/metrics", handleMetrics)
+
+	go func() {
+		fmt.Println("Metrics available on http://" + addr + "/metrics")
+		if err := http.ListenAndServe(addr, mux); err != nil {
+			fmt.Println("Не удалось запустить сервер метрик:", err)
+		}
+	}()
+}
+
+// formatFloat форматирует число так, как его ожидает Prometheus.
+func formatFloat(v float64) string {
+	s := strconv.FormatFloat(v, 'g', -1, 64)
+	// Целые значения выводим без экспоненты (например, 1e+06 → 1000000)
+	if strings.Contains(s, "e+") {
+		s = strconv.FormatFloat(v, 'f', -1, 64)
+	}
+	return s
+}
@@ -0,0 +1,345 @@
+package main
+
+import (
+	"context"
+	"encoding/json"
+	"fmt"
+	"os"
+	"strings"
+	"time"
+
+	"github.com/jackc/pgx/v5/pgxpool"
+)
+
+// Схема базы данных принадлежит серверу: при запуске применяются миграции,
+// которых ещё нет в таблице schema_migrations. Миграции только добавляются в конец списка —
+// уже применённую миграцию менять нельзя (на работающих базах она не выполнится повторно).
+//
+// Несколько узлов могут запускаться одновременно: миграции выполняет тот, кто первым взял
+// рекомендательную блокировку, остальные ждут её и находят все версии уже применёнными.
+//
+// Миграции-индексы (concurrent) при запуске не выполняются: на большой таблице индекс строится
+// долго, и сервер не должен всё это время не принимать соединения. Они выполняются в фоне,
+// когда сервер уже работает (startIndexMigrations), и версия каждой записывается, как только
+// построен её индекс. Поэтому последующие миграции не должны рассчитывать на такой индекс.
+
+// Ключи pg_advisory_lock
+const (
+	migrationLock      int64 = 0x5368696368617401 // миграции при запуске
+	indexMigrationLock       = migrationLock + 2  // построение индексов в фоне (+1 — обслуживание секций)
+)
+
+// migration — одно изменение схемы.
+type migration struct {
+	version int
+	name    string
+	sql     string
+	// concurrent — CREATE INDEX CONCURRENTLY: выполняется вне транзакции, не блокирует запись в таблицу,
+	// в фоне после запуска сервера. Такая миграция должна состоять из одного оператора и создавать
+	// индекс index; если индекс уже есть (его создала более поздняя миграция), только записывается версия.
+	concurrent bool
+	index      string
+}
+
+// migrations — история схемы по порядку версий.
+var migrations = []migration{
+	{version: 1, name: "base schema", sql: baseSchemaDDL},
+	{version: 2, name: "messages by chat and time", concurrent: true, index: "messages_chat_sent_idx",
+		sql: `CREATE INDEX CONCURRENTLY IF NOT EXISTS messages_chat_sent_idx ON messages(chat_id, sent_at DESC)`},
+	{version: 3, name: "chats of a member", concurrent: true, index: "chat_members_user_idx",
+		sql: `CREATE INDEX CONCURRENTLY IF NOT EXISTS chat_members_user_idx ON chat_members(user_id)`},
+	{version: 4, name: "unique login", concurrent: true, index: "users_username_key",
+		sql: `CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS users_username_key ON users(username)`},
+	{version: 5, name: "one private chat per pair", sql: privatePairDDL},
+	{version: 6, name: "attachments", sql: attachmentsDDL},
+	{version: 7, name: "cluster presence and bus", sql: clusterDDL},
+	{version: 8, name: "message search", concurrent: true, index: "messages_content_fts_idx", sql: searchIndexDDL},
+	{version: 9, name: "messages by month", sql: messagesPartitionDDL},
+	// На базах, созданных до миграций, у chat_members мог не быть первичного ключа;
+	// если он есть (chat_members_pkey), миграция ничего не делает
+	{version: 10, name: "unique chat member", concurrent: true, index: "chat_members_pkey",
+		sql: `CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS chat_members_pkey ON chat_members(chat_id, user_id)`},
+}
+
+// baseSchemaDDL — основные таблицы. На базах, созданных до появления миграций,
+// таблицы уже есть, и эта миграция ничего не меняет.
+const baseSchemaDDL = `
+	CREATE TABLE IF NOT EXISTS users (
+		id            BIGSERIAL PRIMARY KEY,
+		username      TEXT NOT NULL UNIQUE,
+		first_name    TEXT NOT NULL,
+		last_name     TEXT NOT NULL DEFAULT '',
+		password_hash TEXT NOT NULL,
+		display_name  TEXT GENERATED ALWAYS AS (btrim(first_name || ' ' || COALESCE(last_name, ''))) STORED,
+		created_at    TIMESTAMPTZ NOT NULL DEFAULT now(),
+		last_login_at TIMESTAMPTZ
+	);
+	CREATE TABLE IF NOT EXISTS chats (
+		id         BIGSERIAL PRIMARY KEY,
+		is_group   BOOLEAN NOT NULL DEFAULT false,
+		title      TEXT,
+		creator_id BIGINT REFERENCES users(id) ON DELETE SET NULL,
+		created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+	);
+	CREATE TABLE IF NOT EXISTS chat_members (
+		chat_id   BIGINT NOT NULL REFERENCES chats(id) ON DELETE CASCADE,
+		user_id   BIGINT NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+		joined_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+		PRIMARY KEY (chat_id, user_id)
+	);
+	CREATE TABLE IF NOT EXISTS messages (
+		id        BIGSERIAL PRIMARY KEY,
+		chat_id   BIGINT NOT NULL REFERENCES chats(id) ON DELETE CASCADE,
+		sender_id BIGINT NOT NULL REFERENCES users(id),
+		content   TEXT NOT NULL DEFAULT '',
+		sent_at   TIMESTAMPTZ NOT NULL DEFAULT now()
+	)`
+
+// privatePairDDL — пара участников приватного чата хранится в самом чате (меньший ID в user_low),
+// и уникальный индекс не даёт двум одновременным запросам создать два чата для одной пары.
+// Существующие приватные чаты заполняются по chat_members; если из-за прежней гонки у пары
+// несколько чатов, пару получает самый ранний, остальные остаются без неё.
+const privatePairDDL = `
+	ALTER TABLE chats
+		ADD COLUMN IF NOT EXISTS user_low  BIGINT REFERENCES users(id) ON DELETE CASCADE,
+		ADD COLUMN IF NOT EXISTS user_high BIGINT REFERENCES users(id) ON DELETE CASCADE;
+	UPDATE chats c SET user_low = p.lo, user_high = p.hi
+	FROM (
+		SELECT DISTINCT ON (lo, hi) chat_id, lo, hi
+		FROM (
+			SELECT cm.chat_id, min(cm.user_id) AS lo, max(cm.user_id) AS hi
+			FROM chat_members cm
+			JOIN chats ch ON ch.id = cm.chat_id AND NOT ch.is_group
+			GROUP BY cm.chat_id
+			HAVING count(*) <= 2
+		) t
+		ORDER BY lo, hi, chat_id
+	) p
+	WHERE c.id = p.chat_id AND c.user_low IS NULL;
+	CREATE UNIQUE INDEX IF NOT EXISTS chats_private_pair_idx
+		ON chats(user_low, user_high) WHERE user_low IS NOT NULL`
+
+// migrate применяет недостающие миграции, кроме миграций-индексов, и возвращает те из них,
+// что ещё не выполнены (их выполняет startIndexMigrations). Вызывается при запуске до приёма соединений.
+func migrate(ctx context.Context) ([]migration, error) {
+	conn, err := DB.Acquire(ctx)
+	if err != nil {
+		return nil, err
+	}
+	defer conn.Release()
+
+	// Блокировка сессии: держится на этом соединении до явного снятия
+	if _, err := conn.Exec(ctx, `SELECT pg_advisory_lock($1)`, migrationLock); err != nil {
+		return nil, fmt.Errorf("блокировка миграций: %w", err)
+	}
+	defer conn.Exec(context.Background(), `SELECT pg_advisory_unlock($1)`, migrationLock)
+
+	if _, err := conn.Exec(ctx, `
+		CREATE TABLE IF NOT EXISTS schema_migrations (
+			version    INT PRIMARY KEY,
+			name       TEXT NOT NULL,
+			applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+		)`); err != nil {
+		return nil, fmt.Errorf("таблица schema_migrations: %w", err)
+	}
+
+	applied := make(map[int]bool)
+	rows, err := conn.Query(ctx, `SELECT version FROM schema_migrations`)
+	if err != nil {
+		return nil, err
+	}
+	for rows.Next() {
+		var v int
+		if err := rows.Scan(&v); err != nil {
+			rows.Close()
+			return nil, err
+		}
+		applied[v] = true
+	}
+	rows.Close()
+	if err := rows.Err(); err != nil {
+		return nil, err
+	}
+
+	var pending []migration
+	for _, mg := range migrations {
+		if applied[mg.version] {
+			continue
+		}
+		if mg.concurrent {
+			pending = append(pending, mg)
+			continue
+		}
+		start := time.Now()
+		if err := applyMigration(ctx, conn, mg); err != nil {
+			return nil, fmt.Errorf("миграция %d (%s): %w", mg.version, mg.name, err)
+		}
+		fmt.Printf("Миграция %d (%s) применена (%v)\n", mg.version, mg.name, time.Since(start).Round(time.Millisecond))
+	}
+	return pending, nil
+}
+
+// startIndexMigrations выполняет в фоне миграции-индексы, не выполненные при запуске, а затем
+// проверяет планы запросов горячего пути (до того индексов для них может ещё не быть).
+func startIndexMigrations(ctx context.Context, pending []migration) {
+	go func() {
+		if err := migrateIndexes(ctx, pending); err != nil {
+			fmt.Println("Ошибка построения индексов (повторится при следующем запуске):", err)
+			return
+		}
+		if err := checkQueryPlans(ctx); err != nil {
+			fmt.Println("Проверка планов запросов:", err)
+		}
+	}()
+}
+
+// migrateIndexes строит индексы миграций pending по порядку. Строит их один узел: остальные
+// ждут блокировку и находят версии уже записанными.
+func migrateIndexes(ctx context.Context, pending []migration) error {
+	conn, err := DB.Acquire(ctx)
+	if err != nil {
+		return err
+	}
+	defer conn.Release()
+
+	if _, err := conn.Exec(ctx, `SELECT pg_advisory_lock($1)`, indexMigrationLock); err != nil {
+		return fmt.Errorf("блокировка миграций: %w", err)
+	}
+	defer conn.Exec(context.Background(), `SELECT pg_advisory_unlock($1)`, indexMigrationLock)
+
+	for _, mg := range pending {
+		var done bool
+		if err := conn.QueryRow(ctx,
+			`SELECT EXISTS (SELECT 1 FROM schema_migrations WHERE version=$1)`, mg.version,
+		).Scan(&done); err != nil {
+			return err
+		}
+		if done {
+			continue // выполнил другой узел, пока мы ждали блокировку
+		}
+		start := time.Now()
+		if err := applyMigration(ctx, conn, mg); err != nil {
+			return fmt.Errorf("миграция %d (%s): %w", mg.version, mg.name, err)
+		}
+		fmt.Printf("Миграция %d (%s) применена (%v)\n", mg.version, mg.name, time.Since(start).Round(time.Millisecond))
+	}
+	return nil
+}
+
+// applyMigration выполняет одну миграцию и записывает её версию.
+func applyMigration(ctx context.Context, conn *pgxpool.Conn, mg migration) error {
+	if mg.concurrent {
+		// Индекс с таким именем уже создала более поздняя миграция (например, перестроившая таблицу)
+		var built bool
+		if err := conn.QueryRow(ctx,
+			`SELECT EXISTS (SELECT 1 FROM pg_index WHERE indexrelid = to_regclass($1) AND indisvalid)`, mg.index,
+		).Scan(&built); err != nil {
+			return err
+		}
+		if !built {
+			if _, err := conn.Exec(ctx, mg.sql); err != nil {
+				// Прерванный CREATE INDEX CONCURRENTLY оставляет нерабочий индекс,
+				// который IF NOT EXISTS при следующем запуске пропустил бы
+				conn.Exec(context.Background(), `DROP INDEX CONCURRENTLY IF EXISTS `+mg.index)
+				return err
+			}
+		}
+		_, err := conn.Exec(ctx,
+			`INSERT INTO schema_migrations(version, name) VALUES ($1, $2)`, mg.version, mg.name)
+		return err
+	}
+
+	tx, err := conn.Begin(ctx)
+	if err != nil {
+		return err
+	}
+	defer tx.Rollback(context.Background()) // после Commit ничего не делает
+	if _, err := tx.Exec(ctx, mg.sql); err != nil {
+		return err
+	}
+	if _, err := tx.Exec(ctx,
+		`INSERT INTO schema_migrations(version, name) VALUES ($1, $2)`, mg.version, mg.name,
+	); err != nil {
+		return err
+	}
+	return tx.Commit(ctx)
+}
+
+// planCheck — запрос горячего пути и пример параметров для EXPLAIN.
+type planCheck struct {
+	name  string
+	query string
+	args  []any
+}
+
+// hotQueries — запросы, которые выполняются на каждое сообщение, вход или открытие чата.
+// Каждый из них должен обходиться индексами: последовательное чтение таблицы растёт вместе с базой.
+var hotQueries = []planCheck{
+	{"history", historyQuery, []any{int64(1)}},
+	{"history_before", historyBeforeQuery, []any{int64(1), time.Now(), int64(1)}},
+	{"fetch_user_chats", userChatsQuery, []any{int64(1)}},
+	{"private_chat", privateChatQuery, []any{int64(1), int64(2)}},
+	{"user_by_name", `SELECT id FROM users WHERE username=$1`, []any{""}},
+	{"presence_contacts", contactsQuery, []any{[]int64{1}}},
+}
+
+// planNode — узел плана из EXPLAIN (FORMAT JSON).
+type planNode struct {
+	NodeType string     `json:"Node Type"`
+	Relation string     `json:"Relation Name"`
+	Plans    []planNode `json:"Plans"`
+}
+
+// checkQueryPlans строит планы запросов горячего пути с enable_seqscan=off и возвращает ошибку,
+// если какой-то из них всё равно читает таблицу целиком: значит, нужного индекса нет.
+// Отключается переменной окружения PLAN_CHECK=off.
+func checkQueryPlans(ctx context.Context) error {
+	if os.Getenv("PLAN_CHECK") == "off" {
+		return nil
+	}
+	tx, err := DB.Begin(ctx)
+	if err != nil {
+		return err
+	}
+	defer tx.Rollback(context.Background())
+	// На маленькой таблице чтение целиком дешевле индекса, поэтому запрещаем его, если есть выбор
+	if _, err := tx.Exec(ctx, `SET LOCAL enable_seqscan = off`); err != nil {
+		return err
+	}
+
+	var bad []string
+	for _, q := range hotQueries {
+		var out string
+		if err := tx.QueryRow(ctx, `EXPLAIN (FORMAT JSON) `+q.query, q.args...).Scan(&out); err != nil {
+			return fmt.Errorf("план запроса %s: %w", q.name, err)
+		}
+		var plans []struct {
+			Plan planNode `json:"Plan"`
+		}
+		if err := json.Unmarshal([]byte(out), &plans); err != nil {
+			return fmt.Errorf("план запроса %s: %w", q.name, err)
+		}
+		for _, p := range plans {
+			for _, rel := range seqScans(p.Plan) {
+				bad = append(bad, q.name+" → "+rel)
+			}
+		}
+	}
+	if len(bad) > 0 {
+		return fmt.Errorf("последовательное чтение таблиц в запросах горячего пути (нет индекса?): %s",
+			strings.Join(bad, ", "))
+	}
+	return nil
+}
+
+// seqScans возвращает таблицы, которые план читает целиком.
+func seqScans(n planNode) []string {
+	var out []string
+	if n.NodeType == "Seq Scan" {
+		out = append(out, n.Relation)
+	}
+	for _, c := range n.Plans {
+		out = append(out, seqScans(c)...)
+	}
+	return out
+}
@@ -8,21 +8,55 @@ import (
 // Структура описывает формат всех сообщений между клиентом и сервером
 // Каждое поле может использоваться в зависимости от типа сообщения
 type Message struct {
-	Type         string        `json:"type"`                   // Тип сообщения: "signup", "signin", "message", "history", "userlist" и т.д.
-	From         string        `json:"from,omitempty"`         // Имя отправителя (username)
-	To           string        `json:"to,omitempty"`           // Имя получателя или ID чата (для групп)
-	Content      string        `json:"content,omitempty"`      // Текст сообщения
-	Password     string        `json:"password,omitempty"`     // Пароль (для входа или регистрации)
-	FirstName    string        `json:"first_name,omitempty"`   // Имя пользователя
-	LastName     string        `json:"last_name,omitempty"`    // Фамилия пользователя
-	Query        string        `json:"query,omitempty"`        // Поисковый запрос (например, поиск пользователей)
-	Name         string        `json:"name,omitempty"`         // Название новой группы
-	Participants []string      `json:"participants,omitempty"` // Участники группы
-	Timestamp    int64         `json:"timestamp,omitempty"`    // Время отправки сообщения (Unix-время)
-	DisplayName  string        `json:"display_name,omitempty"` // Имя, отображаемое в интерфейсе
-	Chats        []ChatPreview `json:"chats,omitempty"`        // Список чатов (используется при передаче chatlist)
-	Users        []UserSummary `json:"users,omitempty"`        // Список пользователей (результат поиска)
-	Chat         *ChatPreview  `json:"chat,omitempty"`         // Данные одного чата
+	Type         string            `json:"type"`                   // Тип сообщения: "signup", "signin", "message", "history", "userlist" и т.д.
+	From         string            `json:"from,omitempty"`         // Имя отправителя (username)
+	To           string            `json:"to,omitempty"`           // Имя получателя или ID чата (для групп)
+	Content      string            `json:"content,omitempty"`      // Текст сообщения
+	Password     string            `json:"password,omitempty"`     // Пароль (для входа или регистрации)
+	FirstName    string            `json:"first_name,omitempty"`   // Имя пользователя
+	LastName     string            `json:"last_name,omitempty"`    // Фамилия пользователя
+	Query        string            `json:"query,omitempty"`        // Поисковый запрос (например, поиск пользователей)
+	Name         string            `json:"name,omitempty"`         // Название новой группы
+	Participants []string          `json:"participants,omitempty"` // Участники группы
+	Timestamp    int64             `json:"timestamp,omitempty"`    // Время отправки сообщения (Unix-время)
+	DisplayName  string            `json:"display_name,omitempty"` // Имя, отображаемое в интерфейсе
+	Chats        []ChatPreview     `json:"chats,omitempty"`        // Список чатов (используется при передаче chatlist)
+	Users        []UserSummary     `json:"users,omitempty"`        // Список пользователей (результат поиска)
+	Chat         *ChatPreview      `json:"chat,omitempty"`         // Данные одного чата
+	Trace        *Trace            `json:"trace,omitempty"`        // Метки времени для трассировки задержек (необязательно)
+	Caps         []string          `json:"caps,omitempty"`         // Возможности протокола (предлагает клиент при signin, выбирает сервер в login_ok)
+	History      bool              `json:"history,omitempty"`      // Сообщение отправлено в ответ на запрос истории (не новое)
+	Limit        int               `json:"limit,omitempty"`        // Размер страницы (поиск сообщений)
+	Before       int64             `json:"before,omitempty"`       // Курсор страницы: в запросе — с какого ID продолжать, в ответе — курсор следующей страницы
+	Results      []SearchHit       `json:"results,omitempty"`      // Найденные сообщения (результат поиска)
+	FileID       int64             `json:"file_id,omitempty"`      // ID вложения (передача файлов)
+	Offset       int64             `json:"offset,omitempty"`       // Смещение в файле: начало куска, точка докачки или подтверждённый объём
+	Size         int64             `json:"size,omitempty"`         // Полный размер файла
+	Window       int64             `json:"window,omitempty"`       // Сколько байт можно отправить без подтверждения
+	Data         []byte            `json:"data,omitempty"`         // Содержимое куска файла
+	File         *FileInfo         `json:"file,omitempty"`         // Вложение, прикреплённое к сообщению
+	Token        string            `json:"token,omitempty"`        // Токен сессии: выдаётся в login_ok, предъявляется в signin вместо пароля
+	Op           string            `json:"op,omitempty"`           // Вид изменения в chat_delta: "add" (чат появился или обновился) или "remove"
+	Cursor       string            `json:"cursor,omitempty"`       // Курсор истории: в history_end — откуда продолжать, в запросе history — с какого места загрузить более ранние, в сообщении — страница перед ним
+	ReqID        int64             `json:"req_id,omitempty"`       // Номер запроса клиента; ответ на запрос (результаты поиска) возвращает его без изменений
+	Request      string            `json:"request,omitempty"`      // В ответе "error" на отклонённый запрос — тип этого запроса
+	RetryAfter   int64             `json:"retry_after,omitempty"`  // В ответе "error" — через сколько миллисекунд повторить запрос
+	Presence     []PresenceChange  `json:"presence,omitempty"`     // Изменения присутствия собеседников (пакет "presence")
+	Full         bool              `json:"full,omitempty"`         // Пакет "presence" — полный снимок: все, кого в нём нет, не в сети
+	Messages     []ExportedMessage `json:"messages,omitempty"`     // Порция сообщений выгружаемого чата (chat_export_chunk)
+}
+
+// Trace — необязательные метки времени, которые собираются по пути сообщения
+// от отправителя через сервер к получателям. Клиент проставляет время отправки,
+// сервер — время приёма, записи в БД и записи в сокет получателя.
+// Серверные метки — Unix-время в наносекундах.
+type Trace struct {
+	ID             string `json:"id"`                         // Идентификатор трассы (генерирует клиент)
+	ClientSend     int64  `json:"client_send,omitempty"`      // Монотонное время отправки на клиенте (нс)
+	ClientSendWall int64  `json:"client_send_wall,omitempty"` // Unix-время отправки на клиенте (нс)
+	ServerRecv     int64  `json:"server_recv,omitempty"`      // Сервер прочитал пакет из сокета
+	ServerDBCommit int64  `json:"server_db_commit,omitempty"` // Сообщение сохранено в БД
+	ServerFanout   int64  `json:"server_fanout,omitempty"`    // Пакет записывается в сокет получателя (после захвата mu)
 }
 
 // Структура, описывающая краткую информацию о чате (для отображения в списке чатов)
@@ -40,16 +74,54 @@ type UserSummary struct {
 	DisplayName string `json:"display_name"` // Отображаемое имя (имя + фамилия)
 }
 
+// Структура одного найденного сообщения (результат полнотекстового поиска)
+type SearchHit struct {
+	MessageID   int64  `json:"message_id"`   // ID сообщения (используется как курсор страниц)
+	ChatID      int64  `json:"chat_id"`      // ID чата
+	Peer        string `json:"peer"`         // Собеседник или ID группы — чтобы клиент мог открыть чат
+	From        string `json:"from"`         // Логин автора
+	DisplayName string `json:"display_name"` // Отображаемое имя автора
+	Content     string `json:"content"`      // Текст сообщения
+	Timestamp   int64  `json:"timestamp"`    // Время отправки (Unix-время)
+}
+
+// Структура одного сообщения в выгрузке чата (chat_export_chunk)
+type ExportedMessage struct {
+	ID          int64     `json:"id"`             // ID сообщения
+	From        string    `json:"from"`           // Логин автора
+	DisplayName string    `json:"display_name"`   // Отображаемое имя автора
+	Content     string    `json:"content"`        // Текст сообщения
+	Timestamp   int64     `json:"timestamp"`      // Время отправки (Unix-время)
+	File        *FileInfo `json:"file,omitempty"` // Вложение
+}
+
+// Структура изменения присутствия собеседника (пакет "presence")
+type PresenceChange struct {
+	User   string `json:"user"`             // Логин собеседника
+	Online bool   `json:"online"`           // В сети
+	Typing string `json:"typing,omitempty"` // Печатает в чате: логин собеседника (приватный чат) или ID группы
+}
+
+// Структура вложения, прикреплённого к сообщению
+type FileInfo struct {
+	ID   int64  `json:"id"`   // ID вложения (по нему файл скачивается)
+	Name string `json:"name"` // Имя файла
+	Size int64  `json:"size"` // Размер в байтах
+}
+
 // Структура клиента, подключённого к серверу
 type Client struct {
-	Conn net.Conn // TCP-соединение клиента
-	Name string   // Имя пользователя (username)
-	ID   int64    // ID пользователя из базы данных
+	Conn    net.Conn // TCP-соединение клиента
+	Name    string   // Имя пользователя (username)
+	ID      int64    // ID пользователя из базы данных
+	Session int64    // Номер входа (растёт по всему кластеру, более новый вход вытесняет старый)
 }
 
-// Глобальные переменные для отслеживания активных соединений
+// Глобальные переменные для отслеживания активных соединений этого узла
+// (клиенты других узлов сюда не попадают — см. cluster.go)
 var (
 	clients    = make(map[net.Conn]*Client) // Сопоставляет соединение с данными клиента
 	nameToConn = make(map[string]net.Conn)  // Позволяет найти соединение по имени пользователя
+	idToConn   = make(map[int64]net.Conn)   // Позволяет найти соединение по ID пользователя (для рассылки)
 	mu         sync.Mutex                   // Защищает от одновременного доступа из разных горутин
 )
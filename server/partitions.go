@@ -0,0 +1,395 @@
+package main
+
+import (
+	"compress/gzip"
+	"context"
+	"errors"
+	"fmt"
+	"os"
+	"path/filepath"
+	"strconv"
+	"time"
+
+	"github.com/jackc/pgx/v5"
+)
+
+// Хранение сообщений по месяцам.
+//
+// Таблица messages секционирована по sent_at: у каждого месяца своя секция messages_yГГГГmММ
+// со своими индексами. Запрос истории идёт по индексу (chat_id, sent_at DESC) и начинает
+// с самой свежей секции, поэтому читает только индексы последних месяцев, сколько бы истории
+// ни было всего. Секции на несколько месяцев вперёд создаются заранее (функция
+// ensure_message_partition); сообщения вне всех диапазонов (например, при сбитых часах)
+// попадают в messages_default.
+//
+// Старые секции можно убрать из таблицы (ARCHIVE_MONTHS — сколько последних месяцев оставить):
+// если задан ARCHIVE_DIR, секция выгружается в сжатый CSV и удаляется, иначе только
+// отсоединяется от messages и остаётся в базе отдельной таблицей. Восстановление архива:
+//
+//	gunzip -c messages_y2024m01.csv.gz | psql -c "COPY messages FROM STDIN (FORMAT csv, HEADER)"
+
+// Параметры обслуживания секций
+const (
+	partitionsAhead     = 2                 // на сколько месяцев вперёд создавать секции
+	maintenanceInterval = 6 * time.Hour     // как часто проверять секции
+	maintenanceLock     = migrationLock + 1 // ключ pg_try_advisory_lock: обслуживанием занят один узел
+
+	legacyBatch       = 1000                   // строк messages_legacy, переносимых одной транзакцией
+	legacyPause       = 100 * time.Millisecond // пауза между порциями переноса: база нужна и чату
+	legacyLockTimeout = "5s"                   // сколько ждать блокировку messages в конце переноса
+)
+
+// messagesPartitionDDL — перевод messages на секции по месяцам (миграция 9).
+//
+// Миграция только переименовывает старую таблицу в messages_legacy и создаёт рядом пустую
+// секционированную messages_part; строки переносятся потом, порциями, при обслуживании секций
+// (moveLegacyMessages). Пока перенос идёт, messages — представление, объединяющее обе таблицы:
+// запросы читают его как раньше, а новые сообщения триггер записывает в messages_part.
+// Когда старая таблица опустеет, представление удаляется и messages_part получает имя messages.
+//
+// Индексы создаются на пустой таблице, поэтому каждая секция получает свои, пустые, при создании,
+// и перестраивать индексы по всей истории не приходится (в том числе GIN поиска из миграции 8).
+//
+// Ключ секционирования должен входить в первичный ключ, поэтому он теперь (id, sent_at),
+// а вложение ссылается на сообщение парой (message_id, message_sent_at). Старый внешний ключ
+// на время переноса снимается (иначе удаление строки из messages_legacy обнулило бы ссылку),
+// новый добавляется, когда перенос закончен.
+const messagesPartitionDDL = `
+	ALTER TABLE messages RENAME TO messages_legacy;
+	ALTER INDEX IF EXISTS messages_pkey RENAME TO messages_legacy_pkey;
+	ALTER INDEX IF EXISTS messages_chat_sent_idx RENAME TO messages_legacy_chat_sent_idx;
+	ALTER INDEX IF EXISTS messages_content_fts_idx RENAME TO messages_legacy_content_fts_idx;
+	CREATE SEQUENCE IF NOT EXISTS messages_id_seq;
+
+	CREATE TABLE messages_part (
+		id        BIGINT NOT NULL DEFAULT nextval('messages_id_seq'),
+		chat_id   BIGINT NOT NULL REFERENCES chats(id) ON DELETE CASCADE,
+		sender_id BIGINT NOT NULL REFERENCES users(id),
+		content   TEXT NOT NULL DEFAULT '',
+		sent_at   TIMESTAMPTZ NOT NULL DEFAULT now(),
+		PRIMARY KEY (id, sent_at)
+	) PARTITION BY RANGE (sent_at);
+	ALTER SEQUENCE messages_id_seq OWNED BY messages_part.id;
+	CREATE INDEX messages_chat_sent_idx ON messages_part(chat_id, sent_at DESC, id DESC);
+	CREATE INDEX messages_content_fts_idx ON messages_part USING GIN (to_tsvector('simple', content));
+	CREATE TABLE messages_default PARTITION OF messages_part DEFAULT;
+
+	-- Секция месяца, в который попадает day (границы — по UTC). Возвращает имя секции.
+	-- Пока идёт перенос, секционированная таблица называется messages_part
+	CREATE OR REPLACE FUNCTION ensure_message_partition(day TIMESTAMPTZ) RETURNS TEXT
+	LANGUAGE plpgsql AS $$
+	DECLARE
+		lo     TIMESTAMPTZ := date_trunc('month', day AT TIME ZONE 'UTC') AT TIME ZONE 'UTC';
+		hi     TIMESTAMPTZ := (date_trunc('month', day AT TIME ZONE 'UTC') + interval '1 month') AT TIME ZONE 'UTC';
+		name   TEXT := 'messages_' || to_char(day AT TIME ZONE 'UTC', '"y"YYYY"m"MM');
+		parent TEXT := CASE WHEN to_regclass('messages_part') IS NULL THEN 'messages' ELSE 'messages_part' END;
+	BEGIN
+		IF to_regclass(name) IS NULL THEN
+			EXECUTE format('CREATE TABLE %I PARTITION OF %I FOR VALUES FROM (%L) TO (%L)', name, parent, lo, hi);
+		END IF;
+		RETURN name;
+	END $$;
+
+	CREATE VIEW messages AS
+		SELECT id, chat_id, sender_id, content, sent_at FROM messages_part
+		UNION ALL
+		SELECT id, chat_id, sender_id, content, sent_at FROM messages_legacy;
+	ALTER VIEW messages ALTER COLUMN id SET DEFAULT nextval('messages_id_seq');
+	ALTER VIEW messages ALTER COLUMN content SET DEFAULT '';
+	ALTER VIEW messages ALTER COLUMN sent_at SET DEFAULT now();
+
+	CREATE FUNCTION messages_view_insert() RETURNS trigger
+	LANGUAGE plpgsql AS $$
+	BEGIN
+		INSERT INTO messages_part(id, chat_id, sender_id, content, sent_at)
+		VALUES (NEW.id, NEW.chat_id, NEW.sender_id, NEW.content, NEW.sent_at);
+		RETURN NEW;
+	END $$;
+	CREATE TRIGGER messages_view_insert INSTEAD OF INSERT ON messages
+		FOR EACH ROW EXECUTE FUNCTION messages_view_insert();
+
+	ALTER TABLE attachments
+		DROP CONSTRAINT IF EXISTS attachments_message_id_fkey,
+		ADD COLUMN message_sent_at TIMESTAMPTZ;
+	UPDATE attachments a SET message_sent_at = m.sent_at
+	FROM messages_legacy m
+	WHERE m.id = a.message_id`
+
+// legacyFinishDDL — конец переноса: messages_legacy пуста, messages_part становится messages.
+// Выполняется в транзакции после проверки, что в messages_legacy не осталось строк.
+const legacyFinishDDL = `
+	DROP VIEW messages;
+	DROP FUNCTION messages_view_insert();
+	ALTER TABLE messages_part RENAME TO messages;
+	ALTER INDEX messages_part_pkey RENAME TO messages_pkey;
+	DROP TABLE messages_legacy;
+	ALTER TABLE attachments ADD CONSTRAINT attachments_message_fkey
+		FOREIGN KEY (message_id, message_sent_at) REFERENCES messages(id, sent_at)
+		ON DELETE SET NULL NOT VALID`
+
+// startPartitionMaintenance создаёт секции впрок и архивирует старые: сразу и затем периодически.
+func startPartitionMaintenance(ctx context.Context) {
+	keep := envInt("ARCHIVE_MONTHS", 0) // 0 — хранить всю историю
+	dir := os.Getenv("ARCHIVE_DIR")
+	go func() {
+		for {
+			if err := maintainPartitions(ctx, keep, dir); err != nil {
+				fmt.Println("Ошибка обслуживания секций сообщений:", err)
+			}
+			select {
+			case <-ctx.Done():
+				return
+			case <-time.After(maintenanceInterval):
+			}
+		}
+	}()
+}
+
+// maintainPartitions выполняет один проход обслуживания, если им не занят другой узел.
+func maintainPartitions(ctx context.Context, keep int, dir string) error {
+	conn, err := DB.Acquire(ctx)
+	if err != nil {
+		return err
+	}
+	defer conn.Release()
+
+	var locked bool
+	if err := conn.QueryRow(ctx, `SELECT pg_try_advisory_lock($1)`, maintenanceLock).Scan(&locked); err != nil {
+		return err
+	}
+	if !locked {
+		return nil // этот проход выполняет другой узел
+	}
+	defer conn.Exec(context.Background(), `SELECT pg_advisory_unlock($1)`, maintenanceLock)
+
+	// Секции текущего и следующих месяцев
+	now := time.Now().UTC()
+	for i := 0; i <= partitionsAhead; i++ {
+		if _, err := conn.Exec(ctx, `SELECT ensure_message_partition($1)`, now.AddDate(0, i, 0)); err != nil {
+			return fmt.Errorf("создание секции: %w", err)
+		}
+	}
+
+	// Перенос строк из таблицы, какой messages была до секций (пока он идёт, архивировать нельзя:
+	// в секцию отсоединённого месяца ещё пришли бы строки)
+	if err := moveLegacyMessages(ctx, conn.Conn()); err != nil {
+		return fmt.Errorf("перенос сообщений в секции: %w", err)
+	}
+	if keep <= 0 {
+		return nil
+	}
+
+	// Секции месяцев раньше границы хранения
+	cutoff := time.Date(now.Year(), now.Month(), 1, 0, 0, 0, 0, time.UTC).AddDate(0, -keep+1, 0)
+	rows, err := conn.Query(ctx, `
+		SELECT c.relname
+		FROM pg_inherits i
+		JOIN pg_class c ON c.oid = i.inhrelid
+		WHERE i.inhparent = 'messages'::regclass
+		ORDER BY c.relname`)
+	if err != nil {
+		return err
+	}
+	var old []string
+	for rows.Next() {
+		var name string
+		if err := rows.Scan(&name); err != nil {
+			rows.Close()
+			return err
+		}
+		if month, ok := partitionMonth(name); ok && month.Before(cutoff) {
+			old = append(old, name)
+		}
+	}
+	rows.Close()
+	if err := rows.Err(); err != nil {
+		return err
+	}
+
+	for _, name := range old {
+		start := time.Now()
+		if err := archivePartition(ctx, conn.Conn(), name, dir); err != nil {
+			return fmt.Errorf("архивирование %s: %w", name, err)
+		}
+		fmt.Printf("Секция %s убрана из messages (%v)\n", name, time.Since(start).Round(time.Millisecond))
+	}
+	return nil
+}
+
+// moveLegacyMessages переносит строки messages_legacy в секции порциями, каждую своей транзакцией,
+// а когда старая таблица опустеет, заканчивает перевод messages на секции (legacyFinishDDL).
+// Если messages_legacy уже нет, ничего не делает.
+func moveLegacyMessages(ctx context.Context, conn *pgx.Conn) error {
+	var legacy bool
+	if err := conn.QueryRow(ctx, `SELECT to_regclass('messages_legacy') IS NOT NULL`).Scan(&legacy); err != nil {
+		return err
+	}
+	if !legacy {
+		return nil
+	}
+
+	start := time.Now()
+	var moved, after int64
+	for {
+		n, last, err := moveLegacyBatch(ctx, conn, after)
+		if err != nil {
+			return err
+		}
+		if n == 0 {
+			break
+		}
+		moved += n
+		after = last
+		select {
+		case <-ctx.Done():
+			return ctx.Err()
+		case <-time.After(legacyPause):
+		}
+	}
+
+	tx, err := conn.Begin(ctx)
+	if err != nil {
+		return err
+	}
+	defer tx.Rollback(context.Background())
+	// Блокировка представления распространяется на обе таблицы под ним. Новые строки в messages_legacy
+	// не попадают (вставку в представление триггер направляет в messages_part), но проверяем
+	if _, err := tx.Exec(ctx, `SET LOCAL lock_timeout = '`+legacyLockTimeout+`'`); err != nil {
+		return err
+	}
+	if _, err := tx.Exec(ctx, `LOCK TABLE messages IN ACCESS EXCLUSIVE MODE`); err != nil {
+		return err
+	}
+	var left bool
+	if err := tx.QueryRow(ctx, `SELECT EXISTS (SELECT 1 FROM messages_legacy)`).Scan(&left); err != nil {
+		return err
+	}
+	if left {
+		return errors.New("в messages_legacy остались строки, перенос продолжится при следующем проходе")
+	}
+	if _, err := tx.Exec(ctx, legacyFinishDDL); err != nil {
+		return err
+	}
+	if err := tx.Commit(ctx); err != nil {
+		return err
+	}
+	fmt.Printf("Сообщения перенесены в секции: %d (%v)\n", moved, time.Since(start).Round(time.Millisecond))
+
+	// Проверка существующих ссылок вложений не блокирует запись в таблицы
+	_, err = conn.Exec(ctx, `ALTER TABLE attachments VALIDATE CONSTRAINT attachments_message_fkey`)
+	return err
+}
+
+// moveLegacyBatch переносит из messages_legacy до legacyBatch строк с id больше after.
+// Возвращает число перенесённых строк и наибольший их id.
+func moveLegacyBatch(ctx context.Context, conn *pgx.Conn, after int64) (int64, int64, error) {
+	tx, err := conn.Begin(ctx)
+	if err != nil {
+		return 0, 0, err
+	}
+	defer tx.Rollback(context.Background())
+
+	// Секции месяцев порции: строка вне всех секций попала бы в messages_default,
+	// и секцию её месяца потом нельзя было бы создать
+	if _, err := tx.Exec(ctx, `
+		SELECT DISTINCT ensure_message_partition(sent_at)
+		FROM (SELECT sent_at FROM messages_legacy WHERE id > $1 ORDER BY id LIMIT $2) b`,
+		after, legacyBatch,
+	); err != nil {
+		return 0, 0, err
+	}
+
+	var n, last int64
+	start := time.Now()
+	err = tx.QueryRow(ctx, `
+		WITH batch AS (
+			DELETE FROM messages_legacy
+			WHERE id IN (SELECT id FROM messages_legacy WHERE id > $1 ORDER BY id LIMIT $2)
+			RETURNING id, chat_id, sender_id, content, sent_at
+		), moved AS (
+			INSERT INTO messages_part(id, chat_id, sender_id, content, sent_at)
+			SELECT id, chat_id, sender_id, content, sent_at FROM batch
+			RETURNING id
+		)
+		SELECT count(*), COALESCE(max(id), 0) FROM moved`,
+		after, legacyBatch,
+	).Scan(&n, &last)
+	observeQuery("legacy_move", start)
+	if err != nil {
+		return 0, 0, err
+	}
+	return n, last, tx.Commit(ctx)
+}
+
+// partitionMonth возвращает месяц секции по её имени (messages_yГГГГmММ).
+func partitionMonth(name string) (time.Time, bool) {
+	var y, m int
+	if n, err := fmt.Sscanf(name, "messages_y%4dm%2d", &y, &m); err != nil || n != 2 {
+		return time.Time{}, false
+	}
+	return time.Date(y, time.Month(m), 1, 0, 0, 0, 0, time.UTC), true
+}
+
+// archivePartition отсоединяет секцию от messages. Если задан каталог архива, содержимое
+// секции сначала выгружается в dir/<секция>.csv.gz, а после отсоединения секция удаляется.
+func archivePartition(ctx context.Context, conn *pgx.Conn, name, dir string) error {
+	ident := pgx.Identifier{name}.Sanitize()
+	if dir != "" {
+		if err := exportPartition(ctx, conn, ident, filepath.Join(dir, name+".csv.gz")); err != nil {
+			return err
+		}
+	}
+
+	tx, err := conn.Begin(ctx)
+	if err != nil {
+		return err
+	}
+	defer tx.Rollback(context.Background())
+	// Внешний ключ не даёт отсоединить секцию, на строки которой ссылаются вложения:
+	// ссылка обнуляется, как при удалении сообщения
+	if _, err := tx.Exec(ctx, `
+		UPDATE attachments SET message_id = NULL, message_sent_at = NULL
+		WHERE (message_id, message_sent_at) IN (SELECT id, sent_at FROM `+ident+`)`); err != nil {
+		return err
+	}
+	if _, err := tx.Exec(ctx, `ALTER TABLE messages DETACH PARTITION `+ident); err != nil {
+		return err
+	}
+	if dir != "" {
+		if _, err := tx.Exec(ctx, `DROP TABLE `+ident); err != nil {
+			return err
+		}
+	}
+	return tx.Commit(ctx)
+}
+
+// exportPartition выгружает секцию в сжатый CSV. Файл появляется под итоговым именем
+// только целиком записанным, поэтому оборванная выгрузка не выглядит готовым архивом.
+func exportPartition(ctx context.Context, conn *pgx.Conn, ident, path string) error {
+	if err := os.MkdirAll(filepath.Dir(path), 0o750); err != nil {
+		return err
+	}
+	tmp := path + ".tmp." + strconv.Itoa(os.Getpid())
+	f, err := os.Create(tmp)
+	if err != nil {
+		return err
+	}
+	defer os.Remove(tmp) // после переименования ничего не удаляет
+
+	zw := gzip.NewWriter(f)
+	_, err = conn.PgConn().CopyTo(ctx, zw,
+		`COPY (SELECT id, chat_id, sender_id, content, sent_at FROM `+ident+`) TO STDOUT (FORMAT csv, HEADER)`)
+	if err == nil {
+		err = zw.Close()
+	}
+	if err == nil {
+		err = f.Sync()
+	}
+	if cerr := f.Close(); err == nil {
+		err = cerr
+	}
+	if err != nil {
+		return err
+	}
+	return os.Rename(tmp, path)
+}
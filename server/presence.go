@@ -0,0 +1,401 @@
+package main
+
+import (
+	"context"
+	"fmt"
+	"net"
+	"strconv"
+	"sync"
+	"time"
+)
+
+// Присутствие (в сети / не в сети) и индикатор набора текста.
+//
+// Вход и выход пользователя (по картам клиентов из models.go) и пакеты "typing" не рассылаются
+// сразу: хаб копит изменения и раз в PRESENCE_FLUSH_MS разом отправляет каждому получателю
+// один пакет "presence" со списком изменений. Получатели — только те, у кого с пользователем
+// есть общий чат (для набора текста — участники того чата, где он печатает). Если за окно
+// пользователь вышел и снова вошёл (переподключение), получатели ничего не получают.
+//
+// Только что вошедший пользователь получает в том же цикле снимок: кто из его собеседников
+// сейчас в сети (Full: остальные — не в сети). Снимки отправляются раньше изменений окна,
+// поэтому изменение не может прийти раньше снимка и быть им перезаписано.
+//
+// Набор текста не имеет события «перестал печатать»: клиент показывает индикатор несколько
+// секунд после последнего пакета и убирает его, когда приходит сообщение или пользователь выходит.
+//
+// Получатели на других узлах получают изменения событием "presence" — одно событие на узел за цикл.
+
+// statusChange — во что перешёл пользователь за окно.
+type statusChange struct {
+	name   string
+	online bool
+}
+
+// typingKey — пользователь печатает в чате to (логин собеседника или ID группы, как в пакете "message").
+type typingKey struct {
+	user int64
+	name string
+	to   string
+}
+
+// presenceHub — изменения присутствия, накопленные за текущее окно.
+type presenceHub struct {
+	mu     sync.Mutex
+	status map[int64]statusChange
+	typing map[typingKey]bool
+	fresh  map[int64]bool // вошедшие за окно: им нужен снимок присутствия собеседников
+}
+
+// presence — хаб присутствия этого узла.
+var presence = newPresenceHub(time.Duration(envInt("PRESENCE_FLUSH_MS", 300)) * time.Millisecond)
+
+// newPresenceHub запускает рассылку накопленных изменений раз в interval.
+func newPresenceHub(interval time.Duration) *presenceHub {
+	h := &presenceHub{
+		status: make(map[int64]statusChange),
+		typing: make(map[typingKey]bool),
+		fresh:  make(map[int64]bool),
+	}
+	go func() {
+		for range time.Tick(interval) {
+			h.flush(context.Background())
+		}
+	}()
+	return h
+}
+
+// connected — пользователь вошёл на этом узле.
+func (h *presenceHub) connected(userID int64, name string) {
+	h.mu.Lock()
+	defer h.mu.Unlock()
+	h.fresh[userID] = true
+	h.flip(userID, name, true)
+}
+
+// disconnected — пользователь вышел (его вход не перехвачен новым).
+func (h *presenceHub) disconnected(userID int64, name string) {
+	h.mu.Lock()
+	defer h.mu.Unlock()
+	delete(h.fresh, userID)
+	h.flip(userID, name, false)
+}
+
+// flip записывает смену состояния. Вызывается под h.mu.
+func (h *presenceHub) flip(userID int64, name string, online bool) {
+	if c, ok := h.status[userID]; ok && c.online != online {
+		delete(h.status, userID) // вернулся в состояние начала окна — сообщать нечего
+		return
+	}
+	h.status[userID] = statusChange{name, online}
+}
+
+// typed — пользователь печатает в чате to. Повторы за окно схлопываются.
+func (h *presenceHub) typed(userID int64, name, to string) {
+	if to == "" {
+		return
+	}
+	h.mu.Lock()
+	h.typing[typingKey{userID, name, to}] = true
+	h.mu.Unlock()
+}
+
+// flush рассылает изменения, накопленные за окно.
+func (h *presenceHub) flush(ctx context.Context) {
+	h.mu.Lock()
+	status, typing, fresh := h.status, h.typing, h.fresh
+	if len(status) == 0 && len(typing) == 0 && len(fresh) == 0 {
+		h.mu.Unlock()
+		return
+	}
+	h.status = make(map[int64]statusChange)
+	h.typing = make(map[typingKey]bool)
+	h.fresh = make(map[int64]bool)
+	h.mu.Unlock()
+
+	start := time.Now()
+	defer fanoutDuration.observeSince("presence", start)
+
+	if len(fresh) > 0 {
+		if err := sendPresenceSnapshots(ctx, fresh); err != nil {
+			fmt.Println("Ошибка БД (снимок присутствия):", err)
+		}
+	}
+
+	out := make(map[int64][]PresenceChange) // получатель → изменения
+	if len(status) > 0 {
+		ids := make([]int64, 0, len(status))
+		for uid := range status {
+			ids = append(ids, uid)
+		}
+		contacts, err := loadContacts(ctx, ids)
+		if err != nil {
+			fmt.Println("Ошибка БД (собеседники для присутствия):", err)
+		}
+		for uid, c := range status {
+			for _, r := range contacts[uid] {
+				out[r] = append(out[r], PresenceChange{User: c.name, Online: c.online})
+			}
+		}
+	}
+	if len(typing) > 0 {
+		targets, err := typingTargets(ctx, typing)
+		if err != nil {
+			fmt.Println("Ошибка БД (получатели набора текста):", err)
+		}
+		for k, rs := range targets {
+			if c, ok := status[k.user]; ok && !c.online {
+				continue // уже вышел — индикатор набора не нужен
+			}
+			// Чат так, как его видит получатель: группа — по ID, приватный чат — по логину печатающего
+			chat := k.to
+			if _, err := strconv.ParseInt(k.to, 10, 64); err != nil {
+				chat = k.name
+			}
+			for _, r := range rs {
+				out[r] = append(out[r], PresenceChange{User: k.name, Online: true, Typing: chat})
+			}
+		}
+	}
+	if len(out) == 0 {
+		return
+	}
+
+	// Получатели этого узла — сразу, остальные — событием узлам, где они онлайн
+	remote := deliverPresenceLocal(out)
+	if len(remote) == 0 {
+		return
+	}
+	routes, err := node.route(ctx, remote)
+	if err != nil {
+		fmt.Println("Ошибка маршрутизации между узлами:", err)
+		return
+	}
+	for n, users := range routes {
+		ev := &busEvent{Kind: "presence", From: nodeID, Presence: make(map[int64][]PresenceChange, len(users))}
+		for _, uid := range users {
+			ev.Presence[uid] = out[uid]
+		}
+		if err := node.publish(ctx, n, ev); err != nil {
+			fmt.Println("Ошибка отправки события узлу", n+":", err)
+		}
+	}
+}
+
+// deliverPresenceLocal отправляет каждому получателю этого узла его изменения одним пакетом
+// и возвращает получателей, которых на этом узле нет.
+func deliverPresenceLocal(out map[int64][]PresenceChange) []int64 {
+	var remote []int64
+	mu.Lock()
+	defer mu.Unlock()
+	for uid, changes := range out {
+		c, ok := idToConn[uid]
+		if !ok {
+			remote = append(remote, uid)
+			continue
+		}
+		sendPresence(c, Message{Type: "presence", Presence: changes})
+	}
+	return remote
+}
+
+// contactsQuery — пары (пользователь, собеседник): у них есть общий чат.
+const contactsQuery = `
+	SELECT DISTINCT a.user_id, b.user_id
+	FROM chat_members a
+	JOIN chat_members b ON b.chat_id = a.chat_id AND b.user_id <> a.user_id
+	WHERE a.user_id = ANY($1)`
+
+// loadContacts возвращает собеседников каждого из пользователей userIDs (одним запросом).
+func loadContacts(ctx context.Context, userIDs []int64) (map[int64][]int64, error) {
+	start := time.Now()
+	rows, err := DB.Query(ctx, contactsQuery, userIDs)
+	if err != nil {
+		return nil, err
+	}
+	defer rows.Close()
+	contacts := make(map[int64][]int64)
+	for rows.Next() {
+		var uid, peer int64
+		if err := rows.Scan(&uid, &peer); err != nil {
+			return contacts, err
+		}
+		contacts[uid] = append(contacts[uid], peer)
+	}
+	observeQuery("presence_contacts", start)
+	return contacts, rows.Err()
+}
+
+// typingTargets возвращает получателей индикатора для каждой записи о наборе текста:
+// других участников группы (если печатающий в ней состоит) или собеседника, с которым
+// у печатающего есть общий чат.
+func typingTargets(ctx context.Context, typing map[typingKey]bool) (map[typingKey][]int64, error) {
+	var groups, users, senders []int64
+	var peers []string
+	for k := range typing {
+		if id, err := strconv.ParseInt(k.to, 10, 64); err == nil {
+			groups = append(groups, id)
+			users = append(users, k.user)
+		} else {
+			peers = append(peers, k.to)
+			senders = append(senders, k.user)
+		}
+	}
+
+	targets := make(map[typingKey][]int64)
+	start := time.Now()
+	if len(groups) > 0 {
+		// Пары (группа, участник) берутся из обоих списков сразу, поэтому лишние строки
+		// (участник состоит в группе, но печатал в другой) отсекаются по typing
+		rows, err := DB.Query(ctx, `
+			SELECT a.chat_id, a.user_id, u.username, b.user_id
+			FROM chat_members a
+			JOIN users u ON u.id = a.user_id
+			JOIN chat_members b ON b.chat_id = a.chat_id AND b.user_id <> a.user_id
+			WHERE a.chat_id = ANY($1) AND a.user_id = ANY($2)`, groups, users)
+		if err != nil {
+			return targets, err
+		}
+		for rows.Next() {
+			var chatID, uid, r int64
+			var name string
+			if err := rows.Scan(&chatID, &uid, &name, &r); err != nil {
+				rows.Close()
+				return targets, err
+			}
+			k := typingKey{uid, name, strconv.FormatInt(chatID, 10)}
+			if typing[k] {
+				targets[k] = append(targets[k], r)
+			}
+		}
+		rows.Close()
+		if err := rows.Err(); err != nil {
+			return targets, err
+		}
+	}
+	if len(peers) > 0 {
+		// Индикатор получает только тот, с кем у печатающего есть общий чат; как и для групп,
+		// лишние пары (общий чат есть, но печатали другому) отсекаются по typing
+		type pair struct {
+			user int64
+			peer string
+		}
+		rows, err := DB.Query(ctx, `
+			SELECT DISTINCT a.user_id, u.id, u.username
+			FROM users u
+			JOIN chat_members b ON b.user_id = u.id
+			JOIN chat_members a ON a.chat_id = b.chat_id AND a.user_id <> b.user_id
+			WHERE u.username = ANY($1) AND a.user_id = ANY($2)`, peers, senders)
+		if err != nil {
+			return targets, err
+		}
+		ids := make(map[pair]int64)
+		for rows.Next() {
+			var uid, id int64
+			var name string
+			if err := rows.Scan(&uid, &id, &name); err != nil {
+				rows.Close()
+				return targets, err
+			}
+			ids[pair{uid, name}] = id
+		}
+		rows.Close()
+		if err := rows.Err(); err != nil {
+			return targets, err
+		}
+		for k := range typing {
+			if id, ok := ids[pair{k.user, k.to}]; ok {
+				targets[k] = []int64{id}
+			}
+		}
+	}
+	observeQuery("presence_typing", start)
+	return targets, nil
+}
+
+// sendPresenceSnapshots отправляет только что вошедшим пользователям, кто из их собеседников в сети.
+func sendPresenceSnapshots(ctx context.Context, fresh map[int64]bool) error {
+	ids := make([]int64, 0, len(fresh))
+	for uid := range fresh {
+		ids = append(ids, uid)
+	}
+	start := time.Now()
+	rows, err := DB.Query(ctx, `
+		SELECT DISTINCT a.user_id, u.id, u.username
+		FROM chat_members a
+		JOIN chat_members b ON b.chat_id = a.chat_id AND b.user_id <> a.user_id
+		JOIN users u ON u.id = b.user_id
+		WHERE a.user_id = ANY($1)`, ids)
+	if err != nil {
+		return err
+	}
+	type contact struct {
+		id   int64
+		name string
+	}
+	contacts := make(map[int64][]contact)
+	all := make(map[int64]bool)
+	for rows.Next() {
+		var uid int64
+		var c contact
+		if err := rows.Scan(&uid, &c.id, &c.name); err != nil {
+			rows.Close()
+			return err
+		}
+		contacts[uid] = append(contacts[uid], c)
+		all[c.id] = true
+	}
+	rows.Close()
+	observeQuery("presence_snapshot", start)
+	if err := rows.Err(); err != nil {
+		return err
+	}
+
+	// Кто в сети: подключённые к этому узлу и те, кого шина находит на других узлах
+	online := make(map[int64]bool)
+	var rest []int64
+	mu.Lock()
+	for id := range all {
+		if _, ok := idToConn[id]; ok {
+			online[id] = true
+		} else {
+			rest = append(rest, id)
+		}
+	}
+	mu.Unlock()
+	if len(rest) > 0 {
+		routes, err := node.route(ctx, rest)
+		if err != nil {
+			return err
+		}
+		for _, users := range routes {
+			for _, id := range users {
+				online[id] = true
+			}
+		}
+	}
+
+	mu.Lock()
+	defer mu.Unlock()
+	for _, uid := range ids {
+		conn, ok := idToConn[uid]
+		if !ok {
+			continue // уже отключился
+		}
+		changes := []PresenceChange{}
+		for _, c := range contacts[uid] {
+			if online[c.id] {
+				changes = append(changes, PresenceChange{User: c.name, Online: true})
+			}
+		}
+		sendPresence(conn, Message{Type: "presence", Full: true, Presence: changes})
+	}
+	return nil
+}
+
+// sendPresence отправляет пакет присутствия и учитывает его в метриках. Вызывается под mu.
+func sendPresence(conn net.Conn, m Message) {
+	sendMessage(conn, m)
+	presencePackets.inc()
+	presenceChanges.add(uint64(len(m.Presence)))
+}
@@ -0,0 +1,220 @@
+package main
+
+import (
+	"math"
+	"net"
+	"os"
+	"runtime"
+	"time"
+)
+
+// Ограничение запросов клиента.
+//
+// Каждое соединение получает корзины токенов: общую на все пакеты и отдельную на каждый тип
+// запроса (packetLimits). Пакет, для которого токена нет, не выполняется — клиент получает
+// "error" с retry_after (через сколько миллисекунд токен появится) и типом отклонённого запроса.
+// Корзины принадлежат циклу чтения соединения, поэтому блокировки им не нужны.
+//
+// Кроме того, число одновременно выполняющихся запросов к БД ограничено на весь узел
+// (DB_INFLIGHT, по умолчанию — вдвое больше соединений пула). Запрос ждёт свободного места
+// не дольше DB_ADMIT_WAIT_MS, затем отклоняется: при перегрузке клиенты сразу получают отказ,
+// а не занимают горутины и очередь пула. Фоновые обработчики (поиск, создание чатов)
+// запускаются только после получения места, так что горутин на соединение не больше, чем мест.
+//
+// RATE_LIMIT=off отключает корзины (ограничение запросов к БД остаётся).
+
+// limitRule — скорость пополнения (токенов в секунду) и ёмкость корзины.
+type limitRule struct {
+	rate  float64
+	burst float64
+}
+
+// connLimit — общая корзина соединения: все пакеты, кроме кусков файлов и подтверждений
+// (их скорость и так ограничивает окно передачи).
+var connLimit = limitRule{rate: 50, burst: 100}
+
+// packetLimits — корзины по типам запросов. Типы, которых здесь нет, ограничивает только общая корзина.
+var packetLimits = map[string]limitRule{
+	"message":        {rate: 10, burst: 20},
+	"history":        {rate: 10, burst: 30}, // открытие чатов, прокрутка и фоновая предзагрузка
+	"user_search":    {rate: 5, burst: 10},  // поиск по мере ввода
+	"message_search": {rate: 2, burst: 5},
+	"start_chat":     {rate: 1, burst: 5},
+	"create_group":   {rate: 1, burst: 5},
+	"group_add":      {rate: 1, burst: 5},
+	"group_remove":   {rate: 1, burst: 5},
+	"file_offer":     {rate: 2, burst: 10},
+	"file_download":  {rate: 2, burst: 10},
+	"typing":         {rate: 1, burst: 3},   // клиент сам шлёт не чаще раза в несколько секунд
+	"chat_export":    {rate: 0.1, burst: 2}, // выгрузка всей истории чата (см. export.go)
+}
+
+// unlimitedPackets — пакеты потока передачи файлов и подтверждения выгрузки чата: не расходуют общую корзину.
+var unlimitedPackets = map[string]bool{"file_chunk": true, "file_ack": true, "chat_export_ack": true}
+
+// rateLimitOff — корзины отключены (RATE_LIMIT=off).
+var rateLimitOff = os.Getenv("RATE_LIMIT") == "off"
+
+// tokenBucket — корзина токенов: пополняется со скоростью rate до burst.
+type tokenBucket struct {
+	limitRule
+	tokens float64
+	last   time.Time
+}
+
+func newTokenBucket(r limitRule, now time.Time) *tokenBucket {
+	return &tokenBucket{limitRule: r, tokens: r.burst, last: now}
+}
+
+// refill начисляет токены за время с прошлого обращения.
+func (b *tokenBucket) refill(now time.Time) {
+	b.tokens = math.Min(b.burst, b.tokens+now.Sub(b.last).Seconds()*b.rate)
+	b.last = now
+}
+
+// wait — через сколько появится целый токен (0 — уже есть). Вызывается после refill.
+func (b *tokenBucket) wait() time.Duration {
+	if b.tokens >= 1 {
+		return 0
+	}
+	return time.Duration(math.Ceil((1 - b.tokens) / b.rate * float64(time.Second)))
+}
+
+// connLimiter — корзины одного соединения.
+type connLimiter struct {
+	all    *tokenBucket
+	byType map[string]*tokenBucket
+}
+
+func newConnLimiter() *connLimiter {
+	return &connLimiter{all: newTokenBucket(connLimit, time.Now()), byType: make(map[string]*tokenBucket)}
+}
+
+// allow расходует токены на пакет типа ptype. Если токена нет в общей корзине или в корзине типа,
+// ничего не расходует и возвращает, через сколько повторить.
+func (l *connLimiter) allow(ptype string) (bool, time.Duration) {
+	if rateLimitOff || unlimitedPackets[ptype] {
+		return true, 0
+	}
+	now := time.Now()
+	l.all.refill(now)
+	wait := l.all.wait()
+	var tb *tokenBucket
+	if r, ok := packetLimits[ptype]; ok {
+		tb = l.byType[ptype]
+		if tb == nil {
+			tb = newTokenBucket(r, now)
+			l.byType[ptype] = tb
+		}
+		tb.refill(now)
+		wait = max(wait, tb.wait())
+	}
+	if wait > 0 {
+		return false, wait
+	}
+	l.all.tokens--
+	if tb != nil {
+		tb.tokens--
+	}
+	return true, 0
+}
+
+// dbPackets — запросы, которые обращаются к БД и проходят через dbGate. Скачивание файла
+// сюда не входит: место держалось бы всю передачу, а одновременных скачиваний на соединение
+// и так не больше одного на файл. Выгрузка чата тоже: у неё своё ограничение (exportSlots).
+var dbPackets = map[string]bool{
+	"message": true, "history": true, "user_search": true, "message_search": true,
+	"start_chat": true, "create_group": true, "group_add": true, "group_remove": true,
+	"file_offer": true,
+}
+
+// dbBusyRetry — через сколько предлагается повторить запрос, отклонённый из-за перегрузки БД.
+const dbBusyRetry = time.Second
+
+// admission — ограничение одновременных запросов к БД на узле.
+type admission struct {
+	slots chan struct{}
+	wait  time.Duration // сколько запрос может ждать места
+}
+
+// dbGate — ограничение запросов к БД этого узла.
+var dbGate = newAdmission(envInt("DB_INFLIGHT", 2*max(4, runtime.NumCPU())),
+	time.Duration(envInt("DB_ADMIT_WAIT_MS", 200))*time.Millisecond)
+
+// newAdmission создаёт ограничение на n одновременных запросов.
+func newAdmission(n int, wait time.Duration) *admission {
+	a := &admission{slots: make(chan struct{}, n), wait: wait}
+	newGaugeFunc("shichat_db_inflight", "Запросы клиентов, выполняющиеся в БД.",
+		func() float64 { return float64(len(a.slots)) })
+	newGaugeFunc("shichat_db_inflight_capacity", "Максимум одновременных запросов клиентов к БД.",
+		func() float64 { return float64(cap(a.slots)) })
+	return a
+}
+
+// acquire занимает место, ожидая его не дольше a.wait. false — мест нет.
+func (a *admission) acquire(ptype string) bool {
+	select {
+	case a.slots <- struct{}{}:
+		return true
+	default:
+	}
+	start := time.Now()
+	t := time.NewTimer(a.wait)
+	defer t.Stop()
+	select {
+	case a.slots <- struct{}{}:
+		admissionWait.observeSince(ptype, start)
+		return true
+	case <-t.C:
+		return false
+	}
+}
+
+// release освобождает место.
+func (a *admission) release() { <-a.slots }
+
+// withDBSlot выполняет обработчик запроса и освобождает занятое admit место в dbGate.
+func withDBSlot(h func(net.Conn, Message), conn net.Conn, m Message) {
+	defer dbGate.release()
+	h(conn, m)
+}
+
+// admit пропускает пакет через корзины соединения и ограничение запросов к БД.
+// При отказе отправляет клиенту ошибку с retry_after и возвращает false.
+// При true пакет к БД занял место в dbGate — его нужно освободить по завершении обработки.
+func admit(conn net.Conn, l *connLimiter, m *Message) bool {
+	if ok, wait := l.allow(m.Type); !ok {
+		rateLimited.inc(m.Type)
+		sendRetryLater(conn, m, "Слишком много запросов", wait)
+		return false
+	}
+	if dbPackets[m.Type] && !dbGate.acquire(m.Type) {
+		admissionRejected.inc(m.Type)
+		sendRetryLater(conn, m, "Сервер перегружен", dbBusyRetry)
+		return false
+	}
+	return true
+}
+
+// sendRetryLater отвечает на отклонённый запрос: текст ошибки, тип запроса, чат (To), файл и номер
+// запроса клиента — чтобы клиент понял, что именно повторить, — и через сколько миллисекунд.
+func sendRetryLater(conn net.Conn, m *Message, text string, wait time.Duration) {
+	ms := wait.Milliseconds()
+	if wait%time.Millisecond != 0 {
+		ms++
+	}
+	sendMessage(conn, Message{
+		Type:       "error",
+		Content:    text + ", повторите через " + formatSeconds(wait),
+		Request:    m.Type,
+		To:         m.To,
+		FileID:     m.FileID,
+		ReqID:      m.ReqID,
+		RetryAfter: ms,
+	})
+}
+
+// formatSeconds — длительность для текста ошибки («0.3 с»).
+func formatSeconds(d time.Duration) string {
+	return formatFloat(math.Ceil(d.Seconds()*10)/10) + " с"
+}
@@ -0,0 +1,123 @@
+package main
+
+import (
+	"context"
+	"fmt"
+	"net"
+	"strings"
+	"time"
+	"unicode"
+)
+
+// Параметры полнотекстового поиска по сообщениям
+const (
+	searchPageSize = 20  // размер страницы по умолчанию
+	searchMaxPage  = 100 // максимальный размер страницы, который может запросить клиент
+)
+
+// searchFailed — текст ошибки в message_search_result (поле content), если поиск не удался.
+const searchFailed = "Ошибка поиска, попробуйте ещё раз"
+
+// searchIndexDDL — GIN-индекс по tsvector содержимого сообщений (миграция 8).
+// Конфигурация 'simple' не зависит от языка (без стемминга), поэтому подходит
+// и для русского, и для английского текста. Выражение в запросе должно совпадать с индексом.
+const searchIndexDDL = `
+	CREATE INDEX CONCURRENTLY IF NOT EXISTS messages_content_fts_idx
+	ON messages USING GIN (to_tsvector('simple', content))`
+
+// prefixTSQuery превращает строку поиска в tsquery: все слова обязательны и ищутся по префиксу
+// ("отч гот" → "отч:* & гот:*"), как и в локальном индексе клиента.
+// Оставляет только буквы и цифры, поэтому синтаксис tsquery из ввода пользователя не попадает в запрос.
+func prefixTSQuery(s string) string {
+	words := strings.FieldsFunc(strings.ToLower(s), func(r rune) bool {
+		return !unicode.IsLetter(r) && !unicode.IsDigit(r)
+	})
+	for i, w := range words {
+		words[i] = w + ":*"
+	}
+	return strings.Join(words, " & ")
+}
+
+// handleMessageSearch обрабатывает запрос полнотекстового поиска по сообщениям.
+// Ищет только в чатах, где состоит пользователь; результаты — от новых к старым,
+// постранично: в поле Before клиент передаёт курсор (ID сообщения), полученный с прошлой страницей.
+// При ошибке БД в ответе — текст ошибки (Content) без результатов.
+func handleMessageSearch(conn net.Conn, m Message) {
+	mu.Lock()
+	sender := clients[conn]
+	mu.Unlock()
+	if sender == nil {
+		return
+	}
+
+	// Ответ уходит на любом пути, в том числе при ошибке: клиент ждёт его по req_id
+	reply := Message{Type: "message_search_result", Query: m.Query, ReqID: m.ReqID}
+	defer func() { sendMessage(conn, reply) }()
+
+	q := prefixTSQuery(m.Query)
+	if q == "" {
+		return // в запросе нет ни слова — пустая страница, продолжения нет
+	}
+	limit := m.Limit
+	if limit <= 0 || limit > searchMaxPage {
+		limit = searchPageSize
+	}
+
+	ctx := context.Background()
+
+	// Запрашиваем на одну строку больше, чтобы понять, есть ли следующая страница
+	start := time.Now()
+	rows, err := DB.Query(ctx, `
+		SELECT m.id, m.chat_id,
+		       CASE WHEN ch.is_group THEN ch.id::TEXT ELSE COALESCE(u2.username, '') END AS peer,
+		       u.username, u.display_name, m.content,
+		       EXTRACT(EPOCH FROM m.sent_at)::BIGINT
+		FROM messages m
+		JOIN chat_members cm ON cm.chat_id = m.chat_id AND cm.user_id = $1
+		JOIN chats ch ON ch.id = m.chat_id
+		JOIN users u ON u.id = m.sender_id
+		LEFT JOIN LATERAL (
+		  SELECT u2.username
+		  FROM chat_members cm2
+		  JOIN users u2 ON u2.id = cm2.user_id
+		  WHERE cm2.chat_id = ch.id AND NOT ch.is_group AND cm2.user_id <> $1
+		  LIMIT 1
+		) u2 ON true
+		WHERE to_tsvector('simple', m.content) @@ to_tsquery('simple', $2)
+		  AND ($3::BIGINT = 0 OR m.id < $3)
+		ORDER BY m.id DESC
+		LIMIT $4`, sender.ID, q, m.Before, limit+1)
+	if err != nil {
+		fmt.Println("Ошибка БД (поиск сообщений):", err)
+		reply.Content = searchFailed
+		return
+	}
+	defer rows.Close()
+
+	var hits []SearchHit
+	for rows.Next() {
+		var h SearchHit
+		if err := rows.Scan(&h.MessageID, &h.ChatID, &h.Peer, &h.From, &h.DisplayName, &h.Content, &h.Timestamp); err != nil {
+			// Пропущенная строка сдвинула бы курсор страницы — лучше не отдавать страницу вовсе
+			fmt.Println("Ошибка БД (поиск сообщений):", err)
+			reply.Content = searchFailed
+			return
+		}
+		hits = append(hits, h)
+	}
+	observeQuery("message_search", start)
+	if err := rows.Err(); err != nil {
+		fmt.Println("Ошибка БД (поиск сообщений):", err)
+		reply.Content = searchFailed
+		return
+	}
+
+	// Курсор следующей страницы — ID последнего отданного сообщения (0 — страниц больше нет)
+	var next int64
+	if len(hits) > limit {
+		hits = hits[:limit]
+		next = hits[limit-1].MessageID
+	}
+
+	reply.Results, reply.Before = hits, next
+}
@@ -1,37 +1,34 @@
 package main
 
 import (
-	"bufio"
-	"encoding/json"
+	"context"
 	"net"
+	"time"
 )
 
 // Обрабатывает одно клиентское соединение (TCP-сокет).
 // Сначала клиент проходит регистрацию или авторизацию,
 // затем может отправлять сообщения и выполнять действия.
-func handleConnection(conn net.Conn) {
+func handleConnection(raw net.Conn) {
+	// Оборачиваем сокет: до входа читаем JSON-строки (до 1 МБ),
+	// после согласования возможностей — кадры в выбранном формате
+	conn := newWireConn(raw)
+	files := newFileTransfers() // передачи файлов этого соединения
+	exports := newChatExports() // выгрузки чатов этого соединения
 	defer func() {
 		removeClient(conn) // При завершении соединения удаляем клиента из памяти
 		conn.Close()       // Закрываем сокет
+		files.close()      // Прерываем передачи файлов (их можно будет продолжить)
+		exports.close()    // и выгрузки чатов
 	}()
 
-	scanner := bufio.NewScanner(conn) // Создаём сканер для построчного чтения данных
-
-	// Увеличиваем максимальный размер входящего сообщения до 1 МБ
-	buf := make([]byte, 0, 64*1024)
-	scanner.Buffer(buf, 1024*1024)
-
 	// Ожидаем первое сообщение — должно быть вход или регистрация
-	if !scanner.Scan() {
-		return // клиент ничего не прислал
-	}
-
 	var initMsg Message
-	// Преобразуем JSON-строку в структуру Message
-	if err := json.Unmarshal(scanner.Bytes(), &initMsg); err != nil {
-		return // если невалидный JSON — отключаемся
+	if err := conn.readPacket(&initMsg); err != nil {
+		return // клиент ничего не прислал или прислал невалидный JSON — отключаемся
 	}
 
+	var userID int64 // ID вошедшего пользователя
 	switch initMsg.Type {
 	case "signup":
 		// Обработка регистрации нового пользователя
@@ -39,20 +36,23 @@ func handleConnection(conn net.Conn) {
 		return // после регистрации соединение закрывается (новый логин потребуется)
 	case "signin":
 		// Обработка входа: проверка пароля, ответ "login_ok"
-		userID, err := handleLogin(conn, initMsg)
+		// Прежний вход пользователя handleLogin уже закрыл и зарегистрировал новый в кластере
+		var session int64
+		var err error
+		userID, session, err = handleLogin(conn, initMsg)
 		if err != nil {
 			// Если авторизация не прошла — просто выходим (ошибка уже отправлена)
 			return
 		}
 
 		// Сохраняем информацию о клиенте в оперативной памяти
-		// Если пользователь уже онлайн — закрываем старое соединение
-		removeClientByName(initMsg.From)
 		mu.Lock()
 		// Сохраняем новое подключение
-		clients[conn] = &Client{Conn: conn, Name: initMsg.From, ID: userID}
+		clients[conn] = &Client{Conn: conn, Name: initMsg.From, ID: userID, Session: session}
 		nameToConn[initMsg.From] = conn
+		idToConn[userID] = conn
 		mu.Unlock()
+		presence.connected(userID, initMsg.From) // собеседники узнают о входе, сам он получит снимок
 
 	default:
 		// Если первое сообщение — не signin/signup — отключаемся
@@ -60,25 +60,60 @@ func handleConnection(conn net.Conn) {
 	}
 
 	// Основной цикл приёма всех следующих сообщений от клиента
-	for scanner.Scan() {
+	limits := newConnLimiter() // корзины запросов соединения (см. ratelimit.go)
+	for {
 		var m Message
-		// Читаем JSON-строку и преобразуем в структуру
-		if err := json.Unmarshal(scanner.Bytes(), &m); err != nil {
-			continue // если невалидный JSON — пропускаем
+		// Читаем следующий пакет и преобразуем в структуру
+		if err := conn.readPacket(&m); err != nil {
+			if isSyntaxError(err) {
+				continue // если невалидный пакет — пропускаем
+			}
+			break // соединение закрыто или поток повреждён
+		}
+		if m.Trace != nil {
+			m.Trace.ServerRecv = time.Now().UnixNano() // отметка приёма для трассировки
 		}
 
-		// Обработка типа сообщения
+		// Лимиты соединения и место для запроса к БД; при отказе клиент уже получил ошибку
+		if !admit(conn, limits, &m) {
+			continue
+		}
+
+		// Обработка типа сообщения. Запросы к БД занимают место в dbGate до конца обработки (withDBSlot)
 		switch m.Type {
 		case "message":
-			handleMessage(conn, m) // отправка личного или группового сообщения
+			m.File = nil                       // вложение к сообщению прикрепляет только сервер
+			withDBSlot(handleMessage, conn, m) // отправка личного или группового сообщения
 		case "history":
-			handleHistoryRequest(conn, m) // запрос истории чата
+			withDBSlot(handleHistoryRequest, conn, m) // запрос истории чата
 		case "user_search":
-			go handleUserSearch(conn, m) // поиск пользователей (в отдельной горутине)
+			go withDBSlot(handleUserSearch, conn, m) // поиск пользователей (в отдельной горутине)
 		case "start_chat":
-			go handleStartChat(conn, m) // начать приватный чат
+			go withDBSlot(handleStartChat, conn, m) // начать приватный чат
 		case "create_group":
-			go handleCreateGroup(conn, m) // создать групповой чат
+			go withDBSlot(handleCreateGroup, conn, m) // создать групповой чат
+		case "group_add":
+			go withDBSlot(handleGroupAdd, conn, m) // добавить участников в группу
+		case "group_remove":
+			go withDBSlot(handleGroupRemove, conn, m) // удалить участников из группы (или выйти из неё)
+		case "message_search":
+			go withDBSlot(handleMessageSearch, conn, m) // полнотекстовый поиск по сообщениям
+		case "file_offer":
+			withDBSlot(files.offer, conn, m) // начать или продолжить загрузку файла
+		case "file_chunk":
+			files.chunk(conn, m) // очередной кусок загружаемого файла (по порядку, в цикле чтения)
+		case "file_download":
+			files.download(conn, m) // скачать файл (передача идёт в отдельной горутине)
+		case "file_ack":
+			files.ack(m) // клиент подтвердил принятые куски скачиваемого файла
+		case "chat_export":
+			exports.start(conn, m) // выгрузить всю историю чата (в отдельной горутине, курсором БД)
+		case "chat_export_ack":
+			exports.ack(m) // клиент записал очередные порции выгрузки
+		case "chat_export_cancel":
+			exports.cancel(m) // клиент отменил выгрузку
+		case "typing":
+			presence.typed(userID, initMsg.From, m.To) // печатает в чате (уйдёт собеседникам пачкой)
 		default:
 			// Неизвестный тип сообщения — ничего не делаем
 		}
@@ -86,22 +121,60 @@ func handleConnection(conn net.Conn) {
 }
 
 // Удаляет клиента из глобальных структур при его отключении
+// и снимает его регистрацию в кластере.
+// Если соединение уже вытеснено новым входом, клиента в картах нет — регистрация принадлежит новому входу.
 func removeClient(conn net.Conn) {
 	mu.Lock()
-	if cl, ok := clients[conn]; ok {
-		delete(nameToConn, cl.Name) // удаляем по имени пользователя
-	}
-	delete(clients, conn) // удаляем по соединению
+	cl := clients[conn]
+	dropClientLocked(conn)
 	mu.Unlock()
+	if cl != nil {
+		node.release(context.Background(), cl.ID, cl.Session)
+		presence.disconnected(cl.ID, cl.Name)
+	}
 }
 
-// removeClientByName удаляет клиента по имени пользователя (если он онлайн).
+// removeClientByName удаляет клиента по имени пользователя (если он онлайн на этом узле).
 func removeClientByName(username string) {
 	mu.Lock()
 	if conn, ok := nameToConn[username]; ok {
-		conn.Close()                 // Закрываем соединение
-		delete(clients, conn)        // Удаляем по соединению
-		delete(nameToConn, username) // Удаляем по имени
+		replaceSessionLocked(conn)
 	}
 	mu.Unlock()
 }
+
+// replaceSessionLocked закрывает соединение, вытесненное новым входом того же пользователя.
+// Сначала клиент получает session_replaced: это не обрыв связи, и переподключаться по старому
+// токену не нужно (сервер его уже не примет). Вызывается под mu.
+func replaceSessionLocked(conn net.Conn) {
+	sendMessage(conn, Message{Type: "session_replaced", Content: "Выполнен вход на другом устройстве"})
+	conn.Close() // цикл чтения этого соединения завершится сам
+	dropClientLocked(conn)
+}
+
+// dropClientLocked удаляет соединение из всех карт клиентов. Вызывается под mu.
+func dropClientLocked(conn net.Conn) {
+	if cl, ok := clients[conn]; ok {
+		// Удаляем по имени и ID, только если они указывают на это соединение
+		if nameToConn[cl.Name] == conn {
+			delete(nameToConn, cl.Name)
+		}
+		if idToConn[cl.ID] == conn {
+			delete(idToConn, cl.ID)
+		}
+	}
+	delete(clients, conn) // Удаляем по соединению
+}
+
+// sendMessage сериализует пакет в согласованном с клиентом формате и отправляет его.
+func sendMessage(conn net.Conn, m Message) {
+	writePacket(conn, m.Type, encodePacket(conn, &m))
+}
+
+// writePacket записывает уже сериализованный пакет в сокет
+// и учитывает задержку записи в метриках (по типу пакета).
+func writePacket(conn net.Conn, ptype string, data []byte) {
+	start := time.Now()
+	conn.Write(data)
+	writeDuration.observeSince(ptype, start)
+}
@@ -0,0 +1,97 @@
+package main
+
+import (
+	"context"
+	"crypto/hmac"
+	"crypto/rand"
+	"crypto/sha256"
+	"encoding/base64"
+	"errors"
+	"fmt"
+	"os"
+	"strconv"
+	"strings"
+	"time"
+)
+
+// Токен сессии выдаётся в login_ok и позволяет переподключиться без пароля:
+// проверка — один HMAC-SHA256 вместо bcrypt.
+//
+// Формат: "<user_id>.<сессия>.<истекает, Unix-время>.<подпись base64url>",
+// подпись — HMAC(SESSION_SECRET, "<user_id>.<сессия>.<истекает>.<username>").
+// Логин в токен не входит (клиент передаёт его в поле from), но подписан,
+// поэтому токен одного пользователя не подходит для другого.
+//
+// Сессия — номер входа в кластере (cluster.claim). Если пользователь с тех пор вошёл заново
+// (на другом устройстве), токен прежнего входа больше не принимается: иначе вытесненный клиент
+// переподключился бы по нему и вытеснил новый вход, а тот — его, и так без конца.
+
+const sessionTTL = 24 * time.Hour // срок действия токена; при каждом входе выдаётся новый
+
+var (
+	errBadToken        = errors.New("недействительный токен сессии")
+	errSessionReplaced = errors.New("вход выполнен на другом устройстве")
+)
+
+// sessionSecret — ключ подписи токенов. Все узлы кластера должны использовать один ключ
+// (SESSION_SECRET), иначе токен, выданный одним узлом, не примет другой.
+var sessionSecret = loadSessionSecret()
+
+// loadSessionSecret берёт ключ из SESSION_SECRET или генерирует случайный
+// (тогда токены перестают действовать после перезапуска сервера).
+func loadSessionSecret() []byte {
+	if s := os.Getenv("SESSION_SECRET"); s != "" {
+		return []byte(s)
+	}
+	key := make([]byte, 32)
+	if _, err := rand.Read(key); err != nil {
+		panic(err)
+	}
+	fmt.Println("SESSION_SECRET не задан: токены сессий будут действовать только до перезапуска")
+	return key
+}
+
+// sessionSignature вычисляет подпись токена.
+func sessionSignature(userID, session, expires int64, username string) []byte {
+	mac := hmac.New(sha256.New, sessionSecret)
+	fmt.Fprintf(mac, "%d.%d.%d.%s", userID, session, expires, username)
+	return mac.Sum(nil)
+}
+
+// newSessionToken выдаёт токен входа session пользователю.
+func newSessionToken(userID, session int64, username string) string {
+	expires := time.Now().Add(sessionTTL).Unix()
+	sig := base64.RawURLEncoding.EncodeToString(sessionSignature(userID, session, expires, username))
+	return fmt.Sprintf("%d.%d.%d.%s", userID, session, expires, sig)
+}
+
+// verifySessionToken проверяет подпись и срок действия токена, а также что его вход не вытеснен
+// более новым, и возвращает ID пользователя.
+func verifySessionToken(ctx context.Context, token, username string) (int64, error) {
+	parts := strings.Split(token, ".")
+	if len(parts) != 4 {
+		return 0, errBadToken
+	}
+	userID, err1 := strconv.ParseInt(parts[0], 10, 64)
+	session, err2 := strconv.ParseInt(parts[1], 10, 64)
+	expires, err3 := strconv.ParseInt(parts[2], 10, 64)
+	sig, err4 := base64.RawURLEncoding.DecodeString(parts[3])
+	if err1 != nil || err2 != nil || err3 != nil || err4 != nil {
+		return 0, errBadToken
+	}
+	if !hmac.Equal(sig, sessionSignature(userID, session, expires, username)) {
+		return 0, errBadToken
+	}
+	if time.Now().Unix() >= expires {
+		return 0, errBadToken
+	}
+	// Пользователь онлайн с другим входом — этот вход вытеснен (0 — не онлайн: обычное переподключение)
+	current, err := node.current(ctx, userID)
+	if err != nil {
+		return 0, err
+	}
+	if current != 0 && current != session {
+		return 0, errSessionReplaced
+	}
+	return userID, nil
+}
@@ -0,0 +1,285 @@
+package main
+
+import (
+	"bufio"
+	"bytes"
+	"compress/flate"
+	"encoding/binary"
+	"encoding/json"
+	"errors"
+	"io"
+	"net"
+	"sync"
+
+	"github.com/vmihailenco/msgpack/v5"
+)
+
+// Протокол по умолчанию — JSON-строки, разделённые "\n".
+// При входе клиент может предложить возможности (поле caps в пакете signin):
+//
+//	"frame"   — кадры с префиксом длины вместо строк;
+//	"msgpack" — тело кадра в MessagePack вместо JSON;
+//	"deflate" — сжатие тела кадра, если оно больше deflateThreshold.
+//
+// Сервер отвечает в login_ok списком выбранных возможностей и сразу после него
+// переключает соединение в новый формат (в обе стороны).
+//
+// Формат кадра: [4 байта длины, big-endian][1 байт флагов][тело].
+// Длина учитывает байт флагов и тело.
+
+const (
+	maxPacketSize    = 1024 * 1024 // максимальный размер одного пакета (как у прежнего bufio.Scanner)
+	deflateThreshold = 1024        // тела меньше этого размера не сжимаются
+	frameFlagDeflate = 1 << 0      // тело кадра сжато deflate (raw, без заголовка zlib)
+)
+
+// Возможности протокола, которые поддерживает сервер
+const (
+	capFrame   = "frame"
+	capMsgpack = "msgpack"
+	capDeflate = "deflate"
+)
+
+var errPacketTooLarge = errors.New("пакет превышает допустимый размер")
+
+// wireConn — соединение клиента вместе с состоянием согласованного формата.
+// Встраивает net.Conn, поэтому используется везде, где ожидается обычное соединение.
+type wireConn struct {
+	net.Conn
+	r *bufio.Reader // буферизованное чтение (нужно и для строк, и для кадров)
+
+	framed  bool // кадры с префиксом длины вместо JSON-строк
+	msgpack bool // тело кадра в MessagePack
+	deflate bool // сжимать крупные кадры
+}
+
+// newWireConn оборачивает соединение; до согласования используется JSON-строками.
+func newWireConn(conn net.Conn) *wireConn {
+	return &wireConn{Conn: conn, r: bufio.NewReaderSize(conn, 64*1024)}
+}
+
+// negotiate выбирает возможности из предложенных клиентом и возвращает выбранные.
+// Переключение формата выполняется отдельно — вызовом apply после отправки login_ok.
+func negotiate(offered []string) []string {
+	var chosen []string
+	has := make(map[string]bool, len(offered))
+	for _, c := range offered {
+		has[c] = true
+	}
+	if !has[capFrame] {
+		return nil // без кадров остальные возможности не имеют смысла
+	}
+	chosen = append(chosen, capFrame)
+	if has[capMsgpack] {
+		chosen = append(chosen, capMsgpack)
+	}
+	if has[capDeflate] {
+		chosen = append(chosen, capDeflate)
+	}
+	return chosen
+}
+
+// apply переключает соединение на выбранные возможности.
+func (wc *wireConn) apply(caps []string) {
+	for _, c := range caps {
+		switch c {
+		case capFrame:
+			wc.framed = true
+		case capMsgpack:
+			wc.msgpack = true
+		case capDeflate:
+			wc.deflate = true
+		}
+	}
+}
+
+// codecKey — ключ формата соединения; пакеты с одинаковым ключом кодируются одинаково.
+func (wc *wireConn) codecKey() int {
+	key := 0
+	if wc.framed {
+		key |= 1
+	}
+	if wc.msgpack {
+		key |= 2
+	}
+	if wc.deflate {
+		key |= 4
+	}
+	return key
+}
+
+// readPacket читает и декодирует следующий пакет от клиента в текущем формате.
+func (wc *wireConn) readPacket(m *Message) error {
+	if !wc.framed {
+		line, err := wc.readLine()
+		if err != nil {
+			return err
+		}
+		return json.Unmarshal(line, m)
+	}
+
+	// Заголовок кадра: длина (флаги + тело)
+	var hdr [4]byte
+	if _, err := io.ReadFull(wc.r, hdr[:]); err != nil {
+		return err
+	}
+	n := binary.BigEndian.Uint32(hdr[:])
+	if n == 0 || n > maxPacketSize+1 {
+		return errPacketTooLarge
+	}
+	frame := make([]byte, n)
+	if _, err := io.ReadFull(wc.r, frame); err != nil {
+		return err
+	}
+
+	// Кадр прочитан целиком: ошибки дальше относятся только к нему, поток не нарушен
+	flags, body := frame[0], frame[1:]
+	if flags&frameFlagDeflate != 0 {
+		var err error
+		if body, err = inflate(body); err != nil {
+			return &badPacketError{err}
+		}
+	}
+	if wc.msgpack {
+		dec := msgpack.NewDecoder(bytes.NewReader(body))
+		dec.SetCustomStructTag("json") // имена полей — те же, что и в JSON
+		if err := dec.Decode(m); err != nil {
+			return &badPacketError{err}
+		}
+		return nil
+	}
+	return json.Unmarshal(body, m)
+}
+
+// badPacketError — кадр прочитан целиком, но его тело не распаковывается или не декодируется
+// из MessagePack.
+type badPacketError struct {
+	err error
+}
+
+func (e *badPacketError) Error() string {
+	return "повреждённый пакет: " + e.err.Error()
+}
+
+func (e *badPacketError) Unwrap() error { return e.err }
+
+// readLine читает одну JSON-строку, не позволяя ей превысить maxPacketSize.
+func (wc *wireConn) readLine() ([]byte, error) {
+	var line []byte
+	for {
+		chunk, err := wc.r.ReadSlice('\n')
+		line = append(line, chunk...)
+		if len(line) > maxPacketSize {
+			return nil, errPacketTooLarge
+		}
+		if err == bufio.ErrBufferFull {
+			continue // строка длиннее буфера — дочитываем
+		}
+		if err != nil {
+			return nil, err
+		}
+		return bytes.TrimRight(line, "\r\n"), nil
+	}
+}
+
+// isSyntaxError сообщает, что ошибка относится к содержимому одного пакета,
+// а не к самому потоку — такой пакет можно пропустить и читать дальше.
+// Неверная длина кадра сюда не относится: после неё границы следующих пакетов неизвестны.
+func isSyntaxError(err error) bool {
+	var syntaxErr *json.SyntaxError
+	var typeErr *json.UnmarshalTypeError
+	var badErr *badPacketError
+	return errors.As(err, &syntaxErr) || errors.As(err, &typeErr) || errors.As(err, &badErr)
+}
+
+// encodePacket сериализует пакет в формате, согласованном с данным соединением.
+func encodePacket(conn net.Conn, m *Message) []byte {
+	wc, ok := conn.(*wireConn)
+	if !ok || !wc.framed {
+		data, _ := json.Marshal(m)
+		return append(data, '\n')
+	}
+
+	var body []byte
+	if wc.msgpack {
+		var buf bytes.Buffer
+		enc := msgpack.NewEncoder(&buf)
+		enc.SetCustomStructTag("json")
+		enc.UseCompactInts(true)
+		_ = enc.Encode(m)
+		body = buf.Bytes()
+	} else {
+		body, _ = json.Marshal(m)
+	}
+
+	// Куски файлов не сжимаем: вложения обычно уже сжаты (фото, архивы), а deflate дорог на 64 КБ
+	var flags byte
+	if wc.deflate && len(body) > deflateThreshold && m.Type != "file_chunk" {
+		body = deflateBytes(body)
+		flags |= frameFlagDeflate
+	}
+
+	frame := make([]byte, 5, 5+len(body))
+	binary.BigEndian.PutUint32(frame[:4], uint32(1+len(body)))
+	frame[4] = flags
+	return append(frame, body...)
+}
+
+// outPacket — пакет, который рассылается нескольким клиентам.
+// Сериализуется один раз для каждого формата, а не для каждого получателя.
+type outPacket struct {
+	m     *Message
+	byKey map[int][]byte
+}
+
+// newOutPacket подготавливает пакет к рассылке.
+func newOutPacket(m *Message) *outPacket {
+	return &outPacket{m: m, byKey: make(map[int][]byte, 2)}
+}
+
+// bytesFor возвращает пакет, закодированный для конкретного соединения.
+func (p *outPacket) bytesFor(conn net.Conn) []byte {
+	key := 0
+	if wc, ok := conn.(*wireConn); ok {
+		key = wc.codecKey()
+	}
+	if data, ok := p.byKey[key]; ok {
+		return data
+	}
+	data := encodePacket(conn, p.m)
+	p.byKey[key] = data
+	return data
+}
+
+// Пул компрессоров: flate.NewWriter выделяет много памяти, поэтому переиспользуем их
+var flateWriters = sync.Pool{
+	New: func() any {
+		w, _ := flate.NewWriter(nil, flate.DefaultCompression)
+		return w
+	},
+}
+
+// deflateBytes сжимает данные алгоритмом deflate (raw).
+func deflateBytes(data []byte) []byte {
+	var buf bytes.Buffer
+	w := flateWriters.Get().(*flate.Writer)
+	w.Reset(&buf)
+	w.Write(data)
+	w.Close()
+	flateWriters.Put(w)
+	return buf.Bytes()
+}
+
+// inflate распаковывает тело кадра, ограничивая размер результата.
+func inflate(data []byte) ([]byte, error) {
+	r := flate.NewReader(bytes.NewReader(data))
+	defer r.Close()
+	out, err := io.ReadAll(io.LimitReader(r, maxPacketSize+1))
+	if err != nil {
+		return nil, err
+	}
+	if len(out) > maxPacketSize {
+		return nil, errPacketTooLarge
+	}
+	return out, nil
+}